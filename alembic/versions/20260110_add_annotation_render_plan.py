@@ -0,0 +1,27 @@
+"""add precompiled render plan to marketing_document_annotation
+
+Revision ID: 20260110_add_annotation_render_plan
+Revises: 20260105_add_product_hd_images
+Create Date: 2026-01-10
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "20260110_add_annotation_render_plan"
+down_revision = "20260105_add_product_hd_images"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL => le plan est compilé à la volée au prochain rendu
+    op.add_column(
+        "marketing_document_annotation",
+        sa.Column("render_plan_json", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column("marketing_document_annotation", "render_plan_json")
@@ -0,0 +1,28 @@
+"""marketing fonts: ttf converted at upload + per-labo font-set version
+
+Revision ID: 20260115_marketing_font_ttf
+Revises: 20260110_add_annotation_render_plan
+Create Date: 2026-01-15
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20260115_marketing_font_ttf"
+down_revision = "20260110_add_annotation_render_plan"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL => police uploadée avant : convertie au rendu (ou via backfill_marketing_font_ttf)
+    op.add_column("marketing_font", sa.Column("ttf_filename", sa.String(length=255), nullable=True))
+    op.add_column(
+        "labo",
+        sa.Column("marketing_fonts_version", sa.Integer(), nullable=False, server_default=sa.text("0")),
+    )
+
+
+def downgrade():
+    op.drop_column("labo", "marketing_fonts_version")
+    op.drop_column("marketing_font", "ttf_filename")
@@ -0,0 +1,71 @@
+"""marketing documents: async multi-size thumbnails + page strip
+
+Revision ID: 20260120_marketing_document_thumbs
+Revises: 20260115_marketing_font_ttf
+Create Date: 2026-01-20
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "20260120_marketing_document_thumbs"
+down_revision = "20260115_marketing_font_ttf"
+branch_labels = None
+depends_on = None
+
+
+def _create_pg_enum_if_not_exists(enum_name: str, values: list[str]) -> None:
+    # Postgres: pas de CREATE TYPE IF NOT EXISTS fiable partout => DO block
+    vals = ", ".join([f"'{v}'" for v in values])
+    op.execute(
+        f"""
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = '{enum_name}') THEN
+        CREATE TYPE {enum_name} AS ENUM ({vals});
+    END IF;
+END$$;
+"""
+    )
+
+
+def _drop_pg_enum_if_exists(enum_name: str) -> None:
+    op.execute(
+        f"""
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_type WHERE typname = '{enum_name}') THEN
+        DROP TYPE {enum_name};
+    END IF;
+END$$;
+"""
+    )
+
+
+def upgrade():
+    _create_pg_enum_if_not_exists("marketingthumbsstatus", ["PENDING", "RENDERING", "READY", "FAILED"])
+
+    # NULL => document uploadé avant : seule la miniature thumb_filename existe
+    op.add_column(
+        "marketing_document",
+        sa.Column(
+            "thumbs_status",
+            postgresql.ENUM(
+                "PENDING", "RENDERING", "READY", "FAILED",
+                name="marketingthumbsstatus",
+                create_type=False,
+            ),
+            nullable=True,
+        ),
+    )
+    op.add_column(
+        "marketing_document",
+        sa.Column("thumbs_json", postgresql.JSONB(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column("marketing_document", "thumbs_json")
+    op.drop_column("marketing_document", "thumbs_status")
+    _drop_pg_enum_if_exists("marketingthumbsstatus")
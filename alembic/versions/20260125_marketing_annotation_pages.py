@@ -0,0 +1,89 @@
+"""marketing annotations: one row per draft page (+ dynamic objects projection)
+
+Revision ID: 20260125_marketing_annotation_pages
+Revises: 20260120_marketing_document_thumbs
+Create Date: 2026-01-25
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "20260125_marketing_annotation_pages"
+down_revision = "20260120_marketing_document_thumbs"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL => pages encore dans data_json (converties au prochain enregistrement
+    # ou via app.maintenance.backfill_marketing_draft_pages)
+    op.add_column("marketing_document_annotation", sa.Column("page_count", sa.Integer(), nullable=True))
+
+    op.create_table(
+        "marketing_document_annotation_page",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "annotation_id",
+            sa.Integer(),
+            sa.ForeignKey("marketing_document_annotation.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column("page_index", sa.Integer(), nullable=False),
+        sa.Column(
+            "data_json",
+            postgresql.JSONB(),
+            nullable=False,
+            server_default=sa.text("'{}'::jsonb"),
+        ),
+        sa.Column(
+            "dynamic_json",
+            postgresql.JSONB(),
+            nullable=False,
+            server_default=sa.text("'[]'::jsonb"),
+        ),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            nullable=False,
+            server_default=sa.text("now()"),
+        ),
+        sa.UniqueConstraint("annotation_id", "page_index", name="uq_marketing_doc_annotation_page"),
+    )
+    op.create_index(
+        "ix_marketing_document_annotation_page_annotation_id",
+        "marketing_document_annotation_page",
+        ["annotation_id"],
+    )
+
+
+def downgrade():
+    # pages ré-intégrées dans data_json avant suppression de la table
+    op.execute(
+        """
+UPDATE marketing_document_annotation a
+SET data_json = a.data_json || jsonb_build_object(
+    'pages',
+    COALESCE(
+        (
+            SELECT jsonb_agg(
+                COALESCE(p.data_json, jsonb_build_object('pageIndex', g.i, 'objects', '[]'::jsonb))
+                ORDER BY g.i
+            )
+            FROM generate_series(0, a.page_count - 1) AS g(i)
+            LEFT JOIN marketing_document_annotation_page p
+                ON p.annotation_id = a.id AND p.page_index = g.i
+        ),
+        '[]'::jsonb
+    )
+)
+WHERE a.page_count IS NOT NULL;
+"""
+    )
+
+    op.drop_index(
+        "ix_marketing_document_annotation_page_annotation_id",
+        table_name="marketing_document_annotation_page",
+    )
+    op.drop_table("marketing_document_annotation_page")
+    op.drop_column("marketing_document_annotation", "page_count")
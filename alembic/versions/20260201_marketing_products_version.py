@@ -0,0 +1,94 @@
+"""labo.marketing_products_version bumped by triggers on product / price_tier
+
+Revision ID: 20260201_marketing_products_version
+Revises: 20260125_marketing_annotation_pages
+Create Date: 2026-02-01
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20260201_marketing_products_version"
+down_revision = "20260125_marketing_annotation_pages"
+branch_labels = None
+depends_on = None
+
+
+# ✅ triggers "par instruction" (transition tables) : un import de 5000 lignes en un
+# seul UPDATE n'incrémente la version qu'une fois par labo.
+# Postgres n'autorise pas de transition table sur un trigger multi-événements
+# => un trigger par événement, fonction commune.
+_PRODUCT_FN = """
+CREATE OR REPLACE FUNCTION marketing_bump_products_version_product() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT DISTINCT labo_id FROM new_rows);
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT labo_id FROM new_rows UNION SELECT labo_id FROM old_rows);
+    ELSE
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT DISTINCT labo_id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+_TIER_FN = """
+CREATE OR REPLACE FUNCTION marketing_bump_products_version_tier() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT p.labo_id FROM product p JOIN new_rows t ON t.product_id = p.id);
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (
+            SELECT p.labo_id FROM product p
+            JOIN (SELECT product_id FROM new_rows UNION SELECT product_id FROM old_rows) t
+                ON t.product_id = p.id
+        );
+    ELSE
+        -- suppression en cascade d'un produit : produit déjà supprimé, le trigger product a incrémenté
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT p.labo_id FROM product p JOIN old_rows t ON t.product_id = p.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def _triggers(table: str, fn: str) -> list[str]:
+    return [
+        f"""CREATE TRIGGER trg_{table}_mkt_version_ins AFTER INSERT ON {table}
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {fn}();""",
+        f"""CREATE TRIGGER trg_{table}_mkt_version_upd AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {fn}();""",
+        f"""CREATE TRIGGER trg_{table}_mkt_version_del AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {fn}();""",
+    ]
+
+
+def upgrade():
+    op.add_column(
+        "labo",
+        sa.Column("marketing_products_version", sa.Integer(), nullable=False, server_default=sa.text("0")),
+    )
+
+    op.execute(_PRODUCT_FN)
+    op.execute(_TIER_FN)
+    for stmt in _triggers("product", "marketing_bump_products_version_product"):
+        op.execute(stmt)
+    for stmt in _triggers("price_tier", "marketing_bump_products_version_tier"):
+        op.execute(stmt)
+
+
+def downgrade():
+    for table in ("price_tier", "product"):
+        for ev in ("ins", "upd", "del"):
+            op.execute(f"DROP TRIGGER IF EXISTS trg_{table}_mkt_version_{ev} ON {table};")
+    op.execute("DROP FUNCTION IF EXISTS marketing_bump_products_version_tier();")
+    op.execute("DROP FUNCTION IF EXISTS marketing_bump_products_version_product();")
+    op.drop_column("labo", "marketing_products_version")
@@ -0,0 +1,36 @@
+"""marketing annotation pages: compiled render plan per page
+
+Revision ID: 20260205_marketing_annotation_page_plan
+Revises: 20260201_marketing_products_version
+Create Date: 2026-02-05
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = "20260205_marketing_annotation_page_plan"
+down_revision = "20260201_marketing_products_version"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL => page compilée au rendu (puis au prochain enregistrement,
+    # ou via app.maintenance.backfill_marketing_draft_pages)
+    op.add_column(
+        "marketing_document_annotation_page",
+        sa.Column("plan_json", postgresql.JSONB(), nullable=True),
+    )
+
+    # ✅ drafts par page : l'ancien plan global (tous les objets de toutes les pages)
+    # n'est plus lu ni réécrit à chaque enregistrement
+    op.execute(
+        "UPDATE marketing_document_annotation SET render_plan_json = NULL "
+        "WHERE page_count IS NOT NULL AND render_plan_json IS NOT NULL"
+    )
+
+
+def downgrade():
+    # plans globaux non reconstruits : recompilés au rendu par l'ancien code
+    op.drop_column("marketing_document_annotation_page", "plan_json")
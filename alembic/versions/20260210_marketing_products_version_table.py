@@ -0,0 +1,179 @@
+"""marketing products version: dedicated table, bumped only on snapshot columns
+
+Revision ID: 20260210_marketing_products_version_table
+Revises: 20260205_marketing_annotation_page_plan
+Create Date: 2026-02-10
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20260210_marketing_products_version_table"
+down_revision = "20260205_marketing_annotation_page_plan"
+branch_labels = None
+depends_on = None
+
+
+# ✅ compteur hors de la table labo : un import / une sync stock ne verrouille plus la
+# ligne labo (ni ne la réécrit) le temps de sa transaction.
+# Upsert trié par labo_id : deux imports multi-labos prennent les verrous dans le même ordre.
+# Labo supprimé (cascade product) : pas de ligne créée (FK).
+_BUMP_FN = """
+CREATE OR REPLACE FUNCTION marketing_bump_products_version(labo_ids integer[]) RETURNS void AS $$
+BEGIN
+    INSERT INTO marketing_products_version (labo_id, version)
+    SELECT t.id, 1
+    FROM (SELECT DISTINCT unnest(labo_ids) AS id) t
+    WHERE t.id IS NOT NULL AND EXISTS (SELECT 1 FROM labo l WHERE l.id = t.id)
+    ORDER BY t.id
+    ON CONFLICT (labo_id) DO UPDATE SET version = marketing_products_version.version + 1;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# colonnes lues par le snapshot (marketing_product_snapshot._product_entry) : un UPDATE
+# qui ne touche que le reste (description, tva, commission...) ne change pas la version
+_PRODUCT_COLS = (
+    "labo_id", "sku", "name", "ean13", "price_ht", "stock", "is_active",
+    "image_url", "thumb_url", "hd_jpg_url", "hd_webp_url",
+)
+_TIER_COLS = ("product_id", "qty_min", "price_ht")
+
+
+def _changed(cols) -> str:
+    n = ", ".join(f"n.{c}" for c in cols)
+    o = ", ".join(f"o.{c}" for c in cols)
+    return f"({n}) IS DISTINCT FROM ({o})"
+
+
+_PRODUCT_FN = f"""
+CREATE OR REPLACE FUNCTION marketing_bump_products_version_product() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM marketing_bump_products_version(ARRAY(SELECT labo_id FROM new_rows));
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM marketing_bump_products_version(ARRAY(
+            SELECT unnest(ARRAY[n.labo_id, o.labo_id])
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE {_changed(_PRODUCT_COLS)}
+        ));
+    ELSE
+        PERFORM marketing_bump_products_version(ARRAY(SELECT labo_id FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+_TIER_FN = f"""
+CREATE OR REPLACE FUNCTION marketing_bump_products_version_tier() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM marketing_bump_products_version(ARRAY(
+            SELECT p.labo_id FROM product p JOIN new_rows t ON t.product_id = p.id
+        ));
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM marketing_bump_products_version(ARRAY(
+            SELECT p.labo_id FROM product p
+            JOIN (
+                SELECT unnest(ARRAY[n.product_id, o.product_id]) AS product_id
+                FROM new_rows n JOIN old_rows o ON o.id = n.id
+                WHERE {_changed(_TIER_COLS)}
+            ) t ON t.product_id = p.id
+        ));
+    ELSE
+        -- suppression en cascade d'un produit : produit déjà supprimé, le trigger product a incrémenté
+        PERFORM marketing_bump_products_version(ARRAY(
+            SELECT p.labo_id FROM product p JOIN old_rows t ON t.product_id = p.id
+        ));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+# fonctions de 20260201 (compteur sur labo), pour le downgrade
+_OLD_PRODUCT_FN = """
+CREATE OR REPLACE FUNCTION marketing_bump_products_version_product() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT DISTINCT labo_id FROM new_rows);
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT labo_id FROM new_rows UNION SELECT labo_id FROM old_rows);
+    ELSE
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT DISTINCT labo_id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+_OLD_TIER_FN = """
+CREATE OR REPLACE FUNCTION marketing_bump_products_version_tier() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT p.labo_id FROM product p JOIN new_rows t ON t.product_id = p.id);
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (
+            SELECT p.labo_id FROM product p
+            JOIN (SELECT product_id FROM new_rows UNION SELECT product_id FROM old_rows) t
+                ON t.product_id = p.id
+        );
+    ELSE
+        UPDATE labo SET marketing_products_version = marketing_products_version + 1
+        WHERE id IN (SELECT p.labo_id FROM product p JOIN old_rows t ON t.product_id = p.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    op.create_table(
+        "marketing_products_version",
+        sa.Column(
+            "labo_id",
+            sa.Integer(),
+            sa.ForeignKey("labo.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("version", sa.BigInteger(), nullable=False, server_default=sa.text("0")),
+    )
+
+    # ✅ versions reprises telles quelles : les snapshots Redis (clé par version) restent valides
+    # et un compteur ne repart jamais en arrière
+    op.execute(
+        "INSERT INTO marketing_products_version (labo_id, version) "
+        "SELECT id, marketing_products_version FROM labo WHERE marketing_products_version > 0"
+    )
+
+    # les triggers de 20260201 appellent ces fonctions par nom : pas à recréer
+    op.execute(_BUMP_FN)
+    op.execute(_PRODUCT_FN)
+    op.execute(_TIER_FN)
+
+    op.drop_column("labo", "marketing_products_version")
+
+
+def downgrade():
+    op.add_column(
+        "labo",
+        sa.Column("marketing_products_version", sa.Integer(), nullable=False, server_default=sa.text("0")),
+    )
+    op.execute(
+        "UPDATE labo l SET marketing_products_version = v.version "
+        "FROM marketing_products_version v WHERE v.labo_id = l.id"
+    )
+
+    op.execute(_OLD_PRODUCT_FN)
+    op.execute(_OLD_TIER_FN)
+    op.execute("DROP FUNCTION IF EXISTS marketing_bump_products_version(integer[]);")
+
+    op.drop_table("marketing_products_version")
@@ -0,0 +1,104 @@
+# app/celery_tasks/marketing_document_thumbs.py
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict
+
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from app.tasks.celery_app import celery
+from app.core.config import settings
+from app.db.models import MarketingDocument, MarketingThumbsStatus
+from app.services.storage import get_marketing_document_path
+from app.services import marketing_document_thumbs as doc_thumbs
+
+logger = logging.getLogger(__name__)
+
+
+async def _generate_thumbs(session: AsyncSession, document_id: int) -> Dict[str, Any]:
+    """
+    Miniatures multi-tailles + bandeau de pages d'UN document.
+    Passe le document en READY (ou FAILED) ; commit fait ici.
+    """
+    doc = await session.get(MarketingDocument, int(document_id))
+    if not doc:
+        logger.warning("[marketing_document_thumbs] document %s introuvable", document_id)
+        return {"ok": False, "error": "document introuvable"}
+
+    pdf_path = get_marketing_document_path(doc.labo_id, doc.filename)
+    out_dir = pdf_path.parent
+    old_files = doc_thumbs.thumb_files(doc.thumbs_json, doc.thumb_filename)
+
+    doc.thumbs_status = MarketingThumbsStatus.RENDERING
+    await session.commit()
+
+    try:
+        result = await asyncio.to_thread(doc_thumbs.generate_document_thumbs, pdf_path, out_dir)
+    except Exception as exc:
+        logger.exception("[marketing_document_thumbs] document %s : miniatures KO", document_id)
+        await session.rollback()
+        doc = await session.get(MarketingDocument, int(document_id))
+        if not doc:
+            return {"ok": False, "error": "document introuvable"}
+        # ✅ JSONB : on réassigne un nouveau dict (pas de mutation en place)
+        data = dict(doc.thumbs_json or {})
+        data["error"] = f"Erreur miniatures: {exc}"
+        doc.thumbs_json = data
+        doc.thumbs_status = MarketingThumbsStatus.FAILED
+        await session.commit()
+        return {"ok": False, "error": data["error"]}
+
+    # document supprimé pendant la génération : on ne laisse pas de fichiers orphelins
+    doc = await session.get(MarketingDocument, int(document_id))
+    if not doc:
+        doc_thumbs.delete_thumb_files(out_dir, doc_thumbs.thumb_files(result))
+        return {"ok": False, "error": "document introuvable"}
+
+    doc.thumb_filename = result["default"]
+    doc.page_count = result["page_count"]
+    doc.thumbs_json = {
+        "widths": result["widths"],
+        "strip": result["strip"],
+        "strip_width": result["strip_width"],
+        "page_size": result["page_size"],
+        "ms": result["ms"],
+    }
+    doc.thumbs_status = MarketingThumbsStatus.READY
+    await session.commit()
+
+    # régénération : anciens fichiers (dont l'ancienne miniature PNG) supprimés après le commit
+    keep = set(doc_thumbs.thumb_files(result))
+    doc_thumbs.delete_thumb_files(out_dir, [n for n in old_files if n not in keep])
+
+    logger.info(
+        "[marketing_document_thumbs] doc=%s READY pages=%s %.0fms",
+        doc.id,
+        result["page_count"],
+        result["ms"],
+    )
+    return {"ok": True, "document_id": doc.id, "page_count": result["page_count"]}
+
+
+async def _async_generate_thumbs(document_id: int) -> Dict[str, Any]:
+    # ⚠️ engine dédié à cette exécution (boucle event propre à la tâche)
+    engine = create_async_engine(settings.DATABASE_URL, echo=False, future=True)
+    async_session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    try:
+        async with async_session_factory() as session:
+            return await _generate_thumbs(session, document_id)
+    finally:
+        await engine.dispose()
+
+
+@celery.task(name=doc_thumbs.THUMBS_TASK_NAME)
+def generate_marketing_document_thumbs(document_id: int) -> Dict[str, Any]:
+    """
+    Enqueue à l'upload (labo_marketing_documents_api) : l'upload répond tout de
+    suite, miniatures et bandeau de pages sont produits ici.
+    """
+    return asyncio.run(_async_generate_thumbs(document_id))
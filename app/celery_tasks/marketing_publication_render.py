@@ -0,0 +1,157 @@
+# app/celery_tasks/marketing_publication_render.py
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict
+
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from app.tasks.celery_app import celery
+from app.core.config import settings
+from app.db.models import (
+    MarketingDocument,
+    MarketingDocumentPublication,
+    MarketingPublicationStatus,
+)
+from app.services import marketing_published_render as published_render
+from app.services import marketing_render_inputs as render_inputs
+from app.services import marketing_pdf_optimize as pdf_optimize
+
+logger = logging.getLogger(__name__)
+
+
+async def _render_publication(session: AsyncSession, publication_id: int) -> Dict[str, Any]:
+    """
+    Pré-rendu d'UNE publication : PDF final (vue agent), miniatures, nb de pages.
+    Passe la publication en READY ; en cas d'échec : nouvelle tentative (PENDING) tant que
+    le quota n'est pas atteint, puis READY sans pré-rendu (rendu à la demande). Commit fait ici.
+    """
+    pub = await session.get(MarketingDocumentPublication, int(publication_id))
+    if not pub:
+        logger.warning("[marketing_publication_render] publication %s introuvable", publication_id)
+        return {"ok": False, "error": "publication introuvable"}
+
+    if pub.status not in (MarketingPublicationStatus.PENDING, MarketingPublicationStatus.RENDERING):
+        # tâche rejouée (retry broker) : déjà traitée
+        return {"ok": True, "skipped": pub.status.value}
+
+    doc = await session.get(MarketingDocument, int(pub.document_id))
+    if not doc:
+        pub.status = MarketingPublicationStatus.FAILED
+        pub.error_message = "Document introuvable"
+        await session.commit()
+        return {"ok": False, "error": pub.error_message}
+
+    pub.status = MarketingPublicationStatus.RENDERING
+    attempt = published_render.mark_render_attempt(pub)
+    await session.commit()
+
+    try:
+        # mêmes helpers que download-rendered agent : le fichier servi est identique au rendu live
+        ri = await render_inputs.load_render_inputs(session, doc, "agent", publication=pub)
+        ctx = await render_inputs.build_render_context(ri)
+        page_keys = await asyncio.to_thread(render_inputs.page_render_keys, ri)
+        # même profil que download-rendered sans ?profile => même clé => file serve
+        optimize = pdf_optimize.profile_name(pdf_optimize.PDF_OPTIMIZE_DEFAULT)
+        render_key = render_inputs.render_key(ri, optimize)
+
+        rel = published_render.new_rendered_pdf_relpath(doc.labo_id, doc.id, pub.version)
+        out_path = published_render.rendered_pdf_path(rel)
+
+        result = await asyncio.to_thread(
+            published_render.render_publication_files,
+            str(ri.pdf_path),
+            ri.draft,
+            ctx,
+            ri.plan_for_render,
+            page_keys,
+            str(out_path),
+            optimize,
+        )
+    except Exception as exc:
+        logger.exception(
+            "[marketing_publication_render] publication %s : rendu KO (tentative %s)", publication_id, attempt
+        )
+        await session.rollback()
+        pub = await session.get(MarketingDocumentPublication, int(publication_id))
+        retried = published_render.schedule_render_retry(pub, f"Erreur rendu publication: {exc}")
+        await session.commit()
+        return {"ok": False, "retry": retried, "error": pub.error_message}
+
+    # ✅ JSONB : on réassigne un nouveau dict (pas de mutation en place)
+    opts = dict(pub.render_options_json or {})
+    opts.pop("render_fallback", None)
+    opts.pop("render_error", None)
+    opts.update(
+        {
+            "rendered_pdf": rel,
+            "render_key": render_key,
+            "page_count": result["page_count"],
+            "thumbs": result["thumbs"],
+            "rendered_pages": result["rendered_pages"],
+            "render_ms": result["render_ms"],
+            "size": result["size"],
+            "optimize": optimize,
+        }
+    )
+    pub.render_options_json = opts
+    pub.status = MarketingPublicationStatus.READY
+    pub.error_message = None
+    await session.commit()
+
+    published_render.prune_document_renders(doc.labo_id, doc.id)
+
+    logger.info(
+        "[marketing_publication_render] doc=%s v%s READY pages=%s rendered=%s %.0fms",
+        doc.id,
+        pub.version,
+        result["page_count"],
+        result["rendered_pages"],
+        result["render_ms"],
+    )
+    return {"ok": True, "publication_id": pub.id, "page_count": result["page_count"]}
+
+
+async def _async_render_publication(publication_id: int) -> Dict[str, Any]:
+    # ⚠️ engine dédié à cette exécution (boucle event propre à la tâche)
+    engine = create_async_engine(settings.DATABASE_URL, echo=False, future=True)
+    async_session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    try:
+        async with async_session_factory() as session:
+            return await _render_publication(session, publication_id)
+    finally:
+        await engine.dispose()
+
+
+@celery.task(name=published_render.RENDER_TASK_NAME)
+def render_marketing_publication(publication_id: int) -> Dict[str, Any]:
+    """
+    Enqueue à la publication (labo_marketing_documents_publish_api) :
+    le rendu lourd est fait une fois par version, les downloads agents
+    deviennent des file serve.
+    """
+    return asyncio.run(_async_render_publication(publication_id))
+
+
+async def _async_recover_stale() -> Dict[str, Any]:
+    engine = create_async_engine(settings.DATABASE_URL, echo=False, future=True)
+    async_session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    try:
+        async with async_session_factory() as session:
+            n = await published_render.recover_stale_publications(session)
+    finally:
+        await engine.dispose()
+    if n:
+        logger.warning("[marketing_publication_render] %s publication(s) bloquée(s) reprise(s)", n)
+    return {"ok": True, "recovered": n}
+
+
+@celery.task(name=published_render.RECOVER_TASK_NAME)
+def recover_stale_marketing_publications() -> Dict[str, Any]:
+    """Planifiée (beat) : reprend les pré-rendus perdus (worker tué pendant le rendu, message perdu)."""
+    return asyncio.run(_async_recover_stale())
@@ -52,6 +52,11 @@ class Labo(Base):
     # Chemin relatif sous app/static (ex: "uploads/labos/12/logo.png")
     logo_path: Mapped[str | None] = mapped_column(Text(), nullable=True)
 
+    # Incrémenté à chaque upload / suppression de police marketing (cache du mapping polices)
+    marketing_fonts_version: Mapped[int] = mapped_column(
+        Integer, nullable=False, server_default=sa.text("0")
+    )
+
     created_at: Mapped[DateTime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
@@ -675,6 +680,13 @@ class OrderItem(Base):
 # =========================================================
 #        MARKETING DOCUMENTS (PDF catalogues / promos)
 # =========================================================
+class MarketingThumbsStatus(enum.Enum):
+    PENDING = "PENDING"
+    RENDERING = "RENDERING"
+    READY = "READY"
+    FAILED = "FAILED"
+
+
 class MarketingDocument(Base):
     __tablename__ = "marketing_document"
 
@@ -699,6 +711,14 @@ class MarketingDocument(Base):
     page_count: Mapped[int | None] = mapped_column(Integer, nullable=True)
     source_sha256: Mapped[str | None] = mapped_column(Text(), nullable=True)
 
+    # ✅ miniatures générées en tâche de fond (NULL => document d'avant : thumb_filename seul)
+    thumbs_status: Mapped[MarketingThumbsStatus | None] = mapped_column(
+        PGEnum(MarketingThumbsStatus, name="marketingthumbsstatus", create_type=False),
+        nullable=True,
+    )
+    # {"widths": {"160": "...webp", ...}, "strip": [...], "strip_width": 96, "page_size": [w, h], "error": ...}
+    thumbs_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
+
     created_at: Mapped[DateTime] = mapped_column(
         DateTime(timezone=True),
         nullable=False,
@@ -755,9 +775,11 @@ class MarketingPublicationStatus(enum.Enum):
 
 class MarketingDocumentAnnotation(Base):
     """
-    Stocke le JSON complet de l'éditeur.
+    Stocke le JSON de l'éditeur.
     - 1 DRAFT par document (unique)
     - des LOCKED : snapshots utilisés pour une publication
+    - page_count renseigné : pages dans marketing_document_annotation_page,
+      data_json ne garde que les clés racine (_meta, appended_pages...)
     """
     __tablename__ = "marketing_document_annotation"
 
@@ -788,6 +810,13 @@ class MarketingDocumentAnnotation(Base):
         server_default=sa.text("'{}'::jsonb"),
     )
 
+    # plan de rendu précompilé (ancien format seulement : page_count NULL) ;
+    # drafts par page => plan par page (MarketingDocumentAnnotationPage.plan_json)
+    render_plan_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
+
+    # ✅ NULL => ancien format : pages dans data_json (converti au prochain enregistrement)
+    page_count: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
     created_by_user_id: Mapped[int | None] = mapped_column(
         ForeignKey("user.id", ondelete="SET NULL"),
         index=True,
@@ -811,12 +840,64 @@ class MarketingDocumentAnnotation(Base):
         back_populates="annotations",
     )
 
+    pages: Mapped[list["MarketingDocumentAnnotationPage"]] = relationship(
+        "MarketingDocumentAnnotationPage",
+        back_populates="annotation",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
     __table_args__ = (
         UniqueConstraint("document_id", "status", name="uq_marketing_doc_annotation_doc_status"),
         Index("ix_marketing_doc_annotation_json_gin", "data_json", postgresql_using="gin"),
     )
 
 
+class MarketingDocumentAnnotationPage(Base):
+    """
+    Une page du draft (pageIndex, objects...) : l'éditeur et les agents ne chargent
+    que les pages / la projection dont ils ont besoin.
+    """
+    __tablename__ = "marketing_document_annotation_page"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    annotation_id: Mapped[int] = mapped_column(
+        ForeignKey("marketing_document_annotation.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+    page_index: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    # la page telle qu'envoyée par l'éditeur
+    data_json: Mapped[dict] = mapped_column(
+        JSONB,
+        nullable=False,
+        server_default=sa.text("'{}'::jsonb"),
+    )
+    # projection précalculée : objets dynamiques (prix / stock / EAN produit) seulement
+    dynamic_json: Mapped[list] = mapped_column(
+        JSONB,
+        nullable=False,
+        server_default=sa.text("'[]'::jsonb"),
+    )
+    # plan de rendu compilé de la page (marketing_render_plan), NULL => compilé au rendu
+    plan_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
+
+    updated_at: Mapped[DateTime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False
+    )
+
+    annotation: Mapped["MarketingDocumentAnnotation"] = relationship(
+        "MarketingDocumentAnnotation",
+        back_populates="pages",
+    )
+
+    __table_args__ = (
+        UniqueConstraint("annotation_id", "page_index", name="uq_marketing_doc_annotation_page"),
+    )
+
+
 class MarketingDocumentProductLink(Base):
     """
     Zones cliquables sur le PDF liées à un produit réel (Product).
@@ -1003,6 +1084,9 @@ class MarketingFont(Base):
     # Nom original uploadé (ex: Montserrat-SemiBold.ttf ou .woff2)
     original_name: Mapped[str | None] = mapped_column(String(255), nullable=True)
 
+    # TTF converti à l'upload (dans <dossier polices>/_cache_ttf/) : utilisé par le renderer PDF
+    ttf_filename: Mapped[str | None] = mapped_column(String(255), nullable=True)
+
     # WOFF2 only
     format: Mapped[str] = mapped_column(
         String(20),
@@ -1034,6 +1118,24 @@ class MarketingFont(Base):
     )
 
 
+class MarketingProductsVersion(Base):
+    """
+    Version du snapshot produits marketing d'un labo : incrémentée par trigger quand
+    un champ servi (prix, stock, nom, images, paliers...) change sur product / price_tier.
+    Table dédiée : les imports / syncs stock ne verrouillent ni ne réécrivent la ligne labo.
+    Ligne absente => version 0.
+    """
+    __tablename__ = "marketing_products_version"
+
+    labo_id: Mapped[int] = mapped_column(
+        ForeignKey("labo.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    version: Mapped[int] = mapped_column(
+        sa.BigInteger, nullable=False, server_default=sa.text("0")
+    )
+
+
 
 
 
@@ -4,7 +4,7 @@ import mimetypes
 mimetypes.add_type("text/javascript", ".mjs")
 mimetypes.add_type("image/webp", ".webp")
 
-from fastapi import FastAPI, APIRouter, Request, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
@@ -30,6 +30,7 @@ from app.middleware.i18n_middleware import I18nMiddleware
 from app.i18n import load_translations, t
 
 from app.core.config import settings
+from app.core.security import require_role
 
 # API Routers
 from app.routers import fonts_global
@@ -349,6 +350,24 @@ async def healthz():
 async def health():
     return {"status": "ok"}
 
+
+# ⚠️ détails internes (pool, timings) : superuser seulement, pas un healthcheck public
+@app.get("/health/render", dependencies=[Depends(require_role(["SUPERUSER", "SUPERADMIN"]))])
+async def health_render():
+    # pool de rendu PDF marketing + agrégats des spans (process courant)
+    from app.services.marketing_render_executor import render_executor
+    from app.services.marketing_render_metrics import render_metrics
+    return {"executor": render_executor.stats(), "metrics": render_metrics.snapshot()}
+
+
+# ------------------------
+# Shutdown : pool de rendu PDF marketing
+# ------------------------
+@app.on_event("shutdown")
+async def _shutdown_render_executor():
+    from app.services.marketing_render_executor import render_executor
+    render_executor.shutdown()
+
 # ------------------------
 # Dev ping Celery
 # ------------------------
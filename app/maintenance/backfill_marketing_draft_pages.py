@@ -0,0 +1,104 @@
+# app/maintenance/backfill_marketing_draft_pages.py
+"""
+Découpe par page les annotations marketing encore à l'ancien format
+(page_count NULL : toutes les pages dans data_json), puis compile le plan de
+rendu des pages qui n'en ont pas (plan_json NULL). Sans ce script, chaque
+draft est converti à son prochain enregistrement, et les pages sans plan
+sont compilées à chaque rendu.
+
+  python -m app.maintenance.backfill_marketing_draft_pages --dry-run
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+from typing import Dict
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import MarketingDocumentAnnotation, MarketingDocumentAnnotationPage
+from app.db.session import AsyncSessionLocal
+from app.services import marketing_draft_store as draft_store
+from app.services.marketing_render_plan import compile_page_plan_json
+
+# pages compilées par transaction
+PLAN_BATCH_SIZE = 200
+
+
+async def _run(dry_run: bool) -> Dict[str, int]:
+    stats = {"todo": 0, "converted": 0, "pages": 0, "failed": 0, "plans_todo": 0, "plans": 0}
+
+    async with AsyncSessionLocal() as session:  # type: AsyncSession
+        stmt = (
+            select(MarketingDocumentAnnotation.id)
+            .where(MarketingDocumentAnnotation.page_count.is_(None))
+            .order_by(MarketingDocumentAnnotation.id.asc())
+        )
+        ids = list((await session.execute(stmt)).scalars().all())
+
+        for anno_id in ids:
+            stats["todo"] += 1
+            if dry_run:
+                continue
+
+            # une transaction par annotation : un draft illisible ne bloque pas les autres
+            anno = await session.get(MarketingDocumentAnnotation, anno_id)
+            try:
+                await draft_store.ensure_paged(session, anno)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                stats["failed"] += 1
+                print("[DRAFT_PAGES_BACKFILL] FAILED", anno_id, type(e).__name__, str(e))
+                continue
+
+            stats["converted"] += 1
+            stats["pages"] += int(anno.page_count or 0)
+
+        # pages découpées avant le plan par page
+        stmt = (
+            select(MarketingDocumentAnnotationPage.id)
+            .where(MarketingDocumentAnnotationPage.plan_json.is_(None))
+            .order_by(MarketingDocumentAnnotationPage.id.asc())
+        )
+        page_ids = list((await session.execute(stmt)).scalars().all())
+        stats["plans_todo"] = len(page_ids)
+        if dry_run:
+            return stats
+
+        for start in range(0, len(page_ids), PLAN_BATCH_SIZE):
+            batch = page_ids[start:start + PLAN_BATCH_SIZE]
+            rows = (
+                await session.execute(
+                    select(MarketingDocumentAnnotationPage.id, MarketingDocumentAnnotationPage.data_json)
+                    .where(MarketingDocumentAnnotationPage.id.in_(batch))
+                )
+            ).all()
+            for page_id, data in rows:
+                plan = compile_page_plan_json(data if isinstance(data, dict) else {})
+                if plan is None:
+                    continue
+                await session.execute(
+                    update(MarketingDocumentAnnotationPage)
+                    .where(
+                        MarketingDocumentAnnotationPage.id == page_id,
+                        MarketingDocumentAnnotationPage.plan_json.is_(None),
+                    )
+                    .values(plan_json=plan)
+                )
+                stats["plans"] += 1
+            await session.commit()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    print(asyncio.run(_run(dry_run=args.dry_run)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# app/maintenance/backfill_marketing_font_ttf.py
+"""
+Convertit en TTF les polices marketing uploadées avant la conversion à l'upload
+(MarketingFont.ttf_filename NULL) et incrémente la version du jeu de polices
+des labos concernés.
+
+  python -m app.maintenance.backfill_marketing_font_ttf --dry-run
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+from pathlib import Path
+from typing import Dict, Set
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import MarketingFont
+from app.db.session import AsyncSessionLocal
+from app.services import marketing_font_map as font_map
+
+
+async def _run(dry_run: bool) -> Dict[str, int]:
+    stats = {"todo": 0, "converted": 0, "missing": 0, "failed": 0}
+    labos: Set[int] = set()
+
+    async with AsyncSessionLocal() as session:  # type: AsyncSession
+        stmt = select(MarketingFont).where(MarketingFont.ttf_filename.is_(None)).order_by(MarketingFont.id.asc())
+        fonts = (await session.execute(stmt)).scalars().all()
+
+        for f in fonts:
+            stats["todo"] += 1
+            fonts_dir = Path(f"/app/media/marketing_fonts/labo_{int(f.labo_id)}")
+            woff2_path = fonts_dir / f.filename
+            if not woff2_path.exists():
+                stats["missing"] += 1
+                print("[FONT_TTF_BACKFILL] missing", f.id, woff2_path)
+                continue
+            if dry_run:
+                continue
+
+            ttf_filename = font_map.ttf_filename_for(f.filename)
+            try:
+                await asyncio.to_thread(
+                    font_map.convert_woff2_to_ttf, woff2_path, font_map.ttf_dir(fonts_dir) / ttf_filename
+                )
+            except Exception as e:
+                stats["failed"] += 1
+                print("[FONT_TTF_BACKFILL] FAILED", f.id, type(e).__name__, str(e))
+                continue
+
+            f.ttf_filename = ttf_filename
+            labos.add(int(f.labo_id))
+            stats["converted"] += 1
+
+        for labo_id in sorted(labos):
+            await font_map.bump_fonts_version(session, labo_id)
+        if not dry_run:
+            await session.commit()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    print(asyncio.run(_run(dry_run=args.dry_run)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# app/maintenance/bench_marketing_renderer.py
+"""
+Benchmark hors-ligne du renderer marketing (render_pdf_with_overlays).
+
+Génère un PDF de base + des drafts synthétiques (N pages × M objets) :
+textes, product_price / product_stock_badge / product_ean, images locales,
+dégradés, formes clip, police custom. Chaque scénario tourne dans un process
+neuf (pic RSS propre au scénario) ; résultat en JSON pour comparer deux branches.
+
+Exemples :
+  python -m app.maintenance.bench_marketing_renderer --pages 12 --objects 30 --out bench_main.json
+  python -m app.maintenance.bench_marketing_renderer --out bench_branch.json --compare bench_main.json
+  python -m app.maintenance.bench_marketing_renderer --optimize screen   # + taille avant/après
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# types d'objets synthétiques (un scénario isolé par type => coût par objet)
+OBJECT_TYPES = (
+    "text",
+    "text_custom_font",
+    "product_price",
+    "product_stock_badge",
+    "product_ean",
+    "image",
+    "gradient",
+    "clip",
+    "shape",
+)
+
+BENCH_FONT_FAMILY = "GLOBAL_FONT_bench"
+FONTS_GLOBAL_DIR = Path(__file__).resolve().parents[1] / "assets" / "fonts_global"
+
+PAGE_W, PAGE_H = 595, 842  # A4 en pt
+N_PRODUCTS = 50
+
+
+# ------------------------------------------------------------
+# Fixtures (PDF de base, images, police)
+# ------------------------------------------------------------
+def build_fixtures(workdir: Path, pages: int) -> Dict[str, Any]:
+    """PDF de base vectoriel + images PNG/JPEG/WEBP + police TTF (dossier de travail)."""
+    import fitz  # PyMuPDF
+    from PIL import Image, ImageDraw
+
+    workdir.mkdir(parents=True, exist_ok=True)
+    media = workdir / "media"
+    media.mkdir(exist_ok=True)
+
+    base_pdf = workdir / "base.pdf"
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=PAGE_W, height=PAGE_H)
+        page.insert_text((40, 60), f"Catalogue synthétique - page {i + 1}", fontsize=20)
+        page.insert_textbox(fitz.Rect(40, 90, PAGE_W - 40, 300), "Lorem ipsum dolor sit amet. " * 30, fontsize=10)
+        page.draw_rect(fitz.Rect(40, 320, PAGE_W - 40, 700), color=(0.2, 0.2, 0.2), fill=(0.95, 0.95, 0.9))
+    doc.save(str(base_pdf), garbage=4, deflate=True)
+    doc.close()
+
+    images: List[str] = []
+    rnd = random.Random(0)
+    for n, (fmt, ext) in enumerate((("PNG", "png"), ("JPEG", "jpg"), ("WEBP", "webp"), ("PNG", "png"))):
+        im = Image.new("RGB", (1200, 900), (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+        dr = ImageDraw.Draw(im)
+        for _ in range(40):
+            x, y = rnd.randint(0, 1100), rnd.randint(0, 800)
+            dr.ellipse((x, y, x + 100, y + 100), fill=(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+        p = media / f"bench_{n}.{ext}"
+        im.save(p, fmt)
+        images.append(str(p))
+
+    fonts = sorted(FONTS_GLOBAL_DIR.glob("*.ttf")) if FONTS_GLOBAL_DIR.exists() else []
+    font_path = str(fonts[0]) if fonts else None
+
+    return {"base_pdf": str(base_pdf), "media_root": str(media), "images": images, "font_path": font_path}
+
+
+# ------------------------------------------------------------
+# Draft synthétique
+# ------------------------------------------------------------
+def _make_object(kind: str, idx: int, pi: int, rnd: random.Random, fx: Dict[str, Any]) -> Dict[str, Any]:
+    # grille 5 colonnes ; positions relatives => indépendant du viewport
+    col, row = idx % 5, (idx // 5) % 12
+    rect = {"x_rel": 0.03 + col * 0.19, "y_rel": 0.03 + row * 0.08, "w_rel": 0.17, "h_rel": 0.06}
+    pid = rnd.randint(1, N_PRODUCTS)
+    oid = f"{kind}_{pi}_{idx}"
+
+    if kind == "text":
+        return {"id": oid, "type": "text", "text": f"Texte {idx} € " * rnd.randint(1, 4),
+                "fontSize": rnd.choice((10, 14, 18)), "fontFamily": "Helvetica", "color": "#222222", **rect}
+    if kind == "text_custom_font":
+        return {"id": oid, "type": "text", "text": f"Promo {idx} – {rnd.randint(5, 50)}%",
+                "fontSize": rnd.choice((14, 20, 28)), "fontFamily": BENCH_FONT_FAMILY, "color": "#c0392b", **rect}
+    if kind == "product_price":
+        dyn: Dict[str, Any] = {"kind": "product_price", "product_id": pid}
+        if rnd.random() < 0.3:
+            dyn.update({"price_mode": "tier", "tier_id": pid * 10 + 1})
+        if rnd.random() < 0.5:
+            dyn["priceStyle"] = {"kind": "int_plus_1pt"}
+        return {"id": oid, "type": "product_price", "dynamic": dyn, "fontSize": 22,
+                "fontFamily": BENCH_FONT_FAMILY, **rect}
+    if kind == "product_stock_badge":
+        return {"id": oid, "type": "product_stock_badge",
+                "dynamic": {"kind": "product_stock_badge", "product_id": pid, "mode_agent": "always", "mode_labo": "always"},
+                "fontSize": 12, "bgEnabled": True, "bgColor": "#e74c3c", **rect}
+    if kind == "product_ean":
+        return {"id": oid, "type": "product_ean", "dynamic": {"kind": "product_ean", "product_id": pid},
+                "fontSize": 11, **rect}
+    if kind == "image":
+        return {"id": oid, "type": "image", "src": rnd.choice(fx["images"]), **rect}
+    if kind == "gradient":
+        return {"id": oid, "type": rnd.choice(("rect", "roundrect")), "fillType": "gradient",
+                "gradColor1": "#%06x" % rnd.randint(0, 0xFFFFFF), "gradColor2": "#%06x" % rnd.randint(0, 0xFFFFFF),
+                "gradAngle": rnd.choice((0, 45, 90)), "radius": 8, **rect}
+    if kind == "clip":
+        return {"id": oid, "type": "roundrect", "isClip": True, "radius": 16,
+                "clip": {"src": rnd.choice(fx["images"]), "transform": {"scale": 1.0 + rnd.random() * 0.5}}, **rect}
+    if kind == "shape":
+        return {"id": oid, "type": rnd.choice(("rect", "roundrect", "line")), "fill": "#%06x" % rnd.randint(0, 0xFFFFFF),
+                "strokeWidth": 2, "radius": 6, "layer": rnd.choice(("back", "front")), **rect}
+    raise ValueError(f"type inconnu: {kind}")
+
+
+def make_synthetic_draft(
+    fx: Dict[str, Any],
+    pages: int,
+    objects_per_page: int,
+    types: List[str],
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Draft N pages × M objets ; types répartis en tourniquet (mélange stable via seed)."""
+    rnd = random.Random(seed)
+    out: Dict[str, Any] = {"_meta": {}, "pages": []}
+    for pi in range(pages):
+        objs = []
+        if types:
+            for i in range(objects_per_page):
+                objs.append(_make_object(types[i % len(types)], i, pi, rnd, fx))
+        out["pages"].append({"objects": objs})
+    return out
+
+
+def make_render_context(fx: Dict[str, Any]):
+    from app.services.marketing_pdf_renderer import RenderContext
+
+    products_by_id = {
+        pid: {"id": pid, "sku": f"SKU{pid}", "name": f"Produit {pid}", "ean13": f"{3000000000000 + pid}",
+              "price_ht": round(1.5 + pid * 0.73, 2), "stock": 0 if pid % 4 == 0 else pid, "labo_id": 1}
+        for pid in range(1, N_PRODUCTS + 1)
+    }
+    tiers = {pid: [{"id": pid * 10 + 1, "qty_min": 10, "price_ht": round(1.2 + pid * 0.6, 2)}] for pid in products_by_id}
+    gfonts = {BENCH_FONT_FAMILY: {"file_path": fx["font_path"]}} if fx.get("font_path") else None
+    return RenderContext(products_by_id=products_by_id, tiers_by_product_id=tiers, global_fonts_by_family=gfonts)
+
+
+# ------------------------------------------------------------
+# Scénario (process neuf)
+# ------------------------------------------------------------
+def _run_scenario(
+    fx: Dict[str, Any], pages: int, objects_per_page: int, types: List[str], repeat: int, optimize: str = "none"
+) -> Dict[str, Any]:
+    # MEDIA_ROOT lu à l'import du renderer : les images synthétiques doivent être dedans
+    os.environ["MEDIA_ROOT"] = fx["media_root"]
+    from app.services.marketing_pdf_renderer import render_pdf_with_overlays
+    from app.services.marketing_render_metrics import collect_timings
+
+    draft = make_synthetic_draft(fx, pages, objects_per_page, types)
+    ctx = make_render_context(fx)
+
+    times: List[float] = []
+    stages: List[Dict[str, Any]] = []
+    size = 0
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        with collect_timings() as tm:
+            out = render_pdf_with_overlays(fx["base_pdf"], draft, ctx, optimize=optimize)
+        times.append(time.perf_counter() - t0)
+        stages.append(tm.to_dict())
+        size = len(out)
+        del out
+
+    # taille sans optimisation : rendu hors chrono (la mesure dans le profil coûterait une sérialisation)
+    size_unoptimized = size
+    if optimize != "none":
+        size_unoptimized = len(render_pdf_with_overlays(fx["base_pdf"], draft, ctx))
+
+    # ru_maxrss : Ko sous Linux, octets sous macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+    warm = times[1:] or times
+    return {
+        "types": types,
+        "pages": pages,
+        "objects": pages * objects_per_page if types else 0,
+        "cold_s": round(times[0], 4),
+        "warm_median_s": round(statistics.median(warm), 4),
+        "warm_min_s": round(min(warm), 4),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "output_bytes": size,
+        "optimize": optimize,
+        "output_bytes_unoptimized": size_unoptimized,
+        # spans du renderer (marketing_render_metrics) : 1er rendu et dernier rendu
+        "stages_cold": stages[0],
+        "stages_warm": stages[-1],
+    }
+
+
+def run_scenario_isolated(*args: Any) -> Dict[str, Any]:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as ex:
+        return ex.submit(_run_scenario, *args).result()
+
+
+# ------------------------------------------------------------
+# Suite
+# ------------------------------------------------------------
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=str(Path(__file__).resolve().parent), stderr=subprocess.DEVNULL
+        ).decode().strip() or None
+    except Exception:
+        return None
+
+
+def run_suite(
+    pages: int, objects_per_page: int, repeat: int, types: List[str], workdir: Path, optimize: str = "none"
+) -> Dict[str, Any]:
+    import fitz
+
+    fx = build_fixtures(workdir, pages)
+
+    print(f"[BENCH] baseline (0 objet) pages={pages}")
+    baseline = run_scenario_isolated(fx, pages, objects_per_page, [], repeat, optimize)
+
+    print(f"[BENCH] mix {','.join(types)} objets/page={objects_per_page}")
+    mixed = run_scenario_isolated(fx, pages, objects_per_page, types, repeat, optimize)
+
+    per_type: Dict[str, Any] = {}
+    for t in types:
+        print(f"[BENCH] type={t}")
+        r = run_scenario_isolated(fx, pages, objects_per_page, [t], repeat, optimize)
+        n = max(1, r["objects"])
+        r["cost_per_object_cold_ms"] = round((r["cold_s"] - baseline["cold_s"]) * 1000 / n, 3)
+        r["cost_per_object_warm_ms"] = round((r["warm_median_s"] - baseline["warm_median_s"]) * 1000 / n, 3)
+        per_type[t] = r
+
+    return {
+        "meta": {
+            "git_rev": _git_rev(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pymupdf": getattr(fitz, "VersionBind", None),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "params": {
+            "pages": pages,
+            "objects_per_page": objects_per_page,
+            "repeat": repeat,
+            "types": types,
+            "optimize": optimize,
+        },
+        "baseline": baseline,
+        "mixed": mixed,
+        "per_type": per_type,
+    }
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any], max_regression_pct: float) -> List[str]:
+    """Lignes de régression (warm_median_s) au-delà du seuil ; vide si RAS."""
+    regressions: List[str] = []
+
+    def check(label: str, cur: Optional[Dict[str, Any]], prev: Optional[Dict[str, Any]]) -> None:
+        if not cur or not prev or not prev.get("warm_median_s"):
+            return
+        delta = (cur["warm_median_s"] - prev["warm_median_s"]) / prev["warm_median_s"] * 100
+        line = f"{label:<22} {prev['warm_median_s']:>8.3f}s -> {cur['warm_median_s']:>8.3f}s ({delta:+.1f}%)"
+        print("[BENCH][CMP]", line)
+        if delta > max_regression_pct:
+            regressions.append(line)
+
+    check("mixed", current.get("mixed"), previous.get("mixed"))
+    for t, r in (current.get("per_type") or {}).items():
+        check(t, r, (previous.get("per_type") or {}).get(t))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark du renderer PDF marketing")
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--objects", type=int, default=25, help="objets par page")
+    parser.add_argument("--repeat", type=int, default=3, help="rendus par scénario (1er = à froid)")
+    parser.add_argument("--types", default=",".join(OBJECT_TYPES), help="sous-ensemble de: " + ",".join(OBJECT_TYPES))
+    parser.add_argument("--workdir", default=None, help="dossier des fixtures (défaut: tmp)")
+    parser.add_argument("--out", default="bench_marketing_renderer.json")
+    parser.add_argument("--compare", default=None, help="JSON d'un run précédent")
+    parser.add_argument("--max-regression-pct", type=float, default=15.0)
+    parser.add_argument("--optimize", default="none", help="profil de taille: screen, print, none")
+    args = parser.parse_args()
+
+    from app.services.marketing_pdf_optimize import profile_name
+
+    try:
+        optimize = profile_name(args.optimize)
+    except ValueError as e:
+        parser.error(str(e))
+
+    types = [t.strip() for t in args.types.split(",") if t.strip()]
+    unknown = [t for t in types if t not in OBJECT_TYPES]
+    if unknown:
+        parser.error(f"types inconnus: {unknown}")
+
+    with tempfile.TemporaryDirectory(prefix="bench_marketing_") as tmp:
+        workdir = Path(args.workdir) if args.workdir else Path(tmp)
+        result = run_suite(args.pages, args.objects, args.repeat, types, workdir, optimize)
+
+    Path(args.out).write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    mixed = result["mixed"]
+    print(f"[BENCH] mixed warm={mixed['warm_median_s']}s rss={mixed['peak_rss_mb']}MB -> {args.out}")
+    if optimize != "none":
+        print(f"[BENCH] taille {optimize}: {mixed['output_bytes_unoptimized']} -> {mixed['output_bytes']} octets")
+
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(result, previous, args.max_regression_pct)
+        if regressions:
+            print(f"[BENCH] ❌ {len(regressions)} régression(s) > {args.max_regression_pct}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
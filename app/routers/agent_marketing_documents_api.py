@@ -1,15 +1,16 @@
 # app/routers/agent_marketing_documents_api.py
 from __future__ import annotations
 
+import asyncio
 import time
 import re
 import copy
-from io import BytesIO
 from pathlib import Path
-from typing import Optional, List, Dict, Any, Set
+from typing import Optional, List, Dict, Any
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse  # ✅ NEW
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, FileResponse, Response  # ✅ NEW
+from starlette.background import BackgroundTask
 
 import traceback
 from pydantic import BaseModel, Field
@@ -26,21 +27,25 @@ from app.db.models import (
     labo_agent,
     Labo,
     Agent,
-    Product,
-    PriceTier,
-    MarketingFont,
 )
-from app.db.models import GlobalFont
 
 from app.core.security import get_current_user
 
 from app.services.marketing_signed_url import (
     make_marketing_token,
     build_public_url,
+    bucketed_exp,
 )
 
 # ✅ PDF renderer (vectoriel)
-from app.services.marketing_pdf_renderer import render_pdf_with_overlays, RenderContext
+from app.services import marketing_render_cache as render_cache
+from app.services import marketing_published_render as published_render
+from app.services import marketing_pdf_optimize as pdf_optimize
+from app.services.marketing_render_executor import render_executor, RenderUnavailable, RenderTimeout
+from app.services import marketing_draft_store as draft_store
+from app.services import marketing_render_inputs as render_inputs
+from app.services import marketing_product_snapshot as product_snapshot
+from app.services.marketing_render_metrics import span, start_request_timings, timing_headers
 
 router = APIRouter(
     prefix="/api-zenhub/agent",
@@ -48,6 +53,8 @@ router = APIRouter(
 )
 
 THUMB_TTL = 300
+# lien de lecture = jeton porteur : court (fenêtre bucketed_exp => valide 5 à 10 min),
+# redemandé à l'expiration ; même URL dans la fenêtre, revalidée par ETag (304)
 VIEW_TTL = 300
 
 MEDIA_DIR = Path("/app/media/marketing_documents")
@@ -82,186 +89,16 @@ async def _agent_can_access_labo(session: AsyncSession, agent_id: int, labo_id:
     return bool(res.scalar())
 
 
-def _collect_product_ids_from_draft(draft: Dict[str, Any]) -> Set[int]:
-    ids: Set[int] = set()
-    for page in (draft.get("pages") or []):
-        if not isinstance(page, dict):
-            continue
-        for obj in (page.get("objects") or []):
-            if not isinstance(obj, dict):
-                continue
-
-            dyn = obj.get("dynamic") or {}
-            kind = (
-                (dyn.get("kind"))
-                or obj.get("_dyn_kind")
-                or obj.get("type")
-                or ""
-            ).strip()
-
-            # ✅ ADD product_ean
-            if kind not in ("product_price", "product_stock_badge", "product_ean"):
-                continue
-
-            pid = (
-                dyn.get("product_id")
-                or dyn.get("productId")
-                or obj.get("product_id")
-                or obj.get("productId")
-                or obj.get("_dyn_product_id")
-            )
-            try:
-                pid_int = int(pid)
-                if pid_int > 0:
-                    ids.add(pid_int)
-            except Exception:
-                continue
-    return ids
-
-
 def _fonts_dir_for_labo(labo_id: int) -> Path:
     return MEDIA_DIR / f"labo_{int(labo_id)}" / "fonts"
 
 
-def _safe_family_name_from_font_id(font_id: int) -> str:
-    # doit matcher le front : LABO_FONT_<id>
-    return f"LABO_FONT_{int(font_id)}"
-
-
 def _normalize_font_key_from_family(family: str, weight: int) -> str:
     fam = (family or "").strip().lower()
     fam = re.sub(r"\s+", " ", fam)
     return f"{fam}__{int(weight)}"
 
 
-def _guess_weight_from_filename(filename: str) -> int:
-    low = (filename or "").lower()
-    if "bold" in low or "-bd" in low or "_bd" in low or "700" in low:
-        return 700
-    return 400
-
-
-def _build_font_files_from_db(fonts: List["MarketingFont"], fonts_dir: Path) -> Dict[str, str]:
-    """
-    Mapping attendu par marketing_pdf_renderer:
-      key = "<family>__<weight>" (family normalisé)
-
-    IMPORTANT:
-      - On ne stocke actuellement que des .woff2 en BDD/disque
-      - PyMuPDF a besoin d'un TTF/OTF pour dessiner le texte
-      - Donc: on convertit le .woff2 -> .ttf dans un cache local, puis on mappe le .ttf
-
-    Le bon répertoire "source" est /app/media/marketing_fonts/labo_<id>/
-    """
-    out: Dict[str, str] = {}
-
-    cache_dir = fonts_dir / "_cache_ttf"
-    cache_dir.mkdir(parents=True, exist_ok=True)
-
-    def _normalize_family(family: str) -> str:
-        return (family or "").strip()
-
-    def _add_family_keys(family_name: str, weight: int, path: Path):
-        fam = _normalize_family(family_name)
-        if not fam:
-            return
-
-        key = _normalize_font_key_from_family(fam, weight)
-        out[key] = str(path)
-
-        out[_normalize_font_key_from_family(fam, 0)] = str(path)
-
-        if weight == 400:
-            out[_normalize_font_key_from_family(fam, 400)] = str(path)
-        if weight == 700:
-            out[_normalize_font_key_from_family(fam, 700)] = str(path)
-
-    def _guess_weight(font_obj, filename_for_guess: str) -> int:
-        original = (getattr(font_obj, "original_name", None) or "").strip()
-        if original:
-            w = _guess_weight_from_filename(original)
-            if w:
-                return w
-        nm = (getattr(font_obj, "name", None) or "").strip()
-        if nm:
-            w = _guess_weight_from_filename(nm)
-            if w:
-                return w
-        return _guess_weight_from_filename(filename_for_guess) or 400
-
-    def _human_family(font_obj, file_stem: str) -> str:
-        human = (getattr(font_obj, "name", None) or "").strip()
-        if human:
-            return human
-
-        base = (file_stem or "").replace("-", " ").replace("_", " ").strip()
-        base = re.sub(r"\bRegular\b|\bBold\b|\bItalic\b|\bMedium\b|\bLight\b", "", base, flags=re.I).strip()
-        base = re.sub(r"([a-z])([A-Z])", r"\1 \2", base).strip()
-        return base
-
-    def _woff2_to_ttf(woff2_path: Path, ttf_path: Path):
-        from fontTools.ttLib import TTFont  # type: ignore
-
-        ttf_path.parent.mkdir(parents=True, exist_ok=True)
-        font = TTFont(str(woff2_path))
-        font.flavor = None
-        font.save(str(ttf_path))
-
-    for f in fonts:
-        fid = int(getattr(f, "id", 0) or 0)
-        if fid <= 0:
-            continue
-
-        filename = (getattr(f, "filename", None) or "").strip()
-        if not filename:
-            continue
-
-        woff2_path = fonts_dir / filename
-        if not woff2_path.exists():
-            continue
-
-        if woff2_path.suffix.lower() != ".woff2":
-            continue
-
-        weight = _guess_weight(f, woff2_path.name)
-
-        sha = (getattr(f, "sha256", None) or "").strip()
-        ttf_name = f"{sha}.ttf" if sha else f"{woff2_path.stem}.ttf"
-        ttf_path = cache_dir / ttf_name
-
-        if (not ttf_path.exists()) or ttf_path.stat().st_size < 1000:
-            try:
-                _woff2_to_ttf(woff2_path, ttf_path)
-            except Exception:
-                continue
-
-        family_labo = _safe_family_name_from_font_id(fid)
-        _add_family_keys(family_labo, weight, ttf_path)
-
-        human = _human_family(f, woff2_path.stem)
-        if human:
-            _add_family_keys(human, weight, ttf_path)
-
-    return out
-
-
-def _build_labo_fonts_by_id(fonts: List[MarketingFont]) -> Dict[int, Dict[str, Any]]:
-    """
-    Permet au renderer de résoudre LABO_FONT_<id> => chemin fichier.
-    Ici on met seulement filename (relatif), le renderer le join avec fonts_dir si besoin.
-    """
-    out: Dict[int, Dict[str, Any]] = {}
-    for f in fonts:
-        fid = int(getattr(f, "id", 0) or 0)
-        if fid <= 0:
-            continue
-        filename = getattr(f, "filename", None) or ""
-        if not filename:
-            continue
-        out[fid] = {"ttf_path": filename, "path": filename}
-    return out
-
-
 def _font_key_variants(family: str, weight: Optional[int]) -> List[str]:
     fam = (family or "").strip()
     w = int(weight) if weight not in (None, "", 0) else 0
@@ -640,6 +477,7 @@ async def list_marketing_documents_for_labo(
             pub_alias.version,
             pub_alias.published_pdf_filename,
             pub_alias.updated_at,
+            pub_alias.render_options_json,
         )
         .select_from(MarketingDocument)
         .outerjoin(
@@ -662,20 +500,29 @@ async def list_marketing_documents_for_labo(
     now = int(time.time())
     out = []
 
-    for (d, pub_ver, pub_filename, pub_updated_at) in rows:
+    for (d, pub_ver, pub_filename, pub_updated_at, pub_opts) in rows:
         thumb_url: Optional[str] = None
         thumb_signed_url: Optional[str] = None
 
         if getattr(d, "thumb_filename", None):
             thumb_url = _media_thumb_url(d.labo_id, d.thumb_filename)
             try:
-                token = make_marketing_token(doc_id=d.id, kind="thumb", exp_ts=now + THUMB_TTL)
+                token = make_marketing_token(
+                    doc_id=d.id,
+                    kind="thumb",
+                    exp_ts=bucketed_exp(THUMB_TTL, now),
+                    labo_id=d.labo_id,
+                    filename=d.thumb_filename,
+                )
                 thumb_signed_url = build_public_url(token)
             except Exception:
                 thumb_signed_url = None
 
         has_published = bool(pub_ver and pub_filename)
 
+        # ✅ pré-rendu de la publication (nb pages + miniatures par page)
+        pub_opts = pub_opts if (has_published and isinstance(pub_opts, dict)) else {}
+
         out.append(
             {
                 "id": d.id,
@@ -686,10 +533,18 @@ async def list_marketing_documents_for_labo(
                 "original_name": d.original_name,
                 "thumb_url": thumb_url,
                 "thumb_signed_url": thumb_signed_url,
+                # ✅ miniatures multi-tailles (listes responsive) ; {} pour les documents d'avant
+                "thumb_urls": {
+                    w: _media_thumb_url(d.labo_id, name)
+                    for w, name in ((d.thumbs_json or {}).get("widths") or {}).items()
+                },
                 "has_published": has_published,
                 "published_version": int(pub_ver) if has_published else None,
                 "published_pdf_filename": str(pub_filename) if has_published else None,
                 "published_at": pub_updated_at.isoformat() if has_published and pub_updated_at else None,
+                "published_page_count": pub_opts.get("page_count"),
+                # ✅ liens signés : les miniatures du pré-rendu contiennent les prix agents
+                "published_thumb_urls": published_render.published_thumb_urls(pub_opts, d.id, d.labo_id, now),
             }
         )
 
@@ -712,6 +567,9 @@ async def get_marketing_document_view_url(
     if not await _agent_can_access_labo(session, agent.id, doc.labo_id):
         raise HTTPException(status_code=403, detail="Accès refusé")
 
+    # ✅ pré-rendu perdu : relancé ou servi en rendu à la demande (sans attendre le beat)
+    await published_render.recover_stale_publications(session, doc.id)
+
     stmt_pub = (
         select(MarketingDocumentPublication)
         .where(
@@ -724,12 +582,45 @@ async def get_marketing_document_view_url(
     )
     pub = (await session.execute(stmt_pub)).scalars().first()
 
+    # ✅ signed_url : servi avec Range / ETag (lecteurs PDF par plages), sans requête DB
+    exp_ts = bucketed_exp(VIEW_TTL)
+
     if pub:
         url = _media_pdf_url(doc.labo_id, pub.published_pdf_filename)
-        return {"url": url, "mode": "published", "is_published": True, "published_version": int(pub.version)}
+        token = make_marketing_token(
+            doc_id=doc.id,
+            kind="published",
+            exp_ts=exp_ts,
+            labo_id=doc.labo_id,
+            filename=pub.published_pdf_filename,
+            sha256=pub.published_pdf_sha256,
+            download_name=doc.original_name,
+        )
+        return {
+            "url": url,
+            "signed_url": build_public_url(token),
+            "mode": "published",
+            "is_published": True,
+            "published_version": int(pub.version),
+        }
 
     url = _media_pdf_url(doc.labo_id, doc.filename)
-    return {"url": url, "mode": "source", "is_published": False, "published_version": None}
+    token = make_marketing_token(
+        doc_id=doc.id,
+        kind="pdf",
+        exp_ts=exp_ts,
+        labo_id=doc.labo_id,
+        filename=doc.filename,
+        sha256=doc.source_sha256,
+        download_name=doc.original_name,
+    )
+    return {
+        "url": url,
+        "signed_url": build_public_url(token),
+        "mode": "source",
+        "is_published": False,
+        "published_version": None,
+    }
 
 
 # ---------------------------------------------------------
@@ -738,6 +629,8 @@ async def get_marketing_document_view_url(
 @router.get("/marketing-documents/{doc_id}/draft")
 async def get_marketing_document_draft(
     doc_id: int,
+    pages: Optional[str] = Query(None, description='ex: "0-4" ou "0,3" (défaut : toutes les pages)'),
+    fields: str = Query(draft_store.FIELDS_ALL, description="all | dynamic | manifest"),
     session: AsyncSession = Depends(get_async_session),
     agent: Agent = Depends(get_current_agent),
 ):
@@ -746,7 +639,16 @@ async def get_marketing_document_draft(
     Règle:
       - Si une publication READY existe => on retourne UNIQUEMENT le draft LOCKED lié à cette publication.
       - Sinon (pas publié) => on peut retourner le DRAFT (preview) ou un draft vide.
+    ?pages= / ?fields=dynamic : seulement les pages / les overlays produits utiles.
     """
+    if fields not in draft_store.DRAFT_FIELDS:
+        raise HTTPException(status_code=400, detail="fields invalide (all | dynamic | manifest)")
+    try:
+        page_indexes = draft_store.parse_pages_param(pages)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"pages invalide: {e}")
+    partial = page_indexes is not None or fields != draft_store.FIELDS_ALL
+
     doc = await session.get(MarketingDocument, doc_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
@@ -779,14 +681,18 @@ async def get_marketing_document_draft(
                 detail="Publication READY avec annotation_locked_id mais annotation LOCKED introuvable",
             )
 
-        return {
-            "draft": locked.data_json or {"pages": [], "_meta": {}},
+        out = {
+            "draft": await draft_store.load_draft(session, locked, page_indexes, fields),
             "draft_version": int(locked.draft_version or 1),
             "source": "locked",
             "published_version": int(pub.version or 0),
             "published_pdf_filename": str(pub.published_pdf_filename) if pub.published_pdf_filename else None,
             "published_at": pub.updated_at.isoformat() if pub.updated_at else None,
         }
+        if partial:
+            out["page_count"] = draft_store.draft_page_count(locked)
+            out["page_indexes"] = draft_store.selected_page_indexes(locked, page_indexes)
+        return out
 
     stmt_d = (
         select(MarketingDocumentAnnotation)
@@ -798,14 +704,18 @@ async def get_marketing_document_draft(
     )
     anno = (await session.execute(stmt_d)).scalars().first()
 
-    return {
-        "draft": (anno.data_json if anno else {"pages": [], "_meta": {}}) or {"pages": [], "_meta": {}},
+    out = {
+        "draft": await draft_store.load_draft(session, anno, page_indexes, fields),
         "draft_version": int(anno.draft_version or 1) if anno else 1,
         "source": "draft",
         "published_version": None,
         "published_pdf_filename": None,
         "published_at": None,
     }
+    if partial:
+        out["page_count"] = draft_store.draft_page_count(anno)
+        out["page_indexes"] = draft_store.selected_page_indexes(anno, page_indexes)
+    return out
 
 
 # ---------------------------------------------------------
@@ -816,64 +726,85 @@ class BulkInfoPayload(BaseModel):
     role: Optional[str] = None
 
 
-def _to_product_item(p: Product) -> Dict[str, Any]:
+def _to_product_item(e: Dict[str, Any]) -> Dict[str, Any]:
+    # e : entrée du snapshot produits (marketing_product_snapshot)
     return {
-        "id": int(p.id),
-        "sku": p.sku,
-        "name": p.name,
-        "ean13": p.ean13,
-        "price_ht": float(p.price_ht or 0),
-        "stock": _maybe_int(getattr(p, "stock", None)),
-        "is_active": bool(p.is_active),
-        "image_url": p.image_url,
-        "labo_id": int(p.labo_id or 0),
+        "id": int(e["id"]),
+        "sku": e.get("sku"),
+        "name": e.get("name"),
+        "ean13": e.get("ean13"),
+        "price_ht": float(e.get("price_ht") or 0),
+        "stock": _maybe_int(e.get("stock")),
+        "is_active": bool(e.get("is_active")),
+        "image_url": e.get("image_url"),
+        "labo_id": int(e.get("labo_id") or 0),
     }
 
 
+async def _agent_bulk_info_response(
+    session: AsyncSession,
+    agent: Agent,
+    ids: List[int],
+    if_none_match: Optional[str],
+) -> Response:
+    # ✅ snapshot partagé par labo (Redis), ETag dérivé des versions produits des labos de l'agent
+    versions = await product_snapshot.get_agent_products_versions(session, int(agent.id))
+    etag = product_snapshot.compute_etag(f"agent:{int(agent.id)}", versions, ids)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if product_snapshot.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    # ✅ labo de chaque id d'abord : un id inconnu / supprimé ne déclenche plus la lecture
+    # (voire la construction) du snapshot de chaque labo de l'agent
+    product_labos = await product_snapshot.get_products_labo_ids(session, ids)
+    found: Dict[int, Dict[str, Any]] = {}
+    for labo_id, version in versions:
+        labo_ids = [i for i in ids if product_labos.get(i) == labo_id]
+        if labo_ids:
+            found.update(await product_snapshot.get_products(session, labo_id, version, labo_ids))
+
+    ok_ids = [i for i in ids if i in found]
+    return JSONResponse(
+        {
+            "products": [_to_product_item(found[i]) for i in ok_ids],
+            "tiers": {str(i): list(found[i].get("tiers") or []) for i in ok_ids},
+        },
+        headers=headers,
+    )
+
+
+@router.get("/marketing/products/bulk-info")
+async def agent_bulk_info_products_get(
+    ids: str = Query("", description="ex: 12,15,18"),
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_async_session),
+    agent: Agent = Depends(get_current_agent),
+):
+    """Même réponse que le POST, avec ETag / 304 (revalidation par le navigateur)."""
+    try:
+        product_ids = product_snapshot.parse_ids_param(ids)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await _agent_bulk_info_response(session, agent, product_ids, if_none_match)
+
+
 @router.post("/marketing/products/bulk-info")
 async def agent_bulk_info_products(
     payload: BulkInfoPayload,
+    if_none_match: Optional[str] = Header(None),
     session: AsyncSession = Depends(get_async_session),
     agent: Agent = Depends(get_current_agent),
 ):
-    ids = [int(x) for x in (payload.product_ids or []) if int(x) > 0]
-    ids = list(dict.fromkeys(ids))
+    ids = product_snapshot.parse_ids(payload.product_ids or [])
     if not ids:
         return {"products": [], "tiers": {}}
-
-    stmt = (
-        select(Product)
-        .select_from(Product)
-        .join(labo_agent, labo_agent.c.labo_id == Product.labo_id)
-        .where(labo_agent.c.agent_id == agent.id)
-        .where(Product.id.in_(ids))
-    )
-    products = (await session.execute(stmt)).scalars().all()
-
-    products_by_id = {int(p.id): p for p in products}
-    ok_ids = list(products_by_id.keys())
-
-    tiers_map: Dict[int, list] = {}
-    if ok_ids:
-        stmt_t = (
-            select(PriceTier)
-            .where(PriceTier.product_id.in_(ok_ids))
-            .order_by(PriceTier.product_id.asc(), PriceTier.qty_min.asc())
-        )
-        tiers = (await session.execute(stmt_t)).scalars().all()
-
-        for t in tiers:
-            pid = int(t.product_id)
-            tiers_map.setdefault(pid, []).append(
-                {"id": int(t.id), "qty_min": int(t.qty_min), "price_ht": float(t.price_ht or 0)}
-            )
-
-    return {
-        "products": [_to_product_item(products_by_id[i]) for i in ok_ids],
-        "tiers": tiers_map,
-    }
+    return await _agent_bulk_info_response(session, agent, ids, if_none_match)
 
 
+# ---------------------------------------------------------
+# Helpers rendu (download-rendered + preview)
+# ---------------------------------------------------------
 # ---------------------------------------------------------
 # 6) ✅ Download PDF modifié (vectoriel) pour l'agent
 # ---------------------------------------------------------
@@ -881,6 +812,7 @@ async def agent_bulk_info_products(
 async def download_marketing_document_rendered_pdf(
     doc_id: int,
     debug: int = 0,
+    profile: Optional[str] = None,
     session: AsyncSession = Depends(get_async_session),
     agent: Agent = Depends(get_current_agent),
 ):
@@ -892,10 +824,19 @@ async def download_marketing_document_rendered_pdf(
     - typos = embarquées (TTF/OTF) depuis /app/media/marketing_documents/labo_{id}/fonts
     - coords = supporte x_rel/y_rel/w_rel/h_rel (prioritaire) + fallback px
 
+    TAILLE:
+      - ?profile=screen|print|none (défaut MARKETING_PDF_OPTIMIZE_DEFAULT) : polices
+        réduites, images rééchantillonnées au dpi du profil (marketing_pdf_optimize)
+
     DEBUG:
       - ajouter ?debug=1 pour obtenir un JSON de diagnostic
     """
     try:
+        try:
+            optimize = pdf_optimize.profile_name(profile or pdf_optimize.PDF_OPTIMIZE_DEFAULT)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
         doc = await session.get(MarketingDocument, doc_id)
         if not doc:
             raise HTTPException(status_code=404, detail="Document introuvable")
@@ -903,148 +844,61 @@ async def download_marketing_document_rendered_pdf(
         if not await _agent_can_access_labo(session, agent.id, doc.labo_id):
             raise HTTPException(status_code=403, detail="Accès refusé")
 
-        stmt_pub = (
-            select(MarketingDocumentPublication)
-            .where(
-                MarketingDocumentPublication.document_id == doc_id,
-                MarketingDocumentPublication.status == MarketingPublicationStatus.READY,
-            )
-            .order_by(MarketingDocumentPublication.version.desc())
-            .limit(1)
-        )
-        pub = (await session.execute(stmt_pub)).scalars().first()
-
-        is_published = False
-        published_version: Optional[int] = None
-
-        if pub and pub.status == MarketingPublicationStatus.READY and pub.published_pdf_filename:
-            pdf_path = MEDIA_DIR / f"labo_{doc.labo_id}" / str(pub.published_pdf_filename)
-            is_published = True
-            published_version = int(pub.version or 0)
-        else:
-            pdf_path = MEDIA_DIR / f"labo_{doc.labo_id}" / str(doc.filename)
+        # ✅ spans (BDD, cache, rendu worker...) => header Server-Timing + agrégats
+        tm = start_request_timings()
+        t0 = time.perf_counter()
 
-        if not pdf_path.exists():
-            raise HTTPException(status_code=500, detail=f"PDF introuvable: {pdf_path}")
+        with span("db"):
+            await published_render.recover_stale_publications(session, doc.id)
+            ri = await render_inputs.load_render_inputs(session, doc, "agent", agent_id=int(agent.id))
 
-        input_pdf_bytes = pdf_path.read_bytes()
-
-        # 2) draft (LOCKED si publié, sinon DRAFT)
-        draft: Dict[str, Any] = {"pages": [], "_meta": {}}
+        base = _safe_filename(doc.title or doc.original_name or "document")
+        suffix = f"v{ri.published_version}" if ri.is_published and ri.published_version else "preview"
+        filename = f"{base}_{suffix}.pdf"
 
-        if pub and getattr(pub, "annotation_locked_id", None):
-            locked = await session.get(MarketingDocumentAnnotation, int(pub.annotation_locked_id))
-            if locked and locked.status == MarketingAnnotationStatus.LOCKED:
-                draft = (locked.data_json or {"pages": [], "_meta": {}}) or {"pages": [], "_meta": {}}
-            else:
-                stmt_d = select(MarketingDocumentAnnotation).where(
-                    MarketingDocumentAnnotation.document_id == doc_id,
-                    MarketingDocumentAnnotation.status == MarketingAnnotationStatus.DRAFT,
+        # ✅ cache du rendu : même base + même draft + mêmes données produit => simple file serve
+        cache_key = render_inputs.render_key(ri, optimize)
+
+        # ✅ version publiée pré-rendue à la publication (tâche Celery) : fichier statique,
+        # tant que produits/polices n'ont pas changé depuis (même clé de rendu)
+        if not debug:
+            with span("published"):
+                static_path = published_render.get_published_render(ri.pub, cache_key)
+            if static_path:
+                return FileResponse(
+                    static_path,
+                    media_type="application/pdf",
+                    filename=filename,
+                    headers=timing_headers(tm, t0, "agent.download", "STATIC"),
                 )
-                anno = (await session.execute(stmt_d)).scalars().first()
-                draft = (anno.data_json if anno else {"pages": [], "_meta": {}}) or {"pages": [], "_meta": {}}
-        else:
-            stmt_d = select(MarketingDocumentAnnotation).where(
-                MarketingDocumentAnnotation.document_id == doc_id,
-                MarketingDocumentAnnotation.status == MarketingAnnotationStatus.DRAFT,
-            )
-            anno = (await session.execute(stmt_d)).scalars().first()
-            draft = (anno.data_json if anno else {"pages": [], "_meta": {}}) or {"pages": [], "_meta": {}}
-
-        # 3) produits + tiers
-        product_ids = _collect_product_ids_from_draft(draft)
-
-        products_by_id: Dict[int, Dict[str, Any]] = {}
-        tiers_by_pid: Dict[int, list] = {}
-
-        if product_ids:
-            stmt_p = (
-                select(Product)
-                .select_from(Product)
-                .join(labo_agent, labo_agent.c.labo_id == Product.labo_id)
-                .where(labo_agent.c.agent_id == agent.id)
-                .where(Product.id.in_(list(product_ids)))
-            )
-            products = (await session.execute(stmt_p)).scalars().all()
-
-            for p in products:
-                stock_val = _maybe_int(getattr(p, "stock", None))
-                products_by_id[int(p.id)] = {
-                    "id": int(p.id),
-                    "sku": p.sku,
-                    "name": p.name,
-                    "ean13": p.ean13,
-                    "price_ht": float(p.price_ht or 0),
-                    "stock": stock_val,  # ✅ None allowed
-                    "labo_id": int(p.labo_id or 0),
-                }
 
-            ok_ids = list(products_by_id.keys())
-            if ok_ids:
-                stmt_t = (
-                    select(PriceTier)
-                    .where(PriceTier.product_id.in_(ok_ids))
-                    .order_by(PriceTier.product_id.asc(), PriceTier.qty_min.asc())
+        if not debug:
+            with span("cache"):
+                cached_path = render_cache.get_cached_render(doc_id, cache_key)
+            if cached_path:
+                return FileResponse(
+                    cached_path,
+                    media_type="application/pdf",
+                    filename=filename,
+                    headers=timing_headers(tm, t0, "agent.download", "HIT"),
                 )
-                tiers = (await session.execute(stmt_t)).scalars().all()
-                for t in tiers:
-                    pid = int(t.product_id)
-                    tiers_by_pid.setdefault(pid, []).append(
-                        {"id": int(t.id), "qty_min": int(t.qty_min), "price_ht": float(t.price_ht or 0)}
-                    )
-
-        # ✅ PATCH: normalise + filtre badges rupture pour l’agent
-        draft_for_render = _filter_and_normalize_draft_for_agent(draft, products_by_id)
-
-        # 4) fonts du labo
-        fonts_dir = Path(f"/app/media/marketing_fonts/labo_{int(doc.labo_id)}")
-
-        stmt_fonts = (
-            select(MarketingFont)
-            .where(MarketingFont.labo_id == int(doc.labo_id))
-            .order_by(MarketingFont.id.asc())
-        )
-        fonts = (await session.execute(stmt_fonts)).scalars().all()
 
-        font_files = _build_font_files_from_db(list(fonts), fonts_dir)
-        labo_fonts_by_id = _build_labo_fonts_by_id(list(fonts))
-
-        # 4bis) ✅ global fonts
-        stmt_gf = (
-            select(GlobalFont)
-            .where(GlobalFont.enabled == True)
-            .order_by(GlobalFont.display_name.asc())
-        )
-        gfonts = (await session.execute(stmt_gf)).scalars().all()
-
-        global_fonts_by_family = {}
-        for gf in gfonts:
-            fam_key = (getattr(gf, "family_key", None) or "").strip()
-            fp = (getattr(gf, "file_path", None) or "").strip()
-            if not fp:
-                continue
-
-            item = {"file_path": fp}
-
-            if fam_key:
-                global_fonts_by_family[fam_key] = item
-
-            gid = int(getattr(gf, "id", 0) or 0)
-            if gid > 0:
-                global_fonts_by_family[f"GLOBAL_FONT_{gid}"] = item
-
-        ctx = RenderContext(
-            products_by_id=products_by_id,
-            tiers_by_product_id=tiers_by_pid,
-            font_files=font_files or None,
-            fonts_dir=str(fonts_dir),
-            labo_fonts_by_id=labo_fonts_by_id or None,
-            global_fonts_by_family=global_fonts_by_family or None,
-            is_agent=True,  # ✅ renderer force aussi is_agent=True, mais on le garde cohérent
-        )
+        with span("fonts_map"):
+            ctx = await render_inputs.build_render_context(ri)
 
         # ✅ DEBUG: return JSON instead of PDF
         if debug:
+            # ri.draft = manifeste seulement : le debug a besoin des objets
+            draft = await draft_store.load_draft(session, ri.anno)
+            products_by_id = ri.products_by_id
+            tiers_by_pid = ri.tiers_by_pid
+            product_ids = ri.product_ids
+            font_files = ctx.font_files
+            is_published = ri.is_published
+            published_version = ri.published_version
+            pdf_path = ri.pdf_path
+            draft_for_render = _filter_and_normalize_draft_for_agent(draft, products_by_id)
+
             def pick_font_family(o: dict) -> Optional[str]:
                 return (
                     o.get("fontFamily")
@@ -1185,24 +1039,59 @@ async def download_marketing_document_rendered_pdf(
                     "font_files_count": len(font_files or {}),
                     "stock_badges_raw": extract_stock_badges(draft),
                     "stock_badges_filtered": extract_stock_badges(draft_for_render),
+                    "render_cache_key": cache_key,
+                    "optimize": optimize,
                 }
             )
 
-        # ✅ render normal (avec draft_for_render)
-        out_bytes = render_pdf_with_overlays(input_pdf_bytes, draft_for_render, ctx)
-
-        base = _safe_filename(doc.title or doc.original_name or "document")
-        suffix = f"v{published_version}" if is_published and published_version else "preview"
-        filename = f"{base}_{suffix}.pdf"
+        # ✅ render normal (avec plan_for_render)
+        # ✅ fichier -> fichier : le worker lit le PDF source par son chemin et écrit le rendu
+        # dans un fichier temporaire ; rien ne transite en mémoire par le process API
+        # ✅ cache par page : seules les pages modifiées (objets ou produits référencés) sont rendues
+        with span("page_keys"):
+            page_keys = await asyncio.to_thread(render_inputs.page_render_keys, ri)
+        out_tmp = render_cache.new_render_tmp(doc_id, cache_key)
+        try:
+            if page_keys:
+                await render_executor.render_pdf_incremental(
+                    str(ri.pdf_path), ri.draft, ctx, ri.plan_for_render, page_keys, str(out_tmp), optimize=optimize
+                )
+            else:
+                await render_executor.render_pdf_to_file(
+                    str(ri.pdf_path), str(out_tmp), ri.draft, ctx, plan=ri.plan_for_render, optimize=optimize
+                )
+        except BaseException:
+            out_tmp.unlink(missing_ok=True)
+            raise
+
+        stored_path = render_cache.commit_render(doc_id, cache_key, out_tmp)
+        if stored_path:
+            return FileResponse(
+                stored_path,
+                media_type="application/pdf",
+                filename=filename,
+                headers=timing_headers(tm, t0, "agent.download", "MISS"),
+            )
 
-        return StreamingResponse(
-            BytesIO(out_bytes),
+        # cache inutilisable : on sert le fichier temporaire puis on le supprime
+        return FileResponse(
+            out_tmp,
             media_type="application/pdf",
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+            filename=filename,
+            headers=timing_headers(tm, t0, "agent.download", "MISS"),
+            background=BackgroundTask(out_tmp.unlink, missing_ok=True),
         )
 
     except HTTPException:
         raise
+    except RenderUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Rendu PDF indisponible: {e}",
+            headers={"Retry-After": str(e.retry_after_s)},
+        )
+    except RenderTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         if debug:
             return JSONResponse(
@@ -1213,3 +1102,83 @@ async def download_marketing_document_rendered_pdf(
                 status_code=500,
             )
         raise HTTPException(status_code=500, detail=f"Erreur génération PDF: {e}")
+
+
+# ---------------------------------------------------------
+# 7) ✅ Aperçu raster d'UNE page rendue (vue agent)
+#    - même rendu que download-rendered, limité à la page demandée
+#    - cache par (empreinte de page, taille, format)
+# ---------------------------------------------------------
+@router.get("/marketing-documents/{doc_id}/pages/{page_index}/preview")
+async def preview_marketing_document_page(
+    doc_id: int,
+    page_index: int,
+    width: Optional[int] = None,
+    dpi: Optional[int] = None,
+    fmt: str = "webp",
+    session: AsyncSession = Depends(get_async_session),
+    agent: Agent = Depends(get_current_agent),
+):
+    fmt = (fmt or "webp").strip().lower()
+    if fmt not in render_cache.PREVIEW_FORMATS:
+        raise HTTPException(status_code=400, detail="Format invalide (webp ou png)")
+
+    try:
+        doc = await session.get(MarketingDocument, doc_id)
+        if not doc:
+            raise HTTPException(status_code=404, detail="Document introuvable")
+
+        if not await _agent_can_access_labo(session, agent.id, doc.labo_id):
+            raise HTTPException(status_code=403, detail="Accès refusé")
+
+        # ✅ spans (BDD, cache, rendu worker...) => header Server-Timing + agrégats
+        tm = start_request_timings()
+        t0 = time.perf_counter()
+
+        with span("db"):
+            ri = await render_inputs.load_render_inputs(session, doc, "agent", agent_id=int(agent.id))
+
+        with span("page_keys"):
+            page_keys = await asyncio.to_thread(render_inputs.page_render_keys, ri)
+        if page_index < 0 or page_index >= len(page_keys):
+            raise HTTPException(status_code=404, detail="Page introuvable")
+
+        page_key = page_keys[page_index]
+        size_key = render_cache.preview_size_key(width, dpi)
+
+        cached = render_cache.get_cached_preview(page_key, size_key, fmt)
+        if cached:
+            return FileResponse(
+                cached,
+                media_type=render_cache.PREVIEW_FORMATS[fmt],
+                headers=timing_headers(tm, t0, "agent.preview", "HIT"),
+            )
+
+        out_path = await render_executor.render_page_preview(
+            str(ri.pdf_path),
+            ri.draft,
+            await render_inputs.build_render_context(ri),
+            ri.plan_for_render,
+            page_index,
+            page_key,
+            size_key,
+            fmt,
+        )
+        return FileResponse(
+            out_path,
+            media_type=render_cache.PREVIEW_FORMATS[fmt],
+            headers=timing_headers(tm, t0, "agent.preview", "MISS"),
+        )
+
+    except HTTPException:
+        raise
+    except RenderUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Rendu PDF indisponible: {e}",
+            headers={"Retry-After": str(e.retry_after_s)},
+        )
+    except RenderTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erreur aperçu page: {e}")
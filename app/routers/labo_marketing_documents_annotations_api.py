@@ -4,7 +4,7 @@ from __future__ import annotations
 from typing import Any, Dict, Optional
 
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel, Field
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
@@ -16,6 +16,8 @@ from app.db.models import (
     MarketingAnnotationStatus,
 )
 from app.core.security import require_role
+from app.services import marketing_render_cache as render_cache
+from app.services import marketing_draft_store as draft_store
 
 router = APIRouter(
     prefix="/api-zenhub/marketing",
@@ -43,6 +45,8 @@ class DraftUpsertPayload(BaseModel):
 @router.get("/documents/{doc_id}/draft")
 async def get_marketing_document_draft(
     doc_id: int,
+    pages: Optional[str] = Query(None, description='ex: "0-4" ou "0,3" (défaut : toutes les pages)'),
+    fields: str = Query(draft_store.FIELDS_ALL, description="all | dynamic | manifest"),
     session: AsyncSession = Depends(get_async_session),
     user=Depends(require_role("LABO")),
 ):
@@ -52,6 +56,13 @@ async def get_marketing_document_draft(
     if not doc or int(doc.labo_id) != labo_id:
         raise HTTPException(status_code=404, detail="Document introuvable")
 
+    if fields not in draft_store.DRAFT_FIELDS:
+        raise HTTPException(status_code=400, detail="fields invalide (all | dynamic | manifest)")
+    try:
+        page_indexes = draft_store.parse_pages_param(pages)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"pages invalide: {e}")
+
     stmt = select(MarketingDocumentAnnotation).where(
         MarketingDocumentAnnotation.document_id == doc_id,
         MarketingDocumentAnnotation.status == MarketingAnnotationStatus.DRAFT,
@@ -62,7 +73,14 @@ async def get_marketing_document_draft(
         # renvoie draft vide si pas encore créé
         return {"draft": {"pages": []}, "draft_version": 1}
 
-    return {"draft": anno.data_json or {}, "draft_version": int(anno.draft_version or 1)}
+    out = {
+        "draft": await draft_store.load_draft(session, anno, page_indexes, fields),
+        "draft_version": int(anno.draft_version or 1),
+    }
+    if page_indexes is not None or fields != draft_store.FIELDS_ALL:
+        out["page_count"] = draft_store.draft_page_count(anno)
+        out["page_indexes"] = draft_store.selected_page_indexes(anno, page_indexes)
+    return out
 
 
 @router.put("/documents/{doc_id}/draft")
@@ -90,18 +108,24 @@ async def upsert_marketing_document_draft(
     )
     anno = (await session.execute(stmt)).scalars().first()
 
+    data_json = payload.data_json or {}
     if not anno:
         anno = MarketingDocumentAnnotation(
             document_id=doc_id,
             status=MarketingAnnotationStatus.DRAFT,
             draft_version=1,
-            data_json=payload.data_json or {},
+            data_json={},
         )
         session.add(anno)
     else:
         # optimistic: si tu veux, tu peux vérifier payload.draft_version == anno.draft_version
-        anno.data_json = payload.data_json or {}
         anno.draft_version = int(anno.draft_version or 1) + 1
 
+    # ✅ une ligne par page (+ plan de rendu de la page), manifeste sur l'annotation
+    await draft_store.save_draft_pages(session, anno, data_json)
+
     await session.commit()
+
+    # ✅ les rendus de l'ancienne version ne seront plus jamais servis
+    render_cache.invalidate_document(doc_id)
     return {"ok": True, "draft_version": int(anno.draft_version or 1)}
@@ -2,33 +2,31 @@
 from __future__ import annotations
 
 from pathlib import Path
-import uuid
 import hashlib
-import fitz  # PyMuPDF
 
-import copy
 import re
+import shutil
+import tempfile
+import time
 import traceback
-from io import BytesIO
-from typing import Any, Dict, Optional, Set, List
+import zipfile
+from dataclasses import replace
+from typing import Any, Dict, Optional, List
+
+import asyncio
 
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.db.session import get_async_session
 from app.db.models import (
     MarketingDocument,
-    MarketingDocumentAnnotation,
-    MarketingAnnotationStatus,
-    MarketingDocumentPublication,
-    MarketingPublicationStatus,
-    Product,
-    PriceTier,
-    MarketingFont,
+    MarketingThumbsStatus,
 )
-from app.db.models import GlobalFont
 from app.core.security import require_role
 
 from app.services.storage import (
@@ -38,8 +36,17 @@ from app.services.storage import (
     delete_marketing_document,
 )
 
-# ✅ PDF renderer (vectoriel)
-from app.services.marketing_pdf_renderer import render_pdf_with_overlays, RenderContext
+from app.services import marketing_render_cache as render_cache
+from app.services import marketing_pdf_optimize as pdf_optimize
+from app.services import marketing_document_thumbs as doc_thumbs
+from app.services.marketing_render_executor import (
+    render_executor,
+    RenderUnavailable,
+    RenderTimeout,
+    RENDER_MAX_VARIANTS,
+)
+from app.services import marketing_render_inputs as render_inputs
+from app.services.marketing_render_metrics import span, start_request_timings, timing_headers
 
 router = APIRouter(
     prefix="/api-zenhub/labo/marketing-documents",
@@ -80,74 +87,40 @@ def _media_pdf_url(labo_id: int, filename: str) -> str:
 
 
 # ---------------------------------------------------------
-# Thumb generator
+# Miniatures (générées en tâche de fond, cf. celery_tasks/marketing_document_thumbs)
 # ---------------------------------------------------------
-def _make_thumb_for_pdf(pdf_path: Path, out_png_path: Path, max_width: int = 320) -> int:
-    """
-    Génère une miniature PNG (page 1) avec PyMuPDF.
-    Retourne page_count.
-    """
-    out_png_path.parent.mkdir(parents=True, exist_ok=True)
-
-    doc = fitz.open(pdf_path)
-    try:
-        page_count = int(doc.page_count or 0)
-        if page_count <= 0:
-            raise RuntimeError("PDF sans page")
-
-        page = doc.load_page(0)
-
-        pix0 = page.get_pixmap(alpha=False)
-        w0 = pix0.width
-        h0 = pix0.height
-        if w0 <= 0:
-            raise RuntimeError("Largeur pixmap invalide")
+def _thumbs_payload(d: MarketingDocument) -> Dict[str, Any]:
+    """thumbs_status + URLs des miniatures par largeur et du bandeau de pages."""
+    data = getattr(d, "thumbs_json", None) or {}
+    widths = data.get("widths") or {}
+    status = getattr(d, "thumbs_status", None)
+    return {
+        # NULL => document d'avant : seule thumb_url existe
+        "thumbs_status": status.value if status else None,
+        "thumb_urls": {w: _media_thumb_url(d.labo_id, name) for w, name in widths.items()},
+        "page_strip_urls": [_media_thumb_url(d.labo_id, name) for name in (data.get("strip") or [])],
+        "page_strip_width": data.get("strip_width"),
+        "thumbs_error": data.get("error"),
+    }
 
-        scale = min(1.0, float(max_width) / float(w0))
-        mat = fitz.Matrix(scale, scale)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-
-        print(
-            f"[marketing_documents] thumb: base={w0}x{h0} -> final={pix.width}x{pix.height} (scale={scale:.4f})"
-        )
-        pix.save(str(out_png_path))
-        return page_count
-    finally:
-        doc.close()
 
+async def _queue_thumbs(session: AsyncSession, doc: MarketingDocument) -> None:
+    doc.thumbs_status = MarketingThumbsStatus.PENDING
+    await session.commit()
+    try:
+        doc_thumbs.queue_document_thumbs(doc.id)
+    except Exception as e:
+        # broker indisponible : génération dans la requête (comme avant)
+        print("[MARKETING_THUMBS] enqueue KO, fallback inline:", e)
+        from app.celery_tasks.marketing_document_thumbs import _generate_thumbs
 
-def _sha256_file(path: Path) -> str:
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+        await _generate_thumbs(session, doc.id)
+    await session.refresh(doc)
 
 
 # ---------------------------------------------------------
 # Helpers (render LABO, aligné AGENT)
 # ---------------------------------------------------------
-def _to_int_or_none(v: Any) -> Optional[int]:
-    try:
-        if v is None or v == "":
-            return None
-        return int(v)
-    except Exception:
-        return None
-
-
-def _maybe_int(v: Any) -> Optional[int]:
-    """
-    - si stock est NULL en BDD => None (inconnu), PAS 0
-    """
-    if v is None:
-        return None
-    try:
-        return int(v)
-    except Exception:
-        return None
-
-
 def _safe_filename(name: str) -> str:
     s = (name or "document").strip().lower()
     s = re.sub(r"[^\w\-]+", "_", s, flags=re.UNICODE)
@@ -155,286 +128,6 @@ def _safe_filename(name: str) -> str:
     return s[:80] or "document"
 
 
-def _collect_product_ids_from_draft(draft: Dict[str, Any]) -> Set[int]:
-    ids: Set[int] = set()
-    for page in (draft.get("pages") or []):
-        if not isinstance(page, dict):
-            continue
-        for obj in (page.get("objects") or []):
-            if not isinstance(obj, dict):
-                continue
-
-            dyn = obj.get("dynamic") or {}
-            kind = (
-                (dyn.get("kind"))
-                or obj.get("_dyn_kind")
-                or obj.get("type")
-                or ""
-            ).strip()
-
-            # ✅ ADD product_ean
-            if kind not in ("product_price", "product_stock_badge", "product_ean"):
-                continue
-
-            pid = (
-                dyn.get("product_id")
-                or dyn.get("productId")
-                or obj.get("product_id")
-                or obj.get("productId")
-                or obj.get("_dyn_product_id")
-            )
-            try:
-                pid_int = int(pid)
-                if pid_int > 0:
-                    ids.add(pid_int)
-            except Exception:
-                continue
-    return ids
-
-
-
-def _guess_weight_from_filename(filename: str) -> int:
-    low = (filename or "").lower()
-    if "bold" in low or "-bd" in low or "_bd" in low or "700" in low:
-        return 700
-    return 400
-
-
-def _safe_family_name_from_font_id(font_id: int) -> str:
-    return f"LABO_FONT_{int(font_id)}"
-
-
-def _normalize_font_key_from_family(family: str, weight: int) -> str:
-    fam = (family or "").strip().lower()
-    fam = re.sub(r"\s+", " ", fam)
-    return f"{fam}__{int(weight)}"
-
-
-def _build_font_files_from_db(fonts: List["MarketingFont"], fonts_dir: Path) -> Dict[str, str]:
-    """
-    Mapping attendu par marketing_pdf_renderer:
-      key = "<family>__<weight>" (family normalisé)
-    On convertit woff2 -> ttf en cache local.
-    """
-    out: Dict[str, str] = {}
-
-    cache_dir = fonts_dir / "_cache_ttf"
-    cache_dir.mkdir(parents=True, exist_ok=True)
-
-    def _add_family_keys(family_name: str, weight: int, path: Path):
-        fam = (family_name or "").strip()
-        if not fam:
-            return
-
-        out[_normalize_font_key_from_family(fam, weight)] = str(path)
-        out[_normalize_font_key_from_family(fam, 0)] = str(path)
-
-        # alias classiques
-        out[_normalize_font_key_from_family(fam, 400)] = str(path)
-        out[_normalize_font_key_from_family(fam, 700)] = str(path)
-
-    def _woff2_to_ttf(woff2_path: Path, ttf_path: Path):
-        from fontTools.ttLib import TTFont  # type: ignore
-
-        ttf_path.parent.mkdir(parents=True, exist_ok=True)
-        font = TTFont(str(woff2_path))
-        font.flavor = None
-        font.save(str(ttf_path))
-
-    for f in fonts:
-        fid = int(getattr(f, "id", 0) or 0)
-        if fid <= 0:
-            continue
-
-        filename = (getattr(f, "filename", None) or "").strip()
-        if not filename:
-            continue
-
-        woff2_path = fonts_dir / filename
-        if not woff2_path.exists():
-            continue
-
-        if woff2_path.suffix.lower() != ".woff2":
-            continue
-
-        original = (getattr(f, "original_name", None) or "").strip()
-        nm = (getattr(f, "name", None) or "").strip()
-        weight = _guess_weight_from_filename(original or nm or woff2_path.name)
-
-        sha = (getattr(f, "sha256", None) or "").strip()
-        ttf_name = f"{sha}.ttf" if sha else f"{woff2_path.stem}.ttf"
-        ttf_path = cache_dir / ttf_name
-
-        if (not ttf_path.exists()) or ttf_path.stat().st_size < 1000:
-            try:
-                _woff2_to_ttf(woff2_path, ttf_path)
-            except Exception:
-                continue
-
-        # clé stable utilisée par le front: LABO_FONT_<id>
-        family_labo = _safe_family_name_from_font_id(fid)
-        _add_family_keys(family_labo, weight, ttf_path)
-
-        # alias humain (optionnel)
-        if nm:
-            _add_family_keys(nm, weight, ttf_path)
-
-    return out
-
-
-def _build_labo_fonts_by_id(fonts: List["MarketingFont"]) -> Dict[int, Dict[str, Any]]:
-    """
-    Permet au renderer de résoudre LABO_FONT_<id> => chemin fichier.
-    """
-    out: Dict[int, Dict[str, Any]] = {}
-    for f in fonts:
-        fid = int(getattr(f, "id", 0) or 0)
-        if fid <= 0:
-            continue
-        filename = (getattr(f, "filename", None) or "").strip()
-        if not filename:
-            continue
-        out[fid] = {"ttf_path": filename, "path": filename}
-    return out
-
-
-def _camel_to_snake_dyn_keys(dyn: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Normalise les clés camelCase venant du front vers snake_case attendu backend.
-    """
-    if not isinstance(dyn, dict):
-        return {}
-    d = dict(dyn)
-
-    if d.get("product_id") is None and d.get("productId") is not None:
-        d["product_id"] = d.get("productId")
-    if d.get("tier_id") is None and d.get("tierId") is not None:
-        d["tier_id"] = d.get("tierId")
-    if d.get("price_mode") is None and d.get("priceMode") is not None:
-        d["price_mode"] = d.get("priceMode")
-    if d.get("mode_agent") is None and d.get("modeAgent") is not None:
-        d["mode_agent"] = d.get("modeAgent")
-    if d.get("mode_labo") is None and d.get("modeLabo") is not None:
-        d["mode_labo"] = d.get("modeLabo")
-    return d
-
-
-def _normalize_overlay_object_for_renderer(obj: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Stabilise le format pour le renderer:
-    - obj["dynamic"] toujours présent
-    - support camelCase
-    - product_id/tier_id en int
-    """
-    o = dict(obj or {})
-    dyn = dict(o.get("dynamic") or {})
-
-    dyn = _camel_to_snake_dyn_keys(dyn)
-
-    # normalise camelCase au niveau racine (best effort)
-    if o.get("product_id") is None and o.get("productId") is not None:
-        o["product_id"] = o.get("productId")
-    if o.get("tier_id") is None and o.get("tierId") is not None:
-        o["tier_id"] = o.get("tierId")
-    if o.get("price_mode") is None and o.get("priceMode") is not None:
-        o["price_mode"] = o.get("priceMode")
-    if o.get("mode_agent") is None and o.get("modeAgent") is not None:
-        o["mode_agent"] = o.get("modeAgent")
-    if o.get("mode_labo") is None and o.get("modeLabo") is not None:
-        o["mode_labo"] = o.get("modeLabo")
-
-    kind = dyn.get("kind") or o.get("_dyn_kind") or o.get("type")
-    if kind:
-        dyn["kind"] = kind
-
-    for k in ("product_id", "price_mode", "tier_id", "mode_agent", "mode_labo", "text"):
-        if dyn.get(k) is None and o.get(k) is not None:
-            dyn[k] = o.get(k)
-
-    if dyn.get("product_id") is not None:
-        dyn["product_id"] = _to_int_or_none(dyn.get("product_id"))
-    if dyn.get("tier_id") is not None:
-        dyn["tier_id"] = _to_int_or_none(dyn.get("tier_id"))
-
-    o["dynamic"] = dyn
-    return o
-
-
-def _normalize_draft_for_labo(draft: Dict[str, Any]) -> Dict[str, Any]:
-    d = copy.deepcopy(draft or {"pages": [], "_meta": {}})
-    for page in (d.get("pages") or []):
-        if not isinstance(page, dict):
-            continue
-        objs = page.get("objects") or []
-        new_objs = []
-        for obj in objs:
-            if not isinstance(obj, dict):
-                continue
-            new_objs.append(_normalize_overlay_object_for_renderer(obj))
-        page["objects"] = new_objs
-    return d
-    
-    
-def _filter_and_normalize_draft_for_labo(
-    draft: Dict[str, Any],
-    products_by_id: Dict[int, Dict[str, Any]],
-) -> Dict[str, Any]:
-    """
-    Labo: on garde les overlays, MAIS on filtre les badges de stock quand ils sont
-    configurés pour n'apparaître que si stock==0 (aligné agent).
-
-    Règle:
-      - mode = mode_labo si présent, sinon mode_agent, sinon "only_if_zero"
-      - si mode in ("only_if_zero", "labo_only_if_zero", "agent_only_if_zero"):
-            - stock None => on n'affiche pas (évite faux positifs)
-            - stock > 0 => on n'affiche pas
-    """
-    d = copy.deepcopy(draft or {"pages": [], "_meta": {}})
-    for page in (d.get("pages") or []):
-        if not isinstance(page, dict):
-            continue
-
-        new_objs = []
-        for obj in (page.get("objects") or []):
-            if not isinstance(obj, dict):
-                continue
-
-            o = _normalize_overlay_object_for_renderer(obj)
-            dyn = o.get("dynamic") or {}
-            kind = (dyn.get("kind") or o.get("type") or "").strip()
-
-            if kind == "product_stock_badge":
-                pid = _to_int_or_none(dyn.get("product_id"))
-
-                mode_labo = (dyn.get("mode_labo") or "").strip().lower()
-                mode_agent = (dyn.get("mode_agent") or "").strip().lower()
-                mode = mode_labo or mode_agent or "only_if_zero"
-
-                if mode in ("only_if_zero", "labo_only_if_zero", "agent_only_if_zero"):
-                    stock = None
-                    if pid and pid in products_by_id:
-                        stock = products_by_id[pid].get("stock", None)
-
-                    # stock inconnu => on masque (évite "rupture" à tort)
-                    if stock is None:
-                        continue
-
-                    try:
-                        if int(stock) > 0:
-                            continue
-                    except Exception:
-                        continue
-
-                new_objs.append(o)
-                continue
-
-            new_objs.append(o)
-
-        page["objects"] = new_objs
-    return d
-    
-
-
 # ---------------------------------------------------------
 # 1) LIST
 #   ✅ renvoie thumb_url + pdf_url (comme agent)
@@ -476,6 +169,7 @@ async def list_marketing_documents(
                 "source_sha256": getattr(d, "source_sha256", None),
                 "thumb_url": thumb_url,
                 "pdf_url": pdf_url,
+                **_thumbs_payload(d),
             }
         )
 
@@ -527,33 +221,14 @@ async def upload_marketing_document(
         title=title.strip(),
         comment=(comment or "").strip() or None,
         doc_type=(doc_type or "").strip() or None,
+        source_sha256=hashlib.sha256(content).hexdigest(),
     )
     session.add(doc)
     await session.commit()
     await session.refresh(doc)
 
-    try:
-        pdf_path = get_marketing_document_path(labo_id, stored_filename)
-
-        thumb_filename = f"thumb_{uuid.uuid4().hex}.png"
-        thumb_path = pdf_path.parent / thumb_filename
-
-        page_count = _make_thumb_for_pdf(pdf_path, thumb_path, max_width=320)
-        sha256 = _sha256_file(pdf_path)
-
-        if hasattr(doc, "thumb_filename"):
-            doc.thumb_filename = thumb_filename
-        if hasattr(doc, "page_count"):
-            doc.page_count = page_count
-        if hasattr(doc, "source_sha256"):
-            doc.source_sha256 = sha256
-
-        session.add(doc)
-        await session.commit()
-        await session.refresh(doc)
-
-    except Exception as e:
-        print(f"[marketing_documents] thumbnail/meta failed: {repr(e)}")
+    # ✅ upload rendu tout de suite : miniatures + bandeau de pages en tâche de fond
+    await _queue_thumbs(session, doc)
 
     return {
         "ok": True,
@@ -563,6 +238,7 @@ async def upload_marketing_document(
         "source_sha256": getattr(doc, "source_sha256", None),
         "pdf_url": _media_pdf_url(labo_id, doc.filename),
         "thumb_url": _media_thumb_url(labo_id, doc.thumb_filename) if getattr(doc, "thumb_filename", None) else None,
+        **_thumbs_payload(doc),
     }
 
 
@@ -607,6 +283,49 @@ async def download_marketing_document_labo(
     return FileResponse(path, media_type="application/pdf", filename=doc.original_name)
 
 
+# ---------------------------------------------------------
+# 4b) THUMBS (statut / régénération)
+# ---------------------------------------------------------
+@router.get("/{doc_id}/thumbs")
+async def get_marketing_document_thumbs_labo(
+    doc_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    labo_id = _get_labo_id(user)
+
+    doc = await session.get(MarketingDocument, doc_id)
+    if not doc or doc.labo_id != labo_id:
+        raise HTTPException(status_code=404, detail="Document introuvable")
+
+    return {
+        "id": doc.id,
+        "page_count": doc.page_count,
+        "thumb_url": _media_thumb_url(doc.labo_id, doc.thumb_filename) if doc.thumb_filename else None,
+        **_thumbs_payload(doc),
+    }
+
+
+@router.post("/{doc_id}/thumbs")
+async def regenerate_marketing_document_thumbs_labo(
+    doc_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    """
+    Régénère miniatures + bandeau (documents d'avant, échec, nouvelles largeurs).
+    Pas de refus si PENDING : un worker tombé ne doit pas bloquer le document.
+    """
+    labo_id = _get_labo_id(user)
+
+    doc = await session.get(MarketingDocument, doc_id)
+    if not doc or doc.labo_id != labo_id:
+        raise HTTPException(status_code=404, detail="Document introuvable")
+
+    await _queue_thumbs(session, doc)
+    return {"ok": True, "id": doc.id, **_thumbs_payload(doc)}
+
+
 # ---------------------------------------------------------
 # 5) DELETE
 # ---------------------------------------------------------
@@ -622,19 +341,15 @@ async def delete_marketing_document_labo(
     if not doc or doc.labo_id != labo_id:
         raise HTTPException(status_code=404, detail="Document introuvable")
 
-    # delete thumb (best effort)
-    try:
-        thumb = getattr(doc, "thumb_filename", None)
-        if thumb:
-            pdf_path = get_marketing_document_path(doc.labo_id, doc.filename)
-            thumb_path = pdf_path.parent / thumb
-            if thumb_path.exists():
-                thumb_path.unlink()
-    except Exception:
-        pass
+    # delete thumbs + bandeau de pages (best effort)
+    pdf_path = get_marketing_document_path(doc.labo_id, doc.filename)
+    doc_thumbs.delete_thumb_files(
+        pdf_path.parent, doc_thumbs.thumb_files(doc.thumbs_json, doc.thumb_filename)
+    )
 
     # delete pdf (best effort)
     delete_marketing_document(doc.labo_id, doc.filename)
+    render_cache.invalidate_document(doc.id)
 
     await session.delete(doc)
     await session.commit()
@@ -646,191 +361,321 @@ async def delete_marketing_document_labo(
 #    - base = PDF publié READY si dispo, sinon PDF source
 #    - overlays = draft DRAFT (édition)
 #    - typos LABO + GLOBAL embarquées
-#    - dyn (prix/rupture) résolus via RenderContext (is_agent=False)
+#    - dyn (prix/rupture) résolus via RenderContext (rendu agent, comme la publication)
 #    - DEBUG: ?debug=1 retourne JSON au lieu du PDF
 # ---------------------------------------------------------
 @router.get("/{doc_id}/download-rendered")
 async def download_marketing_document_rendered_labo(
     doc_id: int,
     debug: int = 0,
+    profile: Optional[str] = None,
     session: AsyncSession = Depends(get_async_session),
     user=Depends(require_role("LABO")),
 ):
+    """?profile=screen|print|none : profil de taille du PDF (défaut MARKETING_PDF_OPTIMIZE_DEFAULT)."""
     try:
         labo_id = _get_labo_id(user)
 
+        try:
+            optimize = pdf_optimize.profile_name(profile or pdf_optimize.PDF_OPTIMIZE_DEFAULT)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
         doc = await session.get(MarketingDocument, doc_id)
         if not doc or int(doc.labo_id) != int(labo_id):
             raise HTTPException(status_code=404, detail="Document introuvable")
 
-        # 1) base PDF : publié READY si dispo sinon source
-        stmt_pub = (
-            select(MarketingDocumentPublication)
-            .where(
-                MarketingDocumentPublication.document_id == doc_id,
-                MarketingDocumentPublication.status == MarketingPublicationStatus.READY,
-                MarketingDocumentPublication.published_pdf_filename.isnot(None),
-            )
-            .order_by(MarketingDocumentPublication.version.desc())
-            .limit(1)
-        )
-        pub = (await session.execute(stmt_pub)).scalars().first()
+        # ✅ spans (BDD, cache, rendu worker...) => header Server-Timing + agrégats
+        tm = start_request_timings()
+        t0 = time.perf_counter()
 
-        is_published = False
-        published_version: Optional[int] = None
+        with span("db"):
+            ri = await render_inputs.load_render_inputs(session, doc, "labo")
 
-        if pub and pub.published_pdf_filename:
-            pdf_path = MEDIA_DIR / f"labo_{doc.labo_id}" / str(pub.published_pdf_filename)
-            is_published = True
-            published_version = int(pub.version or 0)
-        else:
-            pdf_path = get_marketing_document_path(doc.labo_id, doc.filename)
+        base = _safe_filename(doc.title or doc.original_name or "document")
+        suffix = f"v{ri.published_version}" if ri.is_published and ri.published_version else "preview"
+        filename = f"{base}_{suffix}_labo.pdf"
 
-        if not pdf_path.exists():
-            raise HTTPException(status_code=500, detail=f"PDF introuvable: {pdf_path}")
+        # ✅ cache du rendu : même base + même draft + mêmes données produit => simple file serve
+        cache_key = render_inputs.render_key(ri, optimize)
+
+        if not debug:
+            with span("cache"):
+                cached_path = render_cache.get_cached_render(doc_id, cache_key)
+            if cached_path:
+                return FileResponse(
+                    cached_path,
+                    media_type="application/pdf",
+                    filename=filename,
+                    headers=timing_headers(tm, t0, "labo.download", "HIT"),
+                )
 
-        input_pdf_bytes = pdf_path.read_bytes()
+        with span("fonts_map"):
+            ctx = await render_inputs.build_render_context(ri)
 
-        # 2) draft (DRAFT)
-        stmt_d = (
-            select(MarketingDocumentAnnotation)
-            .where(
-                MarketingDocumentAnnotation.document_id == doc_id,
-                MarketingDocumentAnnotation.status == MarketingAnnotationStatus.DRAFT,
+        if debug:
+            return JSONResponse(
+                {
+                    "doc_id": doc_id,
+                    "labo_id": int(labo_id),
+                    "pdf_path": str(ri.pdf_path),
+                    "is_published": bool(ri.is_published),
+                    "published_version": ri.published_version,
+                    "product_ids_in_draft": ri.product_ids,
+                    "products_count": len(ri.products_by_id),
+                    "tiers_count": sum(len(v) for v in ri.tiers_by_pid.values()),
+                    "font_files_count": len(ctx.font_files or {}),
+                    "fonts_dir": str(ri.fonts_dir),
+                    "render_cache_key": cache_key,
+                    "optimize": optimize,
+                }
             )
-            .limit(1)
-        )
-        anno = (await session.execute(stmt_d)).scalars().first()
-        draft: Dict[str, Any] = (anno.data_json if anno else {"pages": [], "_meta": {}}) or {"pages": [], "_meta": {}}
 
-        draft_norm = _normalize_draft_for_labo(draft)
-
-# 3) produits + tiers (LABO)
-        product_ids = _collect_product_ids_from_draft(draft_norm)
+        # 5) render
+        # ✅ fichier -> fichier : le worker lit le PDF source par son chemin et écrit le rendu
+        # dans un fichier temporaire ; rien ne transite en mémoire par le process API
+        # ✅ cache par page : seules les pages modifiées (objets ou produits référencés) sont rendues
+        with span("page_keys"):
+            page_keys = await asyncio.to_thread(render_inputs.page_render_keys, ri)
+        out_tmp = render_cache.new_render_tmp(doc_id, cache_key)
+        try:
+            if page_keys:
+                await render_executor.render_pdf_incremental(
+                    str(ri.pdf_path), ri.draft, ctx, ri.plan_for_render, page_keys, str(out_tmp), optimize=optimize
+                )
+            else:
+                await render_executor.render_pdf_to_file(
+                    str(ri.pdf_path), str(out_tmp), ri.draft, ctx, plan=ri.plan_for_render, optimize=optimize
+                )
+        except BaseException:
+            out_tmp.unlink(missing_ok=True)
+            raise
+
+        stored_path = render_cache.commit_render(doc_id, cache_key, out_tmp)
+        if stored_path:
+            return FileResponse(
+                stored_path,
+                media_type="application/pdf",
+                filename=filename,
+                headers=timing_headers(tm, t0, "labo.download", "MISS"),
+            )
 
-        products_by_id: Dict[int, Dict[str, Any]] = {}
-        tiers_by_pid: Dict[int, list] = {}
+        # cache inutilisable : on sert le fichier temporaire puis on le supprime
+        return FileResponse(
+            out_tmp,
+            media_type="application/pdf",
+            filename=filename,
+            headers=timing_headers(tm, t0, "labo.download", "MISS"),
+            background=BackgroundTask(out_tmp.unlink, missing_ok=True),
+        )
 
-        if product_ids:
-            stmt_p = (
-                select(Product)
-                .where(Product.labo_id == int(labo_id))
-                .where(Product.id.in_(list(product_ids)))
+    except HTTPException:
+        raise
+    except RenderUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Rendu PDF indisponible: {e}",
+            headers={"Retry-After": str(e.retry_after_s)},
+        )
+    except RenderTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        if debug:
+            return JSONResponse(
+                {"error": str(e), "traceback": traceback.format_exc()},
+                status_code=500,
             )
-            products = (await session.execute(stmt_p)).scalars().all()
-
-            for p in products:
-                products_by_id[int(p.id)] = {
-                    "id": int(p.id),
-                    "sku": p.sku,
-                    "name": p.name,
-                    "ean13": p.ean13,
-                    "price_ht": float(p.price_ht or 0),
-                    "stock": _maybe_int(getattr(p, "stock", None)),
-                    "labo_id": int(p.labo_id or 0),
-                }
+        raise HTTPException(status_code=500, detail=f"Erreur génération PDF: {e}")
 
-            ok_ids = list(products_by_id.keys())
-            if ok_ids:
-                stmt_t = (
-                    select(PriceTier)
-                    .where(PriceTier.product_id.in_(ok_ids))
-                    .order_by(PriceTier.product_id.asc(), PriceTier.qty_min.asc())
-                )
-                tiers = (await session.execute(stmt_t)).scalars().all()
-                for t in tiers:
-                    pid = int(t.product_id)
-                    tiers_by_pid.setdefault(pid, []).append(
-                        {"id": int(t.id), "qty_min": int(t.qty_min), "price_ht": float(t.price_ht or 0)}
-                    )
 
-        # ✅ filtre rupture aligné agent (stock>0 => masque)
-        draft_for_render = _filter_and_normalize_draft_for_labo(draft_norm, products_by_id)
+# ---------------------------------------------------------
+# 7) ✅ Aperçu raster d'UNE page rendue (éditeur)
+#    - même rendu que download-rendered, limité à la page demandée
+#    - cache par (empreinte de page, taille, format)
+# ---------------------------------------------------------
+@router.get("/{doc_id}/pages/{page_index}/preview")
+async def preview_marketing_document_page_labo(
+    doc_id: int,
+    page_index: int,
+    width: Optional[int] = None,
+    dpi: Optional[int] = None,
+    fmt: str = "webp",
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    fmt = (fmt or "webp").strip().lower()
+    if fmt not in render_cache.PREVIEW_FORMATS:
+        raise HTTPException(status_code=400, detail="Format invalide (webp ou png)")
 
+    try:
+        labo_id = _get_labo_id(user)
 
+        doc = await session.get(MarketingDocument, doc_id)
+        if not doc or int(doc.labo_id) != int(labo_id):
+            raise HTTPException(status_code=404, detail="Document introuvable")
 
+        # ✅ spans (BDD, cache, rendu worker...) => header Server-Timing + agrégats
+        tm = start_request_timings()
+        t0 = time.perf_counter()
 
+        with span("db"):
+            ri = await render_inputs.load_render_inputs(session, doc, "labo")
 
-        # 4) fonts LABO
-        fonts_dir = Path(f"/app/media/marketing_fonts/labo_{int(doc.labo_id)}")
+        with span("page_keys"):
+            page_keys = await asyncio.to_thread(render_inputs.page_render_keys, ri)
+        if page_index < 0 or page_index >= len(page_keys):
+            raise HTTPException(status_code=404, detail="Page introuvable")
 
-        stmt_fonts = (
-            select(MarketingFont)
-            .where(MarketingFont.labo_id == int(doc.labo_id))
-            .order_by(MarketingFont.id.asc())
-        )
-        fonts = (await session.execute(stmt_fonts)).scalars().all()
+        page_key = page_keys[page_index]
+        size_key = render_cache.preview_size_key(width, dpi)
 
-        font_files = _build_font_files_from_db(list(fonts), fonts_dir)
-        labo_fonts_by_id = _build_labo_fonts_by_id(list(fonts))
+        cached = render_cache.get_cached_preview(page_key, size_key, fmt)
+        if cached:
+            return FileResponse(
+                cached,
+                media_type=render_cache.PREVIEW_FORMATS[fmt],
+                headers=timing_headers(tm, t0, "labo.preview", "HIT"),
+            )
 
-        # 4bis) global fonts
-        stmt_gf = (
-            select(GlobalFont)
-            .where(GlobalFont.enabled == True)
-            .order_by(GlobalFont.display_name.asc())
+        out_path = await render_executor.render_page_preview(
+            str(ri.pdf_path),
+            ri.draft,
+            await render_inputs.build_render_context(ri),
+            ri.plan_for_render,
+            page_index,
+            page_key,
+            size_key,
+            fmt,
         )
-        gfonts = (await session.execute(stmt_gf)).scalars().all()
-
-        global_fonts_by_family: Dict[str, Dict[str, Any]] = {}
-        for gf in gfonts:
-            fam_key = (getattr(gf, "family_key", None) or "").strip()
-            fp = (getattr(gf, "file_path", None) or "").strip()
-            if not fp:
-                continue
-            item = {"file_path": fp}
-            if fam_key:
-                global_fonts_by_family[fam_key] = item
-            gid = int(getattr(gf, "id", 0) or 0)
-            if gid > 0:
-                global_fonts_by_family[f"GLOBAL_FONT_{gid}"] = item
-
-        ctx = RenderContext(
-            products_by_id=products_by_id,
-            tiers_by_product_id=tiers_by_pid,
-            font_files=font_files or None,
-            fonts_dir=str(fonts_dir),
-            labo_fonts_by_id=labo_fonts_by_id or None,
-            global_fonts_by_family=global_fonts_by_family or None,
-            is_agent=False,  # ✅ LABO
+        return FileResponse(
+            out_path,
+            media_type=render_cache.PREVIEW_FORMATS[fmt],
+            headers=timing_headers(tm, t0, "labo.preview", "MISS"),
         )
-        ctx.is_agent = False
 
-        if debug:
-            return JSONResponse(
-                {
-                    "doc_id": doc_id,
-                    "labo_id": int(labo_id),
-                    "pdf_path": str(pdf_path),
-                    "is_published": bool(is_published),
-                    "published_version": published_version,
-                    "product_ids_in_draft": sorted(list(product_ids)),
-                    "products_count": len(products_by_id),
-                    "tiers_count": sum(len(v) for v in tiers_by_pid.values()),
-                    "font_files_count": len(font_files or {}),
-                    "fonts_dir": str(fonts_dir),
-                }
-            )
+    except HTTPException:
+        raise
+    except RenderUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Rendu PDF indisponible: {e}",
+            headers={"Retry-After": str(e.retry_after_s)},
+        )
+    except RenderTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erreur aperçu page: {e}")
 
-        # 5) render
-        out_bytes = render_pdf_with_overlays(input_pdf_bytes, draft_for_render, ctx)
+
+# ---------------------------------------------------------
+# 8) ✅ Rendu par lot : variantes prix d'un même document (ZIP)
+#    - base PDF, images, rasters, objets communs rendus une seule fois
+#    - seuls les objets dynamiques (prix / rupture / EAN) sont rendus par variante
+# ---------------------------------------------------------
+class RenderVariantIn(BaseModel):
+    label: str = Field(min_length=1, max_length=80)
+    price_mode: Optional[str] = Field(default=None, pattern="^(base|tier)$")
+    tier_qty_min: Optional[int] = Field(default=None, ge=0)
+    stock_badge_mode: Optional[str] = Field(default=None, pattern="^(always|never|only_if_zero)$")
+
+
+class RenderVariantsIn(BaseModel):
+    variants: List[RenderVariantIn] = Field(min_length=1)
+    # profil de taille (marketing_pdf_optimize) ; None => MARKETING_PDF_OPTIMIZE_DEFAULT
+    profile: Optional[str] = Field(default=None, pattern="^(screen|print|none)$")
+
+
+def _zip_files(paths: List[Path], names: List[str], zip_path: Path) -> None:
+    # PDF déjà compressés : ZIP_STORED
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for path, name in zip(paths, names):
+            zf.write(path, arcname=name)
+
+
+@router.post("/{doc_id}/render-variants")
+async def render_marketing_document_variants_labo(
+    doc_id: int,
+    payload: RenderVariantsIn,
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    if len(payload.variants) > RENDER_MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Trop de variantes (max {RENDER_MAX_VARIANTS})")
+
+    labo_id = _get_labo_id(user)
+
+    doc = await session.get(MarketingDocument, doc_id)
+    if not doc or int(doc.labo_id) != int(labo_id):
+        raise HTTPException(status_code=404, detail="Document introuvable")
+
+    tm = start_request_timings()
+    t0 = time.perf_counter()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="zenhub_variants_"))
+    served = False
+    try:
+        with span("db"):
+            ri = await render_inputs.load_render_inputs(session, doc, "labo")
+
+        with span("fonts_map"):
+            base_ctx = await render_inputs.build_render_context(ri)
+
+        ctxs = [
+            replace(
+                base_ctx,
+                price_mode=v.price_mode,
+                tier_qty_min=v.tier_qty_min,
+                stock_badge_mode=v.stock_badge_mode,
+            )
+            for v in payload.variants
+        ]
 
         base = _safe_filename(doc.title or doc.original_name or "document")
-        suffix = f"v{published_version}" if is_published and published_version else "preview"
-        filename = f"{base}_{suffix}_labo.pdf"
+        names: List[str] = []
+        for i, v in enumerate(payload.variants):
+            name = f"{base}_{_safe_filename(v.label)}.pdf"
+            names.append(name if name not in names else f"{base}_{_safe_filename(v.label)}_{i + 1}.pdf")
+
+        out_paths = [work_dir / f"variant_{i}.pdf" for i in range(len(ctxs))]
+        # ✅ plan NON filtré : plan_for_render a déjà retiré les badges "only_if_zero" des
+        # produits en stock, une variante stock_badge_mode="always" ne pourrait plus les
+        # afficher ; le renderer décide par variante (ctx.stock_badge_mode, sinon mode_agent du badge)
+        await render_executor.render_pdf_variants(
+            str(ri.pdf_path),
+            ri.draft,
+            ctxs,
+            ri.plan,
+            [str(p) for p in out_paths],
+            optimize=payload.profile or pdf_optimize.PDF_OPTIMIZE_DEFAULT,
+        )
 
-        return StreamingResponse(
-            BytesIO(out_bytes),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        zip_path = work_dir / f"{base}_variantes.zip"
+        with span("zip"):
+            await asyncio.to_thread(_zip_files, out_paths, names, zip_path)
+
+        # le dossier de travail est supprimé une fois le ZIP envoyé
+        response = FileResponse(
+            zip_path,
+            media_type="application/zip",
+            filename=zip_path.name,
+            headers=timing_headers(tm, t0, "labo.variants", "MISS"),
+            background=BackgroundTask(shutil.rmtree, work_dir, ignore_errors=True),
         )
+        served = True
+        return response
 
     except HTTPException:
         raise
+    except RenderUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Rendu PDF indisponible: {e}",
+            headers={"Retry-After": str(e.retry_after_s)},
+        )
+    except RenderTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        if debug:
-            return JSONResponse(
-                {"error": str(e), "traceback": traceback.format_exc()},
-                status_code=500,
-            )
-        raise HTTPException(status_code=500, detail=f"Erreur génération PDF: {e}")
+        raise HTTPException(status_code=500, detail=f"Erreur rendu variantes: {e}")
+    finally:
+        if not served:
+            shutil.rmtree(work_dir, ignore_errors=True)
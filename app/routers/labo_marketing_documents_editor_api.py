@@ -1,10 +1,12 @@
 # app/routers/labo_marketing_documents_editor_api.py
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Any, Dict, List, Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel, Field
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
 
 from app.db.session import get_async_session
 from app.db.models import (
@@ -13,6 +15,13 @@ from app.db.models import (
     MarketingAnnotationStatus,
 )
 from app.core.security import require_role
+from app.services import marketing_render_cache as render_cache
+from app.services import marketing_draft_store as draft_store
+from app.services.marketing_draft_patch import (
+    DRAFT_PATCH_MAX_OPS,
+    DraftPatchError,
+    apply_draft_ops,
+)
 
 router = APIRouter(
     prefix="/api-zenhub/labo/marketing-documents",
@@ -36,6 +45,9 @@ class DraftOut(BaseModel):
     document_id: int
     draft_version: int
     data_json: dict
+    # ✅ chargement partiel (?pages= / ?fields=) : nb total de pages + index des pages renvoyées
+    page_count: Optional[int] = None
+    page_indexes: Optional[List[int]] = None
 
 
 class DraftSaveIn(BaseModel):
@@ -43,6 +55,27 @@ class DraftSaveIn(BaseModel):
     data_json: dict = Field(default_factory=dict)
 
 
+class DraftOpIn(BaseModel):
+    op: Literal["add", "update", "delete", "meta"]
+    page: Optional[int] = Field(None, ge=0)
+    id: Optional[str] = None
+    object: Optional[Dict[str, Any]] = None
+    index: Optional[int] = Field(None, ge=0)   # add : position dans page.objects (défaut : fin)
+    merge: bool = False                        # update : fusion avec l'objet existant
+    data: Optional[Dict[str, Any]] = None      # meta : clés racine du draft (None => suppression)
+
+
+class DraftPatchIn(BaseModel):
+    draft_version: int = Field(..., ge=1)
+    ops: List[DraftOpIn] = Field(default_factory=list, max_length=DRAFT_PATCH_MAX_OPS)
+
+
+class DraftPatchOut(BaseModel):
+    document_id: int
+    draft_version: int
+    pages: List[int]
+
+
 # -------------------------
 # Helpers
 # -------------------------
@@ -91,18 +124,31 @@ def _get_user_id(user) -> int | None:
 @router.get("/{doc_id}/draft", response_model=DraftOut)
 async def get_draft(
     doc_id: int,
+    pages: Optional[str] = Query(None, description='ex: "0-4" ou "0,3" (défaut : toutes les pages)'),
+    fields: str = Query(draft_store.FIELDS_ALL, description="all | dynamic | manifest"),
     session: AsyncSession = Depends(get_async_session),
     user=Depends(require_role("LABO")),
 ):
     labo_id = _get_labo_id(user)
     await _get_doc_owned_by_labo(session, labo_id, doc_id)
 
+    if fields not in draft_store.DRAFT_FIELDS:
+        raise HTTPException(status_code=400, detail="fields invalide (all | dynamic | manifest)")
+    try:
+        page_indexes = draft_store.parse_pages_param(pages)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"pages invalide: {e}")
+
     draft = await _get_or_create_draft(session, doc_id, _get_user_id(user))
+    data_json = await draft_store.load_draft(session, draft, page_indexes, fields)
 
+    partial = page_indexes is not None or fields != draft_store.FIELDS_ALL
     return DraftOut(
         document_id=doc_id,
         draft_version=int(draft.draft_version or 1),
-        data_json=draft.data_json or {},
+        data_json=data_json,
+        page_count=draft_store.draft_page_count(draft) if partial else None,
+        page_indexes=draft_store.selected_page_indexes(draft, page_indexes) if partial else None,
     )
 
 
@@ -128,7 +174,9 @@ async def save_draft(
             detail=f"Conflit de version (current={current_version}, payload={payload.draft_version})",
         )
 
-    draft.data_json = payload.data_json or {}
+    data_json = payload.data_json or {}
+    # ✅ une ligne par page (+ plan de rendu de la page), manifeste sur l'annotation
+    await draft_store.save_draft_pages(session, draft, data_json)
     draft.draft_version = current_version + 1
     draft.updated_by_user_id = _get_user_id(user)
 
@@ -136,8 +184,84 @@ async def save_draft(
     await session.commit()
     await session.refresh(draft)
 
+    # ✅ les rendus de l'ancienne version ne seront plus jamais servis
+    render_cache.invalidate_document(doc_id)
+
     return DraftOut(
         document_id=doc_id,
         draft_version=int(draft.draft_version or 1),
-        data_json=draft.data_json or {},
+        data_json=data_json,
+    )
+
+
+# -------------------------
+# PATCH draft (autosave objet par objet)
+# -------------------------
+@router.patch("/{doc_id}/draft", response_model=DraftPatchOut)
+async def patch_draft(
+    doc_id: int,
+    payload: DraftPatchIn,
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    """
+    Autosave incrémental : l'éditeur n'envoie que les objets ajoutés / modifiés /
+    supprimés, appliqués ici sur les seules pages concernées (lues, recompilées et
+    réécrites seules). Concurrence optimiste : UPDATE
+    conditionné par draft_version (pas de FOR UPDATE), 409 si le draft a bougé.
+    Réponse sans data_json : le client a déjà l'état à jour.
+    """
+    labo_id = _get_labo_id(user)
+    await _get_doc_owned_by_labo(session, labo_id, doc_id)
+
+    draft = await _get_or_create_draft(session, doc_id, _get_user_id(user))
+
+    current_version = int(draft.draft_version or 1)
+    if int(payload.draft_version) != current_version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Conflit de version (current={current_version}, payload={payload.draft_version})",
+        )
+
+    if not payload.ops:
+        return DraftPatchOut(document_id=doc_id, draft_version=current_version, pages=[])
+
+    ops = [op.model_dump(exclude_none=True) for op in payload.ops]
+    # ✅ seules les pages visées sont lues
+    op_pages = {int(op["page"]) for op in ops if op.get("op") != "meta" and op.get("page") is not None}
+    current = await draft_store.load_draft_for_patch(session, draft, op_pages)
+
+    try:
+        data_json, pages = apply_draft_ops(current, ops)
+    except DraftPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    new_version = current_version + 1
+
+    res = await session.execute(
+        update(MarketingDocumentAnnotation)
+        .where(
+            MarketingDocumentAnnotation.id == draft.id,
+            MarketingDocumentAnnotation.draft_version == current_version,
+        )
+        .values(
+            draft_version=new_version,
+            updated_by_user_id=_get_user_id(user),
+        )
+        .returning(MarketingDocumentAnnotation.id)
+        .execution_options(synchronize_session=False)
     )
+    if res.scalar() is None:
+        # un autre autosave est passé entre la lecture et l'écriture
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Conflit de version (draft modifié entre-temps)")
+
+    # pages touchées (recompilées avec leur plan) + manifeste, dans la même transaction
+    # que le changement de version : le plan des autres pages reste dans leur ligne
+    await draft_store.save_draft_pages(session, draft, data_json, pages)
+    await session.commit()
+
+    # ✅ les rendus de l'ancienne version ne seront plus jamais servis
+    render_cache.invalidate_document(doc_id)
+
+    return DraftPatchOut(document_id=doc_id, draft_version=new_version, pages=pages)
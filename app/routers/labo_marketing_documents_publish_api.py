@@ -1,6 +1,8 @@
 # app/routers/labo_marketing_documents_publish_api.py
 from __future__ import annotations
 
+import hashlib
+import logging
 import uuid
 from pathlib import Path
 
@@ -18,6 +20,9 @@ from app.db.models import (
     MarketingPublicationStatus,
 )
 from app.core.security import require_role
+from app.services import marketing_render_cache as render_cache
+from app.services import marketing_published_render as published_render
+from app.services import marketing_draft_store as draft_store
 
 router = APIRouter(
     prefix="/api-zenhub/marketing/documents",
@@ -26,6 +31,8 @@ router = APIRouter(
 
 MEDIA_DIR = Path("/app/media/marketing_documents")
 
+logger = logging.getLogger(__name__)
+
 
 def _get_user_id(user) -> int | None:
     if isinstance(user, dict):
@@ -69,12 +76,27 @@ async def _next_publication_version(session: AsyncSession, doc_id: int) -> int:
     return int(current_max) + 1
 
 
+async def _previous_page_hashes(session: AsyncSession, doc_id: int) -> list:
+    stmt = (
+        select(MarketingDocumentPublication)
+        .where(MarketingDocumentPublication.document_id == doc_id)
+        .order_by(MarketingDocumentPublication.version.desc())
+        .limit(1)
+    )
+    prev = (await session.execute(stmt)).scalars().first()
+    opts = (prev.render_options_json if prev else None) or {}
+    hashes = opts.get("page_hashes") if isinstance(opts, dict) else None
+    return hashes if isinstance(hashes, list) else []
+
+
 async def _upsert_locked_annotation(
     session: AsyncSession,
     *,
     doc_id: int,
     draft_version: int,
     data_json: dict,
+    page_count: int | None,
+    render_plan_json: dict | None,
     user_id: int | None,
 ) -> int:
     """
@@ -90,6 +112,8 @@ async def _upsert_locked_annotation(
             status=MarketingAnnotationStatus.LOCKED,
             draft_version=draft_version,
             data_json=data_json,
+            page_count=page_count,
+            render_plan_json=render_plan_json,
             created_by_user_id=user_id,
             updated_by_user_id=user_id,
         )
@@ -98,6 +122,8 @@ async def _upsert_locked_annotation(
             set_={
                 "draft_version": draft_version,
                 "data_json": data_json,
+                "page_count": page_count,
+                "render_plan_json": render_plan_json,
                 "updated_by_user_id": user_id,
                 # updated_at est géré par onupdate=func.now() sur le modèle
             },
@@ -119,8 +145,11 @@ async def publish_marketing_document(
     Publish:
     - récupère le DRAFT
     - UPSERT snapshot LOCKED (un seul par document)
-    - crée une publication (PENDING/RENDERING)
-    - MVP: copie le PDF source en published/ puis READY
+    - crée une publication PENDING (base = copie du PDF source en published/)
+    - enqueue le pré-rendu (Celery) : PDF final + miniatures + nb pages, puis READY
+    ⚠️ pas d'isolation par version : la publication READY précédente pointe sur le même
+    snapshot LOCKED (réécrit ici) => en attendant, les agents voient déjà les nouveaux
+    overlays sur l'ancienne version, rendus à la demande (le pré-rendu ne correspond plus)
     """
     labo_id = _get_labo_id(user)
     user_id = _get_user_id(user)
@@ -135,28 +164,41 @@ async def publish_marketing_document(
     # 2) calcule next version
     new_version = await _next_publication_version(session, doc.id)
 
-    # 3) UPSERT snapshot LOCKED (évite doublon)
+    # 2bis) empreinte du contenu de chaque page : les pages inchangées depuis la version
+    # précédente gardent la même clé de cache page => rendues une seule fois
+    plan, _ = await draft_store.load_render_plan_and_draft(session, draft)
+    page_hashes = [plan.page_content_hash(i) for i in range(len(plan.pages))]
+    prev_hashes = await _previous_page_hashes(session, doc.id)
+    changed_pages = [
+        i for i, h in enumerate(page_hashes) if i >= len(prev_hashes) or prev_hashes[i] != h
+    ]
+
+    # 3) UPSERT snapshot LOCKED (évite doublon) : manifeste ici, pages recopiées côté SQL
+    await draft_store.ensure_paged(session, draft)
     locked_id = await _upsert_locked_annotation(
         session,
         doc_id=doc.id,
         draft_version=int(draft.draft_version or 1),
-        data_json=draft.data_json or {"pages": []},
+        data_json=draft.data_json or {},
+        page_count=draft.page_count,
+        render_plan_json=draft.render_plan_json,  # None : plans par page, recopiés avec les pages
         user_id=user_id,
     )
+    await draft_store.copy_draft_pages(session, draft, locked_id)
 
     # 4) crée publication
     pub = MarketingDocumentPublication(
         document_id=doc.id,
         annotation_locked_id=locked_id,
         version=new_version,
-        status=MarketingPublicationStatus.RENDERING,  # MVP: immédiat
+        status=MarketingPublicationStatus.PENDING,  # READY posé par la tâche de pré-rendu
         created_by_user_id=user_id,
-        render_options_json={},
+        render_options_json={"page_hashes": page_hashes, "changed_pages": changed_pages},
     )
     session.add(pub)
     await session.flush()  # pub.id
 
-    # 5) MVP génération: copie le PDF source comme "published"
+    # 5) base publiée : copie du PDF source (les overlays sont ajoutés par le pré-rendu)
     published_dir = MEDIA_DIR / f"labo_{doc.labo_id}" / "published"
     published_dir.mkdir(parents=True, exist_ok=True)
 
@@ -169,17 +211,76 @@ async def publish_marketing_document(
 
     out_name = f"{uuid.uuid4().hex}.pdf"
     out_pdf = published_dir / out_name
-    out_pdf.write_bytes(src_pdf.read_bytes())
+    content = src_pdf.read_bytes()
+    out_pdf.write_bytes(content)
 
     pub.published_pdf_filename = f"published/{out_name}"
-    pub.status = MarketingPublicationStatus.READY
+    # ✅ fichier jamais réécrit : ETag fort côté lien public
+    pub.published_pdf_sha256 = hashlib.sha256(content).hexdigest()
 
     await session.commit()
 
+    # 6) ✅ pré-rendu en tâche de fond : le rendu lourd est fait une fois par publication
+    # (et non une fois par agent et par clic sur download-rendered)
+    try:
+        published_render.queue_publication_render(pub.id)
+    except Exception as e:
+        # broker indisponible : même politique qu'un pré-rendu en échec => READY, rendu à la demande
+        logger.warning("[PUBLISH_RENDER] enqueue KO publication_id=%s: %s", pub.id, e)
+        published_render.fallback_to_live_render(pub, f"enqueue KO: {e}")
+        await session.commit()
+
+    # ✅ nouvelle base publiée => les rendus précédents sont obsolètes
+    render_cache.invalidate_document(doc.id)
+
     return {
         "publication_id": pub.id,
         "version": pub.version,
         "status": pub.status.value,
         "published_pdf_filename": pub.published_pdf_filename,
         "locked_annotation_id": locked_id,
+        "changed_pages": changed_pages,
     }
+
+
+@router.get("/{doc_id}/publications")
+async def list_marketing_document_publications(
+    doc_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    """
+    Versions publiées + état du pré-rendu (PENDING / RENDERING / READY / FAILED),
+    nb de pages et miniatures une fois READY.
+    """
+    labo_id = _get_labo_id(user)
+    doc = await _get_doc_for_labo(session, labo_id, doc_id)
+
+    # ✅ pré-rendu perdu (worker tué, message perdu) : relancé ou servi en rendu à la demande
+    await published_render.recover_stale_publications(session, doc.id)
+
+    stmt = (
+        select(MarketingDocumentPublication)
+        .where(MarketingDocumentPublication.document_id == doc.id)
+        .order_by(MarketingDocumentPublication.version.desc())
+    )
+    pubs = (await session.execute(stmt)).scalars().all()
+
+    out = []
+    for pub in pubs:
+        opts = pub.render_options_json if isinstance(pub.render_options_json, dict) else {}
+        out.append(
+            {
+                "publication_id": pub.id,
+                "version": pub.version,
+                "status": pub.status.value,
+                "error_message": pub.error_message,
+                "prerendered": bool(opts.get("rendered_pdf")),
+                "page_count": opts.get("page_count"),
+                "thumb_urls": published_render.published_thumb_urls(opts, doc.id, doc.labo_id),
+                "changed_pages": opts.get("changed_pages"),
+                "created_at": pub.created_at.isoformat() if pub.created_at else None,
+                "updated_at": pub.updated_at.isoformat() if pub.updated_at else None,
+            }
+        )
+    return out
@@ -1,15 +1,17 @@
 # app/routers/labo_marketing_dynamic_products_api.py
 from __future__ import annotations
 
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, or_
 
 from app.db.session import get_async_session
 from app.db.models import Product, PriceTier
 from app.core.security import require_role
+from app.services import marketing_product_snapshot as product_snapshot
 
 router = APIRouter(
     prefix="/api-zenhub/marketing/products",
@@ -130,10 +132,76 @@ async def get_product_tiers(
 
 # ---------------------------------------------------------
 # 3) BULK-INFO (✅ utilisé par overlay_render.js)
+#    snapshot partagé (Redis) indexé par la version produits du labo (marketing_products_version),
+#    ETag dérivé de la version => 304 tant que rien n'a bougé
 # ---------------------------------------------------------
+def _entry_to_product_item(e: Dict[str, Any]) -> Dict[str, Any]:
+    # même forme que _to_product_item, depuis une entrée du snapshot
+    ean13 = (e.get("ean13") or "").strip()
+    return {
+        "id": e["id"],
+        "sku": e.get("sku"),
+        "name": e.get("name"),
+        "ean13": ean13,
+        "ean": ean13,
+        "price_ht": float(e.get("price_ht") or 0),
+        "stock": int(e.get("stock") or 0),
+        "is_active": bool(e.get("is_active")),
+        "thumb_url": e.get("thumb_url"),
+        "hd_jpg_url": e.get("hd_jpg_url"),
+        "hd_webp_url": e.get("hd_webp_url"),
+        "image_url": e.get("image_url"),
+    }
+
+
+async def _bulk_info_response(
+    session: AsyncSession,
+    labo_id: int,
+    ids: List[int],
+    if_none_match: Optional[str],
+) -> Response:
+    version = await product_snapshot.get_products_version(session, labo_id)
+    etag = product_snapshot.compute_etag(f"labo:{labo_id}", [(labo_id, version)], ids)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if product_snapshot.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    found = await product_snapshot.get_products(session, labo_id, version, ids)
+
+    # On ne renvoie que ce qui appartient au labo (sécurité : snapshot par labo)
+    products = [_entry_to_product_item(found[pid]) for pid in ids if pid in found]
+    # ✅ important: si un produit n'a pas de tiers, on renvoie une liste vide
+    tiers_map: Dict[str, Any] = {str(pid): list(found[pid].get("tiers") or []) for pid in ids if pid in found}
+
+    return JSONResponse({"products": products, "tiers": tiers_map}, headers=headers)
+
+
+@router.get("/bulk-info")
+async def bulk_info_get(
+    ids: str = Query("", description="ex: 12,15,18"),
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_async_session),
+    user=Depends(require_role("LABO")),
+):
+    """
+    GET /api-zenhub/marketing/products/bulk-info?ids=12,15
+    Même réponse que le POST, avec ETag : le navigateur revalide (If-None-Match) et
+    reçoit un 304 tant que produits / paliers / stock n'ont pas changé.
+    """
+    labo_id = _get_labo_id(user)
+    try:
+        product_ids = product_snapshot.parse_ids_param(ids)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return await _bulk_info_response(session, labo_id, product_ids, if_none_match)
+
+
 @router.post("/bulk-info")
 async def bulk_info(
     payload: Dict[str, Any],
+    if_none_match: Optional[str] = Header(None),
     session: AsyncSession = Depends(get_async_session),
     user=Depends(require_role("LABO")),
 ):
@@ -154,56 +222,10 @@ async def bulk_info(
     if not isinstance(raw_ids, list):
         raise HTTPException(status_code=400, detail="product_ids doit être une liste")
 
-    # sanitize
-    ids: List[int] = []
-    for x in raw_ids:
-        try:
-            xi = int(x)
-        except Exception:
-            continue
-        if xi > 0:
-            ids.append(xi)
-    ids = list(dict.fromkeys(ids))  # unique preserving order
+    # sanitize (unique preserving order)
+    ids = product_snapshot.parse_ids(raw_ids)
 
     if not ids:
         return {"products": [], "tiers": {}}
 
-    # --- fetch products
-    stmt = (
-        select(Product)
-        .where(Product.labo_id == labo_id)
-        .where(Product.id.in_(ids))
-    )
-    res = await session.execute(stmt)
-    products = res.scalars().all()
-
-    # On ne renvoie que ce qui appartient au labo (sécurité)
-    product_out = [_to_product_item(p) for p in products]
-
-    # --- fetch tiers for those products
-    found_ids = [p.id for p in products]
-    tiers_map: Dict[str, Any] = {}
-
-    if found_ids:
-        tstmt = (
-            select(PriceTier)
-            .where(PriceTier.product_id.in_(found_ids))
-            .order_by(PriceTier.product_id.asc(), PriceTier.qty_min.asc())
-        )
-        tres = await session.execute(tstmt)
-        tiers = tres.scalars().all()
-
-        for t in tiers:
-            pid = int(t.product_id)
-            k = str(pid)
-            if k not in tiers_map:
-                tiers_map[k] = []
-            tiers_map[k].append(_to_tier_item(t))
-
-        # ✅ important: si un produit n'a pas de tiers, on renvoie une liste vide
-        for pid in found_ids:
-            k = str(pid)
-            if k not in tiers_map:
-                tiers_map[k] = []
-
-    return {"products": product_out, "tiers": tiers_map}
+    return await _bulk_info_response(session, labo_id, ids, if_none_match)
@@ -1,6 +1,9 @@
 # app/routers/labo_marketing_fonts_api.py
 from __future__ import annotations
 
+import asyncio
+import hashlib
+
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
@@ -13,8 +16,9 @@ from app.services.storage import (
     store_temp_file,
     store_marketing_font,
     delete_marketing_font_file,
-    get_marketing_font_path,  # optionnel (non utilisé ici)
+    get_marketing_font_path,
 )
+from app.services import marketing_font_map as font_map
 
 router = APIRouter(
     prefix="/api-zenhub/labo/marketing-fonts",
@@ -128,14 +132,36 @@ async def upload_font(
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+    # ✅ woff2 -> ttf ici, une fois (le renderer PDF lit directement le ttf)
+    sha = hashlib.sha256(blob).hexdigest()
+    woff2_path = get_marketing_font_path(labo_id, stored_filename)
+    # nommé d'après le woff2 stocké (uuid) : pas partagé entre deux uploads du même fichier
+    ttf_filename = font_map.ttf_filename_for(stored_filename)
+    try:
+        await asyncio.to_thread(
+            font_map.convert_woff2_to_ttf,
+            woff2_path,
+            font_map.ttf_dir(woff2_path.parent) / ttf_filename,
+        )
+    except Exception as e:
+        print("[MARKETING_FONTS] woff2->ttf FAILED", stored_filename, type(e).__name__, str(e))
+        try:
+            delete_marketing_font_file(labo_id, stored_filename)
+        except Exception:
+            pass
+        raise HTTPException(status_code=400, detail="Police WOFF2 illisible")
+
     # ✅ modèle = name / filename / original_name
     f = MarketingFont(
         labo_id=labo_id,
         name=display_name.strip(),   # <- champ DB
         filename=stored_filename,
         original_name=original,      # <- nécessite l'ajout du champ dans le model
+        ttf_filename=ttf_filename,
+        sha256=sha,
     )
     session.add(f)
+    await font_map.bump_fonts_version(session, labo_id)
     await session.commit()
     await session.refresh(f)
 
@@ -170,6 +196,14 @@ async def delete_font(
     except Exception:
         pass
 
+    if f.ttf_filename:
+        try:
+            ttf_path = font_map.ttf_dir(get_marketing_font_path(f.labo_id, f.filename).parent) / f.ttf_filename
+            ttf_path.unlink(missing_ok=True)
+        except Exception:
+            pass
+
     await session.delete(f)
+    await font_map.bump_fonts_version(session, labo_id)
     await session.commit()
     return {"ok": True}
@@ -1,5 +1,8 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import FileResponse
+import time
+from pathlib import Path, PurePosixPath
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Depends, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.session import get_async_session
@@ -7,22 +10,43 @@ from app.db.models import MarketingDocument
 from app.services.storage import (
     get_marketing_document_path,
 )
-from app.services.marketing_signed_url import parse_and_verify_marketing_token
+from app.services.marketing_signed_url import TOKEN_KINDS, parse_and_verify_marketing_token
+from app.services.marketing_file_response import ranged_file_response
+from app.services.marketing_published_render import resolve_rendered_file
 
 router = APIRouter(tags=["public-marketing-documents"])
 
 
-@router.get("/public/marketing-document")
-async def public_marketing_document(
-    token: str,
-    session: AsyncSession = Depends(get_async_session),
-):
-    try:
-        doc_id, kind = parse_and_verify_marketing_token(token)
-    except Exception:
+async def _locate(
+    payload: Dict[str, Any],
+    session: AsyncSession,
+) -> Tuple[Path, Optional[str], Optional[str]]:
+    """(chemin, sha256, nom affiché) à partir du token."""
+    kind = payload.get("kind")
+    if kind not in TOKEN_KINDS:
         raise HTTPException(status_code=401, detail="Lien invalide ou expiré")
 
-    doc = await session.get(MarketingDocument, doc_id)
+    # ✅ token récent : labo + fichier signés, pas de requête DB
+    filename = payload.get("file")
+    if kind == "render_thumb":
+        # miniature du pré-rendu : hors /media, chemin relatif au dossier des rendus
+        path = resolve_rendered_file(filename)
+        if path is None:
+            raise HTTPException(status_code=401, detail="Lien invalide ou expiré")
+        return path, None, None
+
+    if payload.get("labo_id") and filename:
+        rel = PurePosixPath(str(filename))  # ex: "uuid.pdf", "published/uuid.pdf"
+        if rel.is_absolute() or ".." in rel.parts:
+            raise HTTPException(status_code=401, detail="Lien invalide ou expiré")
+        path = get_marketing_document_path(int(payload["labo_id"]), str(rel))
+        return path, payload.get("sha"), payload.get("name")
+
+    if kind == "published":
+        raise HTTPException(status_code=401, detail="Lien invalide ou expiré")
+
+    # tokens d'avant (doc_id + kind seulement)
+    doc = await session.get(MarketingDocument, int(payload["doc_id"]))
     if not doc:
         raise HTTPException(status_code=404, detail="Document introuvable")
 
@@ -30,13 +54,53 @@ async def public_marketing_document(
     if kind == "thumb":
         if not doc.thumb_filename:
             raise HTTPException(status_code=404)
-        path = base / doc.thumb_filename
-        return FileResponse(path, media_type="image/png")
-
-    # PDF en lecture (inline)
-    path = base / doc.filename
-    return FileResponse(
-        path,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f'inline; filename="{doc.original_name}"'},
-    )
+        return base / doc.thumb_filename, None, None
+    return base / doc.filename, doc.source_sha256, doc.original_name
+
+
+async def _serve(token: str, request: Request, session: AsyncSession):
+    try:
+        payload = parse_and_verify_marketing_token(token)
+    except Exception:
+        raise HTTPException(status_code=401, detail="Lien invalide ou expiré")
+
+    path, sha256, name = await _locate(payload, session)
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Document introuvable")
+
+    kind = payload.get("kind")
+    # URL = jeton porteur : jamais en cache partagé, pas au-delà de l'expiration du lien ;
+    # ETag pour les revalidations
+    remaining = max(0, int(payload["exp"]) - int(time.time()))
+    cache_control = f"private, max-age={remaining}"
+    if kind == "published":
+        # PDF publié : fichier uuid jamais réécrit => pas de revalidation tant que le lien vit
+        cache_control += ", immutable"
+
+    if kind in ("thumb", "render_thumb"):
+        # webp (miniatures générées en tâche de fond) ou png (documents d'avant)
+        media_type = "image/webp" if path.suffix.lower() == ".webp" else "image/png"
+        return ranged_file_response(request, path, media_type, sha256, cache_control)
+
+    # PDF en lecture (inline), par plages pour les lecteurs qui le demandent
+    headers = {"Content-Disposition": f'inline; filename="{name}"'} if name else None
+    return ranged_file_response(request, path, "application/pdf", sha256, cache_control, headers)
+
+
+@router.get("/public/marketing-document")
+async def public_marketing_document(
+    token: str,
+    request: Request,
+    session: AsyncSession = Depends(get_async_session),
+):
+    return await _serve(token, request, session)
+
+
+# ✅ forme produite par build_public_url (miniatures signées de la liste agent)
+@router.get("/public/marketing/{token}")
+async def public_marketing_document_by_path(
+    token: str,
+    request: Request,
+    session: AsyncSession = Depends(get_async_session),
+):
+    return await _serve(token, request, session)
@@ -0,0 +1,135 @@
+# app/services/marketing_document_thumbs.py
+from __future__ import annotations
+
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import fitz  # PyMuPDF
+except Exception:  # pragma: no cover
+    fitz = None
+
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# largeurs des miniatures de la page 1 (listes responsive) ; DEFAULT => thumb_filename
+THUMB_WIDTHS = sorted(
+    {max(32, int(w)) for w in os.environ.get("MARKETING_THUMB_WIDTHS", "160,320,640").split(",") if w.strip()}
+)
+THUMB_DEFAULT_WIDTH = int(os.environ.get("MARKETING_THUMB_DEFAULT_WIDTH", "320"))
+# bandeau de navigation de l'éditeur : une vignette basse résolution par page
+STRIP_WIDTH = int(os.environ.get("MARKETING_STRIP_WIDTH", "96"))
+THUMB_FORMAT = "webp"
+THUMB_QUALITY = 80
+
+# nom de la tâche Celery (app/celery_tasks/marketing_document_thumbs.py)
+THUMBS_TASK_NAME = "marketing_document.thumbs"
+
+
+def queue_document_thumbs(document_id: int) -> str:
+    """Côté API : enqueue la génération des miniatures d'un document. Retourne l'id de tâche."""
+    from app.tasks.celery_app import celery
+
+    task = celery.send_task(
+        THUMBS_TASK_NAME,
+        kwargs={"document_id": int(document_id)},
+        queue="default",
+    )
+    print("[MARKETING_THUMBS] queued document_id=", document_id, "task=", task.id)
+    return str(task.id)
+
+
+# ------------------------------------------------------------
+# Génération (worker Celery, synchrone)
+# ------------------------------------------------------------
+def _save_webp(img: "Image.Image", out: Path) -> None:
+    tmp = out.with_name(f".{out.name}.{os.getpid()}.part")
+    try:
+        img.save(str(tmp), format="WEBP", quality=THUMB_QUALITY, method=4)
+        os.replace(tmp, out)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _page_image(page: "fitz.Page", width: int) -> "Image.Image":
+    # échelle depuis page.rect (taille en pt = px à 72 dpi) : pas de rendu "pour voir"
+    zoom = min(1.0, float(width) / max(1.0, float(page.rect.width)))
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def generate_document_thumbs(pdf_path: Path, out_dir: Path) -> Dict[str, Any]:
+    """
+    Miniatures de la page 1 (une par largeur de THUMB_WIDTHS, un seul rendu à la
+    plus grande puis réductions Pillow) + bandeau : une vignette STRIP_WIDTH par page.
+    Fichiers écrits dans out_dir (dossier media du document), noms retournés.
+    """
+    if fitz is None or Image is None:
+        raise RuntimeError("PyMuPDF et Pillow requis pour les miniatures")
+
+    started = time.perf_counter()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stem = uuid.uuid4().hex
+
+    doc = fitz.open(str(pdf_path))
+    try:
+        page_count = int(doc.page_count or 0)
+        if page_count <= 0:
+            raise RuntimeError("PDF sans page")
+
+        page = doc.load_page(0)
+        big = _page_image(page, max(THUMB_WIDTHS))
+        widths: Dict[str, str] = {}
+        for w in THUMB_WIDTHS:
+            img = big
+            if big.width > w:
+                img = big.resize((w, max(1, round(big.height * w / big.width))), Image.LANCZOS)
+            name = f"thumb_{stem}_w{w}.{THUMB_FORMAT}"
+            _save_webp(img, out_dir / name)
+            widths[str(w)] = name
+
+        strip: List[str] = []
+        for i in range(page_count):
+            name = f"strip_{stem}_p{i + 1}.{THUMB_FORMAT}"
+            _save_webp(_page_image(doc.load_page(i), STRIP_WIDTH), out_dir / name)
+            strip.append(name)
+
+        return {
+            "page_count": page_count,
+            "page_size": [round(float(page.rect.width), 2), round(float(page.rect.height), 2)],
+            "widths": widths,
+            "default": widths.get(str(THUMB_DEFAULT_WIDTH)) or widths[str(THUMB_WIDTHS[0])],
+            "strip": strip,
+            "strip_width": STRIP_WIDTH,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+    finally:
+        doc.close()
+
+
+def thumb_files(thumbs_json: Optional[Dict[str, Any]], thumb_filename: Optional[str] = None) -> List[str]:
+    """Tous les fichiers miniatures d'un document (suppression / régénération)."""
+    names = set()
+    if thumb_filename:
+        names.add(str(thumb_filename))
+    if isinstance(thumbs_json, dict):
+        names.update(str(v) for v in (thumbs_json.get("widths") or {}).values())
+        names.update(str(v) for v in (thumbs_json.get("strip") or []))
+    # noms simples uniquement (pas de chemin)
+    return sorted(n for n in names if n and "/" not in n and "\\" not in n and n not in (".", ".."))
+
+
+def delete_thumb_files(out_dir: Path, names: List[str]) -> None:
+    for n in names:
+        try:
+            (out_dir / n).unlink(missing_ok=True)
+        except Exception:
+            pass
@@ -0,0 +1,132 @@
+# app/services/marketing_draft_patch.py
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+# ------------------------------------------------------------
+# Patch objet par objet du draft de l'éditeur (data_json)
+#   {"op": "add",    "page": 0, "object": {...}, "index": None}
+#   {"op": "update", "page": 0, "id": "...", "object": {...}, "merge": False}
+#   {"op": "delete", "page": 0, "id": "..."}
+#   {"op": "meta",   "data": {"_meta": {...}, "appended_pages": [...]}}  (clés racine hors "pages")
+# ------------------------------------------------------------
+DRAFT_PATCH_MAX_OPS = 2000
+# garde-fou : un index de page farfelu ne doit pas créer des milliers de pages vides
+DRAFT_PATCH_MAX_PAGES = 1000
+
+
+class DraftPatchError(ValueError):
+    """Opération invalide (page / objet introuvable, id manquant...) : 422 côté API."""
+
+
+def _page(pages: List[Any], page_index: int, create: bool) -> Dict[str, Any]:
+    if page_index < 0 or page_index >= DRAFT_PATCH_MAX_PAGES:
+        raise DraftPatchError(f"page invalide: {page_index}")
+    if page_index >= len(pages):
+        if not create:
+            raise DraftPatchError(f"page {page_index} absente du draft")
+        # même forme que getOrCreatePageModel (draft.js)
+        while len(pages) <= page_index:
+            pages.append({"pageIndex": len(pages), "objects": []})
+
+    page = pages[page_index]
+    if not isinstance(page, dict):
+        page = {"pageIndex": page_index, "objects": []}
+    else:
+        page = dict(page)
+    objs = page.get("objects")
+    page["objects"] = list(objs) if isinstance(objs, list) else []
+    pages[page_index] = page
+    return page
+
+
+def _find(objs: List[Any], oid: str) -> int:
+    for i, o in enumerate(objs):
+        if isinstance(o, dict) and str(o.get("id")) == oid:
+            return i
+    return -1
+
+
+def apply_draft_ops(data_json: Dict[str, Any], ops: Iterable[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[int]]:
+    """
+    Applique les opérations sur une copie de data_json (copie superficielle : seules
+    les pages touchées sont recopiées). Retourne (nouveau data_json, pages touchées).
+    Lève DraftPatchError à la première opération invalide (rien n'est appliqué).
+    """
+    out = dict(data_json or {})
+    pages = out.get("pages")
+    out["pages"] = pages = list(pages) if isinstance(pages, list) else []
+
+    copied: Set[int] = set()
+    touched: Set[int] = set()
+
+    for n, op in enumerate(ops):
+        kind = str(op.get("op") or "")
+
+        if kind == "meta":
+            data = op.get("data") or {}
+            if not isinstance(data, dict) or "pages" in data:
+                raise DraftPatchError(f"op #{n}: meta invalide")
+            for k, v in data.items():
+                if v is None:
+                    out.pop(k, None)
+                else:
+                    out[k] = v
+            continue
+
+        if kind not in ("add", "update", "delete"):
+            raise DraftPatchError(f"op #{n}: type inconnu '{kind}'")
+
+        try:
+            page_index = int(op.get("page"))
+        except Exception:
+            raise DraftPatchError(f"op #{n}: page manquante")
+
+        # une page n'est recopiée qu'une fois, même avec plusieurs ops dessus
+        if page_index in copied:
+            page = pages[page_index]
+        else:
+            page = _page(pages, page_index, create=(kind == "add"))
+            copied.add(page_index)
+        objs: List[Any] = page["objects"]
+
+        obj = op.get("object")
+        oid = op.get("id")
+        if oid is None and isinstance(obj, dict):
+            oid = obj.get("id")
+        if oid is None or str(oid) == "":
+            raise DraftPatchError(f"op #{n}: id manquant")
+        oid = str(oid)
+        idx = _find(objs, oid)
+
+        if kind == "add":
+            if not isinstance(obj, dict):
+                raise DraftPatchError(f"op #{n}: object manquant")
+            if idx >= 0:
+                raise DraftPatchError(f"op #{n}: objet {oid} déjà présent page {page_index}")
+            pos = op.get("index")
+            if pos is None:
+                objs.append(obj)
+            else:
+                objs.insert(max(0, min(int(pos), len(objs))), obj)
+
+        elif kind == "update":
+            if not isinstance(obj, dict):
+                raise DraftPatchError(f"op #{n}: object manquant")
+            if idx < 0:
+                raise DraftPatchError(f"op #{n}: objet {oid} introuvable page {page_index}")
+            if op.get("merge"):
+                # comme upsertObject (draft.js) : on garde les champs non envoyés
+                new_obj = {**objs[idx], **obj}
+            else:
+                new_obj = dict(obj)
+            new_obj["id"] = objs[idx].get("id")
+            objs[idx] = new_obj
+
+        else:  # delete : idempotent (autosave rejoué)
+            if idx >= 0:
+                del objs[idx]
+
+        touched.add(page_index)
+
+    return out, sorted(touched)
@@ -0,0 +1,317 @@
+# app/services/marketing_draft_store.py
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import MarketingDocumentAnnotation, MarketingDocumentAnnotationPage
+from app.services.marketing_render_plan import (
+    RenderPlan,
+    _dyn_product_id,
+    assemble_render_plan,
+    compile_page_plan_json,
+    compile_render_plan,
+    load_page_plan,
+    load_render_plan,
+)
+
+# ------------------------------------------------------------
+# Draft de l'éditeur découpé par page
+#   - MarketingDocumentAnnotation.data_json : manifeste (clés racine hors "pages")
+#   - MarketingDocumentAnnotationPage       : une ligne par page (+ projection "dynamic"
+#                                             et plan de rendu compilé de la page)
+#   - page_count NULL => ancien format (pages dans data_json), lu tel quel,
+#     converti au prochain enregistrement
+# ------------------------------------------------------------
+FIELDS_ALL = "all"
+FIELDS_DYNAMIC = "dynamic"    # objets prix / stock / EAN produit seulement (vue agent, ids produits)
+FIELDS_MANIFEST = "manifest"  # clés racine seulement (_meta, appended_pages...)
+DRAFT_FIELDS = (FIELDS_ALL, FIELDS_DYNAMIC, FIELDS_MANIFEST)
+
+# borne du paramètre ?pages= (une plage "0-100000" ne doit pas générer 100k index)
+DRAFT_PAGES_PARAM_MAX = 1000
+
+_EMPTY_DRAFT = {"pages": [], "_meta": {}}
+
+
+def _empty_page(page_index: int) -> Dict[str, Any]:
+    # même forme que getOrCreatePageModel (draft.js)
+    return {"pageIndex": page_index, "objects": []}
+
+
+def split_draft(data_json: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Any]]:
+    """(manifeste sans "pages", pages)"""
+    manifest = dict(data_json or {})
+    pages = manifest.pop("pages", None)
+    return manifest, (pages if isinstance(pages, list) else [])
+
+
+def dynamic_objects(page: Any) -> List[Dict[str, Any]]:
+    objs = (page.get("objects") if isinstance(page, dict) else None) or []
+    if not isinstance(objs, list):
+        return []
+    return [o for o in objs if isinstance(o, dict) and _dyn_product_id(o)]
+
+
+def _project(page: Any, page_index: int, fields: str) -> Dict[str, Any]:
+    if fields == FIELDS_DYNAMIC:
+        return {"pageIndex": page_index, "objects": dynamic_objects(page)}
+    return page if isinstance(page, dict) else _empty_page(page_index)
+
+
+def parse_pages_param(pages: Optional[str]) -> Optional[List[int]]:
+    """
+    ?pages= : "3", "0-4" (bornes incluses), "0-2,7". None / "" => toutes les pages.
+    Lève ValueError si le format est invalide.
+    """
+    if pages is None or not str(pages).strip():
+        return None
+    out = set()
+    for part in str(pages).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-", 1)
+            lo, hi = int(a), int(b)
+        else:
+            lo = hi = int(part)
+        if lo < 0 or hi < lo:
+            raise ValueError(f"plage invalide: {part}")
+        hi = min(hi, lo + DRAFT_PAGES_PARAM_MAX)
+        out.update(range(lo, hi + 1))
+        if len(out) > DRAFT_PAGES_PARAM_MAX:
+            raise ValueError("trop de pages demandées")
+    return sorted(out)
+
+
+def draft_page_count(anno: Optional[MarketingDocumentAnnotation]) -> int:
+    if anno is None:
+        return 0
+    if anno.page_count is not None:
+        return int(anno.page_count)
+    return len(split_draft(anno.data_json or {})[1])
+
+
+def selected_page_indexes(anno: Optional[MarketingDocumentAnnotation], page_indexes: Optional[Iterable[int]]) -> List[int]:
+    """Index des pages renvoyées par load_draft (demandées ET existantes)."""
+    count = draft_page_count(anno)
+    if page_indexes is None:
+        return list(range(count))
+    return sorted({int(i) for i in page_indexes if 0 <= int(i) < count})
+
+
+# ------------------------------------------------------------
+# Lecture
+# ------------------------------------------------------------
+async def _load_page_rows(
+    session: AsyncSession,
+    annotation_id: int,
+    page_indexes: Optional[List[int]],
+    fields: str,
+) -> Dict[int, Any]:
+    col = MarketingDocumentAnnotationPage.dynamic_json if fields == FIELDS_DYNAMIC else MarketingDocumentAnnotationPage.data_json
+    stmt = select(MarketingDocumentAnnotationPage.page_index, col).where(
+        MarketingDocumentAnnotationPage.annotation_id == int(annotation_id)
+    )
+    if page_indexes is not None:
+        stmt = stmt.where(MarketingDocumentAnnotationPage.page_index.in_(page_indexes))
+    rows = (await session.execute(stmt)).all()
+    return {int(i): v for (i, v) in rows}
+
+
+async def load_draft(
+    session: AsyncSession,
+    anno: Optional[MarketingDocumentAnnotation],
+    page_indexes: Optional[Iterable[int]] = None,
+    fields: str = FIELDS_ALL,
+) -> Dict[str, Any]:
+    """
+    Draft reconstitué {manifeste..., "pages": [...]}.
+    page_indexes None => toutes les pages (alignées sur leur index, comme avant).
+    Sinon seulement les pages demandées existantes, dans l'ordre (cf. pageIndex).
+    """
+    if anno is None:
+        return dict(_EMPTY_DRAFT)
+
+    wanted = selected_page_indexes(anno, page_indexes)
+
+    if anno.page_count is None:
+        # ancien format : tout est déjà dans data_json
+        manifest, pages = split_draft(anno.data_json or {})
+        if fields == FIELDS_MANIFEST:
+            return {**manifest, "pages": []}
+        return {**manifest, "pages": [_project(pages[i], i, fields) for i in wanted]}
+
+    manifest = dict(anno.data_json or {})
+    manifest.pop("pages", None)
+    if fields == FIELDS_MANIFEST or not wanted:
+        return {**manifest, "pages": []}
+
+    rows = await _load_page_rows(session, anno.id, None if page_indexes is None else wanted, fields)
+    pages: List[Dict[str, Any]] = []
+    for i in wanted:
+        v = rows.get(i)
+        if fields == FIELDS_DYNAMIC:
+            pages.append({"pageIndex": i, "objects": v if isinstance(v, list) else []})
+        else:
+            pages.append(v if isinstance(v, dict) else _empty_page(i))
+    return {**manifest, "pages": pages}
+
+
+async def load_draft_for_patch(
+    session: AsyncSession,
+    anno: MarketingDocumentAnnotation,
+    page_indexes: Optional[Iterable[int]],
+) -> Dict[str, Any]:
+    """
+    Draft pour apply_draft_ops : pages alignées sur leur index, seules page_indexes
+    chargées (les autres à None : non touchées par le patch). None => tout.
+    """
+    if page_indexes is None or anno.page_count is None:
+        return await load_draft(session, anno)
+
+    count = int(anno.page_count)
+    wanted = selected_page_indexes(anno, page_indexes)
+    manifest = dict(anno.data_json or {})
+    manifest.pop("pages", None)
+
+    pages: List[Any] = [None] * count
+    if wanted:
+        rows = await _load_page_rows(session, anno.id, wanted, FIELDS_ALL)
+        for i in wanted:
+            v = rows.get(i)
+            pages[i] = v if isinstance(v, dict) else _empty_page(i)
+    return {**manifest, "pages": pages}
+
+
+async def load_render_plan_and_draft(
+    session: AsyncSession,
+    anno: Optional[MarketingDocumentAnnotation],
+) -> Tuple[RenderPlan, Dict[str, Any]]:
+    """
+    Rendu : plan + manifeste (_meta / appended_pages : tout ce que le renderer lit
+    du draft quand il a le plan). Drafts par page : plan de chaque page lu dans sa
+    ligne (compilé à la volée si absent / d'un autre format).
+    """
+    if anno is None:
+        return compile_render_plan(_EMPTY_DRAFT), dict(_EMPTY_DRAFT)
+
+    if anno.page_count is None:
+        draft = anno.data_json or dict(_EMPTY_DRAFT)
+        return load_render_plan(anno, draft), draft
+
+    manifest = dict(anno.data_json or {})
+    manifest.pop("pages", None)
+
+    stmt = select(
+        MarketingDocumentAnnotationPage.page_index,
+        MarketingDocumentAnnotationPage.data_json,
+        MarketingDocumentAnnotationPage.plan_json,
+    ).where(MarketingDocumentAnnotationPage.annotation_id == int(anno.id))
+    rows = {int(i): (data, plan) for (i, data, plan) in (await session.execute(stmt)).all()}
+
+    page_plans = []
+    for i in range(int(anno.page_count)):
+        data, stored = rows.get(i, (None, None))
+        page = data if isinstance(data, dict) else _empty_page(i)
+        page_plans.append(load_page_plan(stored, page))
+
+    plan = assemble_render_plan(page_plans, int(anno.draft_version or 1))
+    return plan, {**manifest, "pages": []}
+
+
+# ------------------------------------------------------------
+# Écriture
+# ------------------------------------------------------------
+async def save_draft_pages(
+    session: AsyncSession,
+    anno: MarketingDocumentAnnotation,
+    data_json: Dict[str, Any],
+    page_indexes: Optional[Iterable[int]] = None,
+) -> None:
+    """
+    Enregistre data_json découpé : manifeste sur l'annotation, une ligne par page.
+    page_indexes : pages modifiées (patch) ; None => toutes. Les pages créées au-delà
+    de l'ancien page_count sont toujours écrites. Commit par l'appelant.
+    """
+    manifest, pages = split_draft(data_json)
+
+    if anno.id is None:
+        await session.flush()
+
+    old_count = anno.page_count
+    if page_indexes is None or old_count is None:
+        write = range(len(pages))
+    else:
+        write = sorted({int(i) for i in page_indexes} | set(range(int(old_count), len(pages))))
+
+    rows = []
+    for i in write:
+        if not (0 <= i < len(pages)):
+            continue
+        page = pages[i] if isinstance(pages[i], dict) else _empty_page(i)
+        rows.append(
+            {
+                "annotation_id": int(anno.id),
+                "page_index": int(i),
+                "data_json": page,
+                "dynamic_json": dynamic_objects(page),
+                # ✅ compilé ici, une fois par modification de la page
+                "plan_json": compile_page_plan_json(page),
+            }
+        )
+
+    if rows:
+        stmt = insert(MarketingDocumentAnnotationPage).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["annotation_id", "page_index"],
+            set_={
+                "data_json": stmt.excluded.data_json,
+                "dynamic_json": stmt.excluded.dynamic_json,
+                "plan_json": stmt.excluded.plan_json,
+                "updated_at": func.now(),
+            },
+        )
+        await session.execute(stmt)
+
+    await session.execute(
+        delete(MarketingDocumentAnnotationPage).where(
+            MarketingDocumentAnnotationPage.annotation_id == int(anno.id),
+            MarketingDocumentAnnotationPage.page_index >= len(pages),
+        )
+    )
+
+    anno.data_json = manifest
+    anno.page_count = len(pages)
+    # plan par page : l'ancien plan global n'a plus lieu d'être
+    anno.render_plan_json = None
+
+
+async def ensure_paged(session: AsyncSession, anno: MarketingDocumentAnnotation) -> None:
+    """Convertit un draft ancien format (pages dans data_json). Commit par l'appelant."""
+    if anno.page_count is None:
+        await save_draft_pages(session, anno, anno.data_json or {})
+
+
+async def copy_draft_pages(session: AsyncSession, src: MarketingDocumentAnnotation, dst_id: int) -> None:
+    """Pages de src recopiées sur dst (snapshot LOCKED à la publication), côté SQL."""
+    await ensure_paged(session, src)
+    await session.execute(
+        delete(MarketingDocumentAnnotationPage).where(MarketingDocumentAnnotationPage.annotation_id == int(dst_id))
+    )
+    await session.execute(
+        insert(MarketingDocumentAnnotationPage).from_select(
+            ["annotation_id", "page_index", "data_json", "dynamic_json", "plan_json"],
+            select(
+                literal(int(dst_id)),
+                MarketingDocumentAnnotationPage.page_index,
+                MarketingDocumentAnnotationPage.data_json,
+                MarketingDocumentAnnotationPage.dynamic_json,
+                MarketingDocumentAnnotationPage.plan_json,
+            ).where(MarketingDocumentAnnotationPage.annotation_id == int(src.id)),
+        )
+    )
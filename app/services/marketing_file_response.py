@@ -0,0 +1,135 @@
+# app/services/marketing_file_response.py
+from __future__ import annotations
+
+import os
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# ------------------------------------------------------------
+# Fichiers servis avec validateurs + Range (lecteurs PDF mobiles / pdf.js)
+#   - ETag fort (sha256 stocké) sinon faible (taille + mtime)
+#   - If-None-Match => 304
+#   - Range "bytes=a-b" / "a-" / "-n" => 206 (une seule plage ; plusieurs => 200 complet)
+# ------------------------------------------------------------
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(path_stat: os.stat_result, sha256: Optional[str] = None) -> str:
+    sha = (sha256 or "").strip()
+    if sha:
+        return f'"{sha}"'
+    return f'W/"{path_stat.st_size:x}-{path_stat.st_mtime_ns:x}"'
+
+
+def _etag_in(header: Optional[str], etag: str) -> bool:
+    # comparaison faible (If-None-Match)
+    if not header:
+        return False
+    want = etag[2:] if etag.startswith("W/") else etag
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == want:
+            return True
+    return False
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end) inclus pour une plage unique satisfaisable.
+    None : pas de Range exploitable (=> réponse complète).
+    ValueError : plage non satisfaisable (=> 416).
+    """
+    if not header or not header.strip().lower().startswith("bytes="):
+        return None
+    spec = header.strip()[6:].strip()
+    if "," in spec:
+        return None
+    if "-" not in spec:
+        return None
+    a, b = spec.split("-", 1)
+    a, b = a.strip(), b.strip()
+    if not (a.isdigit() or not a) or not (b.isdigit() or not b) or (not a and not b):
+        return None  # malformée : ignorée
+    if not a:
+        # suffixe : les n derniers octets
+        n = int(b)
+        if n <= 0 or size <= 0:
+            raise ValueError("unsatisfiable")
+        return max(0, size - n), size - 1
+    start = int(a)
+    end = int(b) if b else size - 1
+    if start >= size:
+        raise ValueError("unsatisfiable")
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def _iter_file(path: Path, start: int, length: int) -> Iterator[bytes]:
+    # itérateur sync : Starlette le consomme dans le threadpool
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(
+    request: Request,
+    path: Path,
+    media_type: str,
+    sha256: Optional[str] = None,
+    cache_control: Optional[str] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """Le fichier doit exister (404 à gérer par l'appelant)."""
+    st = os.stat(path)
+    size = int(st.st_size)
+    etag = file_etag(st, sha256)
+
+    base: Dict[str, str] = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+    }
+    if cache_control:
+        base["Cache-Control"] = cache_control
+
+    if _etag_in(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=base)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range : comparaison forte, sinon la plage est ignorée (fichier complet)
+    if range_header and if_range and (etag.startswith("W/") or if_range.strip() != etag):
+        range_header = None
+
+    try:
+        rng = parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={**base, "Content-Range": f"bytes */{size}"})
+
+    if rng is None:
+        return FileResponse(path, media_type=media_type, headers={**base, **(headers or {})}, stat_result=st)
+
+    start, end = rng
+    length = end - start + 1
+    return StreamingResponse(
+        _iter_file(path, start, length),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            **base,
+            **(headers or {}),
+            "Content-Range": f"bytes {start}-{end}/{size}",
+            "Content-Length": str(length),
+        },
+    )
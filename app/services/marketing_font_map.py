@@ -0,0 +1,144 @@
+# app/services/marketing_font_map.py
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Labo
+
+# ------------------------------------------------------------
+# Polices labo (woff2) pour le renderer PDF
+#   - conversion woff2 -> ttf faite à l'upload (MarketingFont.ttf_filename)
+#   - mapping polices par labo mis en cache par process, indexé par
+#     Labo.marketing_fonts_version (incrémenté à chaque upload / suppression)
+# ------------------------------------------------------------
+TTF_SUBDIR = "_cache_ttf"
+# nb de mappings gardés (un par labo)
+FONT_MAP_CACHE_MAX_ENTRIES = int(os.environ.get("MARKETING_FONT_MAP_CACHE_MAX_ENTRIES", "256"))
+
+
+def ttf_dir(fonts_dir: Path) -> Path:
+    return Path(fonts_dir) / TTF_SUBDIR
+
+
+def ttf_filename_for(filename: str, sha256: Optional[str] = None) -> str:
+    # même nommage que l'ancien cache de conversion au rendu
+    sha = (sha256 or "").strip()
+    return f"{sha}.ttf" if sha else f"{Path(filename).stem}.ttf"
+
+
+def convert_woff2_to_ttf(woff2_path: Path, ttf_path: Path) -> None:
+    """woff2 -> ttf (fontTools). Lève si la police est illisible."""
+    from fontTools.ttLib import TTFont  # type: ignore
+
+    ttf_path.parent.mkdir(parents=True, exist_ok=True)
+    font = TTFont(str(woff2_path))
+    font.flavor = None
+    tmp = ttf_path.with_name(f".{ttf_path.name}.{os.getpid()}.tmp")
+    font.save(str(tmp))
+    os.replace(tmp, ttf_path)
+
+
+def resolve_font_ttf(font: Any, fonts_dir: Path) -> Optional[Path]:
+    """
+    TTF d'une ligne MarketingFont.
+    ttf_filename renseigné (upload) : chemin direct, sans toucher au disque.
+    Sinon (police uploadée avant la conversion à l'upload) : conversion à la
+    demande comme avant ; le mapping étant mis en cache, une fois par version.
+    """
+    ttf_name = (getattr(font, "ttf_filename", None) or "").strip()
+    if ttf_name:
+        return ttf_dir(fonts_dir) / ttf_name
+
+    filename = (getattr(font, "filename", None) or "").strip()
+    if not filename:
+        return None
+    woff2_path = Path(fonts_dir) / filename
+    if woff2_path.suffix.lower() != ".woff2" or not woff2_path.exists():
+        return None
+
+    ttf_path = ttf_dir(fonts_dir) / ttf_filename_for(filename, getattr(font, "sha256", None))
+    if (not ttf_path.exists()) or ttf_path.stat().st_size < 1000:
+        try:
+            convert_woff2_to_ttf(woff2_path, ttf_path)
+        except Exception as e:
+            print("[FONT_MAP] woff2->ttf FAILED", woff2_path, type(e).__name__, str(e))
+            return None
+    return ttf_path
+
+
+# ------------------------------------------------------------
+# Version du jeu de polices (BDD : partagée par tous les process API)
+# ------------------------------------------------------------
+async def get_fonts_version(session: AsyncSession, labo_id: int) -> int:
+    stmt = select(Labo.marketing_fonts_version).where(Labo.id == int(labo_id))
+    v = (await session.execute(stmt)).scalar()
+    return int(v or 0)
+
+
+async def bump_fonts_version(session: AsyncSession, labo_id: int) -> None:
+    """À appeler dans la transaction qui ajoute / supprime une police (commit par l'appelant)."""
+    await session.execute(
+        update(Labo)
+        .where(Labo.id == int(labo_id))
+        .values(marketing_fonts_version=Labo.marketing_fonts_version + 1)
+    )
+
+
+# ------------------------------------------------------------
+# Cache process
+# ------------------------------------------------------------
+@dataclass(frozen=True)
+class LaboFontMap:
+    version: int
+    font_files: Dict[str, str]
+    labo_fonts_by_id: Dict[int, Dict[str, Any]]
+
+
+class FontMapCache:
+    """(scope, labo_id) -> LaboFontMap de la version courante ; une autre version => rebuild."""
+
+    def __init__(self, max_entries: int = FONT_MAP_CACHE_MAX_ENTRIES) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, int], LaboFontMap] = {}
+        self.hits = 0
+        self.builds = 0
+
+    async def get_or_build(
+        self,
+        scope: str,
+        labo_id: int,
+        version: int,
+        build: Callable[[], Tuple[Dict[str, str], Dict[int, Dict[str, Any]]]],
+    ) -> LaboFontMap:
+        """build (conversion woff2 -> ttf possible pour les anciennes polices) dans un thread, hors event loop."""
+        key = (scope, int(labo_id))
+        with self._lock:
+            fm = self._entries.get(key)
+            if fm is not None and fm.version == int(version):
+                self.hits += 1
+                return fm
+
+        font_files, labo_fonts_by_id = await asyncio.to_thread(build)
+        fm = LaboFontMap(version=int(version), font_files=font_files, labo_fonts_by_id=labo_fonts_by_id)
+        with self._lock:
+            self.builds += 1
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = fm
+        return fm
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+font_map_cache = FontMapCache()
@@ -0,0 +1,201 @@
+# app/services/marketing_font_registry.py
+from __future__ import annotations
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+try:
+    import fitz  # PyMuPDF
+except Exception:  # pragma: no cover
+    fitz = None  # type: ignore
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# délai avant de re-stat un fichier police (détection remplacement / suppression)
+FONT_REGISTRY_RECHECK_S = float(os.environ.get("MARKETING_FONT_REGISTRY_RECHECK_S", "30"))
+
+_FONT_SUFFIXES = (".ttf", ".otf")
+
+
+class FontEntry:
+    """Police chargée une fois par process : bytes + fitz.Font + avances des glyphes."""
+
+    def __init__(self, path: str, mtime_ns: int, size: int, buffer: bytes, font: "fitz.Font") -> None:
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.buffer = buffer
+        self.font = font
+        self._advances: Dict[str, float] = {}
+
+    def advance(self, ch: str) -> float:
+        """Avance du glyphe pour une taille de 1pt (mémoïsée)."""
+        a = self._advances.get(ch)
+        if a is None:
+            a = float(self.font.glyph_advance(ord(ch)))
+            self._advances[ch] = a
+        return a
+
+    def text_length(self, text: str, fontsize: float) -> float:
+        return sum(self.advance(ch) for ch in (text or "")) * float(fontsize)
+
+
+class FontRegistry:
+    """
+    Registre process-wide des polices TTF/OTF utilisées par le renderer.
+    Clé = chemin ; l'entrée est rechargée si (mtime, taille) change.
+    Les chemins absents sont aussi mémorisés (même délai de re-vérification).
+    """
+
+    def __init__(self, recheck_s: float = FONT_REGISTRY_RECHECK_S) -> None:
+        self.recheck_s = max(0.0, float(recheck_s))
+        self._lock = threading.Lock()
+        self._entries: Dict[str, FontEntry] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._missing: Set[str] = set()
+
+    def get(self, path: Optional[str]) -> Optional[FontEntry]:
+        if fitz is None or not path:
+            return None
+        key = str(path)
+        if not key.lower().endswith(_FONT_SUFFIXES):
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked_at.get(key)
+            if checked is not None and (now - checked) < self.recheck_s:
+                if key in self._missing:
+                    return None
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return entry
+
+        try:
+            st = os.stat(key)
+        except OSError:
+            with self._lock:
+                self._entries.pop(key, None)
+                self._missing.add(key)
+                self._checked_at[key] = now
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+                self._missing.discard(key)
+                self._checked_at[key] = now
+                return entry
+
+        try:
+            buf = Path(key).read_bytes()
+            entry = FontEntry(key, st.st_mtime_ns, st.st_size, buf, fitz.Font(fontbuffer=buf))
+        except Exception as e:
+            print("[PDF_RENDER][FONT] load FAILED", key, type(e).__name__, str(e))
+            entry = None
+
+        with self._lock:
+            self._checked_at[key] = now
+            if entry is None:
+                self._entries.pop(key, None)
+                self._missing.add(key)
+            else:
+                self._entries[key] = entry
+                self._missing.discard(key)
+        return entry
+
+    def exists(self, path: Optional[str]) -> bool:
+        return self.get(path) is not None
+
+    def text_length(self, path: Optional[str], text: str, fontsize: float) -> Optional[float]:
+        entry = self.get(path)
+        if entry is None:
+            return None
+        return entry.text_length(text, fontsize)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._checked_at.clear()
+            self._missing.clear()
+
+
+class DocumentFonts:
+    """
+    Polices déjà embarquées dans UN document en cours de rendu (fontname -> xref).
+    La 1re page insère la police (insert_font, depuis le buffer du registre) ;
+    les pages suivantes référencent juste le même xref dans leurs /Resources,
+    sans re-parser le fichier.
+    """
+
+    def __init__(self, registry: FontRegistry) -> None:
+        self.registry = registry
+        self._xrefs: Dict[str, int] = {}
+        self._on_page: Set[Tuple[int, str]] = set()
+
+    def ensure(self, page: "fitz.Page", fontname: str, fontfile: Optional[str]) -> bool:
+        """True si fontname est utilisable sur la page (insert_text/insert_textbox le retrouveront)."""
+        if fitz is None or not fontname or not fontfile:
+            return False
+
+        mark = (int(page.number), fontname)
+        if mark in self._on_page:
+            return True
+
+        xref = self._xrefs.get(fontname)
+        if xref and _add_font_ref_to_page(page, fontname, xref):
+            self._on_page.add(mark)
+            return True
+
+        entry = self.registry.get(fontfile)
+        try:
+            if entry is not None:
+                xref = page.insert_font(fontname=fontname, fontbuffer=entry.buffer)
+            else:
+                xref = page.insert_font(fontname=fontname, fontfile=fontfile)
+        except Exception:
+            return False
+
+        if xref:
+            self._xrefs[fontname] = int(xref)
+            self._on_page.add(mark)
+            return True
+        return False
+
+
+def _add_font_ref_to_page(page: "fitz.Page", fontname: str, xref: int) -> bool:
+    """
+    Ajoute /Font/<fontname> -> xref dans les ressources de la page.
+    Refuse (False) si les ressources sont héritées : créer un /Resources local
+    masquerait celles du parent.
+    """
+    doc = page.parent
+    try:
+        kind, val = doc.xref_get_key(page.xref, "Resources")
+        if kind == "xref":
+            target, prefix = int(val.split()[0]), ""
+        elif kind == "dict":
+            target, prefix = page.xref, "Resources/"
+        else:
+            return False
+
+        fkind, fval = doc.xref_get_key(target, f"{prefix}Font")
+        if fkind == "xref":
+            target, path = int(fval.split()[0]), fontname
+        elif fkind in ("dict", "null"):
+            path = f"{prefix}Font/{fontname}"
+        else:
+            return False
+
+        doc.xref_set_key(target, path, f"{int(xref)} 0 R")
+        return True
+    except Exception:
+        return False
+
+
+# instance process-wide utilisée par marketing_pdf_renderer
+font_registry = FontRegistry()
@@ -0,0 +1,398 @@
+# app/services/marketing_image_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# budget mémoire (octets) du cache LRU par process
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("MARKETING_IMAGE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+# TTL des échecs (fetch KO, 404, HTML cloudflare...) : court, pour retenter vite
+IMAGE_CACHE_NEGATIVE_TTL_S = float(os.environ.get("MARKETING_IMAGE_CACHE_NEGATIVE_TTL_S", "60"))
+# tier disque partagé entre workers du même noeud ("" => désactivé)
+IMAGE_CACHE_DIR = os.environ.get("MARKETING_IMAGE_CACHE_DIR", "").strip()
+# durée de vie d'une référence url -> contenu sur disque
+IMAGE_CACHE_DISK_TTL_S = float(os.environ.get("MARKETING_IMAGE_CACHE_DISK_TTL_S", str(24 * 3600)))
+# budget mémoire des rasters générés (dégradés, clips) : clés de contenu, jamais sur disque
+RASTER_CACHE_MAX_BYTES = int(os.environ.get("MARKETING_RASTER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# assets normalisés (webp -> png...) : budget mémoire par process
+IMAGE_ASSET_CACHE_MAX_BYTES = int(os.environ.get("MARKETING_IMAGE_ASSET_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# dossier partagé par les workers du pool ("" => désactivé) ; pas de purge : comme
+# MARKETING_IMAGE_CACHE_DIR, à placer sur un volume nettoyé par l'exploitation
+IMAGE_ASSET_DIR = os.environ.get("MARKETING_IMAGE_ASSET_DIR", "").strip()
+
+_MAX_NEGATIVE_ENTRIES = 4096
+
+
+def _sha256_hex(b: bytes) -> str:
+    return hashlib.sha256(b).hexdigest()
+
+
+def _is_remote(key: str) -> bool:
+    low = (key or "").lower()
+    return low.startswith("http://") or low.startswith("https://")
+
+
+class ImageCache:
+    """
+    Cache des images résolues par le renderer marketing.
+
+    - LRU en mémoire borné en octets (pas en nombre d'entrées)
+    - échecs mémorisés séparément avec un TTL court (un fetch KO transitoire
+      ne "blanchit" plus l'image jusqu'au redémarrage)
+    - tier disque optionnel, adressé par contenu (sha256), partagé par tous les
+      workers d'un noeud : refs/<sha(url)> -> sha(contenu), blobs/<sha(contenu)>
+
+    get() renvoie:
+      - bytes non vides : hit
+      - b""             : échec connu (negative hit, TTL non expiré)
+      - None            : miss => à résoudre puis put()
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+        negative_ttl_s: float = IMAGE_CACHE_NEGATIVE_TTL_S,
+        disk_dir: Optional[str] = IMAGE_CACHE_DIR or None,
+        disk_ttl_s: float = IMAGE_CACHE_DISK_TTL_S,
+    ) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        # une seule image ne doit pas pouvoir vider tout le cache
+        self.max_entry_bytes = max(1, self.max_bytes // 8)
+        self.negative_ttl_s = max(0.0, float(negative_ttl_s))
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_ttl_s = max(0.0, float(disk_ttl_s))
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._negative: "OrderedDict[str, float]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    # --------------------------------------------------------
+    # API
+    # --------------------------------------------------------
+    def get(self, key: str) -> Optional[bytes]:
+        if not key:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            b = self._entries.get(key)
+            if b is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return b
+
+            exp = self._negative.get(key)
+            if exp is not None:
+                if exp > now:
+                    self.negative_hits += 1
+                    return b""
+                del self._negative[key]
+
+        b = self._disk_get(key)
+        with self._lock:
+            if b:
+                self.disk_hits += 1
+                self._mem_put(key, b)
+                return b
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Optional[bytes]) -> None:
+        if not key:
+            return
+
+        if not value:
+            with self._lock:
+                self._negative[key] = time.monotonic() + self.negative_ttl_s
+                self._negative.move_to_end(key)
+                while len(self._negative) > _MAX_NEGATIVE_ENTRIES:
+                    self._negative.popitem(last=False)
+            return
+
+        with self._lock:
+            self._negative.pop(key, None)
+            self._mem_put(key, value)
+
+        # seules les images distantes vont sur disque (les fichiers locaux
+        # sont déjà sur disque et peuvent être remplacés)
+        if _is_remote(key):
+            self._disk_put(key, value)
+
+    def content_sha(self, key: str) -> Optional[str]:
+        """sha256 du contenu connu pour une URL distante (tier disque, TTL non expiré), sinon None."""
+        if self.disk_dir is None or not _is_remote(key):
+            return None
+        try:
+            ref = self._ref_path(key)
+            if self.disk_ttl_s and (time.time() - ref.stat().st_mtime) > self.disk_ttl_s:
+                return None
+            return ref.read_text(encoding="utf-8").strip() or None
+        except Exception:
+            return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._negative.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "negative_entries": len(self._negative),
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "disk_dir": str(self.disk_dir) if self.disk_dir else None,
+            }
+
+    # --------------------------------------------------------
+    # Mémoire (appelé sous lock)
+    # --------------------------------------------------------
+    def _mem_put(self, key: str, value: bytes) -> None:
+        size = len(value)
+        if size > self.max_entry_bytes:
+            return
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+
+        self._entries[key] = value
+        self._bytes += size
+
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    # --------------------------------------------------------
+    # Disque (best effort : jamais bloquant pour le rendu)
+    # --------------------------------------------------------
+    def _ref_path(self, key: str) -> Path:
+        h = _sha256_hex(key.encode("utf-8"))
+        return self.disk_dir / "refs" / h[:2] / h  # type: ignore[operator]
+
+    def _blob_path(self, content_sha: str) -> Path:
+        return self.disk_dir / "blobs" / content_sha[:2] / content_sha  # type: ignore[operator]
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if self.disk_dir is None or not _is_remote(key):
+            return None
+        try:
+            ref = self._ref_path(key)
+            st = ref.stat()
+            if self.disk_ttl_s and (time.time() - st.st_mtime) > self.disk_ttl_s:
+                return None
+            content_sha = ref.read_text(encoding="utf-8").strip()
+            if not content_sha:
+                return None
+            b = self._blob_path(content_sha).read_bytes()
+            # blob corrompu / tronqué => on ignore
+            if _sha256_hex(b) != content_sha:
+                return None
+            return b
+        except Exception:
+            return None
+
+    def _disk_put(self, key: str, value: bytes) -> None:
+        if self.disk_dir is None:
+            return
+        try:
+            content_sha = _sha256_hex(value)
+            blob = self._blob_path(content_sha)
+            if not blob.exists():
+                _atomic_write(blob, value)
+            _atomic_write(self._ref_path(key), content_sha.encode("utf-8"))
+        except Exception as e:
+            print("[PDF_RENDER][IMG_CACHE] disk write FAILED", type(e).__name__, str(e))
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """Image prête pour insert_image : bytes PyMuPDF-friendly + dimensions (px)."""
+
+    stream: bytes
+    kind: str
+    width: int
+    height: int
+
+
+class ImageAssetStore:
+    """
+    Assets image normalisés, adressés par le sha256 des bytes SOURCE.
+
+    La 1re fois qu'un contenu est vu, `prepare` le convertit (ex. webp -> png)
+    et le résultat est gardé avec ses dimensions ; les rendus suivants (et les
+    autres workers du noeud via le disque) insèrent directement les bytes préparés.
+
+    Disque optionnel (MARKETING_IMAGE_ASSET_DIR) : <dir>/<sha[:2]>/<sha>.bin + <sha>.json (kind, width, height, bytes).
+    Un échec de conversion est mémorisé par process (même contenu => même échec).
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = IMAGE_ASSET_CACHE_MAX_BYTES,
+        disk_dir: Optional[str] = IMAGE_ASSET_DIR or None,
+    ) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_entry_bytes = max(1, self.max_bytes // 8)
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, PreparedImage]" = OrderedDict()
+        self._failed: "OrderedDict[str, None]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.conversions = 0
+        self.failures = 0
+
+    def get_or_prepare(
+        self,
+        src: bytes,
+        prepare: Callable[[bytes], Optional[PreparedImage]],
+    ) -> Optional[PreparedImage]:
+        if not src:
+            return None
+        sha = _sha256_hex(src)
+
+        with self._lock:
+            p = self._entries.get(sha)
+            if p is not None:
+                self._entries.move_to_end(sha)
+                self.hits += 1
+                return p
+            if sha in self._failed:
+                return None
+
+        p = self._disk_get(sha)
+        if p is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._mem_put(sha, p)
+            return p
+
+        try:
+            p = prepare(src)
+        except Exception:
+            p = None
+
+        with self._lock:
+            if p is None:
+                self.failures += 1
+                self._failed[sha] = None
+                while len(self._failed) > _MAX_NEGATIVE_ENTRIES:
+                    self._failed.popitem(last=False)
+                return None
+            self.conversions += 1
+            self._mem_put(sha, p)
+
+        self._disk_put(sha, p)
+        return p
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._failed.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "failed_entries": len(self._failed),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "conversions": self.conversions,
+                "failures": self.failures,
+                "disk_dir": str(self.disk_dir) if self.disk_dir else None,
+            }
+
+    # appelé sous lock
+    def _mem_put(self, sha: str, p: PreparedImage) -> None:
+        size = len(p.stream)
+        if size > self.max_entry_bytes:
+            return
+        old = self._entries.pop(sha, None)
+        if old is not None:
+            self._bytes -= len(old.stream)
+        self._entries[sha] = p
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.stream)
+
+    def _paths(self, sha: str) -> "tuple[Path, Path]":
+        d = self.disk_dir / sha[:2]  # type: ignore[operator]
+        return d / f"{sha}.bin", d / f"{sha}.json"
+
+    def _disk_get(self, sha: str) -> Optional[PreparedImage]:
+        if self.disk_dir is None:
+            return None
+        try:
+            blob, meta_path = self._paths(sha)
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            b = blob.read_bytes()
+            # blob tronqué (écriture concurrente interrompue) => on reconvertit
+            if len(b) != int(meta["bytes"]):
+                return None
+            return PreparedImage(stream=b, kind=str(meta["kind"]), width=int(meta["width"]), height=int(meta["height"]))
+        except Exception:
+            return None
+
+    def _disk_put(self, sha: str, p: PreparedImage) -> None:
+        if self.disk_dir is None:
+            return
+        try:
+            blob, meta_path = self._paths(sha)
+            _atomic_write(blob, p.stream)
+            meta = {"kind": p.kind, "width": p.width, "height": p.height, "bytes": len(p.stream)}
+            # meta écrite en dernier : présente => blob complet
+            _atomic_write(meta_path, json.dumps(meta).encode("utf-8"))
+        except Exception as e:
+            print("[PDF_RENDER][IMG_ASSET] disk write FAILED", type(e).__name__, str(e))
+
+
+def content_key(*parts: Any) -> str:
+    """Clé stable pour un raster généré (paramètres déjà normalisés par l'appelant)."""
+    return _sha256_hex(repr(parts).encode("utf-8"))
+
+
+# instances process-wide utilisées par marketing_pdf_renderer
+image_cache = ImageCache()
+raster_cache = ImageCache(max_bytes=RASTER_CACHE_MAX_BYTES, disk_dir=None)
+image_assets = ImageAssetStore()
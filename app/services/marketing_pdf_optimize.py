@@ -0,0 +1,317 @@
+# app/services/marketing_pdf_optimize.py
+from __future__ import annotations
+
+import hashlib
+import io
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import fitz  # PyMuPDF
+except Exception:  # pragma: no cover
+    fitz = None
+
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+from app.services.marketing_render_metrics import span, incr
+
+
+@dataclass(frozen=True)
+class OptimizeProfile:
+    """
+    Passe d'optimisation de taille appliquée au PDF final, juste avant l'écriture.
+    image_dpi : résolution cible des images, calculée sur leur rect d'affichage.
+    """
+
+    name: str
+    image_dpi: int
+    jpeg_quality: int
+    # on ne rééchantillonne que si l'image dépasse le besoin d'au moins ce facteur
+    downsample_threshold: float = 1.5
+    # en dessous (px, plus grand côté) on ne touche pas à l'image
+    min_image_px: int = 64
+    subset_fonts: bool = True
+    # CMYK / Indexed -> RGB : OK pour l'écran, pas pour l'imprimeur
+    convert_colorspaces: bool = False
+
+
+PDF_OPTIMIZE_PROFILES: Dict[str, OptimizeProfile] = {
+    # agents (téléchargement mobile, lecture écran)
+    "screen": OptimizeProfile(name="screen", image_dpi=150, jpeg_quality=80, convert_colorspaces=True),
+    # impression : images gardées à 300 dpi, couleurs intactes
+    "print": OptimizeProfile(name="print", image_dpi=300, jpeg_quality=92),
+}
+
+# profil des downloads si la requête n'en précise pas ("none" = désactivé)
+PDF_OPTIMIZE_DEFAULT = os.environ.get("MARKETING_PDF_OPTIMIZE_DEFAULT", "screen").strip().lower() or "none"
+# mesure de la taille PDF complète AVANT optimisation (=> une sérialisation de plus) : bench / diagnostic ;
+# sans elle, le rapport donne toujours les octets images avant / après (image_bytes_*)
+PDF_OPTIMIZE_MEASURE = os.environ.get("MARKETING_PDF_OPTIMIZE_MEASURE", "0") == "1"
+
+# options d'écriture communes (avec ou sans profil)
+SAVE_OPTIONS: Dict[str, Any] = {"garbage": 4, "deflate": True}
+# avec profil : flux images / polices recompressés + objets regroupés en object streams
+OPTIMIZED_SAVE_OPTIONS: Dict[str, Any] = {
+    "garbage": 4,
+    "deflate": True,
+    "deflate_images": True,
+    "deflate_fonts": True,
+    "use_objstms": 1,
+}
+
+
+def resolve_profile(name: Optional[str]) -> Optional[OptimizeProfile]:
+    """"screen" / "print" -> profil ; None / "" / "none" -> None ; inconnu -> ValueError."""
+    key = (name or "").strip().lower()
+    if not key or key == "none":
+        return None
+    prof = PDF_OPTIMIZE_PROFILES.get(key)
+    if prof is None:
+        raise ValueError(f"Profil d'optimisation inconnu: {name} (attendu: {', '.join(sorted(PDF_OPTIMIZE_PROFILES))}, none)")
+    return prof
+
+
+def profile_name(name: Optional[str]) -> str:
+    """Nom normalisé (clés de cache) ; lève ValueError si inconnu."""
+    prof = resolve_profile(name)
+    return prof.name if prof else "none"
+
+
+# ------------------------------------------------------------
+# Images
+# ------------------------------------------------------------
+def _needed_px(doc: "fitz.Document") -> Dict[int, Tuple[float, float, int]]:
+    """
+    xref image -> (largeur, hauteur) max affichées en points sur l'ensemble des pages
+    + 1ère page où elle est affichée (replace_image passe par une page).
+
+    get_image_info(xrefs=True) calcule un md5 de chaque image décodée (très lent) :
+    on rapproche plutôt affichages et xrefs par taille en pixels. Deux images de même
+    taille prennent le plus grand des deux affichages (on sous-échantillonne moins, jamais trop).
+    """
+    shown: Dict[Tuple[int, int], Tuple[float, float]] = {}
+    first_page: Dict[int, int] = {}
+    dims: Dict[int, Tuple[int, int]] = {}
+    for pno in range(doc.page_count):
+        page = doc.load_page(pno)
+        for info in page.get_image_info(hashes=False, xrefs=False):
+            m = fitz.Matrix(info.get("transform") or (1, 0, 0, 1, 0, 0))
+            key = (int(info.get("width") or 0), int(info.get("height") or 0))
+            w_pt, h_pt = math.hypot(m.a, m.b), math.hypot(m.c, m.d)
+            prev = shown.get(key, (0.0, 0.0))
+            shown[key] = (max(prev[0], w_pt), max(prev[1], h_pt))
+        for item in page.get_images(full=True):
+            xref = int(item[0])
+            if xref > 0 and xref not in first_page:
+                first_page[xref] = pno
+                dims[xref] = (int(item[2]), int(item[3]))
+
+    out: Dict[int, Tuple[float, float, int]] = {}
+    for xref, pno in first_page.items():
+        size = shown.get(dims[xref])
+        if size:
+            out[xref] = (size[0], size[1], pno)
+    return out
+
+
+def _image_pixmap(doc: "fitz.Document", xref: int, smask: int, prof: OptimizeProfile) -> Optional["fitz.Pixmap"]:
+    pix = fitz.Pixmap(doc, xref)
+    if pix.colorspace is None:
+        return None  # masque / stencil
+    if pix.colorspace.n not in (1, 3):
+        if not prof.convert_colorspaces:
+            return None
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if smask:
+        mask = fitz.Pixmap(doc, smask)
+        if (mask.width, mask.height) != (pix.width, pix.height):
+            return None
+        pix = fitz.Pixmap(pix, mask)
+    return pix
+
+
+def _encode_resized(pix: "fitz.Pixmap", size: Tuple[int, int], as_jpeg: bool, quality: int) -> bytes:
+    mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[pix.n]
+    img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    img = img.resize(size, Image.LANCZOS)
+    buf = io.BytesIO()
+    if as_jpeg and not pix.alpha:
+        img.save(buf, format="JPEG", quality=int(quality), optimize=True)
+    else:
+        img.save(buf, format="PNG", compress_level=6)
+    return buf.getvalue()
+
+
+def _downsample_images(doc: "fitz.Document", prof: OptimizeProfile, report: Dict[str, Any]) -> None:
+    if Image is None:
+        return
+    needed = _needed_px(doc)
+    for xref, (w_pt, h_pt, pno) in needed.items():
+        try:
+            if doc.xref_get_key(xref, "ImageMask")[1] == "true":
+                continue
+            width = int(doc.xref_get_key(xref, "Width")[1] or 0)
+            height = int(doc.xref_get_key(xref, "Height")[1] or 0)
+            if max(width, height) < prof.min_image_px or w_pt <= 0 or h_pt <= 0:
+                continue
+
+            # px nécessaires au dpi cible pour le plus grand rect d'affichage
+            scale = min(width / (w_pt * prof.image_dpi / 72.0), height / (h_pt * prof.image_dpi / 72.0))
+            if scale < prof.downsample_threshold:
+                continue
+            size = (max(1, round(width / scale)), max(1, round(height / scale)))
+
+            smask_key = doc.xref_get_key(xref, "SMask")
+            smask = int(smask_key[1].split()[0]) if smask_key[0] == "xref" else 0
+            old_bytes = len(doc.xref_stream_raw(xref) or b"") + (len(doc.xref_stream_raw(smask) or b"") if smask else 0)
+
+            pix = _image_pixmap(doc, xref, smask, prof)
+            if pix is None:
+                continue
+            as_jpeg = "DCTDecode" in (doc.xref_get_key(xref, "Filter")[1] or "")
+            stream = _encode_resized(pix, size, as_jpeg, prof.jpeg_quality)
+            if len(stream) >= old_bytes:
+                continue  # déjà plus compact que ce qu'on produirait
+
+            doc.load_page(pno).replace_image(xref, stream=stream)
+            report["images_downsampled"] += 1
+            report["image_bytes_saved"] += old_bytes - len(stream)
+        except Exception as e:
+            # image exotique (JBIG2, colorspace inattendu...) : laissée telle quelle
+            print("[PDF_OPT] image xref", xref, "ignorée:", e)
+
+
+def _image_digest(doc: "fitz.Document", xref: int) -> Tuple[str, int]:
+    """(empreinte, octets bruts image + masque) : flux lus une seule fois."""
+    raw = doc.xref_stream_raw(xref) or b""
+    size = len(raw)
+    h = hashlib.sha256(raw)
+    for key in ("Width", "Height", "BitsPerComponent", "ColorSpace", "Filter", "DecodeParms", "Decode"):
+        h.update(f"|{key}={doc.xref_get_key(xref, key)[1]}".encode())
+    smask = doc.xref_get_key(xref, "SMask")
+    if smask[0] == "xref":
+        raw = doc.xref_stream_raw(int(smask[1].split()[0])) or b""
+        size += len(raw)
+        h.update(hashlib.sha256(raw).digest())
+    return h.hexdigest(), size
+
+
+def _xobject_dict(doc: "fitz.Document", holder: int) -> Tuple[int, str]:
+    """(xref, chemin) du dict /XObject de holder (page ou form) : xref_set_key ne suit pas les références indirectes."""
+    path = "Resources"
+    kind, val = doc.xref_get_key(holder, path)
+    if kind == "xref":
+        holder, path = int(val.split()[0]), ""
+    sub = f"{path}/XObject" if path else "XObject"
+    kind, val = doc.xref_get_key(holder, sub)
+    if kind == "xref":
+        return int(val.split()[0]), ""
+    return holder, sub
+
+
+def _dedupe_images(doc: "fitz.Document", report: Dict[str, Any]) -> None:
+    """
+    Images identiques embarquées plusieurs fois (PDF source, tranches recollées...) :
+    toutes les références pointent sur la 1ère occurrence, garbage=4 supprime les autres.
+    Compte au passage les octets bruts des images (taille "avant" sans sérialisation).
+    """
+    canon: Dict[str, int] = {}
+    digests: Dict[int, str] = {}
+    for pno in range(doc.page_count):
+        page = doc.load_page(pno)
+        for xref, _smask, _w, _h, _bpc, _cs, _alt, name, _filt, referencer in page.get_images(full=True):
+            if xref <= 0 or not name:
+                continue
+            try:
+                digest = digests.get(xref)
+                if digest is None:
+                    digest, size = _image_digest(doc, xref)
+                    digests[xref] = digest
+                    report["image_bytes_before"] += size
+                    if digest in canon:
+                        # doublon : supprimé par garbage=4 une fois ses références redirigées
+                        report["image_bytes_saved"] += size
+                first = canon.setdefault(digest, xref)
+                if first == xref:
+                    continue
+                holder, path = _xobject_dict(doc, referencer or page.xref)
+                doc.xref_set_key(holder, f"{path}/{name}" if path else name, f"{first} 0 R")
+                report["images_deduped"] += 1
+            except Exception as e:
+                print("[PDF_OPT] dédoublonnage image xref", xref, "ignoré:", e)
+
+
+# ------------------------------------------------------------
+# Point d'entrée
+# ------------------------------------------------------------
+def optimize_document(doc: "fitz.Document", profile: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Optimise doc EN PLACE avant écriture (à enregistrer avec OPTIMIZED_SAVE_OPTIONS) :
+    images dédoublonnées puis rééchantillonnées au dpi du profil, polices réduites
+    aux glyphes utilisés. Retourne le rapport (None si profil "none").
+    """
+    prof = resolve_profile(profile)
+    if prof is None or fitz is None:
+        return None
+
+    started = time.perf_counter()
+    report: Dict[str, Any] = {
+        "profile": prof.name,
+        "size_before": None,
+        # octets bruts des images avant / économisés (toujours mesurés, sans sérialisation)
+        "image_bytes_before": 0,
+        "image_bytes_saved": 0,
+        "images_deduped": 0,
+        "images_downsampled": 0,
+        "fonts_subset": False,
+    }
+    with span("optimize"):
+        if PDF_OPTIMIZE_MEASURE:
+            report["size_before"] = len(doc.tobytes(**SAVE_OPTIONS))
+
+        _dedupe_images(doc, report)
+        _downsample_images(doc, prof, report)
+
+        if prof.subset_fonts:
+            try:
+                doc.subset_fonts()
+                report["fonts_subset"] = True
+            except Exception as e:
+                print("[PDF_OPT] subset_fonts KO:", e)
+
+    report["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    incr("opt_images_deduped", report["images_deduped"])
+    incr("opt_images_downsampled", report["images_downsampled"])
+    incr("opt_image_bytes_before", report["image_bytes_before"])
+    incr("opt_image_bytes_saved", report["image_bytes_saved"])
+    return report
+
+
+def save_options(report: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return OPTIMIZED_SAVE_OPTIONS if report is not None else SAVE_OPTIONS
+
+
+def log_report(report: Optional[Dict[str, Any]], size_after: int) -> None:
+    if report is None:
+        return
+    report["size_after"] = int(size_after)
+    before = report.get("size_before")
+    incr("opt_size_after", int(size_after))
+    if before:
+        incr("opt_size_before", int(before))
+    gain = f" ({100.0 * (1 - size_after / before):.0f}%)" if before else ""
+    img_before = int(report.get("image_bytes_before") or 0)
+    img_after = img_before - int(report.get("image_bytes_saved") or 0)
+    img_gain = f" ({100.0 * (1 - img_after / img_before):.0f}%)" if img_before else ""
+    print(
+        f"[PDF_OPT] profile={report['profile']} before={before} after={size_after}{gain}"
+        f" images={img_before}->{img_after}{img_gain}"
+        f" dedup={report['images_deduped']} downsampled={report['images_downsampled']}"
+        f" fonts_subset={report['fonts_subset']} {report['ms']}ms"
+    )
@@ -5,7 +5,7 @@ import base64
 import re
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, List
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, List, Union
 
 try:
     import fitz  # PyMuPDF
@@ -19,12 +19,47 @@ except Exception:
 
 from urllib.parse import urlparse
 
+import contextvars
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 import requests
+from requests.adapters import HTTPAdapter
+
+import hashlib
+from app.services.marketing_image_cache import (
+    IMAGE_CACHE_DISK_TTL_S,
+    image_cache,
+    image_assets,
+    raster_cache,
+    content_key,
+    PreparedImage,
+)
+from app.services import marketing_render_cache as render_cache
+from app.services.marketing_font_registry import font_registry, DocumentFonts
+from app.services.marketing_text_layout import (
+    text_measurer,
+    fit_single_line_fontsize,
+    fit_two_sizes,
+    autofit_start_fontsize,
+)
+from app.services.marketing_render_metrics import span, incr
+from app.services import marketing_pdf_optimize as pdf_optimize
+
+if TYPE_CHECKING:  # import circulaire au runtime (le plan réutilise les helpers d'ici)
+    from app.services.marketing_render_plan import RenderPlan
 
 MEDIA_ROOT = Path(os.environ.get("MEDIA_ROOT", "/app/media")).resolve()
 PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")  # ex: https://zenhub.mondomaine.com
 
+# prefetch images : nb de fetch simultanés (total / par hôte distant)
+IMAGE_PREFETCH_WORKERS = max(1, int(os.environ.get("MARKETING_IMAGE_PREFETCH_WORKERS", "8")))
+IMAGE_PREFETCH_PER_HOST = max(1, int(os.environ.get("MARKETING_IMAGE_PREFETCH_PER_HOST", "4")))
+# dessin groupé par page (shapes + textes dans une seule Shape) ; "0" => un commit par objet
+RENDER_BATCH_DRAW = os.environ.get("MARKETING_RENDER_BATCH_DRAW", "1").strip() != "0"
+
 # ------------------------------------------------------------
 # Colors
 # ------------------------------------------------------------
@@ -136,20 +171,6 @@ def _bytes_looks_webp(b: bytes) -> bool:
     return b[:4] == b"RIFF" and b[8:12] == b"WEBP"
 
 
-def _webp_to_png_bytes(webp_bytes: bytes) -> Optional[bytes]:
-    if Image is None:
-        return None
-    try:
-        from io import BytesIO
-        im = Image.open(BytesIO(webp_bytes))
-        im = im.convert("RGBA") if im.mode not in ("RGB", "RGBA") else im
-        buf = BytesIO()
-        im.save(buf, format="PNG", optimize=True)
-        return buf.getvalue()
-    except Exception:
-        return None
-
-
 def _sniff_image_kind(b: bytes) -> str:
     if not b or len(b) < 16:
         return ""
@@ -164,71 +185,92 @@ def _sniff_image_kind(b: bytes) -> str:
         return "webp"
     return ""
 
-def _try_webp_to_png(b: bytes) -> Optional[bytes]:
-    # nécessite pillow avec support webp
+def _normalize_webp(b: bytes) -> Optional[PreparedImage]:
+    # nécessite pillow avec support webp ; appelé une fois par contenu (image_assets)
     if Image is None:
         return None
-    try:
-        from io import BytesIO
-        im = Image.open(BytesIO(b))
-        im.load()
-        im = im.convert("RGBA") if im.mode not in ("RGB", "RGBA") else im
-        out = BytesIO()
-        im.save(out, format="PNG", optimize=True)
-        return out.getvalue()
-    except Exception:
+    from io import BytesIO
+    im = Image.open(BytesIO(b))
+    im.load()
+    im = im.convert("RGBA") if im.mode not in ("RGB", "RGBA") else im
+    out = BytesIO()
+    im.save(out, format="PNG", optimize=True)
+    return PreparedImage(stream=out.getvalue(), kind="png", width=im.width, height=im.height)
+
+
+def _prepared_image_bytes(b: bytes) -> Optional[bytes]:
+    """
+    Bytes insérables par PyMuPDF : jpg / png / gif tels quels, webp converti
+    en png UNE fois par contenu (store d'assets mémoire + disque) puis réutilisé.
+    None si la source n'est pas une image utilisable.
+    """
+    kind = _sniff_image_kind(b)
+    if kind in ("jpg", "png", "gif"):
+        return b
+    if kind != "webp":
+        return None
+    with span("image_prepare"):
+        p = image_assets.get_or_prepare(b, _normalize_webp)
+    if p is None:
         return None
+    incr("img_webp_prepared")
+    return p.stream
 
 def _bytes_is_definitely_image(b: bytes) -> bool:
     return _sniff_image_kind(b) in ("jpg", "png", "gif", "webp")
 
 
 
-def _resolve_image_to_bytes(src: str, timeout_s: int = 12) -> bytes | None:
+# client HTTP partagé (keep-alive + pool de connexions par hôte)
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=IMAGE_PREFETCH_WORKERS))
+_http.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=IMAGE_PREFETCH_WORKERS))
+
+_host_slots_lock = threading.Lock()
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+
+
+@contextmanager
+def _host_slot(url: str):
+    """Limite le nb de requêtes simultanées vers un même hôte."""
+    host = (urlparse(url).netloc or "").lower()
+    with _host_slots_lock:
+        sem = _host_slots.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(IMAGE_PREFETCH_PER_HOST)
+            _host_slots[host] = sem
+    with sem:
+        yield
+
+
+def _local_image_path(s: str) -> Optional[Path]:
     """
-    Résout une image depuis :
+    Fichier local correspondant à la source, sinon None :
       - un chemin local (/app/... ou MEDIA_ROOT/...)
       - une URL relative /media/... (mappée vers MEDIA_ROOT)
-      - une URL absolue https://TON_DOMAINE/media/... (mappée vers MEDIA_ROOT) ✅
-      - une URL relative /... + PUBLIC_BASE_URL
-      - une URL http(s) distante (avec headers + garde-fous)
-
-    Retourne les bytes de l'image, sinon None.
+      - une URL absolue https://TON_DOMAINE/media/... (mappée vers MEDIA_ROOT)
     """
-    if not src:
-        return None
-
-    s = str(src).strip()
-    if not s:
-        return None
-
-    # ------------------------------------------------------------
     # 1) chemin local direct
-    # ------------------------------------------------------------
     try:
         if s.startswith("/app/") or s.startswith(str(MEDIA_ROOT)):
             p = Path(s).resolve()
             if p.exists() and p.is_file():
-                return p.read_bytes()
+                return p
     except Exception:
         pass
 
-    # ------------------------------------------------------------
     # 2) URL relative /media/... -> MEDIA_ROOT
-    # ------------------------------------------------------------
     try:
         if s.startswith("/media/"):
             p = (MEDIA_ROOT / s[len("/media/"):]).resolve()
             # sécurité: empêche ../ de sortir du MEDIA_ROOT
             if str(p).startswith(str(MEDIA_ROOT)) and p.exists() and p.is_file():
-                return p.read_bytes()
+                return p
     except Exception:
         pass
 
-    # ------------------------------------------------------------
     # ✅ 2bis) URL ABSOLUE vers NOTRE domaine + /media/... -> MEDIA_ROOT
     # (évite requests.get(https://...) et donc les timeouts Cloudflare)
-    # ------------------------------------------------------------
     try:
         if s.startswith("http://") or s.startswith("https://"):
             u = urlparse(s)
@@ -249,10 +291,70 @@ def _resolve_image_to_bytes(src: str, timeout_s: int = 12) -> bytes | None:
             if host in local_hosts and path.startswith("/media/"):
                 p = (MEDIA_ROOT / path[len("/media/"):]).resolve()
                 if str(p).startswith(str(MEDIA_ROOT)) and p.exists() and p.is_file():
-                    return p.read_bytes()
+                    return p
     except Exception:
         pass
 
+    return None
+
+
+def image_source_version(src: str) -> str:
+    """
+    Version du CONTENU d'une source image, pour les clés de cache par page :
+      - fichier local : sha256 du fichier (mémoïsé par taille + mtime)
+      - URL distante : sha du contenu connu du tier disque de l'image_cache,
+        sinon tranche de IMAGE_CACHE_DISK_TTL_S (même fraîcheur que le cache image)
+      - data-url : "" (les bytes sont déjà dans le contenu de la page)
+    Une image remplacée sous la même URL change donc la clé de la page.
+    """
+    s = str(src or "").strip()
+    if not s or s.lower().startswith("data:"):
+        return ""
+
+    p = _local_image_path(s)
+    if p is not None:
+        try:
+            return "f:" + render_cache.file_sha256(p)
+        except Exception:
+            return ""
+
+    if s.startswith("/") and PUBLIC_BASE_URL:
+        s = f"{PUBLIC_BASE_URL}{s}"
+    sha = image_cache.content_sha(s)
+    if sha:
+        return "c:" + sha
+    return "t:" + str(int(time.time() // max(1.0, IMAGE_CACHE_DISK_TTL_S)))
+
+
+def _resolve_image_to_bytes(src: str, timeout_s: int = 12) -> bytes | None:
+    """
+    Résout une image depuis :
+      - un chemin local (/app/... ou MEDIA_ROOT/...)
+      - une URL relative /media/... (mappée vers MEDIA_ROOT)
+      - une URL absolue https://TON_DOMAINE/media/... (mappée vers MEDIA_ROOT) ✅
+      - une URL relative /... + PUBLIC_BASE_URL
+      - une URL http(s) distante (avec headers + garde-fous)
+
+    Retourne les bytes de l'image, sinon None.
+    """
+    if not src:
+        return None
+
+    s = str(src).strip()
+    if not s:
+        return None
+
+    # ------------------------------------------------------------
+    # 1) 2) 2bis) fichier local (chemin, /media/..., URL de notre domaine)
+    # ------------------------------------------------------------
+    p = _local_image_path(s)
+    if p is not None:
+        try:
+            incr("img_local")
+            return p.read_bytes()
+        except Exception:
+            pass
+
     # ------------------------------------------------------------
     # 3) URL relative /... + PUBLIC_BASE_URL -> URL absolue
     # ------------------------------------------------------------
@@ -264,16 +366,18 @@ def _resolve_image_to_bytes(src: str, timeout_s: int = 12) -> bytes | None:
     # ------------------------------------------------------------
     if s.startswith("http://") or s.startswith("https://"):
         try:
-            r = requests.get(
-                s,
-                timeout=timeout_s,
-                allow_redirects=True,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (ZenHub PDF Renderer)",
-                    "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
-                    "Referer": PUBLIC_BASE_URL or "https://www.powerfieldmanager.com",
-                },
-            )
+            incr("img_remote")
+            with _host_slot(s):
+                r = _http.get(
+                    s,
+                    timeout=timeout_s,
+                    allow_redirects=True,
+                    headers={
+                        "User-Agent": "Mozilla/5.0 (ZenHub PDF Renderer)",
+                        "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
+                        "Referer": PUBLIC_BASE_URL or "https://www.powerfieldmanager.com",
+                    },
+                )
 
             ctype = (r.headers.get("Content-Type") or "").lower().strip()
             content = r.content or b""
@@ -321,27 +425,141 @@ def _resolve_image_to_bytes(src: str, timeout_s: int = 12) -> bytes | None:
 
 
 
-def _convert_webp_to_png_bytes(webp_bytes: bytes) -> Optional[bytes]:
+def _load_image_candidate(cand: str, prefetched: Optional[Dict[str, bytes]] = None) -> bytes:
     """
-    Convertit WEBP -> PNG (bytes) si Pillow est dispo.
-    Retourne None si conversion impossible.
+    Résout une source image via le prefetch du rendu, puis le cache process
+    (LRU borné + TTL des échecs). Retourne b"" si la source est inutilisable.
     """
-    try:
-        from PIL import Image  # type: ignore
-        from io import BytesIO
-    except Exception:
-        return None
+    s = str(cand or "").strip()
+    if not s:
+        return b""
 
-    try:
-        inp = BytesIO(webp_bytes)
-        im = Image.open(inp)
-        im.load()
-        out = BytesIO()
-        # PNG = support ultra-safe pour PyMuPDF
-        im.save(out, format="PNG")
-        return out.getvalue()
-    except Exception:
-        return None
+    if prefetched is not None:
+        b = prefetched.get(s)
+        if b is not None:
+            return b
+
+    # data-url : les bytes sont déjà dans la clé, inutile de les cacher
+    b = _parse_data_url(s)
+    if b:
+        incr("img_data_url")
+        return b
+
+    # fichier local : la clé suit taille + mtime (fichier remplacé => relu)
+    key = s
+    p = _local_image_path(s)
+    if p is not None:
+        try:
+            st = p.stat()
+            key = f"{s}#{st.st_size}:{st.st_mtime_ns}"
+        except Exception:
+            pass
+
+    cached = image_cache.get(key)
+    if cached is not None:
+        incr("img_cache_hit")
+        return cached
+
+    b = _resolve_image_to_bytes(s, timeout_s=8) or None
+    image_cache.put(key, b)
+    return b or b""
+
+
+# ------------------------------------------------------------
+# Prefetch images (avant la boucle de rendu)
+# ------------------------------------------------------------
+_prefetch_pool: Optional[ThreadPoolExecutor] = None
+_prefetch_pool_lock = threading.Lock()
+
+
+def _get_prefetch_pool() -> ThreadPoolExecutor:
+    global _prefetch_pool
+    with _prefetch_pool_lock:
+        if _prefetch_pool is None:
+            _prefetch_pool = ThreadPoolExecutor(
+                max_workers=IMAGE_PREFETCH_WORKERS,
+                thread_name_prefix="pdf-img-prefetch",
+            )
+        return _prefetch_pool
+
+
+def _collect_image_candidate_chains(
+    plan: "RenderPlan",
+    page_indexes: List[int],
+    layer: Optional[str] = None,
+) -> List[Tuple[str, ...]]:
+    """
+    Liste dédupliquée des chaînes de candidats (src, fallbacks...) des objets
+    image / clip des pages à rendre, dans le même ordre que la boucle de rendu.
+    """
+    chains: List[Tuple[str, ...]] = []
+    seen = set()
+    for page_index in page_indexes:
+        objs = plan.page_objects(page_index)
+        if layer is not None:
+            shared_objs, variant_objs = plan.split_shared(page_index)
+            objs = shared_objs if layer == "shared" else variant_objs
+        for po in objs:
+            if po.category not in ("clip", "image"):
+                continue
+            cands = po.image_sources or []
+
+            # même limite que la boucle ; data-url : rien à télécharger
+            chain = tuple(c for c in cands[:5] if not c.lower().startswith("data:"))
+            if chain and chain not in seen:
+                seen.add(chain)
+                chains.append(chain)
+    return chains
+
+
+def _prefetch_draft_images(
+    plan: "RenderPlan", page_indexes: List[int], layer: Optional[str] = None
+) -> Dict[str, bytes]:
+    """
+    Résout en parallèle toutes les images des pages à rendre.
+    Chaque chaîne est testée dans l'ordre (s'arrête au 1er candidat valide, comme la
+    boucle), les chaînes tournent en parallèle, une URL n'est chargée qu'une fois.
+    Retourne {source: bytes} (b"" = échec) : la boucle n'a plus qu'à piocher dedans.
+    """
+    chains = _collect_image_candidate_chains(plan, page_indexes, layer)
+    if not chains:
+        return {}
+
+    lock = threading.Lock()
+    inflight: Dict[str, Future] = {}
+
+    def _load_once(cand: str) -> bytes:
+        with lock:
+            fut = inflight.get(cand)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                inflight[cand] = fut
+        if not owner:
+            return fut.result()
+        try:
+            b = _load_image_candidate(cand)
+        except Exception:
+            b = b""
+        fut.set_result(b)
+        return b
+
+    def _run_chain(chain: Tuple[str, ...]) -> None:
+        for cand in chain:
+            b = _load_once(cand)
+            if b and _bytes_is_definitely_image(b):
+                return
+
+    if len(chains) == 1:
+        _run_chain(chains[0])
+    else:
+        pool = _get_prefetch_pool()
+        # copy_context : les compteurs (img_local / img_remote...) suivent dans les threads
+        futs = [pool.submit(contextvars.copy_context().run, _run_chain, c) for c in chains]
+        for f in futs:
+            f.result()
+
+    return {k: f.result() for k, f in inflight.items()}
 
 
 def _pick_first_image_bytes_from_candidates(src_candidates: Any) -> Optional[bytes]:
@@ -476,14 +694,12 @@ def _draw_textbox_fit_single_line(
     # cap hauteur (sinon clipping vertical)
     fs = min(fs, max(4.0, rect.height * 0.80))
 
-    # boucle auto-fit largeur
-    for _ in range(18):
-        w = _text_width_pt(txt, fs, fontname or "helv", fontfile)
-        if w <= rect.width * 0.98:
-            break
-        fs = max(4.0, fs * 0.92)
-        if fs <= 4.01:
-            break
+    # auto-fit largeur : 1 mesure à 1pt, taille calculée directement
+    fs = fit_single_line_fontsize(
+        text_measurer.unit_width(txt, fontname or "helv", fontfile),
+        fs,
+        rect.width * 0.98,
+    )
 
     kwargs: Dict[str, Any] = {
         "fontsize": fs,
@@ -661,9 +877,9 @@ def _resolve_global_fontfile_path(family: str, ctx: "RenderContext") -> Optional
         return None
 
     try:
-        pp = Path(str(p))
-        if pp.exists() and pp.is_file() and pp.suffix.lower() in (".ttf", ".otf"):
-            return str(pp)
+        pp = str(Path(str(p)))
+        if font_registry.exists(pp):
+            return pp
     except Exception:
         return None
 
@@ -677,7 +893,12 @@ def _guess_font_weight_from_path(path: str) -> int:
     return 400
 
 
-def _resolve_fontfile_path(family: str, weight: int, ctx: "RenderContext") -> Optional[str]:
+def _resolve_fontfile_path(
+    family: str,
+    weight: int,
+    ctx: "RenderContext",
+    cache: Optional[Dict[str, str]] = None,
+) -> Optional[str]:
     if fitz is None:
         return None
 
@@ -685,6 +906,18 @@ def _resolve_fontfile_path(family: str, weight: int, ctx: "RenderContext") -> Op
     if not fam:
         return None
 
+    # ✅ résolution mémoïsée pour le rendu en cours ("" = introuvable)
+    memo_key = f"PATH::{fam}::{int(weight or 0)}"
+    if cache is not None and memo_key in cache:
+        return cache[memo_key] or None
+
+    p = _resolve_fontfile_path_uncached(fam, weight, ctx)
+    if cache is not None:
+        cache[memo_key] = p or ""
+    return p
+
+
+def _resolve_fontfile_path_uncached(fam: str, weight: int, ctx: "RenderContext") -> Optional[str]:
     # ✅ 1) GLOBAL fonts (superuser)
     gp = _resolve_global_fontfile_path(fam, ctx)
     if gp:
@@ -705,7 +938,7 @@ def _resolve_fontfile_path(family: str, weight: int, ctx: "RenderContext") -> Op
                 p = Path(str(font_path))
                 if not p.is_absolute() and ctx.fonts_dir:
                     p = Path(ctx.fonts_dir) / p
-                if p.exists() and p.suffix.lower() in (".ttf", ".otf"):
+                if font_registry.exists(str(p)):
                     return str(p)
             except Exception:
                 pass
@@ -717,7 +950,7 @@ def _resolve_fontfile_path(family: str, weight: int, ctx: "RenderContext") -> Op
         if p:
             try:
                 pp = Path(str(p))
-                if pp.exists() and pp.suffix.lower() in (".ttf", ".otf"):
+                if font_registry.exists(str(pp)):
                     return str(pp)
             except Exception:
                 return None
@@ -732,6 +965,7 @@ def _register_font_if_needed(
     weight: int,
     ctx: "RenderContext",
     cache: Dict[str, str],
+    doc_fonts: Optional[DocumentFonts] = None,
 ) -> str:
     if fitz is None:
         return "helv"
@@ -740,20 +974,28 @@ def _register_font_if_needed(
     if not fam:
         return "helv"
 
-    fontfile = _resolve_fontfile_path(fam, weight, ctx)
+    fontfile = _resolve_fontfile_path(fam, weight, ctx, cache)
     if not fontfile:
         return "helv"
 
     eff_weight = weight or _guess_font_weight_from_path(fontfile)
     cache_key = f"{fontfile}::{eff_weight}"
-    if cache_key in cache:
-        return cache[cache_key]
+    internal_name = cache.get(cache_key)
+    if internal_name:
+        # ✅ police déjà embarquée dans ce document : simple référence sur la page
+        if doc_fonts is not None:
+            doc_fonts.ensure(page, internal_name, fontfile)
+        return internal_name
 
     safe_name = re.sub(r"[^a-z0-9]+", "_", fam.lower())[:40] or "font"
     internal_name = f"zh_{safe_name}_{eff_weight}"
     if internal_name in cache.values():
         internal_name = f"{internal_name}_{len(cache) + 1}"
 
+    if doc_fonts is not None and doc_fonts.ensure(page, internal_name, fontfile):
+        cache[cache_key] = internal_name
+        return internal_name
+
     try:
         page.insert_font(fontname=internal_name, fontfile=fontfile)
         cache[cache_key] = internal_name
@@ -785,6 +1027,11 @@ class RenderContext:
 
     is_agent: bool = False
 
+    # ✅ variantes de prix (rendu par lot) : None => réglage de chaque objet
+    price_mode: Optional[str] = None  # "base" / "tier" pour tous les product_price
+    tier_qty_min: Optional[int] = None  # avec "tier" : palier qty_min <= valeur (le plus haut), sinon prix de base
+    stock_badge_mode: Optional[str] = None  # remplace mode_agent ("always" / "never" / "only_if_zero")
+
 
 def _resolve_dynamic_text(obj: Dict[str, Any], ctx: RenderContext) -> Optional[str]:
     dyn = obj.get("dynamic") or {}
@@ -808,14 +1055,22 @@ def _resolve_dynamic_text(obj: Dict[str, Any], ctx: RenderContext) -> Optional[s
         if pid <= 0:
             return None
 
-        price_mode = str(_dyn_get("price_mode", "priceMode") or "base").strip().lower()
+        price_mode = str(ctx.price_mode or _dyn_get("price_mode", "priceMode") or "base").strip().lower()
         tier_id = _dyn_get("tier_id", "tierId")
         tier_id = _safe_int(tier_id, 0) if tier_id is not None else 0
 
         p = (ctx.products_by_id or {}).get(pid) or {}
         price_value = None
 
-        if price_mode == "tier" and tier_id > 0:
+        if price_mode == "tier" and ctx.tier_qty_min is not None:
+            # variante : palier choisi par quantité (les tier_id sont propres à chaque produit)
+            tiers = (ctx.tiers_by_product_id or {}).get(pid) or []
+            ok = [x for x in tiers if _safe_int(x.get("qty_min"), 0) <= int(ctx.tier_qty_min) and x.get("price_ht") is not None]
+            if ok:
+                price_value = max(ok, key=lambda x: _safe_int(x.get("qty_min"), 0)).get("price_ht")
+            elif p.get("price_ht") is not None:
+                price_value = p.get("price_ht")
+        elif price_mode == "tier" and tier_id > 0:
             tiers = (ctx.tiers_by_product_id or {}).get(pid) or []
             t = next((x for x in tiers if _safe_int(x.get("id"), 0) == tier_id), None)
             if t and t.get("price_ht") is not None:
@@ -844,7 +1099,7 @@ def _resolve_dynamic_text(obj: Dict[str, Any], ctx: RenderContext) -> Optional[s
             stock = None
 
         text = str(_dyn_get("text") or "Rupture de stock")
-        mode_agent = str(_dyn_get("mode_agent", "modeAgent") or "only_if_zero").strip().lower()
+        mode_agent = str(ctx.stock_badge_mode or _dyn_get("mode_agent", "modeAgent") or "only_if_zero").strip().lower()
 
         # ✅ AGENT ONLY : ne rien afficher si stock > 0
         if getattr(ctx, "is_agent", False):
@@ -924,20 +1179,8 @@ def _text_width_pt(text: str, fontsize: float, fontname: str, fontfile: Optional
     if not txt:
         return 0.0
 
-    if fontfile:
-        try:
-            f = fitz.Font(fontfile=fontfile)
-            return float(f.text_length(txt, fontsize=fontsize))
-        except Exception:
-            pass
-
-    try:
-        return float(fitz.get_text_length(txt, fontname=fontname or "helv", fontsize=fontsize))
-    except Exception:
-        try:
-            return float(fitz.get_text_length(txt, fontname="helv", fontsize=fontsize))
-        except Exception:
-            return 0.0
+    # ✅ mesure à 1pt mémoïsée (texte, police) : largeur linéaire en taille
+    return text_measurer.width(txt, fontsize, fontname or "helv", fontfile)
 
 
 def _draw_text_centered_line(
@@ -976,21 +1219,28 @@ def _draw_price_mixed_sizes(
     font_size_pt: float,
     color: Tuple[float, float, float],
     euros_plus_pt: float = 2.0,
+    doc_fonts: Optional[DocumentFonts] = None,
+    out: Any = None,
 ) -> None:
+    # out : cible des insert_text (Shape groupée), page par défaut ; page sert aux polices
     if fitz is None:
         return
+    if out is None:
+        out = page
 
     s = (price_txt or "").strip()
     if not s:
         return
 
     EURO_FONTFILE = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-    euro_fontfile = EURO_FONTFILE if Path(EURO_FONTFILE).exists() else None
+    euro_fontfile = EURO_FONTFILE if font_registry.exists(EURO_FONTFILE) else None
     euro_fontname = "dejavu" if euro_fontfile else (fontname_safe or "helv")
+    if euro_fontfile and doc_fonts is not None:
+        doc_fonts.ensure(page, euro_fontname, euro_fontfile)
 
     if "," not in s:
         _insert_text_single_line(
-            page=page,
+            page=out,
             x=rect.x0 + 1.0,
             y=_y_baseline_for_rect(rect),
             text=s,
@@ -1026,28 +1276,21 @@ def _draw_price_mixed_sizes(
         fs_big = max_fs_by_h
         fs_small = max(4.0, fs_small * ratio)
 
-    for _ in range(18):
-        w_a = _text_width_pt(a, fs_big, fontname_main or "helv", fontfile_main) if a else 0.0
-        w_bn = _text_width_pt(b_num, fs_small, fontname_main or "helv", fontfile_main) if b_num else 0.0
-        w_be = _text_width_pt(b_eur, fs_small, euro_fontname or "helv", euro_fontfile) if b_eur else 0.0
-
-        total = w_a + w_bn + w_be
-        if total > 0 and total <= rect.width * 0.98:
-            break
+    # ✅ 3 mesures à 1pt (mémoïsées), puis pure arithmétique
+    u_a = text_measurer.unit_width(a, fontname_main or "helv", fontfile_main) if a else 0.0
+    u_bn = text_measurer.unit_width(b_num, fontname_main or "helv", fontfile_main) if b_num else 0.0
+    u_be = text_measurer.unit_width(b_eur, euro_fontname or "helv", euro_fontfile) if b_eur else 0.0
 
-        fs_big = max(4.0, fs_big * 0.92)
-        fs_small = max(4.0, fs_small * 0.92)
-        if fs_big <= 4.01 and fs_small <= 4.01:
-            break
+    fs_big, fs_small = fit_two_sizes(u_a, u_bn + u_be, fs_big, fs_small, rect.width * 0.98)
 
-    w_a = _text_width_pt(a, fs_big, fontname_main or "helv", fontfile_main) if a else 0.0
-    w_bn = _text_width_pt(b_num, fs_small, fontname_main or "helv", fontfile_main) if b_num else 0.0
-    w_be = _text_width_pt(b_eur, fs_small, euro_fontname or "helv", euro_fontfile) if b_eur else 0.0
+    w_a = u_a * fs_big
+    w_bn = u_bn * fs_small
+    w_be = u_be * fs_small
     total = w_a + w_bn + w_be
 
     if total <= 0:
         _insert_text_single_line(
-            page=page,
+            page=out,
             x=rect.x0 + 1.0,
             y=_y_baseline_for_rect(rect),
             text=s,
@@ -1063,7 +1306,7 @@ def _draw_price_mixed_sizes(
 
     if a:
         _insert_text_single_line(
-            page=page,
+            page=out,
             x=x0,
             y=y0,
             text=a,
@@ -1075,7 +1318,7 @@ def _draw_price_mixed_sizes(
 
     if b_num:
         _insert_text_single_line(
-            page=page,
+            page=out,
             x=x0 + w_a,
             y=y0,
             text=b_num,
@@ -1087,7 +1330,7 @@ def _draw_price_mixed_sizes(
 
     if b_eur:
         _insert_text_single_line(
-            page=page,
+            page=out,
             x=x0 + w_a + w_bn,
             y=y0,
             text=b_eur,
@@ -1278,7 +1521,21 @@ def _insert_textbox_autofit(
     fs = float(kwargs.get("fontsize") or 12.0)
     fs = max(min_fs, fs)
 
-    for _ in range(max_iter):
+    # ✅ saute directement les tailles qui ne peuvent pas rentrer (mesure à 1pt)
+    fontname = kwargs.get("fontname") or "helv"
+    fontfile = kwargs.get("fontfile")
+    fs, skipped = autofit_start_fontsize(
+        [text_measurer.unit_width(line, fontname, fontfile) for line in str(text or "").split("\n")],
+        text_measurer.unit_line_height(fontname, fontfile),
+        fs,
+        float(rect.width),
+        float(rect.height),
+        step=0.9,
+        max_steps=max_iter,
+        min_fs=min_fs,
+    )
+
+    for _ in range(max(0, max_iter - skipped)):
         kwargs["fontsize"] = fs
         try:
             rc = page.insert_textbox(rect, text, **kwargs)
@@ -1486,6 +1743,41 @@ def _render_clip_mask_image_png(
     scale = float(scale if scale else 1.0)
     scale = max(0.05, min(scale, 20.0))
 
+    # ✅ même image + même cadrage => même raster (ex: vignette ronde répétée)
+    key = content_key(
+        "clip",
+        hashlib.sha256(img_bytes).hexdigest(),
+        out_w_px,
+        out_h_px,
+        scale,
+        float(offset_x_px or 0.0),
+        float(offset_y_px or 0.0),
+        int(radius_px or 0),
+    )
+    cached = raster_cache.get(key)
+    if cached is not None:
+        return cached or None
+
+    png = _render_clip_mask_image_png_uncached(img_bytes, out_w_px, out_h_px, scale, offset_x_px, offset_y_px, radius_px)
+    raster_cache.put(key, png)
+    return png
+
+
+def _render_clip_mask_image_png_uncached(
+    img_bytes: bytes,
+    out_w_px: int,
+    out_h_px: int,
+    scale: float,
+    offset_x_px: float,
+    offset_y_px: float,
+    radius_px: int,
+) -> Optional[bytes]:
+    try:
+        from io import BytesIO
+        from PIL import ImageDraw  # type: ignore
+    except Exception:
+        return None
+
     try:
         im = Image.open(BytesIO(img_bytes))
         im.load()
@@ -1680,6 +1972,29 @@ def _make_gradient_png(
     typ = str(g.get("type") or "linear").lower()
     angle = float(g.get("angle") or 0.0)
 
+    # ✅ même taille / couleurs / angle / arrondi => même raster
+    key = content_key("gradient", w_px, h_px, c1, c2, typ, angle, int(radius_px or 0))
+    cached = raster_cache.get(key)
+    if cached is not None:
+        return cached or None
+
+    png = _make_gradient_png_uncached(w_px, h_px, c1, c2, typ, angle, radius_px)
+    raster_cache.put(key, png)
+    return png
+
+
+def _make_gradient_png_uncached(
+    w_px: int,
+    h_px: int,
+    c1: Tuple[int, int, int, int],
+    c2: Tuple[int, int, int, int],
+    typ: str,
+    angle: float,
+    radius_px: int,
+) -> Optional[bytes]:
+    from io import BytesIO
+    from PIL import ImageDraw  # type: ignore
+
     # base gradient image
     if typ == "radial":
         img = Image.new("RGBA", (w_px, h_px), (0, 0, 0, 0))
@@ -1730,377 +2045,668 @@ def _make_gradient_png(
     
 
 
-def render_pdf_with_overlays(
-    input_pdf_bytes: bytes,
-    draft: Dict[str, Any],
-    ctx: RenderContext,
-) -> bytes:
+def _insert_image_once(
+    page: "fitz.Page",
+    rect: "fitz.Rect",
+    stream: bytes,
+    xrefs: Dict[str, int],
+    keep_proportion: bool = True,
+) -> int:
     """
-    Applique les objects du draft sur le PDF (y compris pages ajoutées) et renvoie un nouveau PDF.
-    ⚠️ Tu veux un rendu STRICTEMENT "agent": on force ctx.is_agent=True ici.
+    insert_image avec réutilisation par xref dans le document : une image (ou un
+    raster généré) identique n'est décodée/embarquée qu'une fois, les autres
+    occurrences pointent sur le même objet.
     """
-    # ✅ demandé: rendu identique agent, même en labo
-    ctx.is_agent = True
+    with span("image_insert"):
+        digest = hashlib.sha256(stream).hexdigest()
+        xref = xrefs.get(digest)
+        if xref:
+            incr("img_xref_reused")
+            page.insert_image(rect, xref=xref, keep_proportion=keep_proportion)
+            return xref
 
-    if fitz is None:
-        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
+        xref = page.insert_image(rect, stream=stream, keep_proportion=keep_proportion)
+        if xref:
+            xrefs[digest] = int(xref)
+        return xref
 
-    doc = fitz.open(stream=input_pdf_bytes, filetype="pdf")
 
-    # ✅ ajoute physiquement les pages blanches AVANT rendu
-    _append_blank_pages_from_draft(doc, draft)
+# span par catégorie d'objet du plan (temps exclusif : fonts / raster / image_insert à part)
+_OBJECT_SPANS = {"shape": "shapes", "clip": "clips", "image": "images", "text": "text"}
 
-    pages = draft.get("pages") or []
-    font_cache: Dict[str, str] = {}
+# marge autour d'un texte (jambages, prix posés sur la ligne de base)
+_BATCH_TEXT_PAD_PT = 2.0
 
-    meta = (draft.get("_meta") or {}) if isinstance(draft, dict) else {}
-    debug_render = False
-    meta["debug_render"] = False
 
-    base_w_px, base_h_px, pdfjs_scale = _get_viewport_base_px_and_scale(draft)
+def _pad_box(rect: "fitz.Rect", pad: float) -> Tuple[float, float, float, float]:
+    x0, x1 = sorted((float(rect.x0), float(rect.x1)))
+    y0, y1 = sorted((float(rect.y0), float(rect.y1)))
+    return (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
 
-    # ------------------------------------------------------------
-    # Helpers locaux (robustes)
-    # ------------------------------------------------------------
-    def _normalize_price_text_local(s: Any) -> str:
-        if s is None:
-            return ""
-        t = str(s)
-        t = t.replace("\u00A0", " ")
-        t = t.replace("Â ", " ").replace("Â", "")
-        t = t.replace("â‚¬", "€").replace("â¬", "€")
-        t = re.sub(r"\s+", " ", t).strip()
-        return t
 
-    def _draw_textbox_fit_single_line_local(
-        page: "fitz.Page",
-        rect: "fitz.Rect",
-        text: str,
-        fontname: str,
-        fontfile: Optional[str],
-        fontsize_pt: float,
-        color: Tuple[float, float, float],
-        align: int,
-    ) -> None:
-        if fitz is None:
-            return
+def _box_overlaps_any(box: Tuple[float, float, float, float], boxes: List[Tuple[float, float, float, float]]) -> bool:
+    x0, y0, x1, y1 = box
+    return any(x0 <= b[2] and b[0] <= x1 and y0 <= b[3] and b[1] <= y1 for b in boxes)
 
-        txt = _normalize_price_text_local(text)
-        if not txt:
-            return
 
-        fs = max(4.0, float(fontsize_pt or 12.0))
-        fs = min(fs, max(4.0, rect.height * 0.80))
+class _PageBatch:
+    """
+    Dessin groupé d'une page : les tracés et textes des objets successifs vont
+    dans UNE Shape, commitée en un seul fragment /Contents (au lieu d'un
+    new_shape/commit ou insert_textbox par objet).
+
+    Une Shape écrit ses textes APRÈS ses tracés : l'ordre de dessin n'est
+    garanti que là où rien ne se superpose. On commit donc :
+      - avant un tracé qui recouvre un texte en attente ;
+      - avant un insert direct sur la page (image, clip, dégradé) qui recouvre
+        quelque chose en attente ;
+      - au changement de layer (back -> front) et en fin de page.
+    Même mise en page que page.insert_textbox (c'est le même code, sur la Shape).
+    """
 
-        for _ in range(18):
-            w = _text_width_pt(txt, fs, fontname or "helv", fontfile)
-            if w <= rect.width * 0.98:
-                break
-            fs = max(4.0, fs * 0.92)
-            if fs <= 4.01:
-                break
+    def __init__(self, page: "fitz.Page", enabled: bool = RENDER_BATCH_DRAW) -> None:
+        self.page = page
+        self.enabled = enabled
+        self._shape: Optional["fitz.Shape"] = None
+        self._boxes: List[Tuple[float, float, float, float]] = []
+        self._text_boxes: List[Tuple[float, float, float, float]] = []
+        self._layer: Optional[str] = None
+
+    def _pending(self) -> "fitz.Shape":
+        if self._shape is None:
+            self._shape = self.page.new_shape()
+        return self._shape
+
+    def set_layer(self, layer: str) -> None:
+        if self._layer is not None and layer != self._layer:
+            self.flush()
+        self._layer = layer
+
+    def shape(self, rect: "fitz.Rect", width: float = 0.0) -> "fitz.Shape":
+        """Shape où tracer l'objet (finish par l'appelant, puis done())."""
+        if not self.enabled:
+            return self.page.new_shape()
+        box = _pad_box(rect, max(1.0, float(width or 0.0)))
+        if self._text_boxes and _box_overlaps_any(box, self._text_boxes):
+            self.flush()
+        self._boxes.append(box)
+        return self._pending()
+
+    def done(self, sh: "fitz.Shape") -> None:
+        if not self.enabled:
+            sh.commit()
+
+    def reset_path(self) -> None:
+        # tracé commencé puis en erreur : ne pas le laisser au finish() suivant
+        if self._shape is not None:
+            self._shape.draw_cont = ""
+
+    def text(self, rect: "fitz.Rect") -> Any:
+        """Cible de insert_text / insert_textbox (la Shape en attente, ou la page)."""
+        if not self.enabled:
+            return self.page
+        box = _pad_box(rect, _BATCH_TEXT_PAD_PT)
+        self._boxes.append(box)
+        self._text_boxes.append(box)
+        return self._pending()
+
+    def direct(self, rect: "fitz.Rect") -> None:
+        """Avant un insert direct sur la page : ce qui est en attente et le recouvre passe dessous."""
+        if self._boxes and _box_overlaps_any(_pad_box(rect, 1.0), self._boxes):
+            self.flush()
+
+    def draw_rect(self, rect: "fitz.Rect", radius: Any = None, **finish_kwargs: Any) -> None:
+        # = page.draw_rect
+        sh = self.shape(rect, finish_kwargs.get("width", 1))
+        sh.draw_rect(rect, radius=radius)
+        sh.finish(**finish_kwargs)
+        self.done(sh)
+
+    def draw_line(self, p1: Any, p2: Any, **finish_kwargs: Any) -> None:
+        # = page.draw_line
+        p1, p2 = fitz.Point(p1), fitz.Point(p2)
+        sh = self.shape(fitz.Rect(p1, p2), finish_kwargs.get("width", 1))
+        sh.draw_line(p1, p2)
+        sh.finish(closePath=False, **finish_kwargs)
+        self.done(sh)
+
+    def flush(self) -> None:
+        if self._shape is not None:
+            with span("draw_commit"):
+                self._shape.commit()
+            incr("draw_commits")
+        self._shape = None
+        self._boxes = []
+        self._text_boxes = []
+
+
+# PDF source : bytes, ou chemin (ouvert par MuPDF directement depuis le fichier, sans copie Python)
+PdfSource = Union[bytes, str, Path]
+
+
+def _open_pdf(src: PdfSource) -> "fitz.Document":
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=src, filetype="pdf")
+    return fitz.open(str(src), filetype="pdf")
+
+
+def _save_pdf(doc: "fitz.Document", output_path: Union[str, Path], optimize: Optional[str] = None) -> int:
+    """
+    Écrit doc dans output_path (tmp + rename) et retourne la taille.
+    optimize : profil marketing_pdf_optimize ("screen" / "print") appliqué juste avant l'écriture.
+    """
+    report = pdf_optimize.optimize_document(doc, optimize)
+    out = Path(output_path)
+    tmp = out.with_name(f".{out.name}.{os.getpid()}.part")
+    with span("save"):
+        try:
+            doc.save(str(tmp), **pdf_optimize.save_options(report))
+            os.replace(tmp, out)
+        finally:
+            tmp.unlink(missing_ok=True)
+    size = int(out.stat().st_size)
+    pdf_optimize.log_report(report, size)
+    return size
 
-        kwargs: Dict[str, Any] = {"fontsize": fs, "color": color, "align": align}
-        if fontfile:
-            kwargs["fontfile"] = fontfile
-            if fontname:
-                kwargs["fontname"] = fontname
-        else:
-            kwargs["fontname"] = fontname or "helv"
 
-        page.insert_textbox(rect, txt, **kwargs)
+def count_render_pages(input_pdf: PdfSource, draft: Dict[str, Any]) -> int:
+    """
+    Nb de pages du PDF final (pages source + draft["appended_pages"]),
+    sans rien rendre : sert à découper le rendu en tranches.
+    """
+    if fitz is None:
+        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
 
-    # ------------------------------------------------------------
-    # Render loop: ALL pages (incluant pages ajoutées)
-    # ------------------------------------------------------------
-    total_pages = int(doc.page_count or 0)
-    for page_index in range(total_pages):
-        page = doc.load_page(page_index)
-        page_w_pt = float(page.rect.width)
-        page_h_pt = float(page.rect.height)
+    doc = _open_pdf(input_pdf)
+    try:
+        _append_blank_pages_from_draft(doc, draft)
+        return int(doc.page_count or 0)
+    finally:
+        doc.close()
 
-        pm = pages[page_index] if (isinstance(pages, list) and page_index < len(pages)) else {}
-        objects = (pm or {}).get("objects") if isinstance(pm, dict) else None
-        if not isinstance(objects, list):
-            objects = []
 
-        # ✅ Respect du "layer": back d'abord puis front
-        try:
-            objects = sorted(objects, key=lambda o: 0 if _get_shape_layer(o) == "back" else 1)
-        except Exception:
-            pass
+def count_base_and_render_pages(input_pdf: PdfSource, draft: Dict[str, Any]) -> Tuple[int, int]:
+    """(nb de pages du PDF source, nb de pages du PDF final) : sert aux clés de cache par page."""
+    if fitz is None:
+        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
 
-        for obj in objects:
-            if not isinstance(obj, dict):
-                continue
+    doc = _open_pdf(input_pdf)
+    try:
+        base = int(doc.page_count or 0)
+        _append_blank_pages_from_draft(doc, draft)
+        return base, int(doc.page_count or 0)
+    finally:
+        doc.close()
 
-            obj_type = obj.get("type")
-
-            rect = None
-            if _has_rel(obj):
-                rect = _map_rect_rel_to_page_pt(
-                    _safe_float(obj.get("x_rel"), 0.0),
-                    _safe_float(obj.get("y_rel"), 0.0),
-                    _safe_float(obj.get("w_rel"), 0.0),
-                    _safe_float(obj.get("h_rel"), 0.0),
-                    page_w_pt,
-                    page_h_pt,
-                )
+
+def save_pages_to_files(
+    input_pdf: PdfSource,
+    draft: Dict[str, Any],
+    ctx: "RenderContext",
+    page_range: Tuple[int, int],
+    output_paths: List[Union[str, Path]],
+    plan: Optional["RenderPlan"] = None,
+) -> int:
+    """
+    Rend la tranche page_range puis écrit chaque page dans son propre PDF
+    (output_paths[i] pour la i-ème page de la tranche) : cache par page.
+    """
+    doc = _render_document(input_pdf, draft, ctx, page_range=page_range, plan=plan)
+    try:
+        for i, path in enumerate(output_paths[: int(doc.page_count or 0)]):
+            one = fitz.open()
+            try:
+                with span("page_split"):
+                    one.insert_pdf(doc, from_page=i, to_page=i)
+                # cache par page : le dossier n'est créé qu'à l'écriture
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                _save_pdf(one, path)
+            finally:
+                one.close()
+        return min(len(output_paths), int(doc.page_count or 0))
+    finally:
+        doc.close()
+
+
+def rasterize_pdf_page(
+    pdf_path: Union[str, Path],
+    output_path: Union[str, Path],
+    size_key: str,
+    fmt: str = "webp",
+    page_index: int = 0,
+) -> int:
+    """
+    Aperçu raster d'une page : size_key "w<px>" (largeur) ou "d<dpi>".
+    webp via Pillow (qualité 80), png via PyMuPDF. Retourne la taille écrite.
+    """
+    if fitz is None:
+        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
+
+    doc = fitz.open(str(pdf_path), filetype="pdf")
+    try:
+        page = doc.load_page(int(page_index))
+        if size_key.startswith("d"):
+            zoom = _safe_float(size_key[1:], 72.0) / 72.0
+        else:
+            zoom = _safe_float(size_key[1:], 800.0) / max(1.0, float(page.rect.width))
+        # garde-fou : 16 Mpx max (pages très grandes à haut dpi)
+        max_zoom = (16_000_000 / max(1.0, float(page.rect.width) * float(page.rect.height))) ** 0.5
+        zoom = max(0.05, min(zoom, max_zoom))
+
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+        out = Path(output_path)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out.with_name(f".{out.name}.{os.getpid()}.part")
+        try:
+            if fmt == "webp":
+                if Image is None:
+                    raise RuntimeError("Pillow requis pour les aperçus webp")
+                img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+                img.save(str(tmp), format="WEBP", quality=80, method=4)
             else:
-                x_px = _safe_float(obj.get("x"), 0)
-                y_px = _safe_float(obj.get("y"), 0)
-                w_px = _safe_float(obj.get("w"), 0)
-                h_px = _safe_float(obj.get("h"), 0)
-
-                rect = _map_rect_px_to_page_pt(
-                    x_px,
-                    y_px,
-                    w_px,
-                    h_px,
-                    page_w_pt,
-                    page_h_pt,
-                    base_w_px,
-                    base_h_px,
-                    pdfjs_scale,
-                )
+                pix.save(str(tmp), output="png")
+            os.replace(tmp, out)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return int(out.stat().st_size)
+    finally:
+        doc.close()
+
+
+def merge_pdf_files(
+    part_paths: List[Union[str, Path]],
+    output_path: Union[str, Path],
+    optimize: Optional[str] = None,
+) -> int:
+    """
+    Comme merge_rendered_parts, de fichiers à fichier. Retourne la taille écrite.
+    optimize : appliqué au document recollé (les pages en cache restent brutes).
+    """
+    if fitz is None:
+        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
 
-            if rect is None:
-                continue
+    out_doc = fitz.open()
+    try:
+        for part in part_paths:
+            src = fitz.open(str(part), filetype="pdf")
+            try:
+                out_doc.insert_pdf(src)
+            finally:
+                src.close()
+        return _save_pdf(out_doc, output_path, optimize)
+    finally:
+        out_doc.close()
+
+
+def merge_rendered_parts(parts: List[bytes], optimize: Optional[str] = None) -> bytes:
+    """
+    Recolle dans l'ordre des tranches rendues par render_pdf_with_overlays(page_range=...).
+    garbage=4 fusionne les objets identiques (polices / images embarquées par chaque tranche).
+    """
+    if fitz is None:
+        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
 
-            if debug_render:
-                page.draw_rect(rect, color=(1, 0, 0), width=0.8)
+    out_doc = fitz.open()
+    try:
+        for part in parts:
+            src = fitz.open(stream=part, filetype="pdf")
+            try:
+                out_doc.insert_pdf(src)
+            finally:
+                src.close()
+        report = pdf_optimize.optimize_document(out_doc, optimize)
+        data = out_doc.tobytes(**pdf_optimize.save_options(report))
+        pdf_optimize.log_report(report, len(data))
+        return data
+    finally:
+        out_doc.close()
 
-            # ------------------------------------------------------------
-            # ✅ SHAPES (rect / roundrect / line) + gradient
-            # ------------------------------------------------------------
-            if _is_shape_like(obj) and not _is_clip_shape(obj):
-                kind = _shape_kind(obj)
-                pb_w_px, pb_h_px = _get_obj_page_box_px(obj)
 
-                # stroke
-                stroke_w_px = _get_shape_stroke_width_px(obj)
-                stroke_w_pt = 0.0
-                if stroke_w_px > 0:
-                    stroke_w_pt = _border_px_to_pt(stroke_w_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+def render_pdf_with_overlays(
+    input_pdf: PdfSource,
+    draft: Dict[str, Any],
+    ctx: RenderContext,
+    page_range: Optional[Tuple[int, int]] = None,
+    plan: Optional["RenderPlan"] = None,
+    optimize: Optional[str] = None,
+) -> bytes:
+    """
+    Applique les objects du draft sur le PDF (y compris pages ajoutées) et renvoie un nouveau PDF.
+    ⚠️ Tu veux un rendu STRICTEMENT "agent": on force ctx.is_agent=True ici.
 
-                stroke_rgb, stroke_a = _safe_color_and_opacity(_get_shape_stroke_color(obj), "#111827")
+    input_pdf : bytes ou chemin du PDF source.
 
-                # radius
-                radius_px = _get_shape_radius_px(obj)
-                radius_pt = 0.0
-                if radius_px > 0:
-                    radius_pt = _border_px_to_pt(radius_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+    page_range=(start, stop) : ne rend que ces pages (indices du PDF final, stop exclu)
+    et renvoie un PDF ne contenant qu'elles (rendu parallèle par tranches).
 
-                fill_mode = _get_shape_fill_mode(obj)
+    plan : draft précompilé (marketing_render_plan). Absent => compilé ici depuis draft.
+    draft ne sert alors plus qu'aux pages ajoutées et au viewport (_meta).
 
-                # ---- LINE
-                if kind == "line":
-                    if stroke_w_pt <= 0:
-                        stroke_w_pt = max(0.25, _border_px_to_pt(1, page_w_pt, pb_w_px, base_w_px, pdfjs_scale))
-                    try:
-                        page.draw_line(
-                            (rect.x0, rect.y0),
-                            (rect.x1, rect.y1),
-                            color=stroke_rgb,
-                            width=stroke_w_pt,
-                            stroke_opacity=_clamp01(stroke_a),
-                        )
-                    except Exception:
-                        pass
-                    continue
+    optimize : profil de taille (marketing_pdf_optimize : "screen" / "print", None = aucun) :
+    polices réduites aux glyphes utilisés, images dédoublonnées et rééchantillonnées
+    au dpi du profil. Rapport avant/après dans les logs [PDF_OPT] et les compteurs.
+    """
+    doc = _render_document(input_pdf, draft, ctx, page_range=page_range, plan=plan)
+    try:
+        report = pdf_optimize.optimize_document(doc, optimize)
+        with span("save"):
+            data = doc.tobytes(**pdf_optimize.save_options(report))
+        pdf_optimize.log_report(report, len(data))
+        return data
+    finally:
+        doc.close()
+
+
+def render_pdf_to_file(
+    input_pdf: PdfSource,
+    output_path: Union[str, Path],
+    draft: Dict[str, Any],
+    ctx: RenderContext,
+    page_range: Optional[Tuple[int, int]] = None,
+    plan: Optional["RenderPlan"] = None,
+    optimize: Optional[str] = None,
+) -> int:
+    """
+    Comme render_pdf_with_overlays, mais écrit directement dans output_path :
+    le PDF rendu ne passe jamais par un objet bytes Python. Retourne la taille écrite.
+    """
+    doc = _render_document(input_pdf, draft, ctx, page_range=page_range, plan=plan)
+    try:
+        return _save_pdf(doc, output_path, optimize)
+    finally:
+        doc.close()
 
-                # ---- RECT / ROUNDRECT
-                if fill_mode == "gradient":
-                    g = _get_shape_gradient(obj)
 
-                    scale = 2.0
-                    w_img = int(max(2.0, rect.width * scale))
-                    h_img = int(max(2.0, rect.height * scale))
+def render_pdf_variants_to_files(
+    input_pdf: PdfSource,
+    draft: Dict[str, Any],
+    ctxs: List[RenderContext],
+    output_paths: List[Union[str, Path]],
+    plan: Optional["RenderPlan"] = None,
+    optimize: Optional[str] = None,
+) -> List[int]:
+    """
+    Rendu par lot : un même document, plusieurs contextes prix (ctxs[i] -> output_paths[i]).
 
-                    rad_img = 0
-                    if kind == "roundrect" and radius_px > 0:
-                        rad_img = int(max(0, min(radius_px * scale, min(w_img, h_img) / 2)))
+    PDF source, pages ajoutées et objets communs (tout ce qui ne dépend pas du prix
+    et ne chevauche pas un objet dynamique) sont rendus UNE fois (avec ctxs[0]) ;
+    chaque variante repart d'une copie de ce rendu et ne dessine que le reste.
+    ⚠️ les variantes partagent les polices (même labo) : seuls produits / paliers /
+    modes de prix changent. Retourne les tailles écrites.
+    """
+    if not ctxs:
+        return []
 
-                    png_bytes = _make_gradient_png(w_img, h_img, g, radius_px=rad_img)
-                    if png_bytes:
-                        try:
-                            page.insert_image(rect, stream=png_bytes, keep_proportion=False)
-                        except Exception:
-                            pass
+    if plan is None:
+        from app.services.marketing_render_plan import compile_render_plan
 
-                    # stroke par-dessus
-                    if stroke_w_pt > 0:
-                        try:
-                            sh = page.new_shape()
-                            try:
-                                if kind == "roundrect" and radius_pt > 0:
-                                    sh.draw_rect(rect, radius=radius_pt)
-                                else:
-                                    sh.draw_rect(rect)
-                            except Exception:
-                                sh.draw_rect(rect)
+        with span("plan"):
+            plan = compile_render_plan(draft)
 
-                            sh.finish(
-                                color=stroke_rgb,
-                                fill=None,
-                                width=stroke_w_pt,
-                                stroke_opacity=_clamp01(stroke_a),
-                            )
-                            sh.commit()
-                        except Exception:
-                            try:
-                                page.draw_rect(rect, color=stroke_rgb, width=stroke_w_pt, stroke_opacity=_clamp01(stroke_a))
-                            except Exception:
-                                pass
+    shared = _render_document(input_pdf, draft, ctxs[0], plan=plan, layer="shared")
+    try:
+        with span("save"):
+            # pas de garbage ici : chaque variante est nettoyée à l'écriture
+            shared_bytes = shared.tobytes()
+    finally:
+        shared.close()
+
+    sizes: List[int] = []
+    for ctx, out in zip(ctxs, output_paths):
+        with span("pdf_open"):
+            doc = fitz.open(stream=shared_bytes, filetype="pdf")
+        try:
+            _render_document(None, draft, ctx, plan=plan, layer="variant", doc=doc)
+            sizes.append(_save_pdf(doc, out, optimize))
+        finally:
+            doc.close()
+        incr("variants")
+    return sizes
 
-                    continue
 
-                # fill uni (vector)
-                fill_rgb, fill_a = _safe_color_and_opacity(_get_shape_fill_color(obj), "#ffffff")
+def _render_document(
+    input_pdf: PdfSource,
+    draft: Dict[str, Any],
+    ctx: RenderContext,
+    page_range: Optional[Tuple[int, int]] = None,
+    plan: Optional["RenderPlan"] = None,
+    layer: Optional[str] = None,
+    doc: Optional["fitz.Document"] = None,
+) -> "fitz.Document":
+    """
+    Rendu dans un fitz.Document ouvert (à fermer par l'appelant).
 
-                try:
-                    sh = page.new_shape()
-                    try:
-                        if kind == "roundrect" and radius_pt > 0:
-                            sh.draw_rect(rect, radius=radius_pt)
-                        else:
-                            sh.draw_rect(rect)
-                    except Exception:
-                        sh.draw_rect(rect)
-
-                    sh.finish(
-                        color=(stroke_rgb if stroke_w_pt > 0 else None),
-                        fill=fill_rgb,
-                        width=(stroke_w_pt if stroke_w_pt > 0 else 0),
-                        fill_opacity=_clamp01(fill_a),
-                        stroke_opacity=_clamp01(stroke_a),
+    layer (rendu par lot de variantes, cf. RenderPlan.split_shared) :
+      - "shared"  : seulement les objets communs à toutes les variantes
+      - "variant" : seulement les autres, dessinés sur doc (= copie du rendu "shared")
+    => même résultat qu'un rendu complet (l'ordre ne change qu'entre objets disjoints).
+    """
+    # ✅ demandé: rendu identique agent, même en labo
+    ctx.is_agent = True
+
+    if fitz is None:
+        raise RuntimeError("PyMuPDF (fitz) non installé. Installe 'pymupdf' dans l'image Docker.")
+
+    if doc is None:
+        with span("pdf_open"):
+            doc = _open_pdf(input_pdf)
+
+        # ✅ ajoute physiquement les pages blanches AVANT rendu
+        with span("blank_pages"):
+            _append_blank_pages_from_draft(doc, draft)
+
+    if plan is None:
+        from app.services.marketing_render_plan import compile_render_plan
+
+        with span("plan"):
+            plan = compile_render_plan(draft)
+
+    font_cache: Dict[str, str] = {}
+    doc_fonts = DocumentFonts(font_registry)
+    # sha256(stream) -> xref des images déjà embarquées dans ce document
+    image_xrefs: Dict[str, int] = {}
+
+    meta = (draft.get("_meta") or {}) if isinstance(draft, dict) else {}
+    debug_render = False
+    meta["debug_render"] = False
+
+    base_w_px, base_h_px, pdfjs_scale = _get_viewport_base_px_and_scale(draft)
+
+    # ------------------------------------------------------------
+    # Helpers locaux (robustes)
+    # ------------------------------------------------------------
+    def _normalize_price_text_local(s: Any) -> str:
+        if s is None:
+            return ""
+        t = str(s)
+        t = t.replace("\u00A0", " ")
+        t = t.replace("Â ", " ").replace("Â", "")
+        t = t.replace("â‚¬", "€").replace("â¬", "€")
+        t = re.sub(r"\s+", " ", t).strip()
+        return t
+
+    def _draw_textbox_fit_single_line_local(
+        page: "fitz.Page",
+        rect: "fitz.Rect",
+        text: str,
+        fontname: str,
+        fontfile: Optional[str],
+        fontsize_pt: float,
+        color: Tuple[float, float, float],
+        align: int,
+    ) -> None:
+        if fitz is None:
+            return
+
+        txt = _normalize_price_text_local(text)
+        if not txt:
+            return
+
+        fs = max(4.0, float(fontsize_pt or 12.0))
+        fs = min(fs, max(4.0, rect.height * 0.80))
+
+        fs = fit_single_line_fontsize(
+            text_measurer.unit_width(txt, fontname or "helv", fontfile),
+            fs,
+            rect.width * 0.98,
+        )
+
+        kwargs: Dict[str, Any] = {"fontsize": fs, "color": color, "align": align}
+        if fontfile:
+            kwargs["fontfile"] = fontfile
+            if fontname:
+                kwargs["fontname"] = fontname
+        else:
+            kwargs["fontname"] = fontname or "helv"
+
+        page.insert_textbox(rect, txt, **kwargs)
+
+    # ------------------------------------------------------------
+    # Render loop: ALL pages (incluant pages ajoutées)
+    # ------------------------------------------------------------
+    total_pages = int(doc.page_count or 0)
+    first_page, stop_page = 0, total_pages
+    if page_range is not None:
+        first_page = max(0, int(page_range[0]))
+        stop_page = max(first_page, min(total_pages, int(page_range[1])))
+
+    # ✅ toutes les images des pages rendues, en parallèle, avant la boucle
+    with span("image_fetch"):
+        prefetched_images = _prefetch_draft_images(plan, list(range(first_page, stop_page)), layer=layer)
+
+    for page_index in range(first_page, stop_page):
+        incr("pages")
+        page = doc.load_page(page_index)
+        page_w_pt = float(page.rect.width)
+        page_h_pt = float(page.rect.height)
+        batch = _PageBatch(page)
+
+        # ✅ objets déjà normalisés, triés par layer et classés (plan)
+        page_objects = plan.page_objects(page_index)
+        if layer is not None:
+            shared_objs, variant_objs = plan.split_shared(page_index)
+            page_objects = shared_objs if layer == "shared" else variant_objs
+
+        for po in page_objects:
+            with span(_OBJECT_SPANS.get(po.category, "other")):
+                obj = po.obj
+                obj_type = obj.get("type")
+
+                if po.rect_rel is not None:
+                    rect = _map_rect_rel_to_page_pt(*po.rect_rel, page_w_pt, page_h_pt)
+                else:
+                    rect = _map_rect_px_to_page_pt(
+                        *po.rect_px,
+                        page_w_pt,
+                        page_h_pt,
+                        base_w_px,
+                        base_h_px,
+                        pdfjs_scale,
                     )
-                    sh.commit()
-                except Exception:
-                    try:
-                        page.draw_rect(
-                            rect,
-                            color=(stroke_rgb if stroke_w_pt > 0 else None),
-                            fill=fill_rgb,
-                            width=(stroke_w_pt if stroke_w_pt > 0 else 0),
-                            fill_opacity=_clamp01(fill_a),
-                            stroke_opacity=_clamp01(stroke_a),
-                        )
-                    except Exception:
-                        pass
 
-                continue
+                if rect is None:
+                    continue
 
-            # ------------------------------------------------------------
-            # ✅ CLIP-MASK SHAPE (image inside rect/roundrect)
-            # ------------------------------------------------------------
-                       # ------------------------------------------------------------
-            # ✅ CLIP-MASK SHAPE (image inside rect/roundrect)
-            # ------------------------------------------------------------
-            if _is_clip_shape(obj):
-                pb_w_px, pb_h_px = _get_obj_page_box_px(obj)
+                # plan trié back puis front : un commit au passage
+                batch.set_layer(_get_shape_layer(obj))
 
-                kind = _shape_kind(obj)  # "rect" / "roundrect"
-                radius_px = _get_shape_radius_px(obj)
+                if debug_render:
+                    batch.draw_rect(rect, color=(1, 0, 0), width=0.8)
 
-                # stroke
-                stroke_w_px = _get_shape_stroke_width_px(obj)
-                stroke_w_pt = 0.0
-                if stroke_w_px > 0:
-                    stroke_w_pt = _border_px_to_pt(stroke_w_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+                # ------------------------------------------------------------
+                # ✅ SHAPES (rect / roundrect / line) + gradient
+                # ------------------------------------------------------------
+                if po.category == "shape":
+                    kind = _shape_kind(obj)
+                    pb_w_px, pb_h_px = po.page_box_px
 
-                stroke_rgb, stroke_a = _safe_color_and_opacity(_get_shape_stroke_color(obj), "#111827")
+                    # stroke
+                    stroke_w_px = _get_shape_stroke_width_px(obj)
+                    stroke_w_pt = 0.0
+                    if stroke_w_px > 0:
+                        stroke_w_pt = _border_px_to_pt(stroke_w_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
 
-                # radius pt (utile pour placeholder + stroke)
-                radius_pt = 0.0
-                if kind == "roundrect" and radius_px > 0:
-                    radius_pt = _border_px_to_pt(radius_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+                    stroke_rgb, stroke_a = _safe_color_and_opacity(_get_shape_stroke_color(obj), "#111827")
 
-                # skip si rect minuscule ou hors page
-                try:
-                    if rect.width < 2 or rect.height < 2:
-                        continue
-                    if rect.x1 <= 0 or rect.y1 <= 0 or rect.x0 >= page_w_pt or rect.y0 >= page_h_pt:
-                        continue
-                except Exception:
-                    pass
+                    # radius
+                    radius_px = _get_shape_radius_px(obj)
+                    radius_pt = 0.0
+                    if radius_px > 0:
+                        radius_pt = _border_px_to_pt(radius_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
 
-                candidates = _clip_image_sources(obj)
+                    fill_mode = _get_shape_fill_mode(obj)
 
-                # Placeholder si pas d'image
-                if not candidates:
-                    try:
-                        sh = page.new_shape()
+                    # ---- LINE
+                    if kind == "line":
+                        if stroke_w_pt <= 0:
+                            stroke_w_pt = max(0.25, _border_px_to_pt(1, page_w_pt, pb_w_px, base_w_px, pdfjs_scale))
                         try:
-                            if kind == "roundrect" and radius_pt > 0:
-                                sh.draw_rect(rect, radius=radius_pt)
-                            else:
-                                sh.draw_rect(rect)
+                            batch.draw_line(
+                                (rect.x0, rect.y0),
+                                (rect.x1, rect.y1),
+                                color=stroke_rgb,
+                                width=stroke_w_pt,
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
                         except Exception:
-                            sh.draw_rect(rect)
+                            pass
+                        continue
 
-                        sh.finish(
-                            color=stroke_rgb,
-                            fill=None,
-                            width=max(0.25, stroke_w_pt or 0.8),
-                            stroke_opacity=_clamp01(stroke_a),
-                        )
-                        sh.commit()
-
-                        # diagonale
-                        page.draw_line(
-                            (rect.x1, rect.y0),
-                            (rect.x0, rect.y1),
-                            color=stroke_rgb,
-                            width=max(0.25, stroke_w_pt or 0.8),
-                            stroke_opacity=_clamp01(stroke_a),
-                        )
-                    except Exception:
-                        pass
-                    continue
+                    # ---- RECT / ROUNDRECT
+                    if fill_mode == "gradient":
+                        g = _get_shape_gradient(obj)
 
-                # cache global images (avec "miss cache" sentinel b"")
-                if not hasattr(render_pdf_with_overlays, "_img_cache"):
-                    render_pdf_with_overlays._img_cache = {}  # type: ignore[attr-defined]
-                _IMG_CACHE: Dict[str, bytes] = render_pdf_with_overlays._img_cache  # type: ignore[attr-defined]
+                        scale = 2.0
+                        w_img = int(max(2.0, rect.width * scale))
+                        h_img = int(max(2.0, rect.height * scale))
 
-                img_bytes: Optional[bytes] = None
+                        rad_img = 0
+                        if kind == "roundrect" and radius_px > 0:
+                            rad_img = int(max(0, min(radius_px * scale, min(w_img, h_img) / 2)))
 
-                max_tries = min(5, len(candidates))
-                for cand in candidates[:max_tries]:
-                    cand = str(cand or "").strip()
-                    if not cand:
-                        continue
+                        with span("raster"):
+                            png_bytes = _make_gradient_png(w_img, h_img, g, radius_px=rad_img)
+                        if png_bytes:
+                            try:
+                                batch.direct(rect)
+                                _insert_image_once(page, rect, png_bytes, image_xrefs, keep_proportion=False)
+                            except Exception:
+                                pass
 
-                    # ✅ cache qui retient aussi les échecs
-                    if cand not in _IMG_CACHE:
-                        b = _parse_data_url(cand)
-                        if not b:
-                            b = _resolve_image_to_bytes(cand, timeout_s=8) or None
-                        _IMG_CACHE[cand] = b if b else b""  # sentinel
+                        # stroke par-dessus
+                        if stroke_w_pt > 0:
+                            try:
+                                sh = batch.shape(rect, stroke_w_pt)
+                                try:
+                                    if kind == "roundrect" and radius_pt > 0:
+                                        sh.draw_rect(rect, radius=radius_pt)
+                                    else:
+                                        sh.draw_rect(rect)
+                                except Exception:
+                                    sh.draw_rect(rect)
 
-                    b = _IMG_CACHE.get(cand) or b""
-                    if b == b"":
-                        continue
+                                sh.finish(
+                                    color=stroke_rgb,
+                                    fill=None,
+                                    width=stroke_w_pt,
+                                    stroke_opacity=_clamp01(stroke_a),
+                                )
+                                batch.done(sh)
+                            except Exception:
+                                batch.reset_path()
+                                try:
+                                    batch.draw_rect(rect, color=stroke_rgb, width=stroke_w_pt, stroke_opacity=_clamp01(stroke_a))
+                                except Exception:
+                                    pass
 
-                    if not _bytes_is_definitely_image(b):
                         continue
 
-                    kimg = _sniff_image_kind(b)
-                    if kimg == "webp":
-                        pngb = _try_webp_to_png(b)
-                        if not pngb:
-                            # mémorise l'échec conversion si besoin
-                            continue
-                        b = pngb
-
-                    img_bytes = b
-                    break
+                    # fill uni (vector)
+                    fill_rgb, fill_a = _safe_color_and_opacity(_get_shape_fill_color(obj), "#ffffff")
 
-                if not img_bytes:
-                    # placeholder si on n'a rien pu charger
                     try:
-                        sh = page.new_shape()
+                        sh = batch.shape(rect, stroke_w_pt)
                         try:
                             if kind == "roundrect" and radius_pt > 0:
                                 sh.draw_rect(rect, radius=radius_pt)
@@ -2110,226 +2716,392 @@ def render_pdf_with_overlays(
                             sh.draw_rect(rect)
 
                         sh.finish(
-                            color=stroke_rgb,
-                            fill=None,
-                            width=max(0.25, stroke_w_pt or 0.8),
-                            stroke_opacity=_clamp01(stroke_a),
-                        )
-                        sh.commit()
-
-                        page.draw_line(
-                            (rect.x1, rect.y0),
-                            (rect.x0, rect.y1),
-                            color=stroke_rgb,
-                            width=max(0.25, stroke_w_pt or 0.8),
+                            color=(stroke_rgb if stroke_w_pt > 0 else None),
+                            fill=fill_rgb,
+                            width=(stroke_w_pt if stroke_w_pt > 0 else 0),
+                            fill_opacity=_clamp01(fill_a),
                             stroke_opacity=_clamp01(stroke_a),
                         )
+                        batch.done(sh)
                     except Exception:
-                        pass
-                    continue
-
-                tr = _clip_transform(obj)
-                scale = float(tr.get("scale", 1.0))
-                offx = float(tr.get("offsetX", 0.0))
-                offy = float(tr.get("offsetY", 0.0))
-
-                raster_scale = 2.0
-                out_w = int(max(2.0, rect.width * raster_scale))
-                out_h = int(max(2.0, rect.height * raster_scale))
-
-                # (optionnel mais conseillé) plafond pour éviter des PNG énormes
-                MAX_RASTER = 2200
-                if out_w > MAX_RASTER or out_h > MAX_RASTER:
-                    ratio = min(MAX_RASTER / max(out_w, 1), MAX_RASTER / max(out_h, 1))
-                    ratio = max(0.25, ratio)
-                    out_w = int(max(2, out_w * ratio))
-                    out_h = int(max(2, out_h * ratio))
-                    raster_scale = raster_scale * ratio  # ajuste cohérence offsets
-
-                rad_img = 0
-                if kind == "roundrect" and radius_px > 0:
-                    rad_img = int(max(0, min(radius_px * raster_scale, min(out_w, out_h) / 2)))
-
-                png_stream = _render_clip_mask_image_png(
-                    img_bytes=img_bytes,
-                    out_w_px=out_w,
-                    out_h_px=out_h,
-                    scale=scale,
-                    offset_x_px=offx * raster_scale,
-                    offset_y_px=offy * raster_scale,
-                    radius_px=rad_img,
-                )
-
-                if png_stream:
-                    try:
-                        page.insert_image(rect, stream=png_stream, keep_proportion=False)
-                    except Exception:
+                        batch.reset_path()
                         try:
-                            page.insert_image(rect, stream=img_bytes, keep_proportion=True)
+                            batch.draw_rect(
+                                rect,
+                                color=(stroke_rgb if stroke_w_pt > 0 else None),
+                                fill=fill_rgb,
+                                width=(stroke_w_pt if stroke_w_pt > 0 else 0),
+                                fill_opacity=_clamp01(fill_a),
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
                         except Exception:
                             pass
-                else:
-                    # fallback direct si rendu pillow échoue
+
+                    continue
+
+                # ------------------------------------------------------------
+                # ✅ CLIP-MASK SHAPE (image inside rect/roundrect)
+                # ------------------------------------------------------------
+                           # ------------------------------------------------------------
+                # ✅ CLIP-MASK SHAPE (image inside rect/roundrect)
+                # ------------------------------------------------------------
+                if po.category == "clip":
+                    pb_w_px, pb_h_px = po.page_box_px
+
+                    kind = _shape_kind(obj)  # "rect" / "roundrect"
+                    radius_px = _get_shape_radius_px(obj)
+
+                    # stroke
+                    stroke_w_px = _get_shape_stroke_width_px(obj)
+                    stroke_w_pt = 0.0
+                    if stroke_w_px > 0:
+                        stroke_w_pt = _border_px_to_pt(stroke_w_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+
+                    stroke_rgb, stroke_a = _safe_color_and_opacity(_get_shape_stroke_color(obj), "#111827")
+
+                    # radius pt (utile pour placeholder + stroke)
+                    radius_pt = 0.0
+                    if kind == "roundrect" and radius_px > 0:
+                        radius_pt = _border_px_to_pt(radius_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+
+                    # skip si rect minuscule ou hors page
                     try:
-                        page.insert_image(rect, stream=img_bytes, keep_proportion=True)
+                        if rect.width < 2 or rect.height < 2:
+                            continue
+                        if rect.x1 <= 0 or rect.y1 <= 0 or rect.x0 >= page_w_pt or rect.y0 >= page_h_pt:
+                            continue
                     except Exception:
                         pass
 
-                # stroke au-dessus (optionnel)
-                if stroke_w_pt > 0:
-                    try:
-                        sh = page.new_shape()
+                    candidates = po.image_sources or []
+
+                    # Placeholder si pas d'image
+                    if not candidates:
                         try:
-                            if kind == "roundrect" and radius_pt > 0:
-                                sh.draw_rect(rect, radius=radius_pt)
-                            else:
+                            sh = batch.shape(rect, stroke_w_pt)
+                            try:
+                                if kind == "roundrect" and radius_pt > 0:
+                                    sh.draw_rect(rect, radius=radius_pt)
+                                else:
+                                    sh.draw_rect(rect)
+                            except Exception:
                                 sh.draw_rect(rect)
+
+                            sh.finish(
+                                color=stroke_rgb,
+                                fill=None,
+                                width=max(0.25, stroke_w_pt or 0.8),
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
+                            batch.done(sh)
+
+                            # diagonale
+                            batch.draw_line(
+                                (rect.x1, rect.y0),
+                                (rect.x0, rect.y1),
+                                color=stroke_rgb,
+                                width=max(0.25, stroke_w_pt or 0.8),
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
                         except Exception:
-                            sh.draw_rect(rect)
+                            pass
+                        continue
 
-                        sh.finish(
-                            color=stroke_rgb,
-                            fill=None,
-                            width=stroke_w_pt,
-                            stroke_opacity=_clamp01(stroke_a),
-                        )
-                        sh.commit()
-                    except Exception:
+                    img_bytes: Optional[bytes] = None
+
+                    max_tries = min(5, len(candidates))
+                    for cand in candidates[:max_tries]:
+                        cand = str(cand or "").strip()
+                        if not cand:
+                            continue
+
+                        b = _load_image_candidate(cand, prefetched_images)
+                        if not b:
+                            continue
+
+                        if not _bytes_is_definitely_image(b):
+                            continue
+
+                        # webp => png préparé (converti une fois par contenu)
+                        b = _prepared_image_bytes(b)
+                        if not b:
+                            continue
+
+                        img_bytes = b
+                        break
+
+                    if not img_bytes:
+                        # placeholder si on n'a rien pu charger
                         try:
-                            page.draw_rect(rect, color=stroke_rgb, width=stroke_w_pt, stroke_opacity=_clamp01(stroke_a))
+                            sh = batch.shape(rect, stroke_w_pt)
+                            try:
+                                if kind == "roundrect" and radius_pt > 0:
+                                    sh.draw_rect(rect, radius=radius_pt)
+                                else:
+                                    sh.draw_rect(rect)
+                            except Exception:
+                                sh.draw_rect(rect)
+
+                            sh.finish(
+                                color=stroke_rgb,
+                                fill=None,
+                                width=max(0.25, stroke_w_pt or 0.8),
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
+                            batch.done(sh)
+
+                            batch.draw_line(
+                                (rect.x1, rect.y0),
+                                (rect.x0, rect.y1),
+                                color=stroke_rgb,
+                                width=max(0.25, stroke_w_pt or 0.8),
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
                         except Exception:
                             pass
+                        continue
 
-                continue
+                    tr = _clip_transform(obj)
+                    scale = float(tr.get("scale", 1.0))
+                    offx = float(tr.get("offsetX", 0.0))
+                    offy = float(tr.get("offsetY", 0.0))
 
+                    raster_scale = 2.0
+                    out_w = int(max(2.0, rect.width * raster_scale))
+                    out_h = int(max(2.0, rect.height * raster_scale))
 
-            # ---- IMAGE
-                        # ---- IMAGE
-            if str(obj_type or "").strip().lower() == "image":
-                src0 = (obj.get("src") or "").strip()
-                cands = obj.get("src_candidates") or obj.get("srcCandidates") or []
-                if not isinstance(cands, list):
-                    cands = []
+                    # (optionnel mais conseillé) plafond pour éviter des PNG énormes
+                    MAX_RASTER = 2200
+                    if out_w > MAX_RASTER or out_h > MAX_RASTER:
+                        ratio = min(MAX_RASTER / max(out_w, 1), MAX_RASTER / max(out_h, 1))
+                        ratio = max(0.25, ratio)
+                        out_w = int(max(2, out_w * ratio))
+                        out_h = int(max(2, out_h * ratio))
+                        raster_scale = raster_scale * ratio  # ajuste cohérence offsets
 
-                candidates: List[str] = []
+                    rad_img = 0
+                    if kind == "roundrect" and radius_px > 0:
+                        rad_img = int(max(0, min(radius_px * raster_scale, min(out_w, out_h) / 2)))
+
+                    with span("raster"):
+                        png_stream = _render_clip_mask_image_png(
+                            img_bytes=img_bytes,
+                            out_w_px=out_w,
+                            out_h_px=out_h,
+                            scale=scale,
+                            offset_x_px=offx * raster_scale,
+                            offset_y_px=offy * raster_scale,
+                            radius_px=rad_img,
+                        )
 
-                def _push(u: Any):
-                    ss = str(u or "").strip()
-                    if ss and ss not in candidates:
-                        candidates.append(ss)
+                    if png_stream:
+                        try:
+                            batch.direct(rect)
+                            _insert_image_once(page, rect, png_stream, image_xrefs, keep_proportion=False)
+                        except Exception:
+                            try:
+                                batch.direct(rect)
+                                _insert_image_once(page, rect, img_bytes, image_xrefs, keep_proportion=True)
+                            except Exception:
+                                pass
+                    else:
+                        # fallback direct si rendu pillow échoue
+                        try:
+                            batch.direct(rect)
+                            _insert_image_once(page, rect, img_bytes, image_xrefs, keep_proportion=True)
+                        except Exception:
+                            pass
 
-                _push(src0)
-                for u in cands:
-                    _push(u)
+                    # stroke au-dessus (optionnel)
+                    if stroke_w_pt > 0:
+                        try:
+                            sh = batch.shape(rect, stroke_w_pt)
+                            try:
+                                if kind == "roundrect" and radius_pt > 0:
+                                    sh.draw_rect(rect, radius=radius_pt)
+                                else:
+                                    sh.draw_rect(rect)
+                            except Exception:
+                                sh.draw_rect(rect)
+
+                            sh.finish(
+                                color=stroke_rgb,
+                                fill=None,
+                                width=stroke_w_pt,
+                                stroke_opacity=_clamp01(stroke_a),
+                            )
+                            batch.done(sh)
+                        except Exception:
+                            batch.reset_path()
+                            try:
+                                batch.draw_rect(rect, color=stroke_rgb, width=stroke_w_pt, stroke_opacity=_clamp01(stroke_a))
+                            except Exception:
+                                pass
 
-                if not candidates:
                     continue
 
-                # skip si rect minuscule ou hors page
-                try:
-                    if rect.width < 2 or rect.height < 2:
-                        continue
-                    if rect.x1 <= 0 or rect.y1 <= 0 or rect.x0 >= page_w_pt or rect.y0 >= page_h_pt:
+
+                # ---- IMAGE
+                            # ---- IMAGE
+                if po.category == "image":
+                    candidates = po.image_sources or []
+                    if not candidates:
                         continue
-                except Exception:
-                    pass
 
-                # cache global images (avec "miss cache" sentinel b"")
-                if not hasattr(render_pdf_with_overlays, "_img_cache"):
-                    render_pdf_with_overlays._img_cache = {}  # type: ignore[attr-defined]
-                _IMG_CACHE: Dict[str, bytes] = render_pdf_with_overlays._img_cache  # type: ignore[attr-defined]
+                    # skip si rect minuscule ou hors page
+                    try:
+                        if rect.width < 2 or rect.height < 2:
+                            continue
+                        if rect.x1 <= 0 or rect.y1 <= 0 or rect.x0 >= page_w_pt or rect.y0 >= page_h_pt:
+                            continue
+                    except Exception:
+                        pass
 
-                img_bytes: Optional[bytes] = None
-                chosen: Optional[str] = None
+                    img_bytes: Optional[bytes] = None
+                    chosen: Optional[str] = None
 
-                max_tries = min(5, len(candidates))
-                for cand in candidates[:max_tries]:
-                    chosen = cand
+                    max_tries = min(5, len(candidates))
+                    for cand in candidates[:max_tries]:
+                        chosen = cand
 
-                    if cand not in _IMG_CACHE:
-                        b = _parse_data_url(cand)
+                        b = _load_image_candidate(cand, prefetched_images)
                         if not b:
-                            b = _resolve_image_to_bytes(cand, timeout_s=8) or None
-                        _IMG_CACHE[cand] = b if b else b""  # sentinel
-
-                    b = _IMG_CACHE.get(cand) or b""
-                    if b == b"":
-                        continue
+                            continue
 
-                    if not _bytes_is_definitely_image(b):
-                        print("[PDF_RENDER][IMG] not image bytes, skip:", cand, "head=", b[:24])
-                        continue
+                        if not _bytes_is_definitely_image(b):
+                            print("[PDF_RENDER][IMG] not image bytes, skip:", cand, "head=", b[:24])
+                            continue
 
-                    kind_img = _sniff_image_kind(b)
-                    if kind_img == "webp":
-                        pngb = _try_webp_to_png(b)
-                        if not pngb:
+                        pb = _prepared_image_bytes(b)
+                        if not pb:
                             print("[PDF_RENDER][IMG] webp->png FAILED, next cand:", cand)
                             continue
-                        b = pngb
-                        kind_img = _sniff_image_kind(b)
-                        if kind_img != "png":
-                            print("[PDF_RENDER][IMG] webp->png produced non-png, next cand:", cand)
-                            continue
 
-                    img_bytes = b
-                    break
+                        img_bytes = pb
+                        break
 
-                if not img_bytes:
-                    print("[PDF_RENDER][IMG] bytes NONE for src/candidates=", candidates[:max_tries])
-                    continue
+                    if not img_bytes:
+                        print("[PDF_RENDER][IMG] bytes NONE for src/candidates=", candidates[:max_tries])
+                        continue
 
-                try:
-                    page.insert_image(rect, stream=img_bytes, keep_proportion=True)
-                except Exception as e:
-                    print(
-                        "[PDF_RENDER][IMG] insert_image FAILED:",
-                        type(e).__name__,
-                        str(e),
-                        "chosen=", chosen,
-                        "rect=", rect,
-                        "kind=", _sniff_image_kind(img_bytes),
-                        "len=", len(img_bytes or b""),
-                    )
+                    try:
+                        batch.direct(rect)
+                        _insert_image_once(page, rect, img_bytes, image_xrefs, keep_proportion=True)
+                    except Exception as e:
+                        print(
+                            "[PDF_RENDER][IMG] insert_image FAILED:",
+                            type(e).__name__,
+                            str(e),
+                            "chosen=", chosen,
+                            "rect=", rect,
+                            "kind=", _sniff_image_kind(img_bytes),
+                            "len=", len(img_bytes or b""),
+                        )
 
-                continue
+                    continue
 
 
-            # ---- TEXT (statique ou dynamique)
-            dyn_kind = (obj.get("dynamic") or {}).get("kind") or obj.get("_dyn_kind") or ""
-            is_dynamic = str(dyn_kind).strip() in ("product_price", "product_stock_badge", "product_ean")
-            is_textish = _is_text_like_type(obj_type) or _is_text_like_type(obj.get("type"))
+                # ---- TEXT (statique ou dynamique)
+                if po.category == "text":
+                    dyn_kind = po.dyn_kind
+                    is_dynamic = po.is_dynamic
 
-            if is_dynamic or is_textish:
-                dyn_text = _resolve_dynamic_text(obj, ctx)
+                    dyn_text = _resolve_dynamic_text(obj, ctx)
 
-                if is_dynamic and dyn_text is None:
-                    continue
+                    if is_dynamic and dyn_text is None:
+                        continue
 
-                if dyn_text is None:
-                    dyn_text = str(obj.get("text") or "")
+                    if dyn_text is None:
+                        dyn_text = str(obj.get("text") or "")
 
-                font_size_px = _safe_float(obj.get("fontSize"), 16)
-                pb_w_px, pb_h_px = _get_obj_page_box_px(obj)
-                font_size_pt = _font_px_to_pt(font_size_px, page_h_pt, pb_h_px, base_h_px, pdfjs_scale)
+                    font_size_px = _safe_float(obj.get("fontSize"), 16)
+                    pb_w_px, pb_h_px = po.page_box_px
+                    font_size_pt = _font_px_to_pt(font_size_px, page_h_pt, pb_h_px, base_h_px, pdfjs_scale)
 
-                rgb, _a = _parse_css_color(obj.get("color") or "#111827")
+                    rgb = po.color_rgb
 
-                dyn_kind_eff = str(dyn_kind or obj.get("type") or "").strip()
-                fam = _sanitize_font_family(obj.get("fontFamily") or "")
-                weight = _weight_bucket(obj.get("fontWeight"))
+                    dyn_kind_eff = str(dyn_kind or obj.get("type") or "").strip()
+                    fam = po.font_family
+                    weight = po.font_weight
 
-                if _is_builtin_font_family(fam):
-                    fontfile = None
-                    fontname = _normalize_builtin_fontname(fam)
-                else:
-                    fontfile = _resolve_fontfile_path(fam, weight, ctx)
-                    fontname = _register_font_if_needed(page, doc, fam, weight, ctx, font_cache)
+                    if po.builtin_fontname is not None:
+                        fontfile = None
+                        fontname = po.builtin_fontname
+                    else:
+                        with span("fonts"):
+                            fontfile = _resolve_fontfile_path(fam, weight, ctx, font_cache)
+                            fontname = _register_font_if_needed(page, doc, fam, weight, ctx, font_cache, doc_fonts)
+
+                    if dyn_kind_eff == "product_stock_badge" and getattr(ctx, "is_agent", False):
+                        if dyn_text:
+                            _draw_textbox_fit_single_line_local(
+                                page=batch.text(rect),
+                                rect=rect,
+                                text=dyn_text,
+                                fontname=fontname or "helv",
+                                fontfile=fontfile,
+                                fontsize_pt=font_size_pt,
+                                color=rgb,
+                                align=fitz.TEXT_ALIGN_CENTER,
+                            )
+                        continue
 
-                if dyn_kind_eff == "product_stock_badge" and getattr(ctx, "is_agent", False):
-                    if dyn_text:
+                    # background
+                    bg_enabled = obj.get("bgEnabled")
+                    bg_mode = str(obj.get("bgMode") or "").strip()
+                    if bg_enabled is not False and bg_mode != "transparent":
+                        bg_color = obj.get("bgColor") or "rgba(255,255,255,0.72)"
+                        fill_rgb, fill_a = _parse_css_color(str(bg_color))
+                        if bg_mode != "color" and "rgba" not in str(bg_color).lower():
+                            fill_a = 0.72
+                        batch.draw_rect(rect, color=None, fill=fill_rgb, fill_opacity=_clamp01(fill_a))
+
+                    # border
+                    if obj.get("borderEnabled"):
+                        bw_px = _safe_float(obj.get("borderWidth"), 1)
+                        bw_pt = _border_px_to_pt(bw_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
+                        bc_rgb, bc_a = _parse_css_color(obj.get("borderColor") or "#111827")
+                        batch.draw_rect(rect, color=bc_rgb, width=bw_pt, stroke_opacity=_clamp01(bc_a))
+
+                    # product_price special render
+                    if dyn_kind_eff == "product_price":
+                        dyn = obj.get("dynamic") or {}
+                        ps = dyn.get("priceStyle") if isinstance(dyn, dict) else None
+                        ps_kind = (ps.get("kind") if isinstance(ps, dict) else "") or ""
+
+                        if ps_kind == "int_plus_1pt":
+                            euros_plus_pt = _safe_float((ps or {}).get("euros_plus_pt"), 7.0)
+                            if euros_plus_pt < 7.0:
+                                euros_plus_pt = 7.0
+
+                            _draw_price_mixed_sizes(
+                                page=page,
+                                out=batch.text(rect),
+                                rect=rect,
+                                price_txt=dyn_text,
+                                fontname_main=(fontname or "helv"),
+                                fontfile_main=fontfile,
+                                fontname_safe="helv",
+                                font_size_pt=font_size_pt,
+                                color=rgb,
+                                euros_plus_pt=euros_plus_pt,
+                                doc_fonts=doc_fonts,
+                            )
+                        else:
+                            _draw_textbox_fit_single_line_local(
+                                page=batch.text(rect),
+                                rect=rect,
+                                text=dyn_text,
+                                fontname=fontname or "helv",
+                                fontfile=fontfile,
+                                fontsize_pt=font_size_pt,
+                                color=rgb,
+                                align=fitz.TEXT_ALIGN_CENTER,
+                            )
+
+                    elif dyn_kind_eff == "product_ean":
                         _draw_textbox_fit_single_line_local(
-                            page=page,
+                            page=batch.text(rect),
                             rect=rect,
                             text=dyn_text,
                             fontname=fontname or "helv",
@@ -2338,91 +3110,31 @@ def render_pdf_with_overlays(
                             color=rgb,
                             align=fitz.TEXT_ALIGN_CENTER,
                         )
-                    continue
 
-                # background
-                bg_enabled = obj.get("bgEnabled")
-                bg_mode = str(obj.get("bgMode") or "").strip()
-                if bg_enabled is not False and bg_mode != "transparent":
-                    bg_color = obj.get("bgColor") or "rgba(255,255,255,0.72)"
-                    fill_rgb, fill_a = _parse_css_color(str(bg_color))
-                    if bg_mode != "color" and "rgba" not in str(bg_color).lower():
-                        fill_a = 0.72
-                    page.draw_rect(rect, color=None, fill=fill_rgb, fill_opacity=_clamp01(fill_a))
-
-                # border
-                if obj.get("borderEnabled"):
-                    bw_px = _safe_float(obj.get("borderWidth"), 1)
-                    bw_pt = _border_px_to_pt(bw_px, page_w_pt, pb_w_px, base_w_px, pdfjs_scale)
-                    bc_rgb, bc_a = _parse_css_color(obj.get("borderColor") or "#111827")
-                    page.draw_rect(rect, color=bc_rgb, width=bw_pt, stroke_opacity=_clamp01(bc_a))
-
-                # product_price special render
-                if dyn_kind_eff == "product_price":
-                    dyn = obj.get("dynamic") or {}
-                    ps = dyn.get("priceStyle") if isinstance(dyn, dict) else None
-                    ps_kind = (ps.get("kind") if isinstance(ps, dict) else "") or ""
-
-                    if ps_kind == "int_plus_1pt":
-                        euros_plus_pt = _safe_float((ps or {}).get("euros_plus_pt"), 7.0)
-                        if euros_plus_pt < 7.0:
-                            euros_plus_pt = 7.0
-
-                        _draw_price_mixed_sizes(
-                            page=page,
-                            rect=rect,
-                            price_txt=dyn_text,
-                            fontname_main=(fontname or "helv"),
-                            fontfile_main=fontfile,
-                            fontname_safe="helv",
-                            font_size_pt=font_size_pt,
-                            color=rgb,
-                            euros_plus_pt=euros_plus_pt,
-                        )
                     else:
-                        _draw_textbox_fit_single_line_local(
-                            page=page,
-                            rect=rect,
-                            text=dyn_text,
-                            fontname=fontname or "helv",
-                            fontfile=fontfile,
-                            fontsize_pt=font_size_pt,
-                            color=rgb,
-                            align=fitz.TEXT_ALIGN_CENTER,
-                        )
+                        kwargs: Dict[str, Any] = {
+                            "fontsize": font_size_pt,
+                            "color": rgb,
+                            "align": fitz.TEXT_ALIGN_CENTER,
+                        }
+                        if fontfile:
+                            kwargs["fontfile"] = fontfile
+                            if fontname:
+                                kwargs["fontname"] = fontname
+                        else:
+                            kwargs["fontname"] = fontname or "helv"
 
-                elif dyn_kind_eff == "product_ean":
-                    _draw_textbox_fit_single_line_local(
-                        page=page,
-                        rect=rect,
-                        text=dyn_text,
-                        fontname=fontname or "helv",
-                        fontfile=fontfile,
-                        fontsize_pt=font_size_pt,
-                        color=rgb,
-                        align=fitz.TEXT_ALIGN_CENTER,
-                    )
+                        _insert_textbox_autofit(batch.text(rect), rect, dyn_text, kwargs)
 
-                else:
-                    kwargs: Dict[str, Any] = {
-                        "fontsize": font_size_pt,
-                        "color": rgb,
-                        "align": fitz.TEXT_ALIGN_CENTER,
-                    }
-                    if fontfile:
-                        kwargs["fontfile"] = fontfile
-                        if fontname:
-                            kwargs["fontname"] = fontname
-                    else:
-                        kwargs["fontname"] = fontname or "helv"
+                    continue
 
-                    _insert_textbox_autofit(page, rect, dyn_text, kwargs)
+        batch.flush()
 
-                continue
+    if page_range is not None and (first_page, stop_page) != (0, total_pages):
+        # ✅ tranche : on ne garde que les pages rendues (garbage=4 purge le reste)
+        doc.select(list(range(first_page, stop_page)))
 
-    out = doc.tobytes(deflate=True, garbage=4)
-    doc.close()
-    return out
+    return doc
 
     
     
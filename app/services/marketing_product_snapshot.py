@@ -0,0 +1,281 @@
+# app/services/marketing_product_snapshot.py
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.models import MarketingProductsVersion, PriceTier, Product, labo_agent
+
+# ------------------------------------------------------------
+# Snapshot produits (prix / stock / paliers) pour les objets dynamiques
+#   - marketing_products_version (une ligne par labo) : incrémentée par trigger SQL
+#     quand un champ du snapshot change sur product / price_tier (imports, sync stock, API...)
+#   - snapshot de tous les produits du labo dans Redis, un hash par version :
+#     construit une fois par changement, partagé par tous les workers
+#   - Redis indisponible => requête directe sur les ids demandés (comme avant)
+# ------------------------------------------------------------
+SNAPSHOT_TTL_S = int(os.environ.get("MARKETING_PRODUCT_SNAPSHOT_TTL_S", "86400"))
+# un seul worker construit le snapshot, les autres l'attendent au plus ce délai
+SNAPSHOT_BUILD_WAIT_S = float(os.environ.get("MARKETING_PRODUCT_SNAPSHOT_BUILD_WAIT_S", "2"))
+SNAPSHOT_LOCK_TTL_S = 30
+
+# borne de ?ids= en GET (au-delà : POST)
+BULK_INFO_MAX_IDS = 500
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "mkt:prodsnap"
+_READY_FIELD = "__ready__"
+
+_redis = None
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        import redis.asyncio as aioredis
+
+        _redis = aioredis.from_url(settings.REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+    return _redis
+
+
+def _snapshot_key(labo_id: int, version: int) -> str:
+    return f"{_KEY_PREFIX}:{int(labo_id)}:{int(version)}"
+
+
+def _current_key(labo_id: int) -> str:
+    return f"{_KEY_PREFIX}:{int(labo_id)}:current"
+
+
+def _lock_key(labo_id: int, version: int) -> str:
+    return f"{_KEY_PREFIX}:{int(labo_id)}:{int(version)}:lock"
+
+
+# ------------------------------------------------------------
+# Version / ETag
+# ------------------------------------------------------------
+async def get_products_version(session: AsyncSession, labo_id: int) -> int:
+    stmt = select(MarketingProductsVersion.version).where(MarketingProductsVersion.labo_id == int(labo_id))
+    v = await session.scalar(stmt)
+    return int(v or 0)
+
+
+async def get_agent_products_versions(session: AsyncSession, agent_id: int) -> List[Tuple[int, int]]:
+    """[(labo_id, version)] des labos rattachés à l'agent, triés par labo."""
+    # ligne de version absente (labo sans écriture produit depuis la migration) => 0
+    stmt = (
+        select(labo_agent.c.labo_id, func.coalesce(MarketingProductsVersion.version, 0))
+        .outerjoin(MarketingProductsVersion, MarketingProductsVersion.labo_id == labo_agent.c.labo_id)
+        .where(labo_agent.c.agent_id == int(agent_id))
+        .order_by(labo_agent.c.labo_id.asc())
+    )
+    return [(int(lid), int(v or 0)) for (lid, v) in (await session.execute(stmt)).all()]
+
+
+async def get_products_labo_ids(session: AsyncSession, ids: Sequence[int]) -> Dict[int, int]:
+    """{product_id: labo_id} des ids existants (index PK) : lire seulement les snapshots utiles."""
+    if not ids:
+        return {}
+    stmt = select(Product.id, Product.labo_id).where(Product.id.in_(list(ids)))
+    return {int(pid): int(lid) for (pid, lid) in (await session.execute(stmt)).all()}
+
+
+def compute_etag(scope: str, versions: Sequence[Tuple[int, int]], ids: Sequence[int]) -> str:
+    # faible : même contenu logique, sérialisation JSON non garantie octet par octet
+    raw = json.dumps([scope, list(versions), list(ids)], separators=(",", ":"))
+    return 'W/"mp-' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    want = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if (tag[2:] if tag.startswith("W/") else tag) == want:
+            return True
+    return False
+
+
+def parse_ids(raw: Iterable[Any]) -> List[int]:
+    """ids > 0, dédoublonnés, ordre conservé (entrées invalides ignorées)."""
+    ids: List[int] = []
+    for x in raw or []:
+        try:
+            xi = int(x)
+        except Exception:
+            continue
+        if xi > 0:
+            ids.append(xi)
+    return list(dict.fromkeys(ids))
+
+
+def parse_ids_param(ids: Optional[str]) -> List[int]:
+    """?ids=1,2,3 ; ValueError au-delà de BULK_INFO_MAX_IDS."""
+    out = parse_ids((ids or "").split(","))
+    if len(out) > BULK_INFO_MAX_IDS:
+        raise ValueError(f"trop d'ids (max {BULK_INFO_MAX_IDS}, utiliser POST)")
+    return out
+
+
+# ------------------------------------------------------------
+# Lecture DB
+# ------------------------------------------------------------
+def _product_entry(p: Product) -> Dict[str, Any]:
+    # champs bruts : chaque router garde sa forme de sortie (labo / agent)
+    return {
+        "id": int(p.id),
+        "labo_id": int(p.labo_id or 0),
+        "sku": p.sku,
+        "name": p.name,
+        "ean13": p.ean13,
+        "price_ht": float(p.price_ht or 0),
+        "stock": p.stock,
+        "is_active": bool(p.is_active),
+        "thumb_url": getattr(p, "thumb_url", None),
+        "hd_jpg_url": getattr(p, "hd_jpg_url", None),
+        "hd_webp_url": getattr(p, "hd_webp_url", None),
+        "image_url": getattr(p, "image_url", None),
+        "tiers": [],
+    }
+
+
+async def _query_products(
+    session: AsyncSession,
+    labo_id: int,
+    ids: Optional[List[int]] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """Produits du labo (+ paliers triés par qty_min). ids None => tout le labo."""
+    stmt = select(Product).where(Product.labo_id == int(labo_id))
+    if ids is not None:
+        stmt = stmt.where(Product.id.in_(ids))
+    out = {int(p.id): _product_entry(p) for p in (await session.execute(stmt)).scalars().all()}
+    if not out:
+        return out
+
+    tstmt = select(PriceTier.id, PriceTier.product_id, PriceTier.qty_min, PriceTier.price_ht)
+    if ids is not None:
+        tstmt = tstmt.where(PriceTier.product_id.in_(list(out.keys())))
+    else:
+        tstmt = tstmt.join(Product, Product.id == PriceTier.product_id).where(Product.labo_id == int(labo_id))
+    tstmt = tstmt.order_by(PriceTier.product_id.asc(), PriceTier.qty_min.asc())
+
+    for (tid, pid, qty_min, price_ht) in (await session.execute(tstmt)).all():
+        entry = out.get(int(pid))
+        if entry is not None:
+            entry["tiers"].append(
+                {"id": int(tid), "qty_min": int(qty_min or 0), "price_ht": float(price_ht or 0)}
+            )
+    return out
+
+
+# ------------------------------------------------------------
+# Snapshot Redis
+# ------------------------------------------------------------
+async def _read_snapshot(r, key: str, ids: List[int]) -> Optional[Dict[int, Dict[str, Any]]]:
+    values = await r.hmget(key, [_READY_FIELD, *[str(i) for i in ids]])
+    if values[0] is None:
+        return None
+    out: Dict[int, Dict[str, Any]] = {}
+    for pid, raw in zip(ids, values[1:]):
+        if raw is not None:
+            out[pid] = json.loads(raw)
+    return out
+
+
+async def _build_snapshot(r, session: AsyncSession, labo_id: int, version: int) -> None:
+    products = await _query_products(session, labo_id)
+    key = _snapshot_key(labo_id, version)
+
+    mapping = {str(pid): json.dumps(entry, separators=(",", ":")) for pid, entry in products.items()}
+    mapping[_READY_FIELD] = "1"
+
+    # hash visible d'un coup (MULTI), avec son TTL
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, SNAPSHOT_TTL_S)
+        pipe.getset(_current_key(labo_id), str(int(version)))
+        pipe.expire(_current_key(labo_id), SNAPSHOT_TTL_S)
+        res = await pipe.execute()
+
+    # ✅ l'ancienne version ne sera plus lue : libérée tout de suite
+    prev = res[3]
+    if prev is not None:
+        try:
+            prev_v = int(prev)
+        except Exception:
+            prev_v = None
+        if prev_v is not None and prev_v < int(version):
+            await r.delete(_snapshot_key(labo_id, prev_v))
+        elif prev_v is not None and prev_v > int(version):
+            # lecteur en retard (version lue avant un changement) : garder le pointeur le plus récent
+            await r.set(_current_key(labo_id), str(prev_v), ex=SNAPSHOT_TTL_S)
+            await r.expire(key, 60)
+
+    logger.info("[MKT_PRODUCTS] snapshot labo=%s v=%s products=%s", labo_id, version, len(products))
+
+
+async def _get_from_snapshot(
+    session: AsyncSession,
+    labo_id: int,
+    version: int,
+    ids: List[int],
+) -> Optional[Dict[int, Dict[str, Any]]]:
+    r = _get_redis()
+    key = _snapshot_key(labo_id, version)
+
+    found = await _read_snapshot(r, key, ids)
+    if found is not None:
+        return found
+
+    # un seul constructeur par (labo, version)
+    if await r.set(_lock_key(labo_id, version), "1", nx=True, ex=SNAPSHOT_LOCK_TTL_S):
+        try:
+            await _build_snapshot(r, session, labo_id, version)
+        finally:
+            await r.delete(_lock_key(labo_id, version))
+        return await _read_snapshot(r, key, ids)
+
+    waited = 0.0
+    while waited < SNAPSHOT_BUILD_WAIT_S:
+        await asyncio.sleep(0.1)
+        waited += 0.1
+        found = await _read_snapshot(r, key, ids)
+        if found is not None:
+            return found
+    return None
+
+
+async def get_products(
+    session: AsyncSession,
+    labo_id: int,
+    version: int,
+    ids: List[int],
+) -> Dict[int, Dict[str, Any]]:
+    """
+    {product_id: entrée snapshot} pour les ids du labo (les autres sont absents).
+    Entrée : champs produit bruts + "tiers". Repli sur une requête directe si Redis
+    est indisponible ou si le snapshot est en cours de construction ailleurs.
+    """
+    if not ids:
+        return {}
+    try:
+        found = await _get_from_snapshot(session, labo_id, version, ids)
+        if found is not None:
+            return found
+    except Exception as e:
+        logger.warning(
+            "[MKT_PRODUCTS] redis indisponible, requête directe labo=%s: %s: %s", labo_id, type(e).__name__, e
+        )
+    return await _query_products(session, labo_id, ids)
@@ -0,0 +1,288 @@
+# app/services/marketing_published_render.py
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import MarketingDocumentPublication, MarketingPublicationStatus
+from app.services import marketing_render_cache as render_cache
+from app.services.marketing_render_executor import contiguous_ranges
+from app.services.marketing_render_metrics import collect_timings
+from app.services.marketing_signed_url import bucketed_exp, build_public_url, make_marketing_token
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# PDF finaux des publications (prix agents dedans) : hors /app/media (servi en public),
+# mais partagé entre l'API et le worker Celery (volume /app)
+PUBLISHED_RENDER_DIR = Path(os.environ.get("MARKETING_PUBLISHED_RENDER_DIR", "/app/data/marketing_published"))
+# nb de versions rendues gardées par document
+PUBLISHED_RENDER_KEEP = max(1, int(os.environ.get("MARKETING_PUBLISHED_RENDER_KEEP", "2")))
+# miniatures par page (webp, prix agents dedans) : à côté du PDF rendu, servies par lien signé
+PUBLISHED_THUMB_WIDTH = int(os.environ.get("MARKETING_PUBLISHED_THUMB_WIDTH", "320"))
+PUBLISHED_THUMB_FORMAT = "webp"
+PUBLISHED_THUMB_TTL = 300
+
+# ✅ politique unique : une publication dont le pré-rendu n'aboutit pas (broker KO, échecs
+# répétés, worker mort) passe READY quand même et est rendue à la demande (download-rendered)
+PUBLICATION_RENDER_MAX_ATTEMPTS = max(1, int(os.environ.get("MARKETING_PUBLICATION_RENDER_MAX_ATTEMPTS", "3")))
+PUBLICATION_RENDER_RETRY_S = int(os.environ.get("MARKETING_PUBLICATION_RENDER_RETRY_S", "60"))
+# PENDING / RENDERING sans nouvelle depuis ce délai => tâche perdue (worker tué, message perdu)
+PUBLICATION_RENDER_STALE_S = int(os.environ.get("MARKETING_PUBLICATION_RENDER_STALE_S", "1800"))
+
+# nom des tâches Celery (app/celery_tasks/marketing_publication_render.py)
+RENDER_TASK_NAME = "marketing_publication.render"
+RECOVER_TASK_NAME = "marketing_publication.recover_stale"
+
+
+def queue_publication_render(publication_id: int, countdown: Optional[int] = None) -> str:
+    """Côté API : enqueue le pré-rendu d'une publication. Retourne l'id de tâche."""
+    from app.tasks.celery_app import celery
+
+    task = celery.send_task(
+        RENDER_TASK_NAME,
+        kwargs={"publication_id": int(publication_id)},
+        queue="default",
+        countdown=countdown,
+    )
+    logger.info("[PUBLISH_RENDER] queued publication_id=%s task=%s", publication_id, task.id)
+    return str(task.id)
+
+
+# ------------------------------------------------------------
+# Politique de publication
+# ------------------------------------------------------------
+def render_attempts(pub: Any) -> int:
+    opts = getattr(pub, "render_options_json", None) or {}
+    try:
+        return int(opts.get("render_attempts") or 0) if isinstance(opts, dict) else 0
+    except Exception:
+        return 0
+
+
+def mark_render_attempt(pub: Any) -> int:
+    """Compte une tentative de pré-rendu (avant le rendu : un worker tué compte aussi)."""
+    n = render_attempts(pub) + 1
+    # ✅ JSONB : on réassigne un nouveau dict (pas de mutation en place)
+    opts = dict(pub.render_options_json or {})
+    opts["render_attempts"] = n
+    pub.render_options_json = opts
+    return n
+
+
+def fallback_to_live_render(pub: Any, reason: str) -> None:
+    """
+    Pré-rendu abandonné : la publication est servie quand même (READY),
+    download-rendered rend à la demande faute de fichier pré-rendu.
+    """
+    opts = dict(pub.render_options_json or {})
+    opts["render_fallback"] = "live"
+    opts["render_error"] = str(reason)[:500]
+    pub.render_options_json = opts
+    pub.status = MarketingPublicationStatus.READY
+    pub.error_message = f"Pré-rendu indisponible, rendu à la demande: {reason}"[:1000]
+    logger.warning("[PUBLISH_RENDER] publication_id=%s READY sans pré-rendu: %s", pub.id, reason)
+
+
+def schedule_render_retry(pub: Any, reason: str) -> bool:
+    """
+    Tentative suivante si le quota n'est pas atteint (publication repassée PENDING), sinon
+    rendu à la demande. True si une tentative est (re)programmée. Commit à faire par l'appelant.
+    """
+    if render_attempts(pub) >= PUBLICATION_RENDER_MAX_ATTEMPTS:
+        fallback_to_live_render(pub, reason)
+        return False
+    try:
+        queue_publication_render(pub.id, countdown=PUBLICATION_RENDER_RETRY_S * max(1, render_attempts(pub)))
+    except Exception as e:
+        fallback_to_live_render(pub, f"{reason} (enqueue KO: {e})")
+        return False
+    pub.status = MarketingPublicationStatus.PENDING
+    pub.error_message = str(reason)[:1000] if reason else None
+    return True
+
+
+async def recover_stale_publications(session: AsyncSession, document_id: Optional[int] = None) -> int:
+    """
+    Publications restées PENDING / RENDERING plus de PUBLICATION_RENDER_STALE_S :
+    relancées (quota de tentatives) ou servies en rendu à la demande. Commit fait ici.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=PUBLICATION_RENDER_STALE_S)
+    stmt = select(MarketingDocumentPublication).where(
+        MarketingDocumentPublication.status.in_(
+            [MarketingPublicationStatus.PENDING, MarketingPublicationStatus.RENDERING]
+        ),
+        MarketingDocumentPublication.updated_at < cutoff,
+    )
+    if document_id is not None:
+        stmt = stmt.where(MarketingDocumentPublication.document_id == int(document_id))
+
+    pubs = list((await session.execute(stmt)).scalars().all())
+    for pub in pubs:
+        schedule_render_retry(pub, f"pré-rendu bloqué en {pub.status.value}")
+    if pubs:
+        await session.commit()
+    return len(pubs)
+
+
+# ------------------------------------------------------------
+# Fichiers
+# ------------------------------------------------------------
+def _resolve(rel: Any) -> Optional[Path]:
+    if not rel or not isinstance(rel, str):
+        return None
+    root = PUBLISHED_RENDER_DIR.resolve()
+    p = (root / rel).resolve()
+    if root not in p.parents:
+        return None
+    return p
+
+
+def new_rendered_pdf_relpath(labo_id: int, doc_id: int, version: int) -> str:
+    return f"labo_{int(labo_id)}/doc_{int(doc_id)}_v{int(version)}_{uuid.uuid4().hex}.pdf"
+
+
+def rendered_pdf_path(rel: str) -> Path:
+    p = _resolve(rel)
+    if p is None:
+        raise ValueError(f"Chemin de rendu invalide: {rel}")
+    p.parent.mkdir(parents=True, exist_ok=True)
+    return p
+
+
+def resolve_rendered_file(rel: Any) -> Optional[Path]:
+    """Fichier pré-rendu (PDF ou miniature) à partir de son chemin relatif, None si hors du dossier."""
+    return _resolve(rel)
+
+
+def _thumbs_dir(pdf_path: Path) -> Path:
+    return pdf_path.with_name(f"{pdf_path.stem}_thumbs")
+
+
+def published_thumb_urls(pub_opts: Any, doc_id: int, labo_id: int, now: Optional[int] = None) -> List[str]:
+    """
+    Liens signés des miniatures par page (prix agents dedans : jamais sous /media).
+    Anciennes publications : miniatures "published/..." du dossier du document.
+    """
+    thumbs = (pub_opts or {}).get("thumbs") if isinstance(pub_opts, dict) else None
+    if not thumbs:
+        return []
+    exp = bucketed_exp(PUBLISHED_THUMB_TTL, int(now if now is not None else time.time()))
+    out: List[str] = []
+    for rel in thumbs:
+        try:
+            token = make_marketing_token(
+                doc_id=int(doc_id),
+                kind="thumb" if str(rel).startswith("published/") else "render_thumb",
+                exp_ts=exp,
+                labo_id=int(labo_id),
+                filename=str(rel),
+            )
+            out.append(build_public_url(token))
+        except Exception:
+            continue
+    return out
+
+
+def get_published_render(pub: Any, render_key: str) -> Optional[Path]:
+    """
+    PDF pré-rendu de la publication si il correspond encore au rendu demandé
+    (même clé : même snapshot, mêmes produits/paliers, mêmes polices), sinon None.
+    """
+    if pub is None:
+        return None
+    opts = getattr(pub, "render_options_json", None) or {}
+    if not isinstance(opts, dict) or not render_key or opts.get("render_key") != render_key:
+        return None
+    p = _resolve(opts.get("rendered_pdf"))
+    try:
+        if p is not None and p.is_file() and p.stat().st_size > 0:
+            return p
+    except Exception:
+        return None
+    return None
+
+
+def prune_document_renders(labo_id: int, doc_id: int, keep: int = PUBLISHED_RENDER_KEEP) -> None:
+    """Garde les `keep` rendus les plus récents du document (best effort)."""
+    d = PUBLISHED_RENDER_DIR / f"labo_{int(labo_id)}"
+    try:
+        files = sorted(d.glob(f"doc_{int(doc_id)}_v*.pdf"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for p in files[keep:]:
+            p.unlink(missing_ok=True)
+            # miniatures du rendu : supprimées avec leur PDF
+            shutil.rmtree(_thumbs_dir(p), ignore_errors=True)
+    except Exception:
+        pass
+
+
+# ------------------------------------------------------------
+# Rendu (worker Celery, synchrone)
+# ------------------------------------------------------------
+def render_publication_files(
+    input_pdf: Any,
+    draft: Dict[str, Any],
+    ctx: Any,
+    plan: Any,
+    page_keys: Sequence[str],
+    output_path: str,
+    optimize: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    PDF final + miniatures d'une publication, dans le process courant
+    (un worker Celery prefork ne peut pas lancer le pool de rendu).
+    Cache par page : seules les pages absentes sont rendues, les pages
+    inchangées depuis la version précédente sont reprises telles quelles.
+    optimize : profil de taille appliqué au PDF final (pas aux pages en cache).
+    Miniatures : dossier "<pdf>_thumbs/" à côté du PDF rendu (chemins relatifs à PUBLISHED_RENDER_DIR).
+    """
+    from app.services.marketing_pdf_renderer import (
+        merge_pdf_files,
+        rasterize_pdf_page,
+        render_pdf_to_file,
+        save_pages_to_files,
+    )
+
+    started = time.perf_counter()
+    with collect_timings() as tm:
+        if page_keys:
+            dirty = [i for i, k in enumerate(page_keys) if render_cache.get_cached_page(k) is None]
+            page_paths = [str(render_cache.page_path(k)) for k in page_keys]
+            for a, b in contiguous_ranges(dirty):
+                save_pages_to_files(input_pdf, draft, ctx, (a, b), page_paths[a:b], plan=plan)
+            size = merge_pdf_files(page_paths, output_path, optimize=optimize)
+            render_cache.prune_page_cache()
+        else:
+            # PDF sans page : rien à mettre en cache
+            dirty, page_paths = [], []
+            size = render_pdf_to_file(input_pdf, output_path, draft, ctx, plan=plan, optimize=optimize)
+
+        # miniatures : une par page, depuis les pages en cache (petits PDF)
+        out = Path(output_path)
+        thumbs_dir = _thumbs_dir(out)
+        size_key = render_cache.preview_size_key(PUBLISHED_THUMB_WIDTH, None)
+        thumbs: List[str] = []
+        for i, page_pdf in enumerate(page_paths):
+            name = f"p{i + 1}.{PUBLISHED_THUMB_FORMAT}"
+            rasterize_pdf_page(page_pdf, thumbs_dir / name, size_key, PUBLISHED_THUMB_FORMAT)
+            thumbs.append(str((thumbs_dir / name).relative_to(PUBLISHED_RENDER_DIR.resolve())))
+
+    return {
+        "size": int(size),
+        "page_count": len(page_paths),
+        "rendered_pages": len(dirty),
+        "thumbs": thumbs,
+        "render_ms": round((time.perf_counter() - started) * 1000, 1),
+        "timings": tm.to_dict(),
+    }
@@ -0,0 +1,400 @@
+# app/services/marketing_render_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# ⚠️ hors de /app/media : ce dossier ne doit PAS être servi par /media
+RENDER_CACHE_DIR = Path(os.environ.get("MARKETING_RENDER_CACHE_DIR", "/tmp/zenhub_render_cache"))
+# nb max de rendus conservés par document (toutes variantes confondues)
+RENDER_CACHE_PER_DOC = int(os.environ.get("MARKETING_RENDER_CACHE_PER_DOC", "8"))
+# pages rendues (1 PDF par page), partagées entre versions / documents : taille max totale
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("MARKETING_PAGE_CACHE_MAX_MB", "512")) * 1024 * 1024
+# aperçus raster de pages (éditeur) : taille max totale
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get("MARKETING_PREVIEW_CACHE_MAX_MB", "256")) * 1024 * 1024
+# purge LRU des pages / aperçus : au plus une passe par intervalle (tous process confondus)
+PRUNE_INTERVAL_S = float(os.environ.get("MARKETING_RENDER_CACHE_PRUNE_INTERVAL_S", "300"))
+
+# format d'aperçu -> media type
+PREVIEW_FORMATS = {"webp": "image/webp", "png": "image/png"}
+PREVIEW_DEFAULT_WIDTH = 800
+PREVIEW_MAX_WIDTH = 2400
+
+_lock = threading.Lock()
+_sha_memo: Dict[str, Tuple[int, int, str]] = {}
+
+
+# ------------------------------------------------------------
+# Hash helpers
+# ------------------------------------------------------------
+def _canonical_json(value: Any) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def file_sha256(path: Path) -> str:
+    """
+    sha256 d'un fichier, mémoïsé par (chemin, taille, mtime) :
+    un PDF de 50 Mo n'est hashé qu'une fois par process.
+    """
+    p = Path(path)
+    st = p.stat()
+    k = str(p.resolve())
+
+    with _lock:
+        memo = _sha_memo.get(k)
+    if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+        return memo[2]
+
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _lock:
+        _sha_memo[k] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+
+def _rendered_product(p: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Champs produit tels qu'ils influent sur le rendu : le stock n'est dessiné que via
+    les badges rupture (stock == 0 ou non), sa valeur exacte n'entre pas dans les clés.
+    Sinon chaque synchro de stock invaliderait les rendus (et le pré-rendu publié).
+    """
+    if not isinstance(p, dict):
+        return p
+    out = {k: v for k, v in p.items() if k != "stock"}
+    stock = p.get("stock")
+    try:
+        out["out_of_stock"] = stock is not None and int(stock) == 0
+    except Exception:
+        out["out_of_stock"] = False
+    return out
+
+
+def products_fingerprint(
+    products_by_id: Dict[int, Dict[str, Any]],
+    tiers_by_pid: Dict[int, List[Dict[str, Any]]],
+) -> str:
+    """
+    Empreinte des données produit réellement utilisées par le draft
+    (prix, rupture, EAN, paliers). Si un produit référencé change,
+    l'empreinte change => la clé de cache aussi.
+    """
+    data = {
+        "products": {str(k): _rendered_product(v) for k, v in (products_by_id or {}).items()},
+        "tiers": {str(k): v for k, v in (tiers_by_pid or {}).items()},
+    }
+    return hashlib.sha256(_canonical_json(data)).hexdigest()
+
+
+def fonts_fingerprint(fonts: Iterable[Any], global_fonts: Iterable[Any]) -> str:
+    """
+    Empreinte des polices (labo + globales) à partir des lignes BDD,
+    sans toucher au disque.
+    """
+    data = {
+        "labo": [
+            [int(getattr(f, "id", 0) or 0), getattr(f, "filename", None), getattr(f, "sha256", None)]
+            for f in fonts
+        ],
+        "global": [
+            [int(getattr(g, "id", 0) or 0), getattr(g, "family_key", None), getattr(g, "file_path", None)]
+            for g in global_fonts
+        ],
+    }
+    return hashlib.sha256(_canonical_json(data)).hexdigest()
+
+
+def compute_render_key(
+    *,
+    base_pdf_sha256: str,
+    annotation_id: Optional[int],
+    draft_version: int,
+    mode: str,
+    products_fp: str,
+    fonts_fp: str,
+    optimize: str = "none",
+) -> str:
+    data = {
+        "base": base_pdf_sha256,
+        "annotation_id": annotation_id,
+        "draft_version": int(draft_version or 0),
+        "mode": str(mode),
+        "products": products_fp,
+        "fonts": fonts_fp,
+    }
+    # profil de taille (marketing_pdf_optimize) : absent si "none" => clés inchangées
+    if optimize and optimize != "none":
+        data["optimize"] = str(optimize)
+    return hashlib.sha256(_canonical_json(data)).hexdigest()
+
+
+def page_render_keys(
+    plan: Any,
+    draft: Dict[str, Any],
+    *,
+    base_pdf_sha256: str,
+    base_page_count: int,
+    total_pages: int,
+    products_by_id: Dict[int, Dict[str, Any]],
+    tiers_by_pid: Dict[int, List[Dict[str, Any]]],
+    fonts_fp: str,
+) -> List[str]:
+    """
+    Une clé par page du PDF final : page de base (sha du PDF + index, ou page blanche ajoutée),
+    viewport de l'éditeur, contenu de la page dans le plan (badges déjà filtrés),
+    contenu des images de la page, produits référencés par CETTE page et polices.
+    Pas de "mode" : le renderer force le rendu agent et labo / agent ont le même contexte
+    (marketing_render_inputs.build_render_context, même mapping des polices) => pages partagées.
+    Sync (stat / sha des images locales) : à appeler hors de la boucle asyncio.
+    """
+    # import local : le renderer importe ce module
+    from app.services.marketing_pdf_renderer import image_source_version
+
+    draft = draft if isinstance(draft, dict) else {}
+    meta = draft.get("_meta") or {}
+    viewport = [meta.get("pdf_base_width"), meta.get("pdf_base_height"), meta.get("pdf_scale")]
+    appended = [a for a in (draft.get("appended_pages") or []) if isinstance(a, dict)]
+
+    keys: List[str] = []
+    for i in range(int(total_pages)):
+        if i < base_page_count:
+            base = {"sha": base_pdf_sha256, "index": i}
+        else:
+            j = i - base_page_count
+            a = appended[j] if j < len(appended) else {}
+            base = {"blank": [a.get("width"), a.get("height"), a.get("rotate")]}
+
+        pids = plan.page_product_ids(i)
+        # l'URL est dans le contenu, pas les octets : une image remplacée doit changer la clé
+        images = [
+            [image_source_version(src) for src in (po.image_sources or [])[:5]]
+            for po in plan.page_objects(i)
+            if po.category in ("clip", "image")
+        ]
+        data = {
+            "base": base,
+            "viewport": viewport,
+            "content": plan.page_content_hash(i),
+            "images": images,
+            "products": {str(pid): _rendered_product(products_by_id.get(pid)) for pid in pids},
+            "tiers": {str(pid): tiers_by_pid.get(pid) for pid in pids},
+            "fonts": fonts_fp,
+        }
+        keys.append(hashlib.sha256(_canonical_json(data)).hexdigest())
+    return keys
+
+
+# ------------------------------------------------------------
+# Stockage
+# ------------------------------------------------------------
+def _doc_dir(doc_id: int) -> Path:
+    return RENDER_CACHE_DIR / f"doc_{int(doc_id)}"
+
+
+def get_cached_render(doc_id: int, key: str) -> Optional[Path]:
+    p = _doc_dir(doc_id) / f"{key}.pdf"
+    try:
+        if p.is_file() and p.stat().st_size > 0:
+            # "touch" => le pruning garde les rendus récemment servis
+            os.utime(p, None)
+            return p
+    except Exception:
+        return None
+    return None
+
+
+def new_render_tmp(doc_id: int, key: str) -> Path:
+    """
+    Fichier temporaire où le worker écrit le rendu (à valider par commit_render).
+    Si le dossier de cache est inutilisable : fichier temporaire système.
+    """
+    # hors du dossier du document : invalidate_document peut passer pendant le rendu
+    d = RENDER_CACHE_DIR / "tmp"
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        return d / f"doc_{int(doc_id)}.{key[:16]}.{uuid.uuid4().hex}.pdf"
+    except Exception:
+        fd, name = tempfile.mkstemp(prefix="zenhub_render_", suffix=".pdf")
+        os.close(fd)
+        return Path(name)
+
+
+def commit_render(doc_id: int, key: str, tmp_path: Path) -> Optional[Path]:
+    """Publie le rendu écrit dans tmp_path comme entrée de cache. None si échec (tmp_path reste)."""
+    d = _doc_dir(doc_id)
+    final = d / f"{key}.pdf"
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, final)
+    except Exception as e:
+        print("[RENDER_CACHE] commit FAILED", "doc_id=", doc_id, type(e).__name__, str(e))
+        return None
+
+    _prune_doc_dir(d)
+    return final
+
+
+def store_render(doc_id: int, key: str, pdf_bytes: bytes) -> Optional[Path]:
+    """
+    Écrit le rendu (atomique) et purge les plus anciens du document.
+    Best effort : retourne None si le disque refuse.
+    """
+    d = _doc_dir(doc_id)
+    final = d / f"{key}.pdf"
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        tmp = d / f".{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(pdf_bytes)
+        os.replace(tmp, final)
+    except Exception as e:
+        print("[RENDER_CACHE] store FAILED", "doc_id=", doc_id, type(e).__name__, str(e))
+        return None
+
+    _prune_doc_dir(d)
+    return final
+
+
+def _prune_doc_dir(d: Path) -> None:
+    try:
+        files = sorted(
+            (p for p in d.glob("*.pdf") if p.is_file()),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for p in files[max(1, RENDER_CACHE_PER_DOC):]:
+            p.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+
+def page_path(key: str) -> Path:
+    """Emplacement de la page en cache (calcul seul : le worker crée le dossier en écrivant)."""
+    return RENDER_CACHE_DIR / "pages" / key[:2] / f"{key}.pdf"
+
+
+def get_cached_page(key: str) -> Optional[Path]:
+    p = RENDER_CACHE_DIR / "pages" / key[:2] / f"{key}.pdf"
+    try:
+        if p.is_file() and p.stat().st_size > 0:
+            os.utime(p, None)
+            return p
+    except Exception:
+        return None
+    return None
+
+
+def preview_size_key(width: Optional[int], dpi: Optional[int]) -> str:
+    """Taille d'aperçu normalisée (bornée) : "w<px>" ou "d<dpi>"."""
+    if width:
+        return f"w{max(64, min(PREVIEW_MAX_WIDTH, int(width)))}"
+    if dpi:
+        return f"d{max(36, min(300, int(dpi)))}"
+    return f"w{PREVIEW_DEFAULT_WIDTH}"
+
+
+def _preview_file(page_key: str, size_key: str, fmt: str) -> Path:
+    return RENDER_CACHE_DIR / "previews" / page_key[:2] / f"{page_key}_{size_key}.{fmt}"
+
+
+def preview_path(page_key: str, size_key: str, fmt: str) -> Path:
+    # calcul seul : rasterize_pdf_page crée le dossier en écrivant
+    return _preview_file(page_key, size_key, fmt)
+
+
+def get_cached_preview(page_key: str, size_key: str, fmt: str) -> Optional[Path]:
+    p = _preview_file(page_key, size_key, fmt)
+    try:
+        if p.is_file() and p.stat().st_size > 0:
+            os.utime(p, None)
+            return p
+    except Exception:
+        return None
+    return None
+
+
+def prune_preview_cache(max_bytes: int = PREVIEW_CACHE_MAX_BYTES, force: bool = False) -> None:
+    root = RENDER_CACHE_DIR / "previews"
+    if force or _prune_due(root):
+        _prune_lru(root, "*/*.*", max_bytes, min_age_s=60.0)
+
+
+def prune_page_cache(max_bytes: int = PAGE_CACHE_MAX_BYTES, min_age_s: float = 600.0, force: bool = False) -> None:
+    """
+    Supprime les pages les moins récemment servies au-delà de max_bytes.
+    Les pages touchées depuis moins de min_age_s sont gardées (rendu en cours de recollage).
+    Parcours complet du dossier : au plus une fois par PRUNE_INTERVAL_S (sauf force).
+    """
+    root = RENDER_CACHE_DIR / "pages"
+    if force or _prune_due(root):
+        _prune_lru(root, "*/*.pdf", max_bytes, min_age_s)
+
+
+def _prune_due(root: Path) -> bool:
+    """Marqueur <root>/.last_prune : True (et marqueur rafraîchi) si la dernière passe est assez ancienne."""
+    marker = root / ".last_prune"
+    try:
+        if time.time() - marker.stat().st_mtime < PRUNE_INTERVAL_S:
+            return False
+    except FileNotFoundError:
+        pass
+    except Exception:
+        return False
+    try:
+        root.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+    except Exception:
+        return False
+    return True
+
+
+def _prune_lru(root: Path, pattern: str, max_bytes: int, min_age_s: float) -> None:
+    try:
+        entries = []
+        for p in root.glob(pattern):
+            st = p.stat()
+            entries.append((st.st_mtime, st.st_size, p))
+    except Exception:
+        return
+
+    total = sum(e[1] for e in entries)
+    if total <= max_bytes:
+        return
+    now = time.time()
+    for mtime, size, p in sorted(entries, key=lambda e: e[0]):
+        if now - mtime < min_age_s:
+            break
+        try:
+            p.unlink(missing_ok=True)
+        except Exception:
+            continue
+        total -= size
+        if total <= max_bytes:
+            break
+
+
+def invalidate_document(doc_id: int) -> None:
+    """
+    Supprime tous les rendus d'un document (draft sauvegardé, publication,
+    suppression). Best effort.
+    Les pages (cache par contenu) ne sont pas touchées : une page inchangée
+    (objets, produits, polices, contenu des images) reste réutilisable par la version suivante.
+    """
+    try:
+        shutil.rmtree(_doc_dir(doc_id), ignore_errors=True)
+    except Exception:
+        pass
@@ -0,0 +1,595 @@
+# app/services/marketing_render_executor.py
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from app.services.marketing_render_metrics import current_timings
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# nb de process de rendu (PyMuPDF = CPU bound, 1 process par coeur max)
+RENDER_WORKERS = max(1, int(os.environ.get("MARKETING_RENDER_WORKERS", "2")))
+# nb de jobs en attente acceptés au-delà des workers occupés
+RENDER_QUEUE_SIZE = max(0, int(os.environ.get("MARKETING_RENDER_QUEUE", "8")))
+# durée max d'un rendu (secondes)
+RENDER_TIMEOUT_S = float(os.environ.get("MARKETING_RENDER_TIMEOUT_S", "120"))
+# recycle un worker après N rendus (fuites mémoire PyMuPDF / Pillow)
+RENDER_MAX_TASKS_PER_CHILD = int(os.environ.get("MARKETING_RENDER_MAX_TASKS_PER_CHILD", "50"))
+# valeur du header Retry-After quand la file est pleine
+RENDER_RETRY_AFTER_S = int(os.environ.get("MARKETING_RENDER_RETRY_AFTER_S", "5"))
+# rendu parallèle par tranches de pages (1 => désactivé)
+RENDER_SHARDS = max(1, int(os.environ.get("MARKETING_RENDER_SHARDS", "1")))
+# en dessous de ce nb de pages, le découpage coûte plus qu'il ne rapporte
+RENDER_SHARD_MIN_PAGES = max(2, int(os.environ.get("MARKETING_RENDER_SHARD_MIN_PAGES", "8")))
+# rendu par lot de variantes prix : nb max de variantes par requête
+RENDER_MAX_VARIANTS = max(1, int(os.environ.get("MARKETING_RENDER_MAX_VARIANTS", "100")))
+# rendu par lot de variantes prix : durée max du lot (secondes)
+RENDER_VARIANTS_TIMEOUT_S = float(os.environ.get("MARKETING_RENDER_VARIANTS_TIMEOUT_S", "600"))
+
+
+class RenderUnavailable(Exception):
+    """Le rendu n'a pas pu être pris en charge (file pleine, worker tué...)."""
+
+    def __init__(self, message: str, retry_after_s: int = RENDER_RETRY_AFTER_S) -> None:
+        super().__init__(message)
+        self.retry_after_s = int(retry_after_s)
+
+
+class RenderQueueFull(RenderUnavailable):
+    pass
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def _timed_job(fn: Callable[..., Any], args: Tuple[Any, ...]) -> Tuple[Any, Dict[str, Any], float]:
+    # enveloppe de tous les jobs : spans du renderer collectés dans le worker et renvoyés au parent
+    from app.services.marketing_render_metrics import collect_timings
+
+    started_at = time.time()
+    with collect_timings() as tm:
+        result = fn(*args)
+    return result, tm.to_dict(), started_at
+
+
+# input_pdf : bytes ou chemin (de préférence un chemin : rien à copier vers le worker)
+def _render_job(
+    input_pdf: Any, draft: Dict[str, Any], ctx: Any, plan: Any = None, optimize: Optional[str] = None
+) -> bytes:
+    # exécuté dans le process worker (import local : le parent n'a pas besoin de fitz chargé ici)
+    from app.services.marketing_pdf_renderer import render_pdf_with_overlays
+
+    return render_pdf_with_overlays(input_pdf, draft, ctx, plan=plan, optimize=optimize)
+
+
+def _render_shard_job(
+    input_pdf: Any, draft: Dict[str, Any], ctx: Any, start: int, stop: int, plan: Any = None
+) -> bytes:
+    from app.services.marketing_pdf_renderer import render_pdf_with_overlays
+
+    return render_pdf_with_overlays(input_pdf, draft, ctx, page_range=(start, stop), plan=plan)
+
+
+def _render_file_job(
+    input_pdf: Any,
+    output_path: str,
+    draft: Dict[str, Any],
+    ctx: Any,
+    page_range: Optional[Tuple[int, int]] = None,
+    plan: Any = None,
+    optimize: Optional[str] = None,
+) -> int:
+    from app.services.marketing_pdf_renderer import render_pdf_to_file
+
+    return render_pdf_to_file(input_pdf, output_path, draft, ctx, page_range=page_range, plan=plan, optimize=optimize)
+
+
+def _render_pages_job(
+    input_pdf: Any, draft: Dict[str, Any], ctx: Any, start: int, stop: int, plan: Any, output_paths: List[str]
+) -> int:
+    # tranche rendue puis écrite page par page (cache par page)
+    from app.services.marketing_pdf_renderer import save_pages_to_files
+
+    return save_pages_to_files(input_pdf, draft, ctx, (start, stop), output_paths, plan=plan)
+
+
+def _preview_job(
+    input_pdf: Any,
+    draft: Dict[str, Any],
+    ctx: Any,
+    plan: Any,
+    page_index: int,
+    page_pdf_path: str,
+    page_cached: bool,
+    output_path: str,
+    size_key: str,
+    fmt: str,
+) -> int:
+    # page absente du cache : rendue seule (et gardée pour le prochain download / aperçu)
+    from app.services.marketing_pdf_renderer import rasterize_pdf_page, save_pages_to_files
+
+    if not page_cached:
+        save_pages_to_files(input_pdf, draft, ctx, (page_index, page_index + 1), [page_pdf_path], plan=plan)
+    return rasterize_pdf_page(page_pdf_path, output_path, size_key, fmt)
+
+
+def _render_variants_job(
+    input_pdf: Any,
+    draft: Dict[str, Any],
+    ctxs: List[Any],
+    plan: Any,
+    output_paths: List[str],
+    optimize: Optional[str] = None,
+) -> List[int]:
+    from app.services.marketing_pdf_renderer import render_pdf_variants_to_files
+
+    return render_pdf_variants_to_files(input_pdf, draft, ctxs, output_paths, plan=plan, optimize=optimize)
+
+
+def _merge_job(parts: List[bytes], optimize: Optional[str] = None) -> bytes:
+    from app.services.marketing_pdf_renderer import merge_rendered_parts
+
+    return merge_rendered_parts(parts, optimize=optimize)
+
+
+def _merge_files_job(part_paths: List[str], output_path: str, optimize: Optional[str] = None) -> int:
+    # optimisation faite ici, sur le document recollé (polices / images communes aux tranches)
+    from app.services.marketing_pdf_renderer import merge_pdf_files
+
+    return merge_pdf_files(part_paths, output_path, optimize=optimize)
+
+
+def contiguous_ranges(indexes: Sequence[int]) -> List[Tuple[int, int]]:
+    """[3, 4, 5, 9] -> [(3, 6), (9, 10)]"""
+    out: List[Tuple[int, int]] = []
+    for i in sorted(set(int(x) for x in indexes)):
+        if out and out[-1][1] == i:
+            out[-1] = (out[-1][0], i + 1)
+        else:
+            out.append((i, i + 1))
+    return out
+
+
+def split_page_ranges(total_pages: int, shards: int) -> List[Tuple[int, int]]:
+    """Découpe [0, total_pages) en tranches contiguës de tailles équilibrées."""
+    total_pages = max(0, int(total_pages))
+    shards = max(1, min(int(shards), total_pages or 1))
+    base, extra = divmod(total_pages, shards)
+    out: List[Tuple[int, int]] = []
+    start = 0
+    for i in range(shards):
+        stop = start + base + (1 if i < extra else 0)
+        if stop > start:
+            out.append((start, stop))
+        start = stop
+    return out
+
+
+class RenderExecutor:
+    """
+    Pool de process dédié au rendu PDF marketing.
+
+    - nb de workers fixe, file d'attente bornée (=> RenderQueueFull, à mapper en 503)
+    - timeout par job : un job en attente est annulé ; un job en cours entraîne
+      la mise à la retraite du pool : les nouveaux jobs partent sur un pool neuf,
+      les rendus déjà en cours sur l'ancien se terminent, puis ses process
+      (dont celui bloqué) sont tués. Tuer un seul process casserait tout le pool
+      (BrokenProcessPool sur les autres jobs).
+    - pool créé à la première utilisation (spawn : pas de fork de la boucle asyncio)
+    """
+
+    def __init__(
+        self,
+        workers: int = RENDER_WORKERS,
+        queue_size: int = RENDER_QUEUE_SIZE,
+        timeout_s: float = RENDER_TIMEOUT_S,
+        max_tasks_per_child: int = RENDER_MAX_TASKS_PER_CHILD,
+        shards: int = RENDER_SHARDS,
+        shard_min_pages: int = RENDER_SHARD_MIN_PAGES,
+    ) -> None:
+        self.workers = max(1, int(workers))
+        self.shards = max(1, int(shards))
+        self.shard_min_pages = max(2, int(shard_min_pages))
+        self.queue_size = max(0, int(queue_size))
+        self.timeout_s = float(timeout_s)
+        self.max_tasks_per_child = int(max_tasks_per_child) if max_tasks_per_child else None
+
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+        # jobs soumis et non terminés, par pool (id) : attendus avant de tuer un pool retiré
+        self._inflight: Dict[int, Set[Future]] = {}
+        self._retiring = 0
+
+    # --------------------------------------------------------
+    # Pool
+    # --------------------------------------------------------
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    max_tasks_per_child=self.max_tasks_per_child,
+                )
+            return self._pool
+
+    def _discard_pool(self, pool: ProcessPoolExecutor) -> None:
+        """Tue les process du pool et force la création d'un nouveau au prochain job."""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+            self._inflight.pop(id(pool), None)
+        self._kill_pool(pool)
+
+    def _track(self, pool: ProcessPoolExecutor, fut: Future) -> None:
+        with self._lock:
+            self._inflight.setdefault(id(pool), set()).add(fut)
+
+        def _done(f: Future, key: int = id(pool)) -> None:
+            with self._lock:
+                futs = self._inflight.get(key)
+                if futs is not None:
+                    futs.discard(f)
+
+        fut.add_done_callback(_done)
+
+    def _retire_pool(self, pool: ProcessPoolExecutor, stuck: Sequence[Future]) -> None:
+        """
+        Timeout d'un job en cours : plus aucun job n'est envoyé à ce pool, les autres
+        rendus en cours dessus vont à leur terme (au plus timeout_s), puis ses process
+        sont tués (thread de fond : la boucle asyncio n'attend pas).
+        """
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+            others = [f for f in self._inflight.get(id(pool), set()) if f not in set(stuck)]
+            self._retiring += 1
+
+        def _reap() -> None:
+            try:
+                if others:
+                    wait_futures(others, timeout=self.timeout_s or None)
+            finally:
+                with self._lock:
+                    self._inflight.pop(id(pool), None)
+                    self._retiring -= 1
+                self._kill_pool(pool)
+                print("[RENDER_EXEC] pool retiré arrêté, jobs terminés avant arrêt=", len(others))
+
+        threading.Thread(target=_reap, name="render-pool-reaper", daemon=True).start()
+
+    def _kill_pool(self, pool: ProcessPoolExecutor) -> None:
+        procs = list((getattr(pool, "_processes", None) or {}).values())
+        for p in procs:
+            try:
+                p.terminate()
+            except Exception:
+                pass
+        try:
+            pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "pending": self._pending,
+                "timeout_s": self.timeout_s,
+                "shards": self.shards,
+                "started": self._pool is not None,
+                "retiring_pools": self._retiring,
+            }
+
+    # --------------------------------------------------------
+    # API
+    # --------------------------------------------------------
+    async def run(self, fn: Callable[..., Any], *args: Any, timeout_s: Optional[float] = None) -> Any:
+        """
+        Exécute fn(*args) dans le pool et attend le résultat sans bloquer la boucle.
+        fn et args doivent être picklables (fonction module-level).
+        """
+        with self._admit():
+            return (await self._gather([(fn, args)], self._deadline(timeout_s)))[0]
+
+    async def render_pdf(
+        self, input_pdf: Any, draft: Dict[str, Any], ctx: Any, plan: Any = None, optimize: Optional[str] = None
+    ) -> bytes:
+        """
+        Rendu complet. Si MARKETING_RENDER_SHARDS > 1 et que le document est assez long,
+        les tranches de pages sont rendues en parallèle puis recollées (dans le pool aussi).
+        Un rendu = une seule place dans la file, quel que soit le nb de tranches.
+        plan : RenderPlan précompilé (optionnel), transmis tel quel au renderer.
+        optimize : profil de taille (marketing_pdf_optimize), appliqué au PDF final.
+        """
+        from app.services.marketing_pdf_renderer import count_render_pages
+
+        with self._admit():
+            deadline = self._deadline(None)
+
+            shards = min(self.shards, self.workers)
+            ranges: List[Tuple[int, int]] = []
+            if shards > 1:
+                # ouverture fitz hors de la boucle asyncio
+                total_pages = await asyncio.to_thread(count_render_pages, input_pdf, draft)
+                if total_pages >= self.shard_min_pages:
+                    ranges = split_page_ranges(total_pages, shards)
+
+            if len(ranges) <= 1:
+                return (await self._gather([(_render_job, (input_pdf, draft, ctx, plan, optimize))], deadline))[0]
+
+            parts = await self._gather(
+                [(_render_shard_job, (input_pdf, draft, ctx, a, b, plan)) for a, b in ranges],
+                deadline,
+            )
+            return (await self._gather([(_merge_job, (list(parts), optimize))], deadline))[0]
+
+    async def render_pdf_to_file(
+        self,
+        input_pdf: Any,
+        output_path: str,
+        draft: Dict[str, Any],
+        ctx: Any,
+        plan: Any = None,
+        optimize: Optional[str] = None,
+    ) -> int:
+        """
+        Comme render_pdf, mais le worker écrit directement dans output_path
+        (tranches : fichiers temporaires à côté, recollés dans le pool). Retourne la taille.
+        """
+        from app.services.marketing_pdf_renderer import count_render_pages
+
+        with self._admit():
+            deadline = self._deadline(None)
+
+            shards = min(self.shards, self.workers)
+            ranges: List[Tuple[int, int]] = []
+            if shards > 1:
+                total_pages = await asyncio.to_thread(count_render_pages, input_pdf, draft)
+                if total_pages >= self.shard_min_pages:
+                    ranges = split_page_ranges(total_pages, shards)
+
+            if len(ranges) <= 1:
+                return (
+                    await self._gather(
+                        [(_render_file_job, (input_pdf, output_path, draft, ctx, None, plan, optimize))], deadline
+                    )
+                )[0]
+
+            part_paths = [f"{output_path}.part{i}" for i in range(len(ranges))]
+            try:
+                await self._gather(
+                    [
+                        (_render_file_job, (input_pdf, part, draft, ctx, rng, plan))
+                        for part, rng in zip(part_paths, ranges)
+                    ],
+                    deadline,
+                )
+                return (await self._gather([(_merge_files_job, (part_paths, output_path, optimize))], deadline))[0]
+            finally:
+                for part in part_paths:
+                    try:
+                        os.unlink(part)
+                    except OSError:
+                        pass
+
+    async def render_pdf_incremental(
+        self,
+        input_pdf: Any,
+        draft: Dict[str, Any],
+        ctx: Any,
+        plan: Any,
+        page_keys: Sequence[str],
+        output_path: str,
+        optimize: Optional[str] = None,
+    ) -> int:
+        """
+        Rendu avec cache par page (clés = render_cache.page_render_keys) :
+        seules les pages absentes du cache sont rendues (plages contiguës, en parallèle)
+        et écrites directement dans le cache ; le PDF final est recollé de fichiers
+        à fichier (output_path). Aucun PDF ne transite par le process API. Retourne la taille.
+        optimize : appliqué au recollage (les pages en cache restent brutes et réutilisables).
+        """
+        from app.services import marketing_render_cache as render_cache
+
+        with self._admit():
+            deadline = self._deadline(None)
+
+            cached = await asyncio.to_thread(lambda: [render_cache.get_cached_page(k) for k in page_keys])
+            dirty = [i for i, p in enumerate(cached) if p is None]
+            page_paths = [str(render_cache.page_path(k)) for k in page_keys]
+
+            if dirty:
+                ranges: List[Tuple[int, int]] = []
+                shards = min(self.shards, self.workers)
+                for a, b in contiguous_ranges(dirty):
+                    if shards > 1 and (b - a) >= self.shard_min_pages:
+                        ranges.extend((a + x, a + y) for x, y in split_page_ranges(b - a, shards))
+                    else:
+                        ranges.append((a, b))
+
+                await self._gather(
+                    [
+                        (_render_pages_job, (input_pdf, draft, ctx, a, b, plan, page_paths[a:b]))
+                        for a, b in ranges
+                    ],
+                    deadline,
+                )
+
+            print("[RENDER_EXEC] incremental pages=", len(page_keys), "rendered=", len(dirty))
+            size = (await self._gather([(_merge_files_job, (page_paths, output_path, optimize))], deadline))[0]
+
+            # purge en tâche de fond (throttlée) : la réponse n'attend pas le parcours du cache
+            asyncio.get_running_loop().run_in_executor(None, render_cache.prune_page_cache)
+            return size
+
+    async def render_page_preview(
+        self,
+        input_pdf: Any,
+        draft: Dict[str, Any],
+        ctx: Any,
+        plan: Any,
+        page_index: int,
+        page_key: str,
+        size_key: str,
+        fmt: str,
+    ) -> str:
+        """
+        Aperçu raster d'une seule page (page_key = clé du cache par page).
+        Réutilise la page PDF en cache si présente, sinon ne rend que cette page.
+        Retourne le chemin de l'image (cache des aperçus).
+        """
+        from app.services import marketing_render_cache as render_cache
+
+        with self._admit():
+            deadline = self._deadline(None)
+
+            cached_page = await asyncio.to_thread(render_cache.get_cached_page, page_key)
+            page_pdf = cached_page or render_cache.page_path(page_key)
+            out = render_cache.preview_path(page_key, size_key, fmt)
+
+            await self._gather(
+                [
+                    (
+                        _preview_job,
+                        (input_pdf, draft, ctx, plan, int(page_index), str(page_pdf), cached_page is not None,
+                         str(out), size_key, fmt),
+                    )
+                ],
+                deadline,
+            )
+
+            asyncio.get_running_loop().run_in_executor(None, render_cache.prune_preview_cache)
+            return str(out)
+
+    async def render_pdf_variants(
+        self,
+        input_pdf: Any,
+        draft: Dict[str, Any],
+        ctxs: Sequence[Any],
+        plan: Any,
+        output_paths: Sequence[str],
+        timeout_s: float = RENDER_VARIANTS_TIMEOUT_S,
+        optimize: Optional[str] = None,
+    ) -> List[int]:
+        """
+        Lot de variantes prix d'un même document (ctxs[i] -> output_paths[i]).
+        Variantes réparties en MARKETING_RENDER_SHARDS groupes max (1 job par groupe) ;
+        chaque job ne rend qu'une fois la partie commune. Une seule place dans la file.
+        """
+        with self._admit():
+            deadline = self._deadline(timeout_s)
+
+            groups = split_page_ranges(len(ctxs), min(self.shards, self.workers))
+            parts = await self._gather(
+                [
+                    (
+                        _render_variants_job,
+                        (input_pdf, draft, list(ctxs[a:b]), plan, list(output_paths[a:b]), optimize),
+                    )
+                    for a, b in groups
+                ],
+                deadline,
+            )
+            return [size for part in parts for size in part]
+
+    # --------------------------------------------------------
+    # Interne
+    # --------------------------------------------------------
+    def _deadline(self, timeout_s: Optional[float]) -> Optional[float]:
+        timeout = self.timeout_s if timeout_s is None else float(timeout_s)
+        if not timeout:
+            return None
+        return asyncio.get_running_loop().time() + timeout
+
+    @contextmanager
+    def _admit(self) -> Iterator[None]:
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                raise RenderQueueFull("File de rendu pleine")
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def _gather(self, calls: Sequence[Tuple[Callable[..., Any], Tuple[Any, ...]]], deadline: Optional[float]) -> List[Any]:
+        pool = self._get_pool()
+        cfuts = []
+        submitted_at = time.time()
+        try:
+            for fn, args in calls:
+                fut = pool.submit(_timed_job, fn, tuple(args))
+                self._track(pool, fut)
+                cfuts.append(fut)
+        except BrokenProcessPool:
+            for f in cfuts:
+                f.cancel()
+            self._discard_pool(pool)
+            raise RenderUnavailable("Pool de rendu indisponible")
+        except RuntimeError:
+            # pool retiré entre _get_pool et submit (arrêté par le thread de fond)
+            for f in cfuts:
+                f.cancel()
+            if self._pool is pool:
+                raise
+            raise RenderUnavailable("Pool de rendu en cours de recyclage")
+
+        timeout = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+        try:
+            outs = await asyncio.wait_for(
+                asyncio.gather(*(asyncio.wrap_future(f) for f in cfuts)),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            # les jobs en attente sont annulés ; s'il en reste un en cours, le pool est
+            # retiré (les autres rendus en cours dessus ne sont pas interrompus)
+            for f in cfuts:
+                f.cancel()
+            stuck = [f for f in cfuts if not f.done()]
+            if stuck:
+                print("[RENDER_EXEC] timeout => retire pool")
+                self._retire_pool(pool, stuck)
+            raise RenderTimeout("Rendu trop long")
+        except asyncio.CancelledError:
+            # client parti : inutile de garder les tranches pas encore démarrées
+            for f in cfuts:
+                f.cancel()
+            raise
+        except BrokenProcessPool:
+            # worker mort (OOM, segfault, ou pool recyclé par un autre timeout)
+            for f in cfuts:
+                f.cancel()
+            self._discard_pool(pool)
+            raise RenderUnavailable("Worker de rendu interrompu")
+
+        # ✅ spans des workers => timings de la requête en cours (Server-Timing)
+        tm = current_timings()
+        if tm is not None:
+            for _, data, started_at in outs:
+                tm.merge(data)
+                tm.add("queue", max(0.0, started_at - submitted_at))
+        return [result for result, _, _ in outs]
+
+
+# instance process-wide utilisée par les routers
+render_executor = RenderExecutor()
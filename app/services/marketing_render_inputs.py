@@ -0,0 +1,421 @@
+# app/services/marketing_render_inputs.py
+from __future__ import annotations
+
+import asyncio
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import (
+    GlobalFont,
+    MarketingAnnotationStatus,
+    MarketingDocument,
+    MarketingDocumentAnnotation,
+    MarketingDocumentPublication,
+    MarketingFont,
+    MarketingPublicationStatus,
+    PriceTier,
+    Product,
+    labo_agent,
+)
+from app.services import marketing_draft_store as draft_store
+from app.services import marketing_font_map as font_map
+from app.services import marketing_render_cache as render_cache
+from app.services.marketing_pdf_renderer import RenderContext
+from app.services.marketing_render_plan import filter_stock_badges
+from app.services.storage import get_marketing_document_path
+
+# ------------------------------------------------------------
+# Entrées du rendu marketing (download-rendered, preview, pré-rendu de publication)
+#   - mode "labo"  : draft DRAFT, produits du labo du document
+#   - mode "agent" : draft LOCKED de la publication (sinon DRAFT),
+#                    produits visibles par l'agent (agent_id None => labo du document)
+# ------------------------------------------------------------
+RENDER_MODES = ("labo", "agent")
+
+
+@dataclass
+class RenderInputs:
+    pdf_path: Path
+    base_sha256: str
+    is_published: bool
+    published_version: Optional[int]
+    anno: Optional[MarketingDocumentAnnotation]
+    draft: Dict[str, Any]
+    # plan complet ; plan_for_render = badges rupture filtrés selon le mode (rendus courants)
+    plan: Any
+    plan_for_render: Any
+    product_ids: List[int]
+    products_by_id: Dict[int, Dict[str, Any]]
+    tiers_by_pid: Dict[int, list]
+    fonts: List[MarketingFont]
+    gfonts: List[GlobalFont]
+    fonts_dir: Path
+    fonts_fp: str
+    labo_id: int
+    fonts_version: int
+    mode: str = "agent"
+    pub: Optional[MarketingDocumentPublication] = None
+
+
+def _maybe_int(v: Any) -> Optional[int]:
+    # stock NULL en BDD => None (inconnu), PAS 0
+    if v is None:
+        return None
+    try:
+        return int(v)
+    except Exception:
+        return None
+
+
+async def _latest_ready_publication(session: AsyncSession, doc_id: int) -> Optional[MarketingDocumentPublication]:
+    stmt = (
+        select(MarketingDocumentPublication)
+        .where(
+            MarketingDocumentPublication.document_id == int(doc_id),
+            MarketingDocumentPublication.status == MarketingPublicationStatus.READY,
+            MarketingDocumentPublication.published_pdf_filename.isnot(None),
+        )
+        .order_by(MarketingDocumentPublication.version.desc())
+        .limit(1)
+    )
+    return (await session.execute(stmt)).scalars().first()
+
+
+async def _load_products(
+    session: AsyncSession,
+    product_ids: List[int],
+    labo_id: int,
+    agent_id: Optional[int],
+) -> "tuple[Dict[int, Dict[str, Any]], Dict[int, list]]":
+    products_by_id: Dict[int, Dict[str, Any]] = {}
+    tiers_by_pid: Dict[int, list] = {}
+    if not product_ids:
+        return products_by_id, tiers_by_pid
+
+    if agent_id is not None:
+        stmt_p = (
+            select(Product)
+            .join(labo_agent, labo_agent.c.labo_id == Product.labo_id)
+            .where(labo_agent.c.agent_id == int(agent_id))
+            .where(Product.id.in_(product_ids))
+        )
+    else:
+        stmt_p = select(Product).where(Product.labo_id == int(labo_id), Product.id.in_(product_ids))
+
+    for p in (await session.execute(stmt_p)).scalars().all():
+        products_by_id[int(p.id)] = {
+            "id": int(p.id),
+            "sku": p.sku,
+            "name": p.name,
+            "ean13": p.ean13,
+            "price_ht": float(p.price_ht or 0),
+            "stock": _maybe_int(getattr(p, "stock", None)),  # ✅ None allowed
+            "labo_id": int(p.labo_id or 0),
+        }
+
+    ok_ids = list(products_by_id.keys())
+    if ok_ids:
+        stmt_t = (
+            select(PriceTier)
+            .where(PriceTier.product_id.in_(ok_ids))
+            .order_by(PriceTier.product_id.asc(), PriceTier.qty_min.asc())
+        )
+        for t in (await session.execute(stmt_t)).scalars().all():
+            tiers_by_pid.setdefault(int(t.product_id), []).append(
+                {"id": int(t.id), "qty_min": int(t.qty_min), "price_ht": float(t.price_ht or 0)}
+            )
+    return products_by_id, tiers_by_pid
+
+
+async def load_render_inputs(
+    session: AsyncSession,
+    doc: MarketingDocument,
+    mode: str,
+    agent_id: Optional[int] = None,
+    publication: Optional[MarketingDocumentPublication] = None,
+) -> RenderInputs:
+    """
+    Tout ce qui sert au rendu, sans rien rendre :
+    base PDF, draft + plan, produits/paliers, polices (lignes BDD).
+    publication : pré-rendu d'une publication précise (tâche Celery), sinon dernière READY.
+    """
+    if mode not in RENDER_MODES:
+        raise ValueError(f"mode de rendu inconnu: {mode}")
+    labo_id = int(doc.labo_id)
+
+    # 1) base PDF : publié READY si dispo sinon source
+    pub = publication or await _latest_ready_publication(session, int(doc.id))
+    if pub is not None and pub.published_pdf_filename:
+        pdf_path = get_marketing_document_path(labo_id, str(pub.published_pdf_filename))
+        published_version: Optional[int] = int(pub.version or 0)
+    else:
+        pub = None
+        pdf_path = get_marketing_document_path(labo_id, str(doc.filename))
+        published_version = None
+
+    if not pdf_path.exists():
+        raise HTTPException(status_code=500, detail=f"PDF introuvable: {pdf_path}")
+
+    # sha stocké si connu ; sinon hash du fichier (mémoïsé) hors de la boucle asyncio
+    known_sha = getattr(pub, "published_pdf_sha256", None) if pub else getattr(doc, "source_sha256", None)
+    base_sha256 = str(known_sha) if known_sha else await asyncio.to_thread(render_cache.file_sha256, pdf_path)
+
+    # 2) draft : LOCKED de la publication (agent) sinon DRAFT
+    anno: Optional[MarketingDocumentAnnotation] = None
+    if mode == "agent" and pub is not None and getattr(pub, "annotation_locked_id", None):
+        locked = await session.get(MarketingDocumentAnnotation, int(pub.annotation_locked_id))
+        if locked and locked.status == MarketingAnnotationStatus.LOCKED:
+            anno = locked
+
+    if anno is None:
+        stmt_d = (
+            select(MarketingDocumentAnnotation)
+            .where(
+                MarketingDocumentAnnotation.document_id == int(doc.id),
+                MarketingDocumentAnnotation.status == MarketingAnnotationStatus.DRAFT,
+            )
+            .limit(1)
+        )
+        anno = (await session.execute(stmt_d)).scalars().first()
+
+    # ✅ plan précompilé à l'enregistrement (sinon compilé ici) ; draft = manifeste
+    # (_meta / appended_pages), les pages ne sont lues que si le plan est à recompiler
+    plan, draft = await draft_store.load_render_plan_and_draft(session, anno)
+
+    # 3) produits + tiers
+    product_ids = sorted(set(plan.product_ids))
+    products_by_id, tiers_by_pid = await _load_products(
+        session, product_ids, labo_id, agent_id if mode == "agent" else None
+    )
+
+    # ✅ filtre badges rupture (objets déjà normalisés dans le plan)
+    plan_for_render = filter_stock_badges(plan, products_by_id, mode=mode)
+
+    # 4) fonts du labo
+    fonts_dir = Path(f"/app/media/marketing_fonts/labo_{labo_id}")
+
+    # ✅ version lue AVANT la liste : un upload entre les deux donne au pire une liste
+    # plus récente sous l'ancienne version (reconstruite au prochain rendu), jamais
+    # une liste périmée mise en cache sous la nouvelle version
+    fonts_version = await font_map.get_fonts_version(session, labo_id)
+    stmt_fonts = (
+        select(MarketingFont)
+        .where(MarketingFont.labo_id == labo_id)
+        .order_by(MarketingFont.id.asc())
+    )
+    fonts = list((await session.execute(stmt_fonts)).scalars().all())
+
+    # 4bis) ✅ global fonts
+    stmt_gf = (
+        select(GlobalFont)
+        .where(GlobalFont.enabled == True)
+        .order_by(GlobalFont.display_name.asc())
+    )
+    gfonts = list((await session.execute(stmt_gf)).scalars().all())
+
+    return RenderInputs(
+        pdf_path=pdf_path,
+        base_sha256=base_sha256,
+        is_published=pub is not None,
+        published_version=published_version,
+        anno=anno,
+        draft=draft,
+        plan=plan,
+        plan_for_render=plan_for_render,
+        product_ids=product_ids,
+        products_by_id=products_by_id,
+        tiers_by_pid=tiers_by_pid,
+        fonts=fonts,
+        gfonts=gfonts,
+        fonts_dir=fonts_dir,
+        fonts_fp=render_cache.fonts_fingerprint(fonts, gfonts),
+        labo_id=labo_id,
+        fonts_version=fonts_version,
+        mode=mode,
+        pub=pub,
+    )
+
+
+def page_render_keys(ri: RenderInputs) -> List[str]:
+    """Clés du cache par page. Sync (ouverture fitz du PDF de base, sha des images locales) : via asyncio.to_thread."""
+    from app.services.marketing_pdf_renderer import count_base_and_render_pages
+
+    base_page_count, total_pages = count_base_and_render_pages(str(ri.pdf_path), ri.draft)
+    return render_cache.page_render_keys(
+        ri.plan_for_render,
+        ri.draft,
+        base_pdf_sha256=ri.base_sha256,
+        base_page_count=base_page_count,
+        total_pages=total_pages,
+        products_by_id=ri.products_by_id,
+        tiers_by_pid=ri.tiers_by_pid,
+        fonts_fp=ri.fonts_fp,
+    )
+
+
+def render_key(ri: RenderInputs, optimize: str) -> str:
+    """Clé du rendu complet (cache des downloads + pré-rendu de publication)."""
+    return render_cache.compute_render_key(
+        base_pdf_sha256=ri.base_sha256,
+        annotation_id=int(ri.anno.id) if ri.anno else None,
+        draft_version=int(ri.anno.draft_version or 1) if ri.anno else 0,
+        mode=ri.mode,
+        products_fp=render_cache.products_fingerprint(ri.products_by_id, ri.tiers_by_pid),
+        fonts_fp=ri.fonts_fp,
+        optimize=optimize,
+    )
+
+
+# ------------------------------------------------------------
+# Contexte de rendu AGENT (download-rendered agent + pré-rendu de publication)
+# ------------------------------------------------------------
+def _normalize_font_key(family: str, weight: int) -> str:
+    fam = (family or "").strip().lower()
+    fam = re.sub(r"\s+", " ", fam)
+    return f"{fam}__{int(weight)}"
+
+
+def _guess_weight_from_filename(filename: str) -> int:
+    low = (filename or "").lower()
+    if "bold" in low or "-bd" in low or "_bd" in low or "700" in low:
+        return 700
+    return 400
+
+
+def _build_font_files_from_db(fonts: List[MarketingFont], fonts_dir: Path) -> Dict[str, str]:
+    """
+    Mapping attendu par marketing_pdf_renderer:
+      key = "<family>__<weight>" (family normalisé)
+
+    IMPORTANT:
+      - On ne stocke que des .woff2 en BDD/disque
+      - PyMuPDF a besoin d'un TTF/OTF pour dessiner le texte
+      - Donc: le .woff2 est converti en .ttf à l'upload (MarketingFont.ttf_filename),
+        on mappe le .ttf (cf. marketing_font_map)
+
+    Le bon répertoire "source" est /app/media/marketing_fonts/labo_<id>/
+    """
+    out: Dict[str, str] = {}
+
+    def _add_family_keys(family_name: str, weight: int, path: Path):
+        fam = (family_name or "").strip()
+        if not fam:
+            return
+
+        out[_normalize_font_key(fam, weight)] = str(path)
+        out[_normalize_font_key(fam, 0)] = str(path)
+
+        if weight == 400:
+            out[_normalize_font_key(fam, 400)] = str(path)
+        if weight == 700:
+            out[_normalize_font_key(fam, 700)] = str(path)
+
+    def _guess_weight(font_obj, filename_for_guess: str) -> int:
+        original = (getattr(font_obj, "original_name", None) or "").strip()
+        if original:
+            w = _guess_weight_from_filename(original)
+            if w:
+                return w
+        nm = (getattr(font_obj, "name", None) or "").strip()
+        if nm:
+            w = _guess_weight_from_filename(nm)
+            if w:
+                return w
+        return _guess_weight_from_filename(filename_for_guess) or 400
+
+    def _human_family(font_obj, file_stem: str) -> str:
+        human = (getattr(font_obj, "name", None) or "").strip()
+        if human:
+            return human
+
+        base = (file_stem or "").replace("-", " ").replace("_", " ").strip()
+        base = re.sub(r"\bRegular\b|\bBold\b|\bItalic\b|\bMedium\b|\bLight\b", "", base, flags=re.I).strip()
+        base = re.sub(r"([a-z])([A-Z])", r"\1 \2", base).strip()
+        return base
+
+    for f in fonts:
+        fid = int(getattr(f, "id", 0) or 0)
+        if fid <= 0:
+            continue
+
+        filename = (getattr(f, "filename", None) or "").strip()
+        if not filename:
+            continue
+
+        ttf_path = font_map.resolve_font_ttf(f, fonts_dir)
+        if ttf_path is None:
+            continue
+
+        weight = _guess_weight(f, filename)
+
+        # clé stable utilisée par le front: LABO_FONT_<id>
+        _add_family_keys(f"LABO_FONT_{fid}", weight, ttf_path)
+
+        human = _human_family(f, Path(filename).stem)
+        if human:
+            _add_family_keys(human, weight, ttf_path)
+
+    return out
+
+
+def _build_labo_fonts_by_id(fonts: List[MarketingFont]) -> Dict[int, Dict[str, Any]]:
+    """
+    Permet au renderer de résoudre LABO_FONT_<id> => chemin fichier.
+    Ici on met seulement filename (relatif), le renderer le join avec fonts_dir si besoin.
+    """
+    out: Dict[int, Dict[str, Any]] = {}
+    for f in fonts:
+        fid = int(getattr(f, "id", 0) or 0)
+        if fid <= 0:
+            continue
+        filename = getattr(f, "filename", None) or ""
+        if not filename:
+            continue
+        out[fid] = {"ttf_path": filename, "path": filename}
+    return out
+
+
+async def build_render_context(ri: RenderInputs) -> RenderContext:
+    """
+    Contexte de rendu labo ET agent : un seul mapping des polices, sinon une page du cache
+    (clé sans mode) rendue côté labo serait servie aux agents avec une autre graisse.
+    Mapping en cache par process tant que le jeu de polices du labo ne change pas.
+    """
+    fm = await font_map.font_map_cache.get_or_build(
+        "render",
+        ri.labo_id,
+        ri.fonts_version,
+        lambda: (_build_font_files_from_db(ri.fonts, ri.fonts_dir), _build_labo_fonts_by_id(ri.fonts)),
+    )
+
+    global_fonts_by_family: Dict[str, Dict[str, Any]] = {}
+    for gf in ri.gfonts:
+        fam_key = (getattr(gf, "family_key", None) or "").strip()
+        fp = (getattr(gf, "file_path", None) or "").strip()
+        if not fp:
+            continue
+
+        item = {"file_path": fp}
+
+        if fam_key:
+            global_fonts_by_family[fam_key] = item
+
+        gid = int(getattr(gf, "id", 0) or 0)
+        if gid > 0:
+            global_fonts_by_family[f"GLOBAL_FONT_{gid}"] = item
+
+    return RenderContext(
+        products_by_id=ri.products_by_id,
+        tiers_by_product_id=ri.tiers_by_pid,
+        font_files=fm.font_files or None,
+        fonts_dir=str(ri.fonts_dir),
+        labo_fonts_by_id=fm.labo_fonts_by_id or None,
+        global_fonts_by_family=global_fonts_by_family or None,
+        is_agent=True,  # ✅ renderer force aussi is_agent=True (rendu agent, même en labo)
+    )
@@ -0,0 +1,243 @@
+# app/services/marketing_render_metrics.py
+from __future__ import annotations
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# nb de rendus gardés pour les percentiles (par process API)
+RENDER_METRICS_WINDOW = max(10, int(os.environ.get("MARKETING_RENDER_METRICS_WINDOW", "500")))
+
+
+class RenderTimings:
+    """
+    Spans d'UN rendu (ou d'une requête) : nom -> (durée cumulée, nb) + compteurs.
+
+    Temps EXCLUSIF : un span imbriqué (ex. "fonts" dans "text") met le parent
+    en pause, la somme des spans ne compte donc rien deux fois.
+    Thread-safe (prefetch images en threads) ; pile de spans par thread.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.spans: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def _stack(self) -> List[List[Any]]:
+        st = getattr(self._local, "stack", None)
+        if st is None:
+            st = self._local.stack = []
+        return st
+
+    def enter(self, name: str) -> None:
+        now = time.perf_counter()
+        st = self._stack()
+        if st:
+            top = st[-1]
+            top[1] += now - top[2]
+        st.append([name, 0.0, now])
+
+    def exit(self) -> None:
+        now = time.perf_counter()
+        st = self._stack()
+        if not st:
+            return
+        name, acc, t0 = st.pop()
+        self.add(name, acc + (now - t0))
+        if st:
+            st[-1][2] = now
+
+    def add(self, name: str, seconds: float, n: int = 1) -> None:
+        with self._lock:
+            s = self.spans.get(name)
+            if s is None:
+                self.spans[name] = [float(seconds), int(n)]
+            else:
+                s[0] += float(seconds)
+                s[1] += int(n)
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def merge(self, data: Optional[Dict[str, Any]]) -> None:
+        """Ajoute un to_dict() (ex. renvoyé par un worker de rendu)."""
+        if not data:
+            return
+        for name, s in (data.get("spans") or {}).items():
+            self.add(name, float(s.get("ms") or 0) / 1000.0, int(s.get("n") or 0))
+        for name, n in (data.get("counters") or {}).items():
+            self.incr(name, int(n or 0))
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "spans": {k: {"ms": round(v[0] * 1000, 3), "n": v[1]} for k, v in self.spans.items()},
+                "counters": dict(self.counters),
+            }
+
+    def server_timing(self, total_s: Optional[float] = None) -> str:
+        """
+        Valeur du header Server-Timing : un metric par span (dur en ms, desc = nb),
+        puis les compteurs (desc seul). Les spans des workers sont sommés
+        (tranches en parallèle => peut dépasser "total").
+        """
+        parts: List[str] = []
+        with self._lock:
+            for name, (sec, n) in sorted(self.spans.items(), key=lambda kv: -kv[1][0]):
+                parts.append(f'{_token(name)};dur={sec * 1000:.1f};desc="n={n}"')
+            for name, n in sorted(self.counters.items()):
+                parts.append(f'{_token(name)};desc="{n}"')
+        if total_s is not None:
+            parts.append(f"total;dur={total_s * 1000:.1f}")
+        return ", ".join(parts)
+
+
+def _token(name: str) -> str:
+    # Server-Timing : le nom est un token HTTP
+    return "".join(c if (c.isalnum() or c in "._-") else "_" for c in str(name)) or "_"
+
+
+# ------------------------------------------------------------
+# Timings "courants" (contextvar : requête API ou job worker)
+# ------------------------------------------------------------
+_current: contextvars.ContextVar[Optional[RenderTimings]] = contextvars.ContextVar(
+    "marketing_render_timings", default=None
+)
+
+
+def current_timings() -> Optional[RenderTimings]:
+    return _current.get()
+
+
+class collect_timings:
+    """
+    with collect_timings() as tm: ...  => tous les span()/incr() du bloc vont dans tm.
+    Sans collect_timings actif, span()/incr() ne font rien (coût ~nul).
+    """
+
+    def __init__(self, timings: Optional[RenderTimings] = None) -> None:
+        self.timings = timings or RenderTimings()
+        self._token: Optional[contextvars.Token] = None
+
+    def __enter__(self) -> RenderTimings:
+        self._token = _current.set(self.timings)
+        return self.timings
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+
+
+class span:
+    """with span("fonts"): ...  (no-op si aucun collect_timings actif)"""
+
+    __slots__ = ("name", "_tm")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._tm: Optional[RenderTimings] = None
+
+    def __enter__(self) -> None:
+        tm = _current.get()
+        if tm is not None:
+            self._tm = tm
+            tm.enter(self.name)
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._tm is not None:
+            self._tm.exit()
+            self._tm = None
+
+
+def incr(name: str, n: int = 1) -> None:
+    tm = _current.get()
+    if tm is not None:
+        tm.incr(name, n)
+
+
+def start_request_timings() -> RenderTimings:
+    """
+    Démarre la collecte pour la requête en cours (route async FastAPI).
+    Le contextvar vit dans la tâche asyncio de la requête : pas de reset à faire.
+    """
+    tm = RenderTimings()
+    _current.set(tm)
+    return tm
+
+
+# ------------------------------------------------------------
+# Agrégats process (API)
+# ------------------------------------------------------------
+class RenderMetrics:
+    """
+    Agrégats des rendus servis par CE process API : cumul par span / compteur,
+    percentiles de la durée totale sur une fenêtre glissante, hits/miss de cache.
+    (1 instance par process uvicorn : à sommer côté supervision si plusieurs workers.)
+    """
+
+    def __init__(self, window: int = RENDER_METRICS_WINDOW) -> None:
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests: Dict[str, int] = {}
+        self.spans: Dict[str, List[float]] = {}  # name -> [total_s, n, max_s]
+        self.counters: Dict[str, int] = {}
+        self._durations: Deque[float] = deque(maxlen=int(window))
+
+    def record(self, route: str, cache: str, total_s: float, timings: Optional[RenderTimings]) -> None:
+        data = timings.to_dict() if timings is not None else {}
+        with self._lock:
+            key = f"{route}:{cache}"
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._durations.append(float(total_s))
+            for name, s in (data.get("spans") or {}).items():
+                sec = float(s.get("ms") or 0) / 1000.0
+                agg = self.spans.get(name)
+                if agg is None:
+                    self.spans[name] = [sec, int(s.get("n") or 0), sec]
+                else:
+                    agg[0] += sec
+                    agg[1] += int(s.get("n") or 0)
+                    agg[2] = max(agg[2], sec)
+            for name, n in (data.get("counters") or {}).items():
+                self.counters[name] = self.counters.get(name, 0) + int(n or 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            durs = sorted(self._durations)
+
+            def pct(p: float) -> Optional[float]:
+                if not durs:
+                    return None
+                return round(durs[min(len(durs) - 1, int(p * len(durs)))] * 1000, 1)
+
+            return {
+                "since": int(self.started_at),
+                "pid": os.getpid(),
+                "requests": dict(self.requests),
+                "total_ms": {"p50": pct(0.50), "p95": pct(0.95), "max": pct(1.0), "window": len(durs)},
+                "spans": {
+                    k: {"total_ms": round(v[0] * 1000, 1), "n": v[1], "max_ms": round(v[2] * 1000, 1)}
+                    for k, v in sorted(self.spans.items(), key=lambda kv: -kv[1][0])
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+
+# instance process-wide (routers + /health/render)
+render_metrics = RenderMetrics()
+
+
+def timing_headers(tm: RenderTimings, started: float, route: str, cache: str) -> Dict[str, str]:
+    """Headers de réponse (X-Render-Cache + Server-Timing) et agrégat du process."""
+    total_s = time.perf_counter() - started
+    render_metrics.record(route, cache, total_s, tm)
+    return {"X-Render-Cache": cache, "Server-Timing": tm.server_timing(total_s)}
@@ -0,0 +1,490 @@
+# app/services/marketing_render_plan.py
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.services.marketing_pdf_renderer import (
+    _clip_image_sources,
+    _get_obj_page_box_px,
+    _get_shape_layer,
+    _has_rel,
+    _is_builtin_font_family,
+    _is_clip_shape,
+    _is_shape_like,
+    _is_text_like_type,
+    _iter_image_sources,
+    _normalize_builtin_fontname,
+    _parse_css_color,
+    _safe_float,
+    _sanitize_font_family,
+    _weight_bucket,
+)
+
+# à incrémenter dès que le format (ou la compilation) change : les plans stockés
+# avec une autre version sont ignorés et recompilés à la volée
+# v2 : objets référencés par leur index dans la page du draft (plus de copie de l'objet)
+RENDER_PLAN_VERSION = 2
+
+_DYN_KINDS = ("product_price", "product_stock_badge", "product_ean")
+_STOCK_ZERO_MODES_LABO = ("only_if_zero", "labo_only_if_zero", "agent_only_if_zero")
+_STOCK_ZERO_MODES_AGENT = ("only_if_zero", "agent_only_if_zero", "")
+
+
+def _to_int_or_none(v: Any) -> Optional[int]:
+    try:
+        if v is None or v == "":
+            return None
+        return int(v)
+    except Exception:
+        return None
+
+
+def normalize_overlay_object(obj: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Même normalisation que les routers (labo/agent) avant rendu :
+    - obj["dynamic"] toujours présent
+    - camelCase -> snake_case
+    - product_id/tier_id en int
+    """
+    o = dict(obj or {})
+    dyn = dict(o.get("dynamic") or {})
+
+    for snake, camel in (
+        ("product_id", "productId"),
+        ("tier_id", "tierId"),
+        ("price_mode", "priceMode"),
+        ("mode_agent", "modeAgent"),
+        ("mode_labo", "modeLabo"),
+    ):
+        if dyn.get(snake) is None and dyn.get(camel) is not None:
+            dyn[snake] = dyn.get(camel)
+        if o.get(snake) is None and o.get(camel) is not None:
+            o[snake] = o.get(camel)
+
+    kind = dyn.get("kind") or o.get("_dyn_kind") or o.get("type")
+    if kind:
+        dyn["kind"] = kind
+
+    for k in ("product_id", "price_mode", "tier_id", "mode_agent", "mode_labo", "text"):
+        if dyn.get(k) is None and o.get(k) is not None:
+            dyn[k] = o.get(k)
+
+    if dyn.get("product_id") is not None:
+        dyn["product_id"] = _to_int_or_none(dyn.get("product_id"))
+    if dyn.get("tier_id") is not None:
+        dyn["tier_id"] = _to_int_or_none(dyn.get("tier_id"))
+
+    o["dynamic"] = dyn
+    return o
+
+
+# marge (fraction de page) autour des rects pour les chevauchements : traits, arrondis
+_OVERLAP_MARGIN_REL = 0.02
+
+
+def _rel_overlaps(a: Tuple[float, float, float, float], b: Tuple[float, float, float, float]) -> bool:
+    m = _OVERLAP_MARGIN_REL
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ax - m < bx + bw and bx - m < ax + aw and ay - m < by + bh and by - m < ay + ah
+
+
+class PlanObject:
+    """
+    Un overlay prêt à dessiner : catégorie de la branche de rendu, entrées du rect
+    (rel ou px : la taille de page n'est connue qu'au rendu), couleur et police résolues.
+    Stocké sans l'objet lui-même : index dans page.objects, l'objet est relu du draft.
+    """
+
+    __slots__ = (
+        "obj",
+        "index",
+        "category",
+        "rect_rel",
+        "rect_px",
+        "page_box_px",
+        "image_sources",
+        "dyn_kind",
+        "is_dynamic",
+        "color_rgb",
+        "font_family",
+        "font_weight",
+        "builtin_fontname",
+    )
+
+    def __init__(self, obj: Dict[str, Any], category: str, index: int = -1) -> None:
+        self.obj = obj
+        self.index = index  # position de l'objet dans page.objects du draft
+        self.category = category  # "shape" | "clip" | "image" | "text"
+        self.rect_rel: Optional[Tuple[float, float, float, float]] = None
+        self.rect_px: Optional[Tuple[float, float, float, float]] = None
+        self.page_box_px: Tuple[float, float] = (0.0, 0.0)
+        self.image_sources: Optional[List[str]] = None
+        self.dyn_kind = ""
+        self.is_dynamic = False
+        self.color_rgb: Optional[Tuple[float, float, float]] = None
+        self.font_family = ""
+        self.font_weight = 400
+        self.builtin_fontname: Optional[str] = None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "i": self.index,
+            "category": self.category,
+            "rect_rel": list(self.rect_rel) if self.rect_rel else None,
+            "rect_px": list(self.rect_px) if self.rect_px else None,
+            "page_box_px": list(self.page_box_px),
+            "image_sources": self.image_sources,
+            "dyn_kind": self.dyn_kind,
+            "is_dynamic": self.is_dynamic,
+            "color_rgb": list(self.color_rgb) if self.color_rgb else None,
+            "font_family": self.font_family,
+            "font_weight": self.font_weight,
+            "builtin_fontname": self.builtin_fontname,
+        }
+
+    @classmethod
+    def from_json(cls, d: Dict[str, Any], obj: Dict[str, Any]) -> "PlanObject":
+        """obj : objet du draft (normalisé) à l'index d["i"], cf. bind_page_objects."""
+        po = cls(obj, d["category"], int(d["i"]))
+        po.rect_rel = tuple(d["rect_rel"]) if d.get("rect_rel") else None
+        po.rect_px = tuple(d["rect_px"]) if d.get("rect_px") else None
+        po.page_box_px = tuple(d.get("page_box_px") or (0.0, 0.0))
+        po.image_sources = d.get("image_sources")
+        po.dyn_kind = d.get("dyn_kind") or ""
+        po.is_dynamic = bool(d.get("is_dynamic"))
+        po.color_rgb = tuple(d["color_rgb"]) if d.get("color_rgb") else None
+        po.font_family = d.get("font_family") or ""
+        po.font_weight = int(d.get("font_weight") or 400)
+        po.builtin_fontname = d.get("builtin_fontname")
+        return po
+
+
+class RenderPlan:
+    """
+    Draft compilé une fois (à l'enregistrement) : objets déjà normalisés,
+    triés par layer et classés, + ids produits nécessaires aux valeurs dynamiques.
+    """
+
+    __slots__ = ("version", "draft_version", "pages", "product_ids")
+
+    def __init__(
+        self,
+        pages: List[List[PlanObject]],
+        product_ids: List[int],
+        draft_version: Optional[int] = None,
+        version: int = RENDER_PLAN_VERSION,
+    ) -> None:
+        self.version = version
+        self.draft_version = draft_version
+        self.pages = pages
+        self.product_ids = product_ids
+
+    def page_objects(self, page_index: int) -> List[PlanObject]:
+        if 0 <= page_index < len(self.pages):
+            return self.pages[page_index]
+        return []
+
+    def page_product_ids(self, page_index: int) -> List[int]:
+        """Produits dont dépendent les valeurs dynamiques de la page."""
+        ids = {_dyn_product_id(po.obj) for po in self.page_objects(page_index) if po.is_dynamic}
+        return sorted(i for i in ids if i)
+
+    def split_shared(self, page_index: int) -> Tuple[List[PlanObject], List[PlanObject]]:
+        """
+        (objets communs à toutes les variantes prix, objets propres à chaque variante),
+        chacun dans l'ordre de rendu. Un objet statique reste commun tant qu'il ne
+        chevauche aucun objet déjà classé "variante" : l'ordre de dessin ne compte que
+        là où les objets se superposent. Sans rect relatif (coords px), on ne sait pas
+        le situer => tout ce qui suit passe en variante.
+        """
+        shared: List[PlanObject] = []
+        variant: List[PlanObject] = []
+        boxes: List[Tuple[float, float, float, float]] = []
+        unknown = False
+
+        for po in self.page_objects(page_index):
+            if po.is_dynamic or unknown or (boxes and (po.rect_rel is None or any(_rel_overlaps(po.rect_rel, b) for b in boxes))):
+                variant.append(po)
+                if po.rect_rel is None:
+                    unknown = True
+                else:
+                    boxes.append(po.rect_rel)
+            else:
+                shared.append(po)
+        return shared, variant
+
+    def page_content_hash(self, page_index: int) -> str:
+        """Empreinte du contenu de la page (hors données produit) : change dès qu'un objet change."""
+        data = {
+            "v": self.version,
+            "objects": [{**po.to_json(), "obj": po.obj} for po in self.page_objects(page_index)],
+        }
+        raw = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "draft_version": self.draft_version,
+            "product_ids": list(self.product_ids),
+            "pages": [[po.to_json() for po in objs] for objs in self.pages],
+        }
+
+    @classmethod
+    def from_json(cls, d: Dict[str, Any], draft: Dict[str, Any]) -> "RenderPlan":
+        pages = _draft_pages(draft)
+        stored_pages = d.get("pages") or []
+        if len(stored_pages) != len(pages):
+            raise ValueError("plan / draft: nb de pages différent")
+        return cls(
+            pages=[bind_page_objects(objs or [], page) for objs, page in zip(stored_pages, pages)],
+            product_ids=[int(x) for x in (d.get("product_ids") or [])],
+            draft_version=d.get("draft_version"),
+            version=int(d.get("version") or 0),
+        )
+
+
+def _dyn_product_id(o: Dict[str, Any]) -> Optional[int]:
+    dyn = o.get("dynamic") or {}
+    kind = ((dyn.get("kind")) or o.get("_dyn_kind") or o.get("type") or "").strip()
+    if kind not in _DYN_KINDS:
+        return None
+    pid = (
+        dyn.get("product_id")
+        or dyn.get("productId")
+        or o.get("product_id")
+        or o.get("productId")
+        or o.get("_dyn_product_id")
+    )
+    pid_int = _to_int_or_none(pid)
+    return pid_int if pid_int and pid_int > 0 else None
+
+
+def _compile_object(o: Dict[str, Any]) -> Optional[PlanObject]:
+    # même ordre de branches que la boucle du renderer
+    if _is_shape_like(o) and not _is_clip_shape(o):
+        po = PlanObject(o, "shape")
+    elif _is_clip_shape(o):
+        po = PlanObject(o, "clip")
+        po.image_sources = _clip_image_sources(o)
+    elif str(o.get("type") or "").strip().lower() == "image":
+        po = PlanObject(o, "image")
+        po.image_sources = _iter_image_sources(o)
+    else:
+        dyn_kind = (o.get("dynamic") or {}).get("kind") or o.get("_dyn_kind") or ""
+        is_dynamic = str(dyn_kind).strip() in _DYN_KINDS
+        if not (is_dynamic or _is_text_like_type(o.get("type"))):
+            return None  # rien à dessiner
+
+        po = PlanObject(o, "text")
+        po.dyn_kind = dyn_kind
+        po.is_dynamic = is_dynamic
+        po.color_rgb, _a = _parse_css_color(o.get("color") or "#111827")
+        po.font_family = _sanitize_font_family(o.get("fontFamily") or "")
+        po.font_weight = _weight_bucket(o.get("fontWeight"))
+        if _is_builtin_font_family(po.font_family):
+            po.builtin_fontname = _normalize_builtin_fontname(po.font_family)
+
+    if _has_rel(o):
+        po.rect_rel = (
+            _safe_float(o.get("x_rel"), 0.0),
+            _safe_float(o.get("y_rel"), 0.0),
+            _safe_float(o.get("w_rel"), 0.0),
+            _safe_float(o.get("h_rel"), 0.0),
+        )
+    else:
+        po.rect_px = (
+            _safe_float(o.get("x"), 0),
+            _safe_float(o.get("y"), 0),
+            _safe_float(o.get("w"), 0),
+            _safe_float(o.get("h"), 0),
+        )
+    po.page_box_px = _get_obj_page_box_px(o)
+    return po
+
+
+def _compile_page(page: Any) -> Tuple[List[PlanObject], Set[int]]:
+    objs = (page.get("objects") if isinstance(page, dict) else None) or []
+    if not isinstance(objs, list):
+        objs = []
+
+    # (index dans page.objects, objet normalisé)
+    normalized = [(i, normalize_overlay_object(o)) for i, o in enumerate(objs) if isinstance(o, dict)]
+
+    # ✅ Respect du "layer": back d'abord puis front
+    try:
+        normalized = sorted(normalized, key=lambda io: 0 if _get_shape_layer(io[1]) == "back" else 1)
+    except Exception:
+        pass
+
+    plan_objs: List[PlanObject] = []
+    product_ids: Set[int] = set()
+    for i, o in normalized:
+        pid = _dyn_product_id(o)
+        if pid:
+            product_ids.add(pid)
+        po = _compile_object(o)
+        if po is not None:
+            po.index = i
+            plan_objs.append(po)
+    return plan_objs, product_ids
+
+
+def bind_page_objects(stored_objects: List[Dict[str, Any]], page: Any) -> List[PlanObject]:
+    """
+    Objets d'un plan stocké rattachés aux objets de la page du draft (par index).
+    Lève si un index ne correspond plus à un objet : le plan est alors recompilé.
+    """
+    objs = (page.get("objects") if isinstance(page, dict) else None) or []
+    out: List[PlanObject] = []
+    for d in stored_objects:
+        raw = objs[int(d["i"])] if 0 <= int(d["i"]) < len(objs) else None
+        if not isinstance(raw, dict):
+            raise ValueError(f"objet {d.get('i')} absent de la page")
+        out.append(PlanObject.from_json(d, normalize_overlay_object(raw)))
+    return out
+
+
+def _draft_pages(draft: Dict[str, Any]) -> List[Any]:
+    pages = (draft or {}).get("pages") or []
+    return pages if isinstance(pages, list) else []
+
+
+def compile_render_plan(draft: Dict[str, Any], draft_version: Optional[int] = None) -> RenderPlan:
+    """Compile le draft de l'éditeur en plan de rendu (aucune donnée produit nécessaire)."""
+    pages_out: List[List[PlanObject]] = []
+    product_ids: Set[int] = set()
+
+    for page in _draft_pages(draft):
+        plan_objs, pids = _compile_page(page)
+        product_ids |= pids
+        pages_out.append(plan_objs)
+
+    return RenderPlan(pages=pages_out, product_ids=sorted(product_ids), draft_version=draft_version)
+
+
+def stored_plan_is_current(stored: Any, draft_version: int) -> bool:
+    """Plan stocké utilisable tel quel : même version de format, même draft_version."""
+    if not isinstance(stored, dict):
+        return False
+    try:
+        return int(stored.get("version") or 0) == RENDER_PLAN_VERSION and stored.get("draft_version") == int(draft_version)
+    except Exception:
+        return False
+
+
+# ------------------------------------------------------------
+# Plan par page (drafts découpés : MarketingDocumentAnnotationPage.plan_json)
+#   compilé avec la page, dans la même ligne : une page non modifiée n'est
+#   jamais recompilée ni réécrite
+# ------------------------------------------------------------
+def compile_page_plan_json(page: Any) -> Optional[Dict[str, Any]]:
+    """Plan stockable d'une page. None si la compilation échoue : la page sera compilée au rendu."""
+    try:
+        plan_objs, pids = _compile_page(page)
+        return {
+            "version": RENDER_PLAN_VERSION,
+            "product_ids": sorted(pids),
+            "objects": [po.to_json() for po in plan_objs],
+        }
+    except Exception as e:
+        print("[RENDER_PLAN] page compile FAILED", type(e).__name__, str(e))
+        return None
+
+
+def load_page_plan(stored: Any, page: Any) -> Tuple[List[PlanObject], Set[int]]:
+    """Objets + ids produits d'une page : plan stocké s'il est au format courant, sinon compilé."""
+    if isinstance(stored, dict) and int(stored.get("version") or 0) == RENDER_PLAN_VERSION:
+        try:
+            objs = bind_page_objects(stored.get("objects") or [], page)
+            return objs, {int(x) for x in (stored.get("product_ids") or [])}
+        except Exception as e:
+            print("[RENDER_PLAN] stored page plan unreadable, recompile", type(e).__name__, str(e))
+    return _compile_page(page)
+
+
+def assemble_render_plan(
+    page_plans: List[Tuple[List[PlanObject], Set[int]]],
+    draft_version: Optional[int] = None,
+) -> RenderPlan:
+    product_ids: Set[int] = set()
+    for _objs, pids in page_plans:
+        product_ids |= pids
+    return RenderPlan(
+        pages=[objs for objs, _pids in page_plans],
+        product_ids=sorted(product_ids),
+        draft_version=draft_version,
+    )
+
+
+def load_render_plan(anno: Any, draft: Optional[Dict[str, Any]] = None) -> RenderPlan:
+    """
+    Ancien format (pages dans data_json) : plan stocké sur l'annotation s'il est à jour
+    (même version de format, même draft_version), sinon compilation à la volée depuis
+    draft (défaut : data_json de l'annotation). Drafts par page : cf. marketing_draft_store.
+    """
+    if anno is None:
+        return compile_render_plan({"pages": []})
+
+    draft_version = int(getattr(anno, "draft_version", None) or 1)
+    stored = getattr(anno, "render_plan_json", None)
+    if draft is None:
+        draft = getattr(anno, "data_json", None) or {}
+
+    if stored_plan_is_current(stored, draft_version):
+        try:
+            return RenderPlan.from_json(stored, draft)
+        except Exception as e:
+            print("[RENDER_PLAN] stored plan unreadable, recompile", type(e).__name__, str(e))
+
+    return compile_render_plan(draft, draft_version)
+
+
+def filter_stock_badges(plan: RenderPlan, products_by_id: Dict[int, Dict[str, Any]], mode: str) -> RenderPlan:
+    """
+    Masque les badges rupture configurés "only_if_zero" quand le stock est > 0 ou inconnu.
+    mode="labo" : mode_labo, sinon mode_agent, sinon only_if_zero
+    mode="agent" : mode_agent, sinon only_if_zero
+    Les objets ne sont pas copiés (plan en lecture seule).
+    """
+
+    def _keep(po: PlanObject) -> bool:
+        o = po.obj
+        dyn = o.get("dynamic") or {}
+        kind = str(dyn.get("kind") or o.get("type") or "").strip()
+        if kind != "product_stock_badge":
+            return True
+
+        if mode == "agent":
+            badge_mode = str(dyn.get("mode_agent") or "only_if_zero").strip().lower()
+            zero_modes = _STOCK_ZERO_MODES_AGENT
+        else:
+            badge_mode = (
+                str(dyn.get("mode_labo") or "").strip().lower()
+                or str(dyn.get("mode_agent") or "").strip().lower()
+                or "only_if_zero"
+            )
+            zero_modes = _STOCK_ZERO_MODES_LABO
+
+        if badge_mode not in zero_modes:
+            return True
+
+        pid = _to_int_or_none(dyn.get("product_id"))
+        stock = products_by_id[pid].get("stock", None) if pid and pid in products_by_id else None
+        # stock inconnu => on masque (évite "rupture" à tort)
+        if stock is None:
+            return False
+        try:
+            return int(stock) <= 0
+        except Exception:
+            return False
+
+    return RenderPlan(
+        pages=[[po for po in objs if _keep(po)] for objs in plan.pages],
+        product_ids=plan.product_ids,
+        draft_version=plan.draft_version,
+        version=plan.version,
+    )
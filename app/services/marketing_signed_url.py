@@ -6,7 +6,7 @@ import hashlib
 import hmac
 import json
 import time
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 
 from app.core.config import settings
@@ -42,12 +42,43 @@ def _sign_payload(payload: Dict[str, Any]) -> str:
     return _b64url_encode(sig)
 
 
-def make_marketing_token(doc_id: int, kind: str, exp_ts: int) -> str:
+# kinds : "pdf" (PDF source), "thumb" (miniature), "published" (PDF publié, immuable),
+# "render_thumb" (miniature de page du pré-rendu, dossier des rendus publiés)
+TOKEN_KINDS = ("pdf", "thumb", "published", "render_thumb")
+
+
+def bucketed_exp(ttl_s: int, now: Optional[int] = None) -> int:
+    """
+    Expiration arrondie à la fenêtre de ttl_s (validité entre ttl_s et 2*ttl_s) :
+    même token => même URL pendant la fenêtre, donc réutilisable par le cache navigateur.
+    """
+    now = int(time.time()) if now is None else int(now)
+    ttl_s = max(1, int(ttl_s))
+    return (now // ttl_s + 2) * ttl_s
+
+
+def make_marketing_token(
+    doc_id: int,
+    kind: str,
+    exp_ts: int,
+    labo_id: Optional[int] = None,
+    filename: Optional[str] = None,
+    sha256: Optional[str] = None,
+    download_name: Optional[str] = None,
+) -> str:
     """
     Génère un token "payload.signature"
-    payload = {"doc_id":..., "kind":"pdf|thumb", "exp":...}
+    payload = {"doc_id":..., "kind":"pdf|thumb|published", "exp":...}
+    + labo_id / file (/ sha, name) : fichier localisé sans requête DB côté public
     """
-    payload = {"doc_id": int(doc_id), "kind": str(kind), "exp": int(exp_ts)}
+    payload: Dict[str, Any] = {"doc_id": int(doc_id), "kind": str(kind), "exp": int(exp_ts)}
+    if labo_id is not None and filename:
+        payload["labo_id"] = int(labo_id)
+        payload["file"] = str(filename)
+        if sha256:
+            payload["sha"] = str(sha256)
+        if download_name:
+            payload["name"] = str(download_name)
     sig = _sign_payload(payload)
     blob = _b64url_encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
     return f"{blob}.{sig}"
@@ -96,6 +127,6 @@ def parse_and_verify_marketing_token(token: str) -> Dict[str, Any]:
 def build_public_url(token: str) -> str:
     """
     URL publique consommée par l'iframe ou l'image <img>.
-    Tu dois avoir un router qui expose /public/marketing/{token}
+    Servie par app/routers/public_marketing_document.py
     """
     return f"/public/marketing/{token}"
@@ -0,0 +1,214 @@
+# app/services/marketing_text_layout.py
+from __future__ import annotations
+
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fitz  # PyMuPDF
+except Exception:  # pragma: no cover
+    fitz = None  # type: ignore
+
+from app.services.marketing_font_registry import font_registry
+
+# ------------------------------------------------------------
+# Config (env)
+# ------------------------------------------------------------
+# nb max de mesures (texte, police) gardées par process
+TEXT_MEASURE_MAX_ENTRIES = int(os.environ.get("MARKETING_TEXT_MEASURE_MAX_ENTRIES", "50000"))
+
+_FALLBACK_FONTNAME = "helv"
+
+
+class TextMeasurer:
+    """
+    Mesure de texte à 1pt, mémoïsée par (texte, police).
+    La largeur est linéaire en taille : width(fs) = unit_width * fs,
+    donc une seule mesure sert pour toutes les tailles essayées.
+    Police fichier : clé (chemin, mtime) via le registre => invalidée si la police change.
+    """
+
+    def __init__(self, max_entries: int = TEXT_MEASURE_MAX_ENTRIES) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._widths: Dict[Tuple[str, Tuple], float] = {}
+        self._line_heights: Dict[Tuple, float] = {}
+        self._base14: Dict[str, "fitz.Font"] = {}
+
+    def _font_key(self, fontname: str, fontfile: Optional[str]) -> Tuple:
+        if fontfile:
+            entry = font_registry.get(fontfile)
+            if entry is not None:
+                return ("file", entry.path, entry.mtime_ns)
+            return ("file?", str(fontfile))
+        return ("base14", (fontname or _FALLBACK_FONTNAME).lower())
+
+    def _measure_unit(self, text: str, fontname: str, fontfile: Optional[str]) -> float:
+        if fontfile:
+            entry = font_registry.get(fontfile)
+            if entry is not None:
+                return entry.text_length(text, 1.0)
+            try:
+                return float(fitz.Font(fontfile=fontfile).text_length(text, fontsize=1.0))
+            except Exception:
+                pass
+        try:
+            return float(fitz.get_text_length(text, fontname=fontname or _FALLBACK_FONTNAME, fontsize=1.0))
+        except Exception:
+            try:
+                return float(fitz.get_text_length(text, fontname=_FALLBACK_FONTNAME, fontsize=1.0))
+            except Exception:
+                return 0.0
+
+    def unit_width(self, text: str, fontname: str, fontfile: Optional[str]) -> float:
+        """Largeur du texte pour fontsize=1."""
+        if fitz is None or not text:
+            return 0.0
+
+        key = (text, self._font_key(fontname, fontfile))
+        with self._lock:
+            w = self._widths.get(key)
+        if w is not None:
+            return w
+
+        w = self._measure_unit(text, fontname, fontfile)
+        with self._lock:
+            if len(self._widths) >= self.max_entries:
+                self._widths.clear()
+            self._widths[key] = w
+        return w
+
+    def width(self, text: str, fontsize: float, fontname: str, fontfile: Optional[str]) -> float:
+        return self.unit_width(text, fontname, fontfile) * float(fontsize)
+
+    def unit_line_height(self, fontname: str, fontfile: Optional[str]) -> float:
+        """Hauteur de ligne (ascender - descender) pour fontsize=1."""
+        if fitz is None:
+            return 1.2
+
+        key = self._font_key(fontname, fontfile)
+        with self._lock:
+            lh = self._line_heights.get(key)
+        if lh is not None:
+            return lh
+
+        lh = 1.2
+        try:
+            entry = font_registry.get(fontfile) if fontfile else None
+            if entry is not None:
+                f = entry.font
+            else:
+                name = (fontname or _FALLBACK_FONTNAME).lower()
+                f = self._base14.get(name)
+                if f is None:
+                    f = fitz.Font(name)
+                    self._base14[name] = f
+            lh = max(0.5, float(f.ascender) - float(f.descender))
+        except Exception:
+            pass
+
+        with self._lock:
+            self._line_heights[key] = lh
+        return lh
+
+    def clear(self) -> None:
+        with self._lock:
+            self._widths.clear()
+            self._line_heights.clear()
+
+
+# ------------------------------------------------------------
+# Autofit (forme fermée)
+# ------------------------------------------------------------
+def fit_single_line_fontsize(
+    unit_width: float,
+    fontsize: float,
+    max_width: float,
+    step: float = 0.92,
+    max_steps: int = 18,
+    min_fs: float = 4.0,
+) -> float:
+    """
+    Taille finale de la boucle "réduire de (1-step) tant que ça dépasse", calculée
+    directement : plus petit k tel que fontsize * step^k * unit_width <= max_width.
+    Même grille de tailles que l'ancienne boucle (rendu inchangé).
+    """
+    fs = max(min_fs, float(fontsize))
+    if unit_width <= 0 or max_width <= 0 or fs * unit_width <= max_width:
+        return fs
+
+    k = math.ceil(math.log(max_width / (fs * unit_width)) / math.log(step) - 1e-9)
+    k = max(1, min(int(k), int(max_steps)))
+
+    # plancher : la boucle s'arrête dès qu'on passe sous min_fs (+ marge)
+    k_floor = math.ceil(math.log((min_fs + 0.01) / fs) / math.log(step) - 1e-9) if fs > min_fs + 0.01 else 0
+    if k_floor > 0:
+        k = min(k, k_floor)
+
+    return max(min_fs, fs * (step ** k))
+
+
+def fit_two_sizes(
+    unit_big: float,
+    unit_small: float,
+    fs_big: float,
+    fs_small: float,
+    max_width: float,
+    step: float = 0.92,
+    max_steps: int = 18,
+    min_fs: float = 4.0,
+) -> Tuple[float, float]:
+    """
+    Deux tailles réduites ensemble (prix : entiers en gros, décimales + € en petit).
+    Largeurs déjà connues à 1pt => simple arithmétique, aucune mesure dans la boucle.
+    """
+    for _ in range(int(max_steps)):
+        total = fs_big * unit_big + fs_small * unit_small
+        if total > 0 and total <= max_width:
+            break
+        fs_big = max(min_fs, fs_big * step)
+        fs_small = max(min_fs, fs_small * step)
+        if fs_big <= min_fs + 0.01 and fs_small <= min_fs + 0.01:
+            break
+    return fs_big, fs_small
+
+
+def autofit_start_fontsize(
+    paragraph_unit_widths: List[float],
+    unit_line_height: float,
+    fontsize: float,
+    rect_w: float,
+    rect_h: float,
+    step: float = 0.9,
+    max_steps: int = 12,
+    min_fs: float = 4.0,
+) -> Tuple[float, int]:
+    """
+    Pour insert_textbox multi-lignes : saute les tailles qui ne peuvent PAS rentrer
+    (pas assez de lignes disponibles pour la largeur totale du texte).
+    Retourne (taille de départ, nb de pas déjà consommés). Borne volontairement
+    prudente : insert_textbox reste juge final.
+    """
+    fs = max(min_fs, float(fontsize))
+    if rect_w <= 0 or rect_h <= 0:
+        return fs, 0
+
+    steps = 0
+    while steps < max_steps:
+        lines_avail = math.floor(rect_h / (unit_line_height * fs)) if fs > 0 else 0
+        # marge 15% : espaces supprimés aux retours à la ligne, arrondis de PyMuPDF
+        lines_needed = sum(max(1, math.ceil(w * fs * 0.85 / rect_w)) for w in paragraph_unit_widths) or 1
+        if lines_avail >= lines_needed:
+            break
+        nxt = fs * step
+        if nxt < min_fs:
+            break
+        fs = nxt
+        steps += 1
+    return fs, steps
+
+
+# instance process-wide utilisée par marketing_pdf_renderer
+text_measurer = TextMeasurer()
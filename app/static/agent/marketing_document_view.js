@@ -172,6 +172,9 @@ function collectProductIdsFromDraft(draft) {
   return [...new Set(ids)];
 }
 
+// au-delà : POST (longueur d'URL)
+const BULK_INFO_GET_MAX_IDS = 200;
+
 async function agentBulkInfo(productIds = []) {
   const ids = [...new Set(productIds.map((x) => Number(x)).filter((x) => Number.isFinite(x) && x > 0))];
   if (!ids.length) return;
@@ -184,11 +187,15 @@ async function agentBulkInfo(productIds = []) {
   dynCache.pendingBulk.add(key);
 
   try {
-    const data = await fetchJSON(`${API_BASE}/agent/marketing/products/bulk-info`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ product_ids: missing }),
-    });
+    // ✅ GET (ETag / 304 : revalidé par le cache navigateur) ; POST si la liste est longue
+    const data =
+      missing.length <= BULK_INFO_GET_MAX_IDS
+        ? await fetchJSON(`${API_BASE}/agent/marketing/products/bulk-info?ids=${missing.join(",")}`)
+        : await fetchJSON(`${API_BASE}/agent/marketing/products/bulk-info`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ product_ids: missing }),
+          });
 
     for (const p of data?.products || []) {
       if (!p?.id) continue;
@@ -488,7 +495,8 @@ async function renderDoc({ forceReload = false } = {}) {
     }),
   ]);
 
-  const pdfUrl = view?.url;
+  // ✅ URL signée : plages (Range) + ETag, le PDF n'est plus retéléchargé en entier
+  const pdfUrl = view?.signed_url || view?.url;
   const draft = draftRes?.draft || { pages: [] };
 
   if (!pdfUrl) {
@@ -600,6 +600,8 @@ async function loadDraft() {
   setStatus("Chargement du brouillon…");
   const d = await fetchJSON(`${API_BASE}/labo/marketing-documents/${state.DOC_ID}/draft`, { method: "GET" });
 
+  // ⚠️ snapshot du draft serveur AVANT les migrations en place : elles partiront au 1er PATCH
+  __savedSnapshot = snapshotDraft(d);
   state.currentDraft = d;
   ensureDraftShape();
   state.currentDraft = softMigrateDraftFonts(state.currentDraft);
@@ -781,29 +783,126 @@ function wireFitWidthOnResize() {
   // (vide pour l’instant)
 }
 
-async function saveDraft() {
-  if (!state.DOC_ID) throw new Error("DOC_ID manquant (data-doc-id).");
-  if (!state.currentDraft) return;
+// ------------------------------------------------------------
+// ✅ Autosave incrémental : PATCH /draft avec les seuls objets ajoutés / modifiés /
+// supprimés depuis la dernière sauvegarde. PUT complet si la structure change
+// (pages ajoutées / retirées, ordre des objets, champs de page) ou si le PATCH échoue.
+// ------------------------------------------------------------
+let __savedSnapshot = null; // { version, root: {key: json}, pages: [{ rest, ids, objs }] }
+
+function snapshotDraft(draft) {
+  const dj = (draft && draft.data_json) || {};
+  const root = {};
+  for (const k of Object.keys(dj)) {
+    if (k !== "pages") root[k] = JSON.stringify(dj[k]);
+  }
+  const pages = (Array.isArray(dj.pages) ? dj.pages : []).map((p) => {
+    const { objects, ...rest } = p || {};
+    const list = Array.isArray(objects) ? objects : [];
+    const objs = {};
+    for (const o of list) objs[String(o && o.id)] = JSON.stringify(o);
+    return { rest: JSON.stringify(rest), ids: list.map((o) => String(o && o.id)), objs };
+  });
+  return { version: draft ? draft.draft_version : null, root, pages };
+}
 
-  stampDraftMeta();
+/** Ops PATCH depuis le snapshot ; null => PUT complet. */
+function diffDraftOps(prev, draft) {
+  if (!prev || !draft || prev.version !== draft.draft_version) return null;
 
-  setStatus("Sauvegarde…");
+  const dj = draft.data_json || {};
+  const pages = Array.isArray(dj.pages) ? dj.pages : [];
+  if (pages.length !== prev.pages.length) return null;
 
-  state.currentDraft = sanitizeDraftBeforeSave(state.currentDraft);
+  const ops = [];
+
+  const meta = {};
+  for (const k of Object.keys(dj)) {
+    if (k === "pages") continue;
+    const cur = JSON.stringify(dj[k]);
+    if (prev.root[k] !== cur) meta[k] = dj[k] === undefined ? null : dj[k];
+  }
+  for (const k of Object.keys(prev.root)) {
+    if (!(k in dj)) meta[k] = null;
+  }
+  if (Object.keys(meta).length) ops.push({ op: "meta", data: meta });
+
+  for (let i = 0; i < pages.length; i++) {
+    const p = pages[i] || {};
+    const before = prev.pages[i];
+    const { objects, ...rest } = p;
+    if (JSON.stringify(rest) !== before.rest) return null;
+
+    const list = Array.isArray(objects) ? objects : [];
+    const ids = list.map((o) => (o && o.id != null ? String(o.id) : null));
+    if (ids.some((id) => !id) || new Set(ids).size !== ids.length) return null;
+
+    const idSet = new Set(ids);
+    for (const id of before.ids) {
+      if (!idSet.has(id)) ops.push({ op: "delete", page: i, id });
+    }
+
+    // les objets conservés doivent garder leur ordre (layer / z-order)
+    const kept = ids.filter((id) => id in before.objs);
+    const keptBefore = before.ids.filter((id) => idSet.has(id));
+    if (kept.join("\u0000") !== keptBefore.join("\u0000")) return null;
 
+    list.forEach((o, pos) => {
+      const id = ids[pos];
+      if (!(id in before.objs)) ops.push({ op: "add", page: i, index: pos, object: o });
+      else if (before.objs[id] !== JSON.stringify(o)) ops.push({ op: "update", page: i, id, object: o });
+    });
+  }
+  return ops;
+}
+
+async function putDraft() {
   const payload = {
     draft_version: state.currentDraft.draft_version,
     data_json: state.currentDraft.data_json || {},
   };
 
-  const saved = await fetchJSON(`${API_BASE}/labo/marketing-documents/${state.DOC_ID}/draft`, {
+  return fetchJSON(`${API_BASE}/labo/marketing-documents/${state.DOC_ID}/draft`, {
     method: "PUT",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify(payload),
   });
+}
+
+async function saveDraft() {
+  if (!state.DOC_ID) throw new Error("DOC_ID manquant (data-doc-id).");
+  if (!state.currentDraft) return;
+
+  stampDraftMeta();
+
+  setStatus("Sauvegarde…");
+
+  state.currentDraft = sanitizeDraftBeforeSave(state.currentDraft);
+
+  const ops = diffDraftOps(__savedSnapshot, state.currentDraft);
+  if (ops) {
+    try {
+      const patched = await fetchJSON(`${API_BASE}/labo/marketing-documents/${state.DOC_ID}/draft`, {
+        method: "PATCH",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ draft_version: state.currentDraft.draft_version, ops }),
+      });
+      state.currentDraft.draft_version = patched.draft_version;
+      __savedSnapshot = snapshotDraft(state.currentDraft);
+      setStatus(`Sauvegardé (v${patched.draft_version})`);
+      return state.currentDraft;
+    } catch (e) {
+      // conflit : un PUT ferait pareil => on remonte l'erreur
+      if (String(e && e.message).includes("Conflit de version")) throw e;
+      console.warn("[LABO_EDITOR] PATCH draft KO, fallback PUT:", e);
+    }
+  }
+
+  const saved = await putDraft();
 
   state.currentDraft = saved;
   ensureDraftShape();
+  __savedSnapshot = snapshotDraft(state.currentDraft);
   setStatus(`Sauvegardé (v${saved.draft_version})`);
   return saved;
 }
@@ -229,6 +229,9 @@ function getRole() {
   return r || "LABO";
 }
 
+// au-delà : POST (longueur d'URL)
+const BULK_INFO_GET_MAX_IDS = 200;
+
 function buildBulkKey(productId) {
   return `p:${productId}`;
 }
@@ -253,11 +256,15 @@ async function ensureBulkInfo(productIds = []) {
     const role = getRole();
     const payload = { product_ids: toFetch, role };
 
-    const data = await fetchJSON(`${API_BASE}/marketing/products/bulk-info`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(payload),
-    });
+    // ✅ GET (ETag / 304 : revalidé par le cache navigateur) ; POST si la liste est longue
+    const data =
+      toFetch.length <= BULK_INFO_GET_MAX_IDS
+        ? await fetchJSON(`${API_BASE}/marketing/products/bulk-info?ids=${toFetch.join(",")}`)
+        : await fetchJSON(`${API_BASE}/marketing/products/bulk-info`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify(payload),
+          });
 
     const products = data?.products || [];
     for (const p of products) {
@@ -1,6 +1,7 @@
 # app/tasks/celery_app.py
 import os
 from celery import Celery
+from celery.schedules import crontab
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 
@@ -25,6 +26,16 @@ celery.conf.update(
     result_serializer="json",
 )
 
+# ✅ planification : nécessite un process beat sur CETTE app
+#    (celery -A app.tasks.celery_app.celery beat, service "beat" du docker-compose)
+celery.conf.beat_schedule = {
+    # pré-rendus de publications marketing bloqués (worker tué, message perdu)
+    "marketing_publication_recover_stale": {
+        "task": "marketing_publication.recover_stale",
+        "schedule": crontab(minute="*/10"),  # toutes les 10 minutes
+    },
+}
+
 # Autodiscovery (optionnel)
 celery.autodiscover_tasks(["app.tasks"])
 
@@ -37,4 +48,6 @@ except Exception as e:
     traceback.print_exc()
 
 import app.celery_tasks.labo_stock_sync       # noqa: E402,F401
-import app.celery_tasks.labo_sales_import_sync  # noqa: E402,F401
\ No newline at end of file
+import app.celery_tasks.labo_sales_import_sync  # noqa: E402,F401
+import app.celery_tasks.marketing_publication_render  # noqa: E402,F401
+import app.celery_tasks.marketing_document_thumbs  # noqa: E402,F401